@@ -0,0 +1,351 @@
+"""
+Context budget — trim / compact chat history before it reaches llama-server
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+Prompt processing over accumulated history, not generation, is what made
+brain replies slow: a 140K-token conversation took 30-40s per message on the
+L4, and a request larger than the slot failed inside llama-server ("exceeds
+context size") after the whole upload. Nothing in front of llama-server
+knew how many tokens a request was.
+
+ContextBudget.fit(request) runs before a chat request is forwarded:
+
+  count     every message is tokenized with the served model's tokenizer
+            (llama-server /tokenize, no slot needed) + a per-message
+            template overhead; images count IMAGE_TOKEN_ESTIMATE. Counts
+            are cached by message digest, so a conversation's history is
+            tokenized once, not on every turn.
+  fits      limit = min(input_budget, context_size - max_tokens). Under
+            it, the request goes through untouched.
+  trims     otherwise, with history split into turns (a user message + the
+            replies / tool calls after it, kept together):
+              - leading system messages and the last keep_recent turns
+                stay verbatim
+              - older turns are replaced, oldest first, by condensed
+                copies (whitespace-collapsed, cut at a sentence boundary
+                around COMPACT_CHARS, images → "[image]"), cached per
+                message
+              - if that is not enough, the oldest condensed turns are
+                dropped; recent turns are only touched when even that
+                does not fit, and the last turn never is
+            Trimming aims below low_water × limit, and the cut chosen for
+            a conversation is remembered (keyed by the digest of the
+            history it condenses / drops) and reused while it still fits
+            and isn't more than a turn under low water — successive
+            turns then share an identical prompt prefix and
+            llama-server's prompt cache reuses it instead of re-processing
+            the history after every trim.
+  rejects   system prompt + last turn alone over the limit → HTTP 413
+            {"type": "context_budget_exceeded", ...} — before anything is
+            forwarded.
+
+Condensed turns are extractive, not model-written summaries: on a
+`--parallel 1` server a summarization call would take the only slot and
+evict the conversation's cached prompt.
+
+Response headers: X-Context-Tokens, X-Context-Budget, and when trimmed
+X-Context-Original-Tokens / X-Context-Condensed-Turns /
+X-Context-Dropped-Turns.
+
+No modal import; fastapi imported lazily (image dep).
+"""
+
+import asyncio
+import hashlib
+import json
+import re
+from collections import OrderedDict
+
+# Chat-template tokens around each message (<|im_start|>role\n … <|im_end|>\n)
+MESSAGE_OVERHEAD_TOKENS = 6
+# Image blocks, counted without sending them to /tokenize
+IMAGE_TOKEN_ESTIMATE = 1024
+# max_tokens assumed when the request does not set one
+DEFAULT_OUTPUT_RESERVE = 1024
+KEEP_RECENT_TURNS = 4
+# Trim to this fraction of the limit, so the next turns fit without a new cut
+LOW_WATER = 0.8
+COMPACT_CHARS = 280
+TOKENIZE_CONCURRENCY = 4
+TOKEN_CACHE_ENTRIES = 8192
+CUT_MEMO_ENTRIES = 256
+
+SYSTEM_ROLES = ("system", "developer")
+_SENTENCE_END = re.compile(r"[.!?…](?:\s|$)")
+
+
+def _digest(obj) -> str:
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _prefix_digests(system: list, turns: list) -> list:
+    """[digest of system + turns[:n]] for n = 1..len(turns), in one pass."""
+    h = hashlib.sha1(json.dumps(system, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    out = []
+    for turn in turns:
+        h.update(json.dumps(turn, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        out.append(h.hexdigest())
+    return out
+
+
+def _content_text(content) -> tuple:
+    """(text, image count) of a message's content (string or blocks)."""
+    images = 0
+    if isinstance(content, str):
+        text = content
+    elif isinstance(content, list):
+        parts = []
+        for block in content:
+            if not isinstance(block, dict):
+                continue
+            if block.get("type") == "text":
+                parts.append(block.get("text") or "")
+            elif block.get("type") in ("image_url", "input_image", "image"):
+                images += 1
+        text = "\n".join(parts)
+    else:
+        text = ""
+    return text, images
+
+
+def message_text(message: dict) -> tuple:
+    """(text to tokenize, image count) of an OpenAI-format message."""
+    text, images = _content_text(message.get("content"))
+    if message.get("tool_calls"):
+        text += json.dumps(message["tool_calls"], ensure_ascii=False)
+    return text, images
+
+
+def condense_text(text: str, limit: int = COMPACT_CHARS) -> str:
+    text = " ".join(text.split())
+    if len(text) <= limit:
+        return text
+    head = text[:limit]
+    ends = [m.end() for m in _SENTENCE_END.finditer(head)]
+    if ends and ends[-1] >= limit // 3:
+        head = head[:ends[-1]].rstrip()
+    else:
+        head = head.rsplit(" ", 1)[0]
+    return head + " …"
+
+
+def condense_message(message: dict) -> dict:
+    """Extractive short form of a message; role and tool fields kept."""
+    text, images = _content_text(message.get("content"))
+    condensed = condense_text(text)
+    if images:
+        condensed = ("[image] " * images).strip() + (" " + condensed if condensed else "")
+    return {**message, "content": condensed}
+
+
+def split_turns(messages: list) -> tuple:
+    """(leading system messages, turns) — each turn starts at a user message."""
+    n_system = 0
+    while n_system < len(messages) and messages[n_system].get("role") in SYSTEM_ROLES:
+        n_system += 1
+    turns = []
+    for msg in messages[n_system:]:
+        if msg.get("role") == "user" or not turns:
+            turns.append([msg])
+        else:
+            turns[-1].append(msg)
+    return messages[:n_system], turns
+
+
+class ContextBudget:
+    """Per-container request pre-processor; counts via a llama_proxy.LlamaClient."""
+
+    def __init__(self, client, input_budget: int, context_size: int,
+                 keep_recent_turns: int = KEEP_RECENT_TURNS, low_water: float = LOW_WATER,
+                 label: str = "llama"):
+        self.client = client
+        self.input_budget = input_budget
+        self.context_size = context_size
+        self.keep_recent_turns = keep_recent_turns
+        self.low_water = low_water
+        self.label = label
+        self._tokens = OrderedDict()  # message digest → tokens
+        self._condensed = OrderedDict()  # message digest → condensed message
+        self._cuts = OrderedDict()  # conversation key → (dropped, condensed) turns
+        self._sem = None
+        self.requests = 0
+        self.trimmed = 0
+        self.rejected = 0
+        self.tokens_removed = 0
+        self.tokenize_calls = 0
+        self.cache_hits = 0
+        self.tokenize_errors = 0
+
+    # ── Counting ───────────────────────────────────────────────────────
+
+    async def _tokenize(self, text: str):
+        """Token count, or None if llama-server could not tokenize it."""
+        if not text:
+            return 0
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(TOKENIZE_CONCURRENCY)
+        async with self._sem:
+            self.tokenize_calls += 1
+            try:
+                return await self.client.tokenize(text)
+            except Exception as e:
+                self.tokenize_errors += 1
+                print(f"[{self.label}] ⚠️ /tokenize failed ({e}) — estimating", flush=True)
+                return None
+
+    async def count(self, message: dict) -> int:
+        key = _digest(message)
+        cached = self._tokens.get(key)
+        if cached is not None:
+            self._tokens.move_to_end(key)
+            self.cache_hits += 1
+            return cached
+        text, images = message_text(message)
+        text_tokens = await self._tokenize(text)
+        if text_tokens is None:
+            # Over-estimate (~3 chars/token) rather than fail; not cached
+            return len(text) // 3 + 1 + images * IMAGE_TOKEN_ESTIMATE + MESSAGE_OVERHEAD_TOKENS
+        tokens = text_tokens + images * IMAGE_TOKEN_ESTIMATE + MESSAGE_OVERHEAD_TOKENS
+        self._tokens[key] = tokens
+        while len(self._tokens) > TOKEN_CACHE_ENTRIES:
+            self._tokens.popitem(last=False)
+        return tokens
+
+    def condensed(self, message: dict) -> dict:
+        key = _digest(message)
+        cached = self._condensed.get(key)
+        if cached is None:
+            cached = condense_message(message)
+            self._condensed[key] = cached
+            while len(self._condensed) > TOKEN_CACHE_ENTRIES:
+                self._condensed.popitem(last=False)
+        else:
+            self._condensed.move_to_end(key)
+        return cached
+
+    async def _turn_tokens(self, turns: list, condensed: bool) -> list:
+        """Token count per turn; all uncached messages tokenized concurrently."""
+        flat = [(i, self.condensed(m) if condensed else m) for i, turn in enumerate(turns) for m in turn]
+        counts = [0] * len(turns)
+        for (i, _m), tokens in zip(flat, await asyncio.gather(*(self.count(m) for _i, m in flat))):
+            counts[i] += tokens
+        return counts
+
+    # ── Fitting ────────────────────────────────────────────────────────
+
+    def _candidates(self, n_turns: int):
+        """(dropped, condensed) cuts in order of increasing reduction."""
+        older = max(0, n_turns - self.keep_recent_turns)
+        for nc in range(1, older + 1):
+            yield 0, nc
+        for nd in range(1, older + 1):
+            yield nd, older - nd
+        # Last resort: eat into the recent turns, never the last one
+        for nd in range(older + 1, n_turns):
+            yield nd, 0
+
+    def _reject(self, tokens: int, limit: int, reserve: int):
+        from fastapi import HTTPException
+
+        self.rejected += 1
+        raise HTTPException(status_code=413, detail={
+            "error": (f"request needs {tokens} input tokens for its system prompt and latest "
+                      f"turn alone; the budget is {limit} (max_tokens {reserve} reserved)"),
+            "type": "context_budget_exceeded",
+            "input_tokens": tokens,
+            "budget": limit,
+        })
+
+    async def fit(self, request: dict) -> tuple:
+        """(request to forward, response headers). Raises HTTPException 413."""
+        messages = request.get("messages")
+        if not isinstance(messages, list) or not messages:
+            return request, {}
+        self.requests += 1
+        try:
+            reserve = int(request.get("max_tokens") or request.get("n_predict") or DEFAULT_OUTPUT_RESERVE)
+        except (TypeError, ValueError):
+            reserve = DEFAULT_OUTPUT_RESERVE
+        limit = min(self.input_budget, self.context_size - max(reserve, 0))
+
+        system, turns = split_turns(messages)
+        system_tokens = sum(await asyncio.gather(*(self.count(m) for m in system)))
+        full = await self._turn_tokens(turns, condensed=False)
+        total = system_tokens + sum(full)
+        headers = {"X-Context-Tokens": str(total), "X-Context-Budget": str(limit)}
+        if total <= limit:
+            return request, headers
+        if not turns or system_tokens + full[-1] > limit:
+            self._reject(system_tokens + (full[-1] if turns else 0), limit, reserve)
+
+        short = await self._turn_tokens(turns[:-1], condensed=True) + [full[-1]]
+
+        def cut_total(nd: int, nc: int) -> int:
+            return system_tokens + sum(short[nd:nd + nc]) + sum(full[nd + nc:])
+
+        # The memo is keyed by the digest of system + the turns a cut
+        # condenses / drops, so it only matches a conversation whose history
+        # up to the cut is identical — not another one with the same opener.
+        keys = _prefix_digests(system, turns)
+        key = cut = None
+        for n in range(len(turns) - 1, 0, -1):
+            if keys[n - 1] in self._cuts:
+                key = keys[n - 1]
+                cut = self._cuts[key]
+                break
+        if cut is not None:
+            t = cut_total(*cut)
+            # Over the limit, or so far under low water that a lighter cut
+            # (one more turn kept verbatim) would fit too → choose again
+            if t > limit or limit * self.low_water - t > max(full[:cut[0] + cut[1]]):
+                del self._cuts[key]
+                cut = None
+        if cut is None:
+            fallback = None
+            for nd, nc in self._candidates(len(turns)):
+                t = cut_total(nd, nc)
+                if fallback is None and t <= limit:
+                    fallback = (nd, nc)
+                if t <= limit * self.low_water:
+                    cut = (nd, nc)
+                    break
+            cut = cut or fallback
+            if cut is None:
+                self._reject(cut_total(len(turns) - 1, 0), limit, reserve)
+            key = keys[cut[0] + cut[1] - 1]
+            self._cuts[key] = cut
+            while len(self._cuts) > CUT_MEMO_ENTRIES:
+                self._cuts.popitem(last=False)
+        self._cuts.move_to_end(key)
+
+        nd, nc = cut
+        kept = list(system)
+        for turn in turns[nd:nd + nc]:
+            kept.extend(self.condensed(m) for m in turn)
+        for turn in turns[nd + nc:]:
+            kept.extend(turn)
+        new_total = cut_total(nd, nc)
+        self.trimmed += 1
+        self.tokens_removed += total - new_total
+        print(f"[{self.label}] ✂️ context {total} → {new_total} tokens (budget {limit}): "
+              f"{nc} turn(s) condensed, {nd} dropped", flush=True)
+        headers.update({
+            "X-Context-Tokens": str(new_total),
+            "X-Context-Original-Tokens": str(total),
+            "X-Context-Condensed-Turns": str(nc),
+            "X-Context-Dropped-Turns": str(nd),
+        })
+        return {**request, "messages": kept}, headers
+
+    def stats(self) -> dict:
+        return {
+            "input_budget": self.input_budget,
+            "keep_recent_turns": self.keep_recent_turns,
+            "requests": self.requests,
+            "trimmed": self.trimmed,
+            "rejected": self.rejected,
+            "tokens_removed": self.tokens_removed,
+            "tokenize_calls": self.tokenize_calls,
+            "token_cache_hits": self.cache_hits,
+            "tokenize_errors": self.tokenize_errors,
+            "conversations_tracked": len(self._cuts),
+        }
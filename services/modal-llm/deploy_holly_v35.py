@@ -27,11 +27,12 @@ Usage:
 
 import modal
 import os
-import subprocess
-import time
-import threading
 from typing import Any
 
+import llama_proxy
+import llama_supervisor
+from context_budget import ContextBudget
+
 app = modal.App("holly-brain-v35")
 
 # Persistent volume — caches the 5.3GB GGUF so cold starts after the first
@@ -49,6 +50,9 @@ MMPROJ_FILE = "mmproj-Qwen3.5-9B-Uncensored-HauhauCS-Aggressive-BF16.gguf"
 
 # llama-server (from llama.cpp) binds here.
 LLAMA_PORT = 8080
+# llama-server --parallel (KV slots). The proxy admits this many requests
+# upstream at once and queues the rest itself — see llama_proxy.py.
+LLAMA_PARALLEL = 1
 N_GPU_LAYERS = 999  # offload everything to GPU
 # V3.6 (2026-06-30): Bumped 32K → 128K context. Qwen3.5 supports 262K natively;
 # 128K fits L4 (24GB) with room for KV cache (~10GB at Q8) + model (5.3GB) +
@@ -57,6 +61,12 @@ N_GPU_LAYERS = 999  # offload everything to GPU
 # accumulated history. Steve's directive: Holly is unlimited forever —
 # no more artificial walls.
 CONTEXT_SIZE = 131072  # 128K context (within Qwen's 262K native limit)
+# Input tokens a chat request may reach llama-server with — see
+# context_budget.py. Prompt processing dominates latency (140K tokens took
+# 30-40s on the L4); past this, older turns are condensed / dropped and the
+# system prompt + recent turns kept verbatim. Raise toward CONTEXT_SIZE to
+# keep more history verbatim at the cost of latency.
+CONTEXT_INPUT_BUDGET = 65536
 
 
 # ── Image: build llama.cpp once, cache forever ───────────────────────────────
@@ -84,57 +94,14 @@ image = (
         "-DCMAKE_CUDA_ARCHITECTURES=75 && "
         "cmake --build build --config Release -j --target llama-server",
     )
-    .pip_install("huggingface_hub", "fastapi", "requests")
+    .pip_install("huggingface_hub", "fastapi", "httpx")
     .env({"HF_HUB_ENABLE_HF_TRANSFER": "1"})
+    .add_local_python_source("context_budget", "llama_proxy", "llama_supervisor")
 )
 
-
-def _download_models() -> None:
-    """Pull GGUF + mmproj from HF on first run; subsequent runs use the volume."""
-    from huggingface_hub import hf_hub_download
-
-    gguf_path = os.path.join(MODEL_DIR, GGUF_FILE)
-    mmproj_path = os.path.join(MODEL_DIR, MMPROJ_FILE)
-
-    if not os.path.exists(gguf_path):
-        print(f"[holly-brain-v35] Downloading {GGUF_FILE} (5.3 GB)...")
-        hf_hub_download(
-            repo_id=HF_REPO,
-            filename=GGUF_FILE,
-            local_dir=MODEL_DIR,
-        )
-        print(f"[holly-brain-v35] ✅ GGUF cached")
-
-    if not os.path.exists(mmproj_path):
-        print(f"[holly-brain-v35] Downloading {MMPROJ_FILE} (880 MB)...")
-        hf_hub_download(
-            repo_id=HF_REPO,
-            filename=MMPROJ_FILE,
-            local_dir=MODEL_DIR,
-        )
-        print(f"[holly-brain-v35] ✅ mmproj cached")
-
-    # Commit downloads to the volume so the next container starts fast
-    try:
-        vol.commit()
-    except Exception as e:
-        print(f"[holly-brain-v35] Volume commit warning: {e}")
-
-
-def _wait_for_llama(timeout_s: int = 120) -> bool:
-    """Block until llama-server responds to /health or timeout."""
-    import requests
-
-    deadline = time.time() + timeout_s
-    while time.time() < deadline:
-        try:
-            r = requests.get(f"http://127.0.0.1:{LLAMA_PORT}/health", timeout=2)
-            if r.status_code == 200:
-                return True
-        except Exception:
-            pass
-        time.sleep(1)
-    return False
+# Endpoint signatures reference fastapi.Response
+with image.imports():
+    import fastapi
 
 
 @app.cls(
@@ -175,7 +142,8 @@ class HollyBrain:
     @modal.enter()
     def boot(self):
         """Container startup: pull models if needed, then launch llama-server."""
-        _download_models()
+        llama_supervisor.download_models(HF_REPO, [GGUF_FILE, MMPROJ_FILE], MODEL_DIR,
+                                         commit=vol.commit, label="holly-brain-v35")
 
         gguf_path = os.path.join(MODEL_DIR, GGUF_FILE)
         mmproj_path = os.path.join(MODEL_DIR, MMPROJ_FILE)
@@ -186,8 +154,9 @@ class HollyBrain:
         print(f"  ctx:    {CONTEXT_SIZE}")
         print(f"  gpu:    L4 24GB (offloading all {N_GPU_LAYERS} layers)")
 
-        # llama-server stays alive for the life of the container
-        self.server_proc = subprocess.Popen(
+        # llama-server stays alive for the life of the container — relaunched
+        # with backoff if it exits (llama_supervisor.py)
+        self.server = llama_supervisor.LlamaSupervisor(
             [
                 "/opt/llama.cpp/build/bin/llama-server",
                 "--model", gguf_path,
@@ -203,93 +172,68 @@ class HollyBrain:
                 # gets the full 128K. L4 VRAM can't fit 4×128K KV cache
                 # (~40GB), so we trade concurrency for full context.
                 # If concurrency becomes critical, upgrade to A100 40GB.
-                "--parallel", "1",
+                "--parallel", str(LLAMA_PARALLEL),
                 "--cont-batching",
                 "--metrics",
             ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
+            LLAMA_PORT,
+            label="holly-brain-v35",
         )
+        self.server.start()  # raises if not ready within 180s
 
-        # Background thread to drain llama-server stdout to Modal logs
-        threading.Thread(target=self._drain_stdout, daemon=True).start()
-
-        if not _wait_for_llama(timeout_s=180):
-            raise RuntimeError(
-                "llama-server failed to become healthy within 180s — "
-                "check container logs for build/runtime errors"
-            )
+        # Pooled keep-alive client + slot admission for the proxy endpoints
+        self.llama = llama_proxy.LlamaClient(LLAMA_PORT, LLAMA_PARALLEL, label="holly-brain-v35",
+                                             down=self.server.down_reason)
+        self.context = ContextBudget(self.llama, CONTEXT_INPUT_BUDGET, CONTEXT_SIZE, label="holly-brain-v35")
 
         print("[holly-brain-v35] ✅ Ready — accepting requests")
 
-    def _drain_stdout(self):
-        """Forward llama-server output to container logs (Modal captures stdout)."""
-        assert self.server_proc.stdout is not None
-        for line in iter(self.server_proc.stdout.readline, b""):
-            try:
-                print(f"[llama-server] {line.decode().rstrip()}", flush=True)
-            except Exception:
-                pass
+    @modal.exit()
+    def shutdown(self):
+        """Container teardown: stop the supervisor so it doesn't relaunch llama-server."""
+        if hasattr(self, "server"):
+            self.server.stop()
 
     @modal.fastapi_endpoint(method="POST", label="brain-chat")
-    def chat(self, request: dict) -> dict:
+    async def chat(self, request: dict, response: "fastapi.Response" = None) -> dict:
         """
         OpenAI-compatible chat completions.
         Forward request body to local llama-server /v1/chat/completions.
         Supports messages with image_url content blocks for vision.
+        "stream": true → llama-server's SSE chunks relayed as generated;
+        otherwise the whole completion as one JSON body. Both go through
+        the pooled client (llama_proxy.py) and report X-Queue-Wait-Ms.
+        History over CONTEXT_INPUT_BUDGET tokens is condensed / trimmed
+        first, or refused with 413 (context_budget.py; X-Context-* headers).
         """
-        import requests as _requests
-        from fastapi import HTTPException
-
-        try:
-            resp = _requests.post(
-                f"http://127.0.0.1:{LLAMA_PORT}/v1/chat/completions",
-                json=request,
-                timeout=120,
-            )
-        except _requests.exceptions.Timeout:
-            raise HTTPException(
-                status_code=504,
-                detail={"error": "llama-server timeout (120s)", "type": "timeout"},
-            )
-        except Exception as e:
-            raise HTTPException(
-                status_code=500,
-                detail={"error": str(e), "type": "internal_error"},
-            )
-
-        if resp.status_code != 200:
-            raise HTTPException(
-                status_code=resp.status_code,
-                detail=resp.json(),
-            )
+        request, budget_headers = await self.context.fit(request)
+        if llama_proxy.wants_stream(request):
+            return await self.llama.stream_response("/v1/chat/completions", request,
+                                                    headers=budget_headers)
+
+        result, timing = await self.llama.forward("/v1/chat/completions", request)
+        if response is not None:
+            response.headers.update({**budget_headers, **timing})
         # Plain dict return — Modal's fastapi_endpoint serializes to JSON.
         # Do NOT wrap in JSONResponse: Modal returns the OpenAPI schema
         # description instead of actual data when you do.
-        return resp.json()
+        return result
 
     @modal.fastapi_endpoint(method="POST", label="brain-completion")
-    def completion(self, request: dict) -> dict:
-        """OpenAI-compatible /v1/completions (non-chat)."""
-        import requests as _requests
-        from fastapi import HTTPException
-
-        resp = _requests.post(
-            f"http://127.0.0.1:{LLAMA_PORT}/v1/completions",
-            json=request,
-            timeout=120,
-        )
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail=resp.json())
-        return resp.json()
+    async def completion(self, request: dict, response: "fastapi.Response" = None) -> dict:
+        """OpenAI-compatible /v1/completions (non-chat); "stream" and timing headers as in chat."""
+        if llama_proxy.wants_stream(request):
+            return await self.llama.stream_response("/v1/completions", request)
+
+        result, timing = await self.llama.forward("/v1/completions", request)
+        if response is not None:
+            response.headers.update(timing)
+        return result
 
     @modal.fastapi_endpoint(method="GET", label="brain-health")
     def health(self) -> dict:
         """Health check — returns model info if ready."""
-        alive = (
-            hasattr(self, "server_proc")
-            and self.server_proc.poll() is None
-        )
+        alive = hasattr(self, "server") and self.server.alive
         return {
             "status": "healthy" if alive else "degraded",
             "model": HF_REPO,
@@ -297,6 +241,9 @@ class HollyBrain:
             "multimodal": True,
             "refusals_documented": "0/465",
             "context_window": CONTEXT_SIZE,
+            "llama_server": self.server.stats() if hasattr(self, "server") else None,
+            "proxy": self.llama.stats() if hasattr(self, "llama") else None,
+            "context_budget": self.context.stats() if hasattr(self, "context") else None,
             "serverless": True,
             "max_containers": 1,
             "scaledown_window": 2700,
@@ -304,6 +251,19 @@ class HollyBrain:
             "version": "v3.5",
         }
 
+    @modal.fastapi_endpoint(method="GET", label="brain-metrics")
+    async def metrics(self) -> dict:
+        """llama-server /metrics summarized (tokens/s, prompt-eval time, KV
+        cache usage, deferred requests) with the supervisor's process state
+        and the proxy's own queue. Counters restart with llama-server."""
+        raw = await self.llama.metrics() if hasattr(self, "llama") else {}
+        return {
+            "llama_server": self.server.stats() if hasattr(self, "server") else None,
+            "metrics": llama_supervisor.summarize_metrics(raw),
+            "proxy": self.llama.stats() if hasattr(self, "llama") else None,
+            "raw": raw,
+        }
+
     @modal.fastapi_endpoint(method="GET", label="brain-info")
     def info(self) -> dict:
         """API info / metadata."""
@@ -315,6 +275,7 @@ class HollyBrain:
                 "chat": "/brain-chat",
                 "completion": "/brain-completion",
                 "health": "/brain-health",
+                "metrics": "/brain-metrics",
                 "info": "/brain-info",
             },
             "notes": [
@@ -346,5 +307,8 @@ def main(action: str = "deploy"):
     elif action == "health":
         result = HollyBrain().health.remote()
         print(f"Health: {result}")
+    elif action == "metrics":
+        result = HollyBrain().metrics.remote()
+        print(f"Metrics: {result}")
     else:
-        print(f"Usage: modal run deploy_holly_v35.py --action [deploy|test|health]")
+        print(f"Usage: modal run deploy_holly_v35.py --action [deploy|test|health|metrics]")
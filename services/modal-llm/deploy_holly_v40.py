@@ -27,21 +27,30 @@ Usage:
   curl https://iamhollywoodpro--brain-chat-v40.modal.run \\
     -H "Content-Type: application/json" \\
     -d '{"messages":[{"role":"user","content":"Who are you?"}]}'
+  # Token streaming (SSE, OpenAI chunk format) — add "stream": true, curl -N
+  curl -N https://iamhollywoodpro--brain-chat-v40.modal.run \\
+    -H "Content-Type: application/json" \\
+    -d '{"stream":true,"messages":[{"role":"user","content":"Who are you?"}]}'
 """
 
 import modal
 import os
-import subprocess
-import time
-import threading
 from typing import Any
 
+import llama_proxy
+import llama_supervisor
+from context_budget import ContextBudget
+from prefix_cache import PrefixCache
+
 app = modal.App("holly-brain-v40")
 
 # Separate volume from v35 — caches the 9.5GB Q8 GGUF independently.
 # This allows v35 (Q4) and v40 (Q8) to coexist without volume conflicts.
 vol = modal.Volume.from_name("holly-brain-v40", create_if_missing=True)
 MODEL_DIR = "/models"
+# llama-server --slot-save-path: the system-prompt KV saved by
+# prefix_cache.py lives on the volume, so it survives scale-to-zero.
+SLOT_SAVE_DIR = f"{MODEL_DIR}/slots"
 
 # ── Model spec ───────────────────────────────────────────────────────────────
 # Same HauhauCS aggressive abliteration of Qwen 3.5 9B as V3.5, but Q8_0.
@@ -55,6 +64,9 @@ MMPROJ_FILE = "mmproj-Qwen3.5-9B-Uncensored-HauhauCS-Aggressive-BF16.gguf"
 
 # llama-server (from llama.cpp) binds here.
 LLAMA_PORT = 8080
+# llama-server --parallel (KV slots). The proxy admits this many requests
+# upstream at once and queues the rest itself — see llama_proxy.py.
+LLAMA_PARALLEL = 1
 N_GPU_LAYERS = 999  # offload everything to GPU
 # V3.6 (2026-06-30): Bumped 32K → 128K context. Qwen3.5 supports 262K natively;
 # 128K fits L4 (24GB) with room for KV cache (~10GB at Q8) + model (5.3GB) +
@@ -63,6 +75,12 @@ N_GPU_LAYERS = 999  # offload everything to GPU
 # accumulated history. Steve's directive: Holly is unlimited forever —
 # no more artificial walls.
 CONTEXT_SIZE = 131072  # 128K context (within Qwen's 262K native limit)
+# Input tokens a chat request may reach llama-server with — see
+# context_budget.py. Prompt processing dominates latency (140K tokens took
+# 30-40s on the L4); past this, older turns are condensed / dropped and the
+# system prompt + recent turns kept verbatim. Raise toward CONTEXT_SIZE to
+# keep more history verbatim at the cost of latency.
+CONTEXT_INPUT_BUDGET = 65536
 
 
 # ── Image: build llama.cpp once, cache forever ───────────────────────────────
@@ -90,57 +108,14 @@ image = (
         "-DCMAKE_CUDA_ARCHITECTURES=75 && "
         "cmake --build build --config Release -j --target llama-server",
     )
-    .pip_install("huggingface_hub", "fastapi", "requests")
+    .pip_install("huggingface_hub", "fastapi", "httpx")
     .env({"HF_HUB_ENABLE_HF_TRANSFER": "1"})
+    .add_local_python_source("context_budget", "llama_proxy", "llama_supervisor", "prefix_cache")
 )
 
-
-def _download_models() -> None:
-    """Pull GGUF + mmproj from HF on first run; subsequent runs use the volume."""
-    from huggingface_hub import hf_hub_download
-
-    gguf_path = os.path.join(MODEL_DIR, GGUF_FILE)
-    mmproj_path = os.path.join(MODEL_DIR, MMPROJ_FILE)
-
-    if not os.path.exists(gguf_path):
-        print(f"[holly-brain-v40] Downloading {GGUF_FILE} (9.5 GB)...")
-        hf_hub_download(
-            repo_id=HF_REPO,
-            filename=GGUF_FILE,
-            local_dir=MODEL_DIR,
-        )
-        print(f"[holly-brain-v40] ✅ GGUF cached")
-
-    if not os.path.exists(mmproj_path):
-        print(f"[holly-brain-v40] Downloading {MMPROJ_FILE} (880 MB)...")
-        hf_hub_download(
-            repo_id=HF_REPO,
-            filename=MMPROJ_FILE,
-            local_dir=MODEL_DIR,
-        )
-        print(f"[holly-brain-v40] ✅ mmproj cached")
-
-    # Commit downloads to the volume so the next container starts fast
-    try:
-        vol.commit()
-    except Exception as e:
-        print(f"[holly-brain-v40] Volume commit warning: {e}")
-
-
-def _wait_for_llama(timeout_s: int = 120) -> bool:
-    """Block until llama-server responds to /health or timeout."""
-    import requests
-
-    deadline = time.time() + timeout_s
-    while time.time() < deadline:
-        try:
-            r = requests.get(f"http://127.0.0.1:{LLAMA_PORT}/health", timeout=2)
-            if r.status_code == 200:
-                return True
-        except Exception:
-            pass
-        time.sleep(1)
-    return False
+# Endpoint signatures reference fastapi.Response
+with image.imports():
+    import fastapi
 
 
 @app.cls(
@@ -181,10 +156,12 @@ class HollyBrain:
     @modal.enter()
     def boot(self):
         """Container startup: pull models if needed, then launch llama-server."""
-        _download_models()
+        llama_supervisor.download_models(HF_REPO, [GGUF_FILE, MMPROJ_FILE], MODEL_DIR,
+                                         commit=vol.commit, label="holly-brain-v40")
 
         gguf_path = os.path.join(MODEL_DIR, GGUF_FILE)
         mmproj_path = os.path.join(MODEL_DIR, MMPROJ_FILE)
+        os.makedirs(SLOT_SAVE_DIR, exist_ok=True)
 
         print(f"[holly-brain-v40] Launching llama-server...")
         print(f"  model:  {gguf_path}")
@@ -192,8 +169,9 @@ class HollyBrain:
         print(f"  ctx:    {CONTEXT_SIZE}")
         print(f"  gpu:    L4 24GB (offloading all {N_GPU_LAYERS} layers)")
 
-        # llama-server stays alive for the life of the container
-        self.server_proc = subprocess.Popen(
+        # llama-server stays alive for the life of the container — relaunched
+        # with backoff if it exits (llama_supervisor.py)
+        self.server = llama_supervisor.LlamaSupervisor(
             [
                 "/opt/llama.cpp/build/bin/llama-server",
                 "--model", gguf_path,
@@ -209,93 +187,80 @@ class HollyBrain:
                 # gets the full 128K. L4 VRAM can't fit 4×128K KV cache
                 # (~40GB), so we trade concurrency for full context.
                 # If concurrency becomes critical, upgrade to A100 40GB.
-                "--parallel", "1",
+                "--parallel", str(LLAMA_PARALLEL),
                 "--cont-batching",
                 "--metrics",
+                "--slot-save-path", SLOT_SAVE_DIR,
             ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
+            LLAMA_PORT,
+            label="holly-brain-v40",
         )
-
-        # Background thread to drain llama-server stdout to Modal logs
-        threading.Thread(target=self._drain_stdout, daemon=True).start()
-
-        if not _wait_for_llama(timeout_s=180):
-            raise RuntimeError(
-                "llama-server failed to become healthy within 180s — "
-                "check container logs for build/runtime errors"
-            )
+        self.server.start()  # raises if not ready within 180s
+
+        # Pooled keep-alive client + slot admission for the proxy endpoints
+        self.llama = llama_proxy.LlamaClient(LLAMA_PORT, LLAMA_PARALLEL, label="holly-brain-v40",
+                                             down=self.server.down_reason)
+        self.context = ContextBudget(self.llama, CONTEXT_INPUT_BUDGET, CONTEXT_SIZE, label="holly-brain-v40")
+        # Persona system prompt KV from the last container — loaded before
+        # traffic so the first conversation doesn't re-process it
+        self.prefix = PrefixCache(self.llama, SLOT_SAVE_DIR, GGUF_FILE, commit=vol.commit,
+                                  label="holly-brain-v40")
+        self.prefix.restore()
+        # A relaunched llama-server starts with an empty KV cache
+        self.server.on_restart.append(self.prefix.restore)
 
         print("[holly-brain-v40] ✅ Ready — accepting requests")
 
-    def _drain_stdout(self):
-        """Forward llama-server output to container logs (Modal captures stdout)."""
-        assert self.server_proc.stdout is not None
-        for line in iter(self.server_proc.stdout.readline, b""):
-            try:
-                print(f"[llama-server] {line.decode().rstrip()}", flush=True)
-            except Exception:
-                pass
+    @modal.exit()
+    def shutdown(self):
+        """Container teardown: stop the supervisor so it doesn't relaunch llama-server."""
+        if hasattr(self, "server"):
+            self.server.stop()
 
     @modal.fastapi_endpoint(method="POST", label="brain-chat-v40")
-    def chat(self, request: dict) -> dict:
+    async def chat(self, request: dict, response: "fastapi.Response" = None) -> dict:
         """
         OpenAI-compatible chat completions.
         Forward request body to local llama-server /v1/chat/completions.
         Supports messages with image_url content blocks for vision.
+        "stream": true → llama-server's SSE chunks relayed as generated;
+        otherwise the whole completion as one JSON body. Both go through
+        the pooled client (llama_proxy.py) and report X-Queue-Wait-Ms.
+        History over CONTEXT_INPUT_BUDGET tokens is condensed / trimmed
+        first, or refused with 413 (context_budget.py; X-Context-* headers).
         """
-        import requests as _requests
-        from fastapi import HTTPException
-
-        try:
-            resp = _requests.post(
-                f"http://127.0.0.1:{LLAMA_PORT}/v1/chat/completions",
-                json=request,
-                timeout=120,
-            )
-        except _requests.exceptions.Timeout:
-            raise HTTPException(
-                status_code=504,
-                detail={"error": "llama-server timeout (120s)", "type": "timeout"},
-            )
-        except Exception as e:
-            raise HTTPException(
-                status_code=500,
-                detail={"error": str(e), "type": "internal_error"},
-            )
-
-        if resp.status_code != 200:
-            raise HTTPException(
-                status_code=resp.status_code,
-                detail=resp.json(),
-            )
+        request, budget_headers = await self.context.fit(request)
+        request = self.prefix.prepare(request)
+        self.prefix.observe(request)
+        if llama_proxy.wants_stream(request):
+            return await self.llama.stream_response("/v1/chat/completions", request,
+                                                    headers=budget_headers)
+
+        result, timing = await self.llama.forward("/v1/chat/completions", request)
+        if response is not None:
+            response.headers.update({**budget_headers, **timing})
         # Plain dict return — Modal's fastapi_endpoint serializes to JSON.
         # Do NOT wrap in JSONResponse: Modal returns the OpenAPI schema
         # description instead of actual data when you do.
-        return resp.json()
+        return result
 
     @modal.fastapi_endpoint(method="POST", label="brain-completion-v40")
-    def completion(self, request: dict) -> dict:
-        """OpenAI-compatible /v1/completions (non-chat)."""
-        import requests as _requests
-        from fastapi import HTTPException
-
-        resp = _requests.post(
-            f"http://127.0.0.1:{LLAMA_PORT}/v1/completions",
-            json=request,
-            timeout=120,
-        )
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail=resp.json())
-        return resp.json()
+    async def completion(self, request: dict, response: "fastapi.Response" = None) -> dict:
+        """OpenAI-compatible /v1/completions (non-chat); "stream" and timing headers as in chat."""
+        request = self.prefix.prepare(request)
+        if llama_proxy.wants_stream(request):
+            return await self.llama.stream_response("/v1/completions", request)
+
+        result, timing = await self.llama.forward("/v1/completions", request)
+        if response is not None:
+            response.headers.update(timing)
+        return result
 
     @modal.fastapi_endpoint(method="GET", label="brain-health-v40")
     def health(self) -> dict:
-        """Health check — returns model info if ready."""
-        alive = (
-            hasattr(self, "server_proc")
-            and self.server_proc.poll() is None
-        )
+        """Health check — returns model info if ready, with prompt-cache hits
+        (proxy.prompt_tokens_cached). llama-server /metrics: see metrics."""
+        alive = hasattr(self, "server") and self.server.alive
         return {
             "status": "healthy" if alive else "degraded",
             "model": HF_REPO,
@@ -303,6 +268,10 @@ class HollyBrain:
             "multimodal": True,
             "refusals_documented": "0/465",
             "context_window": CONTEXT_SIZE,
+            "llama_server": self.server.stats() if hasattr(self, "server") else None,
+            "proxy": self.llama.stats() if hasattr(self, "llama") else None,
+            "context_budget": self.context.stats() if hasattr(self, "context") else None,
+            "prefix_cache": self.prefix.stats() if hasattr(self, "prefix") else None,
             "serverless": True,
             "max_containers": 1,
             "scaledown_window": 2700,
@@ -310,6 +279,20 @@ class HollyBrain:
             "version": "v4.0",
         }
 
+    @modal.fastapi_endpoint(method="GET", label="brain-metrics-v40")
+    async def metrics(self) -> dict:
+        """llama-server /metrics summarized (tokens/s, prompt-eval time, KV
+        cache usage, deferred requests) with the supervisor's process state
+        and the proxy's own queue. Counters restart with llama-server."""
+        raw = await self.llama.metrics() if hasattr(self, "llama") else {}
+        return {
+            "llama_server": self.server.stats() if hasattr(self, "server") else None,
+            "metrics": llama_supervisor.summarize_metrics(raw),
+            "proxy": self.llama.stats() if hasattr(self, "llama") else None,
+            "prefix_cache": self.prefix.stats() if hasattr(self, "prefix") else None,
+            "raw": raw,
+        }
+
     @modal.fastapi_endpoint(method="GET", label="brain-info-v40")
     def info(self) -> dict:
         """API info / metadata."""
@@ -321,6 +304,7 @@ class HollyBrain:
                 "chat": "/brain-chat-v40",
                 "completion": "/brain-completion-v40",
                 "health": "/brain-health-v40",
+                "metrics": "/brain-metrics-v40",
                 "info": "/brain-info-v40",
             },
             "notes": [
@@ -352,5 +336,8 @@ def main(action: str = "deploy"):
     elif action == "health":
         result = HollyBrain().health.remote()
         print(f"Health: {result}")
+    elif action == "metrics":
+        result = HollyBrain().metrics.remote()
+        print(f"Metrics: {result}")
     else:
-        print(f"Usage: modal run deploy_holly_v40.py --action [deploy|test|health]")
+        print(f"Usage: modal run deploy_holly_v40.py --action [deploy|test|health|metrics]")
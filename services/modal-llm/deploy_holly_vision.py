@@ -39,11 +39,11 @@ USAGE:
 
 import modal
 import os
-import subprocess
-import time
-import threading
 from typing import Any
 
+import llama_proxy
+import llama_supervisor
+
 app = modal.App("holly-vision")
 
 # Persistent volume — caches GGUF so cold starts after the first one are fast.
@@ -61,6 +61,9 @@ MMPROJ_FILE = "mmproj-bf16.gguf"  # 644 MB — recommended default
 
 # llama-server (from llama.cpp) binds here.
 LLAMA_PORT = 8081  # 8080 is brain-v35; this endpoint uses 8081 to avoid clash
+# llama-server --parallel (KV slots). The proxy admits this many requests
+# upstream at once and queues the rest itself — see llama_proxy.py.
+LLAMA_PARALLEL = 4
 N_GPU_LAYERS = 999  # offload everything to GPU
 CONTEXT_SIZE = 8192  # Qwen3.5-4B handles 8K image+text context comfortably
 
@@ -88,56 +91,14 @@ image = (
         "-DCMAKE_CUDA_ARCHITECTURES=75 && "
         "cmake --build build --config Release -j --target llama-server",
     )
-    .pip_install("huggingface_hub", "fastapi", "requests")
+    .pip_install("huggingface_hub", "fastapi", "httpx")
     .env({"HF_HUB_ENABLE_HF_TRANSFER": "1"})
+    .add_local_python_source("llama_proxy", "llama_supervisor")
 )
 
-
-def _download_models() -> None:
-    """Pull GGUF + mmproj from HF on first run; subsequent runs use the volume."""
-    from huggingface_hub import hf_hub_download
-
-    gguf_path = os.path.join(MODEL_DIR, GGUF_FILE)
-    mmproj_path = os.path.join(MODEL_DIR, MMPROJ_FILE)
-
-    if not os.path.exists(gguf_path):
-        print(f"[holly-vision] Downloading {GGUF_FILE}...")
-        hf_hub_download(
-            repo_id=HF_REPO,
-            filename=GGUF_FILE,
-            local_dir=MODEL_DIR,
-        )
-        print(f"[holly-vision] ✅ GGUF cached")
-
-    if not os.path.exists(mmproj_path):
-        print(f"[holly-vision] Downloading {MMPROJ_FILE}...")
-        hf_hub_download(
-            repo_id=HF_REPO,
-            filename=MMPROJ_FILE,
-            local_dir=MODEL_DIR,
-        )
-        print(f"[holly-vision] ✅ mmproj cached")
-
-    try:
-        vol.commit()
-    except Exception as e:
-        print(f"[holly-vision] Volume commit warning: {e}")
-
-
-def _wait_for_llama(timeout_s: int = 180) -> bool:
-    """Block until llama-server responds to /health or timeout."""
-    import requests
-
-    deadline = time.time() + timeout_s
-    while time.time() < deadline:
-        try:
-            r = requests.get(f"http://127.0.0.1:{LLAMA_PORT}/health", timeout=2)
-            if r.status_code == 200:
-                return True
-        except Exception:
-            pass
-        time.sleep(1)
-    return False
+# Endpoint signatures reference fastapi.Response
+with image.imports():
+    import fastapi
 
 
 @app.cls(
@@ -156,7 +117,8 @@ class HollyVision:
     @modal.enter()
     def boot(self):
         """Container startup: pull models if needed, then launch llama-server."""
-        _download_models()
+        llama_supervisor.download_models(HF_REPO, [GGUF_FILE, MMPROJ_FILE], MODEL_DIR,
+                                         commit=vol.commit, label="holly-vision")
 
         gguf_path = os.path.join(MODEL_DIR, GGUF_FILE)
         mmproj_path = os.path.join(MODEL_DIR, MMPROJ_FILE)
@@ -167,7 +129,9 @@ class HollyVision:
         print(f"  ctx:    {CONTEXT_SIZE}")
         print(f"  gpu:    T4 (offloading all {N_GPU_LAYERS} layers)")
 
-        self.server_proc = subprocess.Popen(
+        # llama-server stays alive for the life of the container — relaunched
+        # with backoff if it exits (llama_supervisor.py)
+        self.server = llama_supervisor.LlamaSupervisor(
             [
                 "/opt/llama.cpp/build/bin/llama-server",
                 "--model", gguf_path,
@@ -176,78 +140,53 @@ class HollyVision:
                 "--host", "127.0.0.1",
                 "--n-gpu-layers", str(N_GPU_LAYERS),
                 "--ctx-size", str(CONTEXT_SIZE),
-                "--parallel", "4",
+                "--parallel", str(LLAMA_PARALLEL),
                 "--cont-batching",
                 "--jinja",  # required for Qwen3.5 chat template + tools
                 "--metrics",
             ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
+            LLAMA_PORT,
+            label="holly-vision",
         )
+        self.server.start()  # raises if not ready within 180s
 
-        threading.Thread(target=self._drain_stdout, daemon=True).start()
-
-        if not _wait_for_llama(timeout_s=180):
-            raise RuntimeError(
-                "llama-server failed to become healthy within 180s — "
-                "check container logs for build/runtime errors"
-            )
+        # Pooled keep-alive client + slot admission for the proxy endpoint
+        self.llama = llama_proxy.LlamaClient(LLAMA_PORT, LLAMA_PARALLEL, label="holly-vision",
+                                             down=self.server.down_reason)
 
         print("[holly-vision] ✅ Ready — accepting requests")
 
-    def _drain_stdout(self):
-        """Forward llama-server output to container logs."""
-        assert self.server_proc.stdout is not None
-        for line in iter(self.server_proc.stdout.readline, b""):
-            try:
-                print(f"[llama-server] {line.decode().rstrip()}", flush=True)
-            except Exception:
-                pass
+    @modal.exit()
+    def shutdown(self):
+        """Container teardown: stop the supervisor so it doesn't relaunch llama-server."""
+        if hasattr(self, "server"):
+            self.server.stop()
 
     @modal.fastapi_endpoint(method="POST", label="vision-chat")
-    def chat(self, request: dict) -> dict:
+    async def chat(self, request: dict, response: "fastapi.Response" = None) -> dict:
         """
         OpenAI-compatible chat completions with vision support.
         Forward request body to local llama-server /v1/chat/completions.
         Supports messages with image_url content blocks (data: URLs).
+        "stream": true → llama-server's SSE chunks relayed as generated;
+        otherwise the whole completion as one JSON body. Both go through
+        the pooled client (llama_proxy.py) and report X-Queue-Wait-Ms.
         """
-        import requests as _requests
-        from fastapi import HTTPException
-
-        try:
-            resp = _requests.post(
-                f"http://127.0.0.1:{LLAMA_PORT}/v1/chat/completions",
-                json=request,
-                timeout=120,
-            )
-        except _requests.exceptions.Timeout:
-            raise HTTPException(
-                status_code=504,
-                detail={"error": "llama-server timeout (120s)", "type": "timeout"},
-            )
-        except Exception as e:
-            raise HTTPException(
-                status_code=500,
-                detail={"error": str(e), "type": "internal_error"},
-            )
+        if llama_proxy.wants_stream(request):
+            return await self.llama.stream_response("/v1/chat/completions", request)
 
-        if resp.status_code != 200:
-            raise HTTPException(
-                status_code=resp.status_code,
-                detail=resp.json(),
-            )
+        result, timing = await self.llama.forward("/v1/chat/completions", request)
+        if response is not None:
+            response.headers.update(timing)
         # Plain dict return — Modal's fastapi_endpoint serializes to JSON.
         # Do NOT wrap in JSONResponse: Modal returns the OpenAPI schema
         # description instead of actual data when you do.
-        return resp.json()
+        return result
 
     @modal.fastapi_endpoint(method="GET", label="vision-health")
     def health(self) -> dict:
         """Health check — returns model info if ready."""
-        alive = (
-            hasattr(self, "server_proc")
-            and self.server_proc.poll() is None
-        )
+        alive = hasattr(self, "server") and self.server.alive
         return {
             "status": "healthy" if alive else "degraded",
             "model": HF_REPO,
@@ -256,6 +195,8 @@ class HollyVision:
             "abliterated": True,
             "abliteration_method": "gabliteration (multi-directional SVD)",
             "context_window": CONTEXT_SIZE,
+            "llama_server": self.server.stats() if hasattr(self, "server") else None,
+            "proxy": self.llama.stats() if hasattr(self, "llama") else None,
             "serverless": True,
             "max_containers": 1,
             "scaledown_window": 300,
@@ -265,6 +206,19 @@ class HollyVision:
             "primary": "holly-brain-v35",
         }
 
+    @modal.fastapi_endpoint(method="GET", label="vision-metrics")
+    async def metrics(self) -> dict:
+        """llama-server /metrics summarized (tokens/s, prompt-eval time, KV
+        cache usage, deferred requests) with the supervisor's process state
+        and the proxy's own queue. Counters restart with llama-server."""
+        raw = await self.llama.metrics() if hasattr(self, "llama") else {}
+        return {
+            "llama_server": self.server.stats() if hasattr(self, "server") else None,
+            "metrics": llama_supervisor.summarize_metrics(raw),
+            "proxy": self.llama.stats() if hasattr(self, "llama") else None,
+            "raw": raw,
+        }
+
     @modal.fastapi_endpoint(method="GET", label="vision-info")
     def info(self) -> dict:
         """API info / metadata."""
@@ -275,6 +229,7 @@ class HollyVision:
             "endpoints": {
                 "chat": "/vision-chat",
                 "health": "/vision-health",
+                "metrics": "/vision-metrics",
                 "info": "/vision-info",
             },
             "notes": [
@@ -299,5 +254,8 @@ def main(action: str = "deploy"):
     elif action == "health":
         result = HollyVision().health.remote()
         print(f"Health: {result}")
+    elif action == "metrics":
+        result = HollyVision().metrics.remote()
+        print(f"Metrics: {result}")
     else:
-        print(f"Usage: modal run deploy_holly_vision.py --action [deploy|test|health]")
+        print(f"Usage: modal run deploy_holly_vision.py --action [deploy|test|health|metrics]")
@@ -0,0 +1,366 @@
+"""
+llama-server proxy — pooled async client, SSE pass-through, slot admission
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+brain-chat / brain-completion / vision-chat forwarded to llama-server with a
+blocking requests.post(..., timeout=120): a fresh TCP connection per call,
+a worker thread parked for the whole generation, and with
+@modal.concurrent(max_inputs=4) in front of `--parallel 1` three of those
+threads just sat in llama-server's own queue with nothing saying so.
+
+LlamaClient is one per container (created in boot, used from the async
+endpoints):
+
+  - one keep-alive httpx.AsyncClient to 127.0.0.1:LLAMA_PORT
+  - an asyncio.Semaphore of `slots` = llama-server's --parallel, so at
+    most that many requests are in flight upstream and the rest wait here,
+    where the wait is measured
+  - X-Queue-Wait-Ms (time waiting for a slot) and X-Generation-Ms (time
+    llama-server spent on the request) on every response; streamed
+    responses carry X-Queue-Wait-Ms only — their headers leave before
+    generation starts
+
+"stream": true (see stream_response) relays llama-server's own SSE stream
+(text/event-stream, OpenAI chunk format, ending in "data: [DONE]") chunk by
+chunk as it is generated. Connection / status errors before the first byte
+still come back as HTTPException with llama-server's error body, exactly
+like the non-streaming path; later errors become an in-stream
+{"error": ...} frame. When the client goes away Starlette cancels the
+relay, the upstream response is closed and its connection dropped —
+llama-server's next write fails and it stops generating for that slot
+instead of finishing a reply nobody reads.
+
+Requests without "stream" keep their contract: the completion as one JSON
+body, same status codes and error shapes as before.
+
+down: optional callable returning why llama-server isn't serving (e.g.
+llama_supervisor.LlamaSupervisor.down_reason while it restarts), or None.
+A transport error while it says so becomes 503 + Retry-After instead of 500.
+
+No modal import; httpx and fastapi are imported lazily (image deps).
+"""
+
+import asyncio
+import contextlib
+import json
+import time
+import weakref
+
+LLAMA_HOST = "127.0.0.1"
+# Seconds without an upstream byte before a request is abandoned (the old
+# requests.post timeout)
+REQUEST_TIMEOUT_S = 120
+CONNECT_TIMEOUT_S = 5
+# Pooled connections beyond the slots, for calls that don't occupy a slot
+# (/tokenize from context_budget.py) while every slot is streaming
+AUX_CONNECTIONS = 4
+# Retry-After on 503s while llama-server is down (a restart reloads the model)
+RETRY_AFTER_S = 30
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # nginx / proxies: don't buffer the stream
+}
+
+
+def wants_stream(request: dict) -> bool:
+    return bool(request.get("stream"))
+
+
+def sse_event_error(message: str, err_type: str) -> bytes:
+    """An OpenAI-style in-stream error frame (after headers went out, the
+    status code can no longer change)."""
+    return f"data: {json.dumps({'error': {'message': message, 'type': err_type}})}\n\n".encode("utf-8")
+
+
+def _error_detail(raw: bytes):
+    """Body of a non-200 answer, parsed like resp.json() in the old sync path."""
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return {"error": raw.decode("utf-8", errors="replace")[:2000]}
+
+
+def _ms(seconds: float) -> str:
+    return str(int(seconds * 1000))
+
+
+def parse_metrics(text: str) -> dict:
+    """Prometheus text from llama-server /metrics (--metrics) → {name: value},
+    "llamacpp:" prefix stripped, labels ignored."""
+    out = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name, _, value = line.rpartition(" ")
+        name = name.split("{", 1)[0].strip()
+        if name.startswith("llamacpp:"):
+            name = name[len("llamacpp:"):]
+        try:
+            out[name] = float(value)
+        except ValueError:
+            continue
+    return out
+
+
+class _Slot:
+    """One acquired llama-server slot. release() is idempotent."""
+
+    def __init__(self, client: "LlamaClient", wait_s: float):
+        self.client = client
+        self.wait_s = wait_s
+        self.t0 = time.perf_counter()
+        self.t1 = None
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.t1 = time.perf_counter()
+            self.client._release()
+
+    @property
+    def elapsed_s(self) -> float:
+        """Time holding the slot (frozen at release)."""
+        return (self.t1 or time.perf_counter()) - self.t0
+
+
+class LlamaClient:
+    """Keep-alive async client to one llama-server, at most `slots` requests in flight."""
+
+    def __init__(self, port: int, slots: int, label: str = "llama",
+                 timeout: float = REQUEST_TIMEOUT_S, down=None):
+        self.base_url = f"http://{LLAMA_HOST}:{port}"
+        self.slots = slots
+        self.label = label
+        self.timeout = timeout
+        self.down = down
+        # Both bind to the event loop on first use — created lazily there
+        self._client = None
+        self._sem = None
+        self.waiting = 0
+        self.active = 0
+        self.requests = 0
+        self.streams = 0
+        self.disconnects = 0
+        self.queue_wait_ms_total = 0
+        self.generation_ms_total = 0
+        # From llama-server's per-response "timings": prompt tokens reused
+        # from the slot's cache (cache_n) vs. evaluated (prompt_n)
+        self.prompt_tokens_cached = 0
+        self.prompt_tokens_evaluated = 0
+
+    def _note_timings(self, payload):
+        timings = payload.get("timings") if isinstance(payload, dict) else None
+        if isinstance(timings, dict):
+            self.prompt_tokens_cached += int(timings.get("cache_n") or 0)
+            self.prompt_tokens_evaluated += int(timings.get("prompt_n") or 0)
+
+    def _http(self):
+        import httpx
+
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(self.timeout, connect=CONNECT_TIMEOUT_S),
+                limits=httpx.Limits(max_connections=self.slots + AUX_CONNECTIONS,
+                                    max_keepalive_connections=self.slots + AUX_CONNECTIONS),
+            )
+            self._sem = asyncio.Semaphore(self.slots)
+        return self._client
+
+    async def _acquire(self) -> _Slot:
+        self._http()
+        t0 = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._sem.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        slot = _Slot(self, time.perf_counter() - t0)
+        self.requests += 1
+        self.queue_wait_ms_total += int(slot.wait_s * 1000)
+        return slot
+
+    def _release(self):
+        self.active -= 1
+        self._sem.release()
+
+    @staticmethod
+    def _raise(status_code: int, detail, headers: dict):
+        from fastapi import HTTPException
+
+        raise HTTPException(status_code=status_code, detail=detail, headers=headers)
+
+    def _transport_error(self, e: Exception, headers: dict):
+        import httpx
+
+        reason = self.down() if self.down is not None else None
+        if reason and isinstance(e, httpx.TransportError):
+            self._raise(503, {"error": reason, "type": "unavailable"},
+                        {**headers, "Retry-After": str(RETRY_AFTER_S)})
+        if isinstance(e, httpx.TimeoutException):
+            self._raise(504, {"error": f"llama-server timeout ({int(self.timeout)}s)",
+                              "type": "timeout"}, headers)
+        self._raise(500, {"error": str(e) or type(e).__name__, "type": "internal_error"}, headers)
+
+    async def forward(self, path: str, body: dict):
+        """Non-streaming POST. Returns (parsed JSON, timing headers); errors
+        raise HTTPException with the same status / detail as the sync proxy did."""
+        slot = await self._acquire()
+        try:
+            try:
+                resp = await self._http().post(path, json=body)
+            except Exception as e:
+                self._transport_error(e, self._timing(slot))
+        finally:
+            slot.release()
+        self.generation_ms_total += int(slot.elapsed_s * 1000)
+        headers = self._timing(slot)
+        if resp.status_code != 200:
+            self._raise(resp.status_code, _error_detail(resp.content), headers)
+        result = resp.json()
+        self._note_timings(result)
+        return result, headers
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Hold one slot for a sequence of call()s (e.g. warm + save a prefix
+        with nothing else touching the slot in between)."""
+        slot = await self._acquire()
+        try:
+            yield slot
+        finally:
+            slot.release()
+
+    async def call(self, path: str, body: dict = None, method: str = "POST"):
+        """Plain request without admission — (status, parsed JSON or text).
+        For slot-free endpoints, or inside `async with client.slot()`."""
+        resp = await self._http().request(method, path, json=body)
+        try:
+            return resp.status_code, resp.json()
+        except ValueError:
+            return resp.status_code, resp.text
+
+    async def metrics(self) -> dict:
+        """llama-server /metrics, parsed ({} if unavailable)."""
+        try:
+            resp = await self._http().get("/metrics", timeout=5)
+        except Exception:
+            return {}
+        return parse_metrics(resp.text) if resp.status_code == 200 else {}
+
+    async def tokenize(self, text: str) -> int:
+        """Token count of text with the served model's tokenizer. /tokenize
+        runs on llama-server's HTTP thread, not a slot — no admission."""
+        resp = await self._http().post("/tokenize", json={"content": text})
+        resp.raise_for_status()
+        return len(resp.json().get("tokens", []))
+
+    @staticmethod
+    def _timing(slot: _Slot, generation: bool = True) -> dict:
+        headers = {"X-Queue-Wait-Ms": _ms(slot.wait_s)}
+        if generation:
+            headers["X-Generation-Ms"] = _ms(slot.elapsed_s)
+        return headers
+
+    async def stream_response(self, path: str, body: dict, headers: dict = None):
+        """StreamingResponse relaying llama-server's SSE for a "stream": true
+        request. headers: extra response headers (e.g. context_budget's)."""
+        from fastapi.responses import StreamingResponse
+
+        slot = await self._acquire()
+        client = self._http()
+        try:
+            request = client.build_request("POST", path, json=body,
+                                           headers={"Accept": "text/event-stream"})
+            resp = await client.send(request, stream=True)
+        except BaseException as e:
+            slot.release()  # also on cancellation — the client left while we connected
+            if isinstance(e, Exception):
+                self._transport_error(e, self._timing(slot))
+            raise
+        if resp.status_code != 200:
+            try:
+                raw = await resp.aread()
+            finally:
+                await resp.aclose()
+                slot.release()
+            self._raise(resp.status_code, _error_detail(raw), self._timing(slot))
+
+        self.streams += 1
+        relay = self._relay(resp, slot)
+        # A client that disconnects before the first chunk means the relay is
+        # never started, so its finally never runs — free the slot on GC instead.
+        weakref.finalize(relay, self._abandon, resp, slot)
+        return StreamingResponse(relay, media_type="text/event-stream",
+                                 headers={**SSE_HEADERS, **(headers or {}),
+                                          **self._timing(slot, generation=False)})
+
+    def _abandon(self, resp, slot: _Slot):
+        if not slot.released:
+            slot.release()
+            try:
+                asyncio.get_running_loop().create_task(resp.aclose())
+            except RuntimeError:
+                pass  # no loop (interpreter shutdown) — the pool goes with it
+
+    async def _relay(self, resp, slot: _Slot):
+        """Relay upstream bytes unchanged; drop the upstream on client disconnect."""
+        import httpx
+
+        sent = 0
+        done = False
+        tail = b""
+        try:
+            try:
+                async for chunk in resp.aiter_raw():
+                    sent += len(chunk)
+                    yield chunk
+                    # The final chunk carries "timings" — pick up cache_n
+                    lines = (tail + chunk).split(b"\n")
+                    tail = lines.pop()[-65536:]
+                    for line in lines:
+                        if line.startswith(b"data: {") and b'"timings"' in line:
+                            try:
+                                self._note_timings(json.loads(line[6:]))
+                            except ValueError:
+                                pass
+            except httpx.TimeoutException:
+                yield sse_event_error(f"llama-server stalled ({int(self.timeout)}s without output)",
+                                      "timeout")
+            except httpx.HTTPError as e:
+                yield sse_event_error(str(e) or type(e).__name__, "internal_error")
+            done = True
+        finally:
+            # Closing a response that was not read to the end drops its
+            # connection, which is what tells llama-server to stop.
+            await resp.aclose()
+            slot.release()
+            self.generation_ms_total += int(slot.elapsed_s * 1000)
+            if done:
+                print(f"[{self.label}] stream done: {sent} bytes, queue {_ms(slot.wait_s)}ms, "
+                      f"generation {_ms(slot.elapsed_s)}ms", flush=True)
+            else:
+                self.disconnects += 1
+                print(f"[{self.label}] 📴 client disconnected after {sent} bytes / "
+                      f"{slot.elapsed_s:.1f}s — upstream closed, generation cancelled", flush=True)
+
+    def stats(self) -> dict:
+        return {
+            "slots": self.slots,
+            "active": self.active,
+            "waiting": self.waiting,
+            "requests": self.requests,
+            "streams": self.streams,
+            "client_disconnects": self.disconnects,
+            "queue_wait_ms_total": self.queue_wait_ms_total,
+            "generation_ms_total": self.generation_ms_total,
+            "prompt_tokens_cached": self.prompt_tokens_cached,
+            "prompt_tokens_evaluated": self.prompt_tokens_evaluated,
+        }
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,305 @@
+"""
+llama-server supervisor — launch, readiness, crash restart, /metrics summary
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+deploy_holly_v35 / v40 / vision each carried a copy of _download_models /
+_wait_for_llama / boot / _drain_stdout: Popen once, poll /health with
+requests once a second, print stdout from a thread. If llama-server died
+afterwards (CUDA OOM on a huge prompt, a crash in the mmproj path) nothing
+noticed — health said "degraded" and every request 500'd on a refused
+connection until Modal recycled the container at scaledown.
+
+LlamaSupervisor owns the process for the life of the container:
+
+  start()        Popen the command, drain its output to the container log,
+                 block until ready. Ready is read from llama-server's own
+                 log (READY_MARKERS, printed once the model is loaded), with
+                 GET /health == 200 as the fallback for builds that word it
+                 differently. Exiting during startup fails at once instead
+                 of after the whole timeout.
+  monitor        a daemon thread waits on the process. An exit stop() didn't
+                 ask for is logged with the last lines of output and the
+                 server relaunched after a backoff (BACKOFF_S, back to the
+                 start once a run stayed up STABLE_S). on_restart callbacks
+                 run when it is ready again — the KV cache went with the old
+                 process (prefix_cache.PrefixCache.restore reloads it).
+  stop()         @modal.exit: no more restarts; terminate, then kill.
+  down_reason()  why llama-server isn't serving right now, or None —
+                 llama_proxy answers 503 + Retry-After with it instead of a
+                 connection-refused 500.
+
+summarize_metrics() turns llama-server /metrics (--metrics, parsed by
+llama_proxy.parse_metrics) into the numbers the metrics endpoints report:
+generation / prompt tokens per second, prompt-eval time, KV cache usage,
+requests processing / deferred.
+
+download_models() is the shared first-run HF download into the volume.
+
+Stdlib only, no modal import (huggingface_hub is imported lazily, image dep).
+"""
+
+import collections
+import os
+import subprocess
+import threading
+import time
+import urllib.request
+
+# llama-server log lines that mean "model loaded, serving": the first from
+# main() right before its loop, the second from the slot scheduler
+READY_MARKERS = ("starting the main loop", "all slots are idle")
+# Seconds to wait before relaunch #1, #2, … (the last repeats)
+BACKOFF_S = (1, 2, 5, 10, 30, 60)
+# A run that stayed up this long resets the backoff
+STABLE_S = 300
+READY_TIMEOUT_S = 180
+# Output lines kept for the crash report
+TAIL_LINES = 40
+
+
+def download_models(repo: str, files: list, model_dir: str, commit=None,
+                    label: str = "llama") -> None:
+    """Pull files from HF on first run; later runs use the volume."""
+    from huggingface_hub import hf_hub_download
+
+    fetched = False
+    for filename in files:
+        if os.path.exists(os.path.join(model_dir, filename)):
+            continue
+        print(f"[{label}] Downloading {filename}...")
+        hf_hub_download(repo_id=repo, filename=filename, local_dir=model_dir)
+        print(f"[{label}] ✅ {filename} cached")
+        fetched = True
+
+    # Commit downloads to the volume so the next container starts fast
+    if fetched and commit is not None:
+        try:
+            commit()
+        except Exception as e:
+            print(f"[{label}] Volume commit warning: {e}")
+
+
+def _first(*values):
+    for value in values:
+        if value is not None:
+            return value
+    return None
+
+
+def _rate(count, seconds):
+    return count / seconds if count is not None and seconds else None
+
+
+def _round(value, digits: int = 2):
+    return round(value, digits) if value is not None else None
+
+
+def summarize_metrics(raw: dict) -> dict:
+    """llama_proxy.parse_metrics output → the reported numbers. Counters are
+    since the current llama-server process started; None where this build
+    doesn't export the metric."""
+    get = raw.get
+    return {
+        "available": bool(raw),
+        "generation_tokens_per_s": _round(_first(
+            get("predicted_tokens_seconds"),
+            _rate(get("tokens_predicted_total"), get("tokens_predicted_seconds_total")))),
+        "prompt_tokens_per_s": _round(_first(
+            get("prompt_tokens_seconds"),
+            _rate(get("prompt_tokens_total"), get("prompt_seconds_total")))),
+        "prompt_eval_s_total": _round(get("prompt_seconds_total")),
+        "generation_s_total": _round(get("tokens_predicted_seconds_total")),
+        "prompt_tokens_total": get("prompt_tokens_total"),
+        "generated_tokens_total": get("tokens_predicted_total"),
+        "kv_cache_usage_ratio": _round(get("kv_cache_usage_ratio"), 4),
+        "kv_cache_tokens": get("kv_cache_tokens"),
+        "requests_processing": get("requests_processing"),
+        "requests_deferred": get("requests_deferred"),
+    }
+
+
+class LlamaSupervisor:
+    """One llama-server process, kept running (see module docstring)."""
+
+    def __init__(self, cmd: list, port: int, label: str = "llama",
+                 ready_timeout_s: float = READY_TIMEOUT_S, backoff_s=BACKOFF_S,
+                 stable_s: float = STABLE_S):
+        self.cmd = list(cmd)
+        self.port = port
+        self.label = label
+        self.ready_timeout_s = ready_timeout_s
+        self.backoff_s = tuple(backoff_s)
+        self.stable_s = stable_s
+        self.on_restart = []
+        self.proc = None
+        self.state = "stopped"
+        self.restarts = 0
+        self.failed_launches = 0
+        self.started_at = None
+        self.ready_ms = None
+        self.ready_source = None
+        self.last_exit_code = None
+        self.last_exit_at = None
+        self.last_error = None
+        self.tail = collections.deque(maxlen=TAIL_LINES)
+        self._ready = threading.Event()
+        self._stopping = threading.Event()
+        self._monitor = None
+        self._drainer = None
+
+    # ── Process ────────────────────────────────────────────────────────
+
+    def _launch(self):
+        self._ready = threading.Event()
+        self.state = "starting"
+        self.started_at = time.time()
+        self.proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self._drainer = threading.Thread(target=self._drain, args=(self.proc, self._ready), daemon=True)
+        self._drainer.start()
+
+    def _drain(self, proc, ready: threading.Event):
+        """Forward llama-server output to container logs (Modal captures
+        stdout); note readiness and errors on the way."""
+        for raw in iter(proc.stdout.readline, b""):
+            line = raw.decode("utf-8", errors="replace").rstrip()
+            print(f"[llama-server] {line}", flush=True)
+            self.tail.append(line)
+            if not ready.is_set() and any(m in line for m in READY_MARKERS):
+                self.ready_source = "log"
+                ready.set()
+            lowered = line.lower()
+            if "error" in lowered or "failed" in lowered:
+                self.last_error = line[:500]
+
+    def _drained(self, timeout_s: float = 2):
+        """After an exit: let the drain thread log the last lines first."""
+        if self._drainer is not None:
+            self._drainer.join(timeout=timeout_s)
+
+    def _health_ok(self) -> bool:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/health", timeout=2) as r:
+                return r.status == 200
+        except (OSError, ValueError):
+            return False
+
+    def _wait_ready(self, timeout_s: float) -> bool:
+        """True once ready; False if the process exited or timed out."""
+        deadline = time.time() + timeout_s
+        while time.time() < deadline and not self._stopping.is_set():
+            if self._ready.wait(timeout=1):
+                break
+            if self.proc.poll() is not None:
+                return False
+            if self._health_ok():
+                self.ready_source = "health"
+                self._ready.set()
+                break
+        if not self._ready.is_set() or self.proc.poll() is not None:
+            return False
+        self.ready_ms = int((time.time() - self.started_at) * 1000)
+        self.state = "ready"
+        return True
+
+    def _terminate(self, proc, grace_s: float = 10):
+        if proc is None or proc.poll() is not None:
+            return
+        proc.terminate()
+        try:
+            proc.wait(timeout=grace_s)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+    # ── Lifecycle ──────────────────────────────────────────────────────
+
+    def start(self):
+        """Launch and block until ready (boot). Raises RuntimeError if it
+        exits or doesn't get there within ready_timeout_s."""
+        self._stopping.clear()
+        self._launch()
+        if not self._wait_ready(self.ready_timeout_s):
+            code = self.proc.poll()
+            self._terminate(self.proc)
+            self._drained()
+            self.state = "failed"
+            raise RuntimeError(
+                f"llama-server failed to become healthy within {int(self.ready_timeout_s)}s"
+                + (f" (exited with code {code})" if code is not None else "")
+                + " — check container logs for build/runtime errors")
+        print(f"[{self.label}] ✅ llama-server ready in {self.ready_ms}ms "
+              f"(pid {self.proc.pid}, via {self.ready_source})", flush=True)
+        self._monitor = threading.Thread(target=self._watch, daemon=True)
+        self._monitor.start()
+
+    def _watch(self):
+        attempt = 0
+        while not self._stopping.is_set():
+            code = self.proc.wait()
+            if self._stopping.is_set():
+                break
+            self._drained()
+            ran_s = time.time() - self.started_at
+            self.last_exit_code = code
+            self.last_exit_at = time.time()
+            if ran_s >= self.stable_s:
+                attempt = 0
+            delay = self.backoff_s[min(attempt, len(self.backoff_s) - 1)]
+            attempt += 1
+            self.state = "backoff"
+            print(f"[{self.label}] 💥 llama-server exited with code {code} after {ran_s:.0f}s — "
+                  f"restarting in {delay}s. Last output:\n  " + "\n  ".join(list(self.tail)[-10:]),
+                  flush=True)
+            if self._stopping.wait(timeout=delay):
+                break
+            self._launch()
+            if not self._wait_ready(self.ready_timeout_s):
+                if self._stopping.is_set():
+                    break
+                self.failed_launches += 1
+                self._terminate(self.proc)
+                continue  # proc.wait() returns at once → next backoff step
+            self.restarts += 1
+            print(f"[{self.label}] ✅ llama-server back after restart #{self.restarts} "
+                  f"({self.ready_ms}ms to ready)", flush=True)
+            for callback in self.on_restart:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"[{self.label}] ⚠️ on_restart callback failed: {e}", flush=True)
+        self.state = "stopped"
+
+    def stop(self, grace_s: float = 10):
+        """No more restarts; terminate the server (container shutdown)."""
+        self._stopping.set()
+        self._terminate(self.proc, grace_s)
+        if self._monitor is not None:
+            self._monitor.join(timeout=grace_s)
+        self.state = "stopped"
+
+    # ── Status ─────────────────────────────────────────────────────────
+
+    @property
+    def alive(self) -> bool:
+        return self.state == "ready" and self.proc is not None and self.proc.poll() is None
+
+    def down_reason(self):
+        if self.alive:
+            return None
+        if self.state in ("starting", "backoff"):
+            return f"llama-server restarting (exit code {self.last_exit_code})"
+        return f"llama-server {self.state}"
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "alive": self.alive,
+            "pid": self.proc.pid if self.proc is not None else None,
+            "uptime_s": int(time.time() - self.started_at) if self.alive else None,
+            "ready_ms": self.ready_ms,
+            "ready_source": self.ready_source,
+            "restarts": self.restarts,
+            "failed_launches": self.failed_launches,
+            "last_exit_code": self.last_exit_code,
+            "last_exit_at": self.last_exit_at,
+            "last_error": self.last_error,
+        }
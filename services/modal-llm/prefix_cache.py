@@ -0,0 +1,308 @@
+"""
+Persistent KV prefix cache for the brain's system prompt
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+Every conversation starts with the same large persona system prompt, and
+after every scale-to-zero the first request re-processed it from scratch on
+the L4 before generating a single token.
+
+llama-server can write a slot's KV cache to disk and read it back
+(--slot-save-path, POST /slots/{id}?action=save|restore). PrefixCache uses
+that to carry the system prefix across cold starts:
+
+  observe(request)   after each chat request: the leading system
+                     message(s) are the prefix. One seen min_seen times
+                     that differs from the saved one is warmed and saved
+                     in the background once the proxy is idle —
+                     /apply-template renders it exactly as a chat prompt
+                     begins, /completion (n_predict 1, cache_prompt) fills
+                     the slot, /slots/0?action=save writes it to the
+                     volume, a manifest records which prefix it is. Where
+                     slot files are unsupported only the manifest is
+                     written (token count from /tokenize) — the slot is
+                     left alone.
+  restore()          in boot, before "Ready": /slots/0?action=restore
+                     loads the saved KV, so the first conversation after a
+                     cold start reuses the prefix (llama-server matches the
+                     common token prefix when cache_prompt is set).
+  prepare(request)   sets cache_prompt on forwarded requests.
+
+If the restore fails (file missing, llama.cpp rebuilt with another state
+format) or this llama-server refuses slot files — builds with a multimodal
+projector loaded answer slot actions with "not supported" — restore() warms
+the prefix from the manifest's stored messages instead: still before
+traffic, so the cost moves from the first user's reply into the cold start.
+
+Prefix hits show up as cache_n in llama-server's per-response timings,
+totalled by llama_proxy.LlamaClient, next to /metrics in health.
+
+Stdlib only (the runtime path goes through llama_proxy.LlamaClient), no
+modal import.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+
+MANIFEST = "prefix-manifest.json"
+SLOT_ID = 0
+# Times a new system prefix must be seen before it replaces the saved one
+MIN_SEEN = 2
+# How long a background save waits for the proxy to go idle before giving up
+IDLE_WAIT_S = 600
+SYSTEM_ROLES = ("system", "developer")
+
+
+def system_prefix(request: dict) -> list:
+    messages = request.get("messages")
+    if not isinstance(messages, list):
+        return []
+    prefix = []
+    for msg in messages:
+        if not isinstance(msg, dict) or msg.get("role") not in SYSTEM_ROLES:
+            break
+        prefix.append(msg)
+    return prefix
+
+
+def prefix_digest(messages: list, model: str) -> str:
+    blob = json.dumps({"model": model, "messages": messages}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def _post_sync(base_url: str, path: str, body: dict, timeout: float):
+    """(status, parsed JSON) — boot runs before the async client exists."""
+    req = urllib.request.Request(
+        base_url + path, data=json.dumps(body).encode("utf-8"),
+        headers={"Content-Type": "application/json"}, method="POST")
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return resp.status, json.loads(resp.read() or b"{}")
+    except urllib.error.HTTPError as e:
+        raw = e.read()
+        try:
+            return e.code, json.loads(raw)
+        except ValueError:
+            return e.code, {"error": raw.decode("utf-8", errors="replace")[:500]}
+    except (OSError, ValueError) as e:
+        return 0, {"error": str(e)}
+
+
+class PrefixCache:
+    """Save / restore the system-prompt KV of slot 0 (see module docstring)."""
+
+    def __init__(self, client, save_dir: str, model: str, commit=None,
+                 min_seen: int = MIN_SEEN, label: str = "llama"):
+        self.client = client
+        self.save_dir = save_dir
+        self.model = model
+        self.commit = commit
+        self.min_seen = min_seen
+        self.label = label
+        self.manifest = self._load_manifest()
+        self._seen = {}
+        self._task = None
+        self.slot_files_supported = None  # unknown until a save / restore answers
+        self.restored_tokens = 0
+        self.restore_ms = None
+        self.boot_warm_ms = None
+        self.saves = 0
+        self.save_errors = 0
+        self.last_error = None
+        self.requests_on_saved_prefix = 0
+
+    # ── Manifest ────────────────────────────────────────────────────────
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.save_dir, MANIFEST)
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get("model") != self.model:
+            return None  # a different GGUF — its KV is useless here
+        return manifest
+
+    def _write_manifest(self, manifest: dict):
+        tmp = f"{self.manifest_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self.manifest_path)
+        self.manifest = manifest
+
+    @property
+    def saved_digest(self):
+        return self.manifest.get("digest") if self.manifest else None
+
+    # ── Boot (sync, before traffic) ─────────────────────────────────────
+
+    def restore(self, timeout: float = 300) -> bool:
+        """Load the saved prefix into slot 0; warm it from the manifest's
+        messages if the slot file can't be used. True if the prefix is hot."""
+        if not self.manifest:
+            print(f"[{self.label}] prefix cache: nothing saved yet")
+            return False
+        base = self.client.base_url
+        t0 = time.time()
+        filename = self.manifest.get("file")
+        if filename and os.path.exists(os.path.join(self.save_dir, filename)):
+            status, body = _post_sync(base, f"/slots/{SLOT_ID}?action=restore",
+                                      {"filename": filename}, timeout)
+            if status == 200:
+                self.slot_files_supported = True
+                self.restored_tokens = int(body.get("n_restored") or 0)
+                self.restore_ms = int((time.time() - t0) * 1000)
+                print(f"[{self.label}] ✅ prefix cache restored: {self.restored_tokens} tokens "
+                      f"in {self.restore_ms}ms")
+                return True
+            self._note_slot_error(status, body, "restore")
+        # Fall back: process the prefix now rather than on the first request
+        t0 = time.time()
+        status, body = _post_sync(base, "/apply-template",
+                                  {"messages": self.manifest["messages"]}, timeout)
+        if status == 200 and body.get("prompt"):
+            status, body = _post_sync(base, "/completion", {
+                "prompt": body["prompt"], "n_predict": 1, "cache_prompt": True,
+                "id_slot": SLOT_ID}, timeout)
+        if status != 200:
+            self.last_error = f"warm {status}: {str(body)[:300]}"
+            print(f"[{self.label}] ⚠️ prefix warm failed: {self.last_error}")
+            return False
+        self.boot_warm_ms = int((time.time() - t0) * 1000)
+        print(f"[{self.label}] 🔥 prefix warmed from manifest in {self.boot_warm_ms}ms")
+        return True
+
+    async def _probe_slot_files(self):
+        """Save slot 0 as it is to a scratch file — learns whether this build
+        writes slot files before anything is warmed for a save that can't
+        happen. A save doesn't change the slot's KV."""
+        probe = "holly-prefix-probe.bin"
+        async with self.client.slot():
+            status, body = await self.client.call(
+                f"/slots/{SLOT_ID}?action=save", {"filename": probe})
+        if status != 200:
+            self._note_slot_error(status, body, "save")
+            return
+        self.slot_files_supported = True
+        try:
+            os.remove(os.path.join(self.save_dir, probe))
+        except OSError:
+            pass
+
+    def _note_slot_error(self, status: int, body, action: str):
+        self.last_error = f"{action} {status}: {str(body)[:300]}"
+        if status in (400, 501) and "support" in str(body).lower():
+            self.slot_files_supported = False
+        print(f"[{self.label}] ⚠️ prefix cache {action} failed: {self.last_error}")
+
+    # ── Requests ───────────────────────────────────────────────────────
+
+    @staticmethod
+    def prepare(request: dict) -> dict:
+        """Forwarded requests reuse the slot's cached prompt prefix."""
+        if "cache_prompt" in request:
+            return request
+        return {**request, "cache_prompt": True}
+
+    def observe(self, request: dict):
+        """Note the request's system prefix; schedule a save if it is new."""
+        prefix = system_prefix(request)
+        if not prefix:
+            return
+        digest = prefix_digest(prefix, self.model)
+        if digest == self.saved_digest:
+            self.requests_on_saved_prefix += 1
+            return
+        self._seen[digest] = self._seen.get(digest, 0) + 1
+        if len(self._seen) > 64:  # one-off prompts — keep the counter small
+            self._seen = {digest: self._seen[digest]}
+        if self._seen[digest] >= self.min_seen and (self._task is None or self._task.done()):
+            self._task = asyncio.get_running_loop().create_task(self._save(prefix, digest))
+
+    async def _wait_idle(self) -> bool:
+        deadline = time.time() + IDLE_WAIT_S
+        while self.client.active or self.client.waiting:
+            if time.time() > deadline:
+                return False
+            await asyncio.sleep(0.5)
+        return True
+
+    async def _save(self, prefix: list, digest: str):
+        if not await self._wait_idle():
+            return
+        t0 = time.time()
+        filename = f"holly-prefix-{digest[:16]}.bin"
+        try:
+            status, body = await self.client.call("/apply-template", {"messages": prefix})
+            if status != 200 or not isinstance(body, dict) or not body.get("prompt"):
+                raise RuntimeError(f"apply-template {status}: {str(body)[:300]}")
+            prompt = body["prompt"]
+            if self.slot_files_supported is None:
+                await self._probe_slot_files()
+            saved = None
+            if self.slot_files_supported:
+                async with self.client.slot():
+                    status, body = await self.client.call("/completion", {
+                        "prompt": prompt, "n_predict": 1, "cache_prompt": True,
+                        "id_slot": SLOT_ID})
+                    if status != 200:
+                        raise RuntimeError(f"warm {status}: {str(body)[:300]}")
+                    n_tokens = int((body.get("timings") or {}).get("prompt_n") or 0) + \
+                        int((body.get("timings") or {}).get("cache_n") or 0)
+                    status, saved = await self.client.call(
+                        f"/slots/{SLOT_ID}?action=save", {"filename": filename})
+                    if status != 200:
+                        self._note_slot_error(status, saved, "save")
+                        saved = None
+            else:
+                # No slot file to write: warming slot 0 now would only evict
+                # the KV of the conversation it holds (v40 runs --parallel 1).
+                # The manifest is enough for restore() to warm it at boot.
+                n_tokens = await self.client.tokenize(prompt)
+        except Exception as e:
+            self.save_errors += 1
+            self.last_error = str(e)[:300]
+            print(f"[{self.label}] ⚠️ prefix save failed: {self.last_error}", flush=True)
+            return
+        old = self.manifest.get("file") if self.manifest else None
+        self._write_manifest({
+            "digest": digest,
+            "model": self.model,
+            "file": filename if saved else None,
+            "n_tokens": n_tokens,
+            "saved_at": time.time(),
+            "messages": prefix,
+        })
+        if old and old != filename:
+            try:
+                os.remove(os.path.join(self.save_dir, old))
+            except OSError:
+                pass
+        if self.commit is not None:
+            await asyncio.to_thread(self.commit)
+        self.saves += 1
+        self._seen.pop(digest, None)
+        print(f"[{self.label}] 💾 prefix cache saved: {n_tokens} tokens"
+              f"{'' if saved else ' (manifest only — slot files unsupported)'} "
+              f"in {time.time() - t0:.1f}s", flush=True)
+
+    def stats(self) -> dict:
+        return {
+            "saved_prefix": self.saved_digest[:16] if self.saved_digest else None,
+            "saved_tokens": self.manifest.get("n_tokens") if self.manifest else None,
+            "slot_files_supported": self.slot_files_supported,
+            "restored_tokens": self.restored_tokens,
+            "restore_ms": self.restore_ms,
+            "boot_warm_ms": self.boot_warm_ms,
+            "saves": self.saves,
+            "save_errors": self.save_errors,
+            "requests_on_saved_prefix": self.requests_on_saved_prefix,
+            "last_error": self.last_error,
+        }
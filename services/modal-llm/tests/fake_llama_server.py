@@ -0,0 +1,231 @@
+"""Stand-in llama-server for the modal-llm tests.
+
+FakeLlama serves the endpoints the proxy, prefix cache and supervisor talk
+to, in-process (tests set its attributes to script a run) or as a
+subprocess (main(), for test_llama_supervisor.py):
+
+  GET  /health              503 while "loading", then 200
+  GET  /metrics             Prometheus text, --metrics names
+  POST /v1/chat/completions JSON after gen_s, or with "stream": true an SSE
+                            stream of `chunks` chunks chunk_s apart, the
+                            last one carrying "timings", then [DONE]
+       /v1/completions      same
+  POST /tokenize            one token per whitespace-separated word
+  POST /apply-template      the system message rendered ChatML-style
+  POST /completion          the warm: n_predict 1, "timings"
+  POST /slots/0?action=save|restore   501 "not supported" unless slot_files
+
+Scripting (in-process attributes):
+
+  fail_status     answer every generation with this status and an
+                  OpenAI-style error body
+  stream_script   "ok" | "abort" (close the socket mid-stream, no final
+                  chunk) | "stall" (stop writing after the first chunk)
+  calls           [(path, body)] of every POST
+  in_flight / max_in_flight   concurrent generations
+  disconnected    set when a stream write fails — the client went away
+
+Subprocess flags script the supervisor's failure modes:
+
+  --load-s S          seconds of "loading" before ready
+  --silent-ready      don't log the ready line (readiness via /health only)
+  --fail-load         log a load error and exit 1 instead of serving
+  --crash-after S     exit 134 S seconds after ready…
+  --crash-marker P    …only if file P doesn't exist yet (created on crash),
+                      so the relaunched process stays up
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS = """\
+# HELP llamacpp:prompt_tokens_total Number of prompt tokens processed.
+# TYPE llamacpp:prompt_tokens_total counter
+llamacpp:prompt_tokens_total 1200
+llamacpp:prompt_seconds_total 0.8
+llamacpp:tokens_predicted_total 300
+llamacpp:tokens_predicted_seconds_total 10
+llamacpp:n_decode_total 310
+llamacpp:prompt_tokens_seconds 1500
+llamacpp:predicted_tokens_seconds 30
+llamacpp:kv_cache_usage_ratio 0.25
+llamacpp:kv_cache_tokens 2048
+llamacpp:requests_processing 1
+llamacpp:requests_deferred 2
+"""
+TIMINGS = {"prompt_n": 12, "cache_n": 30}
+
+
+def chunk(i: int) -> bytes:
+    delta = {"choices": [{"index": 0, "delta": {"content": f"tok{i} "}}]}
+    return f"data: {json.dumps(delta)}\n\n".encode()
+
+
+class FakeLlama:
+    def __init__(self, port: int = 0, loaded: bool = True):
+        self.loaded = threading.Event()
+        if loaded:
+            self.loaded.set()
+        self.slot_files = True
+        self.gen_s = 0.0
+        self.chunks = 5
+        self.chunk_s = 0.01
+        self.fail_status = None
+        self.stream_script = "ok"
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.disconnected = threading.Event()
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _generating(self, delta: int):
+        with self._lock:
+            self.in_flight += delta
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *a):
+                pass
+
+            def _send(self, status, body, ctype="application/json"):
+                raw = body if isinstance(body, bytes) else json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+            def do_GET(self):
+                if self.path == "/health":
+                    if fake.loaded.is_set():
+                        return self._send(200, {"status": "ok"})
+                    return self._send(503, {"error": {"message": "Loading model"}})
+                if self.path == "/metrics":
+                    return self._send(200, METRICS.encode(), "text/plain; version=0.0.4")
+                self._send(404, {})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])) or b"{}")
+                with fake._lock:
+                    fake.calls.append((self.path, body))
+                if self.path in ("/v1/chat/completions", "/v1/completions"):
+                    return self._generate(body)
+                if self.path == "/tokenize":
+                    return self._send(200, {"tokens": list(range(len(body["content"].split())))})
+                if self.path == "/apply-template":
+                    content = body["messages"][0]["content"]
+                    return self._send(200, {"prompt": f"<|im_start|>system\n{content}<|im_end|>\n"})
+                if self.path == "/completion":
+                    return self._send(200, {"content": "", "timings": {"prompt_n": 12, "cache_n": 0}})
+                if self.path.startswith("/slots/0"):
+                    if not fake.slot_files:
+                        return self._send(501, {"error": {
+                            "message": "This feature is not supported by multimodal"}})
+                    return self._send(200, {"filename": body["filename"], "n_saved": 12,
+                                            "n_restored": 12})
+                self._send(404, {"error": "not found"})
+
+            def _generate(self, body):
+                if fake.fail_status:
+                    return self._send(fake.fail_status, {"error": {
+                        "code": fake.fail_status, "type": "invalid_request_error",
+                        "message": "the request exceeds the available context size"}})
+                fake._generating(+1)
+                try:
+                    if body.get("stream"):
+                        return self._stream()
+                    time.sleep(fake.gen_s)
+                    self._send(200, {"choices": [{"index": 0, "message": {
+                        "role": "assistant", "content": "hello"}}], "timings": TIMINGS})
+                finally:
+                    fake._generating(-1)
+
+            def _write_chunk(self, data: bytes):
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            def _stream(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    for i in range(fake.chunks):
+                        self._write_chunk(chunk(i))
+                        if fake.stream_script == "abort" and i == 1:
+                            self.close_connection = True
+                            return
+                        if fake.stream_script == "stall":
+                            time.sleep(3600 if i == 0 else 0)
+                        time.sleep(fake.chunk_s)
+                    final = {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                             "timings": TIMINGS}
+                    self._write_chunk(f"data: {json.dumps(final)}\n\n".encode())
+                    self._write_chunk(b"data: [DONE]\n\n")
+                    self._write_chunk(b"")
+                except OSError:
+                    fake.disconnected.set()
+                    self.close_connection = True
+
+        return Handler
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, required=True)
+    ap.add_argument("--load-s", type=float, default=0.2)
+    ap.add_argument("--silent-ready", action="store_true")
+    ap.add_argument("--fail-load", action="store_true")
+    ap.add_argument("--crash-after", type=float)
+    ap.add_argument("--crash-marker")
+    args = ap.parse_args()
+
+    print("build: 0000 (fake) with cc for x86_64-linux-gnu", flush=True)
+    fake = FakeLlama(args.port, loaded=False).start()
+    print(f"main: HTTP server is listening, hostname: 127.0.0.1, port: {args.port}", flush=True)
+    print("main: loading model", flush=True)
+    time.sleep(args.load_s)
+    if args.fail_load:
+        print("llama_model_load: error loading model: fake failure", flush=True)
+        print("main: exiting due to model loading error", flush=True)
+        os._exit(1)
+    fake.loaded.set()
+    print("main: model loaded", flush=True)
+    if not args.silent_ready:
+        print(f"main: server is listening on http://127.0.0.1:{args.port} - starting the main loop",
+              flush=True)
+        print("srv  update_slots: all slots are idle", flush=True)
+
+    if args.crash_after is not None and not (args.crash_marker and os.path.exists(args.crash_marker)):
+        time.sleep(args.crash_after)
+        if args.crash_marker:
+            open(args.crash_marker, "w").close()
+        print("CUDA error: out of memory", flush=True)
+        os._exit(134)
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""ContextBudget keeps the system prompt and recent turns, condenses / drops
+the oldest ones, and reuses a conversation's cut so the prompt prefix stays
+stable across turns.
+
+Runs locally: context_budget is stdlib-only; a fake client stands in for
+llama-server's /tokenize (one token per word). The 413 check needs fastapi.
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context_budget import MESSAGE_OVERHEAD_TOKENS, ContextBudget, condense_text, split_turns  # noqa: E402
+
+
+class WordTokenizer:
+    def __init__(self):
+        self.calls = 0
+
+    async def tokenize(self, text):
+        self.calls += 1
+        return len(text.split())
+
+
+def conversation(n_turns, words=100):
+    msgs = [{"role": "system", "content": "persona " * 50}]
+    for i in range(n_turns):
+        msgs.append({"role": "user", "content": f"question {i}. " + "word " * words})
+        msgs.append({"role": "assistant", "content": f"answer {i}. " + "reply " * words})
+    return msgs
+
+
+def fit(budget, messages, **extra):
+    return asyncio.run(budget.fit({"messages": messages, "max_tokens": 100, **extra}))
+
+
+def test_under_budget_untouched_and_counts_cached():
+    client = WordTokenizer()
+    budget = ContextBudget(client, input_budget=10_000, context_size=32_000)
+    msgs = conversation(3)
+    request, headers = fit(budget, msgs)
+    assert request["messages"] is msgs
+    calls = client.calls
+    fit(budget, msgs + [{"role": "user", "content": "next"}])
+    assert client.calls == calls + 1  # only the new message is tokenized
+    assert int(headers["X-Context-Tokens"]) == sum(
+        len(m["content"].split()) + MESSAGE_OVERHEAD_TOKENS for m in msgs)
+
+
+def test_over_budget_keeps_system_and_recent_turns():
+    budget = ContextBudget(WordTokenizer(), input_budget=1500, context_size=32_000,
+                           keep_recent_turns=2)
+    msgs = conversation(12)
+    request, headers = fit(budget, msgs)
+    kept = request["messages"]
+    assert kept[0] == msgs[0]
+    assert kept[-4:] == msgs[-4:]  # last 2 turns verbatim
+    assert int(headers["X-Context-Tokens"]) <= 1500 * budget.low_water
+    assert int(headers["X-Context-Original-Tokens"]) > 1500
+    condensed = int(headers["X-Context-Condensed-Turns"])
+    dropped = int(headers["X-Context-Dropped-Turns"])
+    assert condensed + dropped > 0
+    assert len(split_turns(kept)[1]) == 12 - dropped
+
+
+def test_cut_reused_so_prefix_is_stable():
+    budget = ContextBudget(WordTokenizer(), input_budget=3000, context_size=32_000,
+                           keep_recent_turns=2)
+    msgs = conversation(14)
+    first, _ = fit(budget, msgs)
+    grown = msgs + [{"role": "user", "content": "one more"},
+                    {"role": "assistant", "content": "sure"}]
+    second, _ = fit(budget, grown)
+    prefix = first["messages"]
+    assert second["messages"][:len(prefix)] == prefix
+
+
+def test_latest_turn_too_large_is_rejected():
+    HTTPException = pytest.importorskip("fastapi").HTTPException
+    budget = ContextBudget(WordTokenizer(), input_budget=500, context_size=32_000)
+    msgs = conversation(1) + [{"role": "user", "content": "huge " * 1000}]
+    with pytest.raises(HTTPException) as e:
+        fit(budget, msgs)
+    assert e.value.status_code == 413
+    assert e.value.detail["type"] == "context_budget_exceeded"
+
+
+def test_condense_text_cuts_at_sentence():
+    text = "First sentence here. " * 30
+    out = condense_text(text, limit=100)
+    assert len(out) <= 102 and out.endswith("here. …")
+
+
+def test_shared_opener_does_not_share_cut():
+    def make():
+        return ContextBudget(WordTokenizer(), input_budget=3000, context_size=32_000,
+                             keep_recent_turns=2)
+
+    long = conversation(14, words=300)
+    # Same system prompt and first question, then a different, lighter chat
+    short = long[:2] + [{"role": "assistant", "content": "a different answer"}]
+    short += conversation(14, words=100)[3:]
+    budget = make()
+    fit(budget, long)
+    reused, reused_headers = fit(budget, short)
+    fresh, fresh_headers = fit(make(), short)
+    assert reused == fresh and reused_headers == fresh_headers
+
+
+def test_cut_recomputed_when_far_under_low_water():
+    def make():
+        return ContextBudget(WordTokenizer(), input_budget=10_000, context_size=5000,
+                             keep_recent_turns=2)
+
+    budget = make()
+    msgs = conversation(24)
+    _, first = fit(budget, msgs, max_tokens=2500)  # limit 2500: a deep cut
+    grown = msgs + [{"role": "user", "content": "one more"},
+                    {"role": "assistant", "content": "sure"}]
+    # limit 4900: the remembered cut still fits, with ~2000 tokens idle
+    reused, headers = fit(budget, grown)
+    fresh, fresh_headers = fit(make(), grown)
+    assert int(first["X-Context-Dropped-Turns"]) > 0
+    assert reused == fresh and headers == fresh_headers
+    assert headers["X-Context-Dropped-Turns"] == "0"
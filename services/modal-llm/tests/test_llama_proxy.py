@@ -0,0 +1,199 @@
+"""LlamaClient admits requests through its slot semaphore, reports queue /
+generation time, passes llama-server's errors through, relays "stream": true
+SSE unchanged (errors after the headers as an in-stream frame), and frees
+the slot and drops the upstream when a stream's client goes away.
+
+Runs locally against tests/fake_llama_server.py (in-process); needs httpx
+and fastapi, as the deployed image does.
+"""
+
+import asyncio
+import gc
+import json
+import os
+import socket
+import sys
+import time
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+pytest.importorskip("httpx")
+HTTPException = pytest.importorskip("fastapi").HTTPException
+
+from fake_llama_server import FakeLlama, chunk  # noqa: E402
+from llama_proxy import RETRY_AFTER_S, LlamaClient  # noqa: E402
+
+CHAT = {"messages": [{"role": "user", "content": "hi"}]}
+
+
+@pytest.fixture
+def fake():
+    server = FakeLlama().start()
+    yield server
+    server.stop()
+
+
+def client_for(fake, **kwargs):
+    return LlamaClient(fake.port, kwargs.pop("slots", 1), label="test", **kwargs)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def released(client, timeout_s=5):
+    deadline = time.time() + timeout_s
+    while client.active and time.time() < deadline:
+        await asyncio.sleep(0.01)
+    return client.active == 0
+
+
+def test_one_slot_queues_concurrent_requests(fake):
+    fake.gen_s = 0.1
+
+    async def main():
+        client = client_for(fake)
+        calls = [asyncio.create_task(client.forward("/v1/chat/completions", CHAT)) for _ in range(4)]
+        await asyncio.sleep(0.05)
+        during = (client.active, client.waiting)
+        results = await asyncio.gather(*calls)
+        await client.aclose()
+        return client, during, results
+
+    client, during, results = run(main())
+    assert during == (1, 3)
+    assert fake.max_in_flight == 1
+    assert all(body["choices"][0]["message"]["content"] == "hello" for body, _ in results)
+    waits = sorted(int(h["X-Queue-Wait-Ms"]) for _, h in results)
+    assert waits[0] < 50 and waits[-1] >= 250  # each waited for the ones before it
+    assert all(int(h["X-Generation-Ms"]) >= 100 for _, h in results)
+    assert (client.active, client.waiting, client.requests) == (0, 0, 4)
+    assert client.prompt_tokens_cached == 4 * 30
+
+
+def test_upstream_error_passed_through(fake):
+    fake.fail_status = 400
+
+    async def main():
+        client = client_for(fake)
+        try:
+            await client.forward("/v1/chat/completions", CHAT)
+        finally:
+            await client.aclose()
+
+    with pytest.raises(HTTPException) as e:
+        run(main())
+    assert e.value.status_code == 400
+    assert e.value.detail == {"error": {"code": 400, "type": "invalid_request_error",
+                                        "message": "the request exceeds the available context size"}}
+    assert "X-Queue-Wait-Ms" in e.value.headers and "X-Generation-Ms" in e.value.headers
+
+
+def test_503_with_retry_after_while_server_down():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]  # nothing listens here
+    client = LlamaClient(port, 1, down=lambda: "llama-server restarting (exit code 134)")
+    with pytest.raises(HTTPException) as e:
+        run(client.forward("/v1/chat/completions", CHAT))
+    assert e.value.status_code == 503
+    assert e.value.headers["Retry-After"] == str(RETRY_AFTER_S)
+    assert e.value.detail["type"] == "unavailable"
+    assert client.active == 0
+
+
+def test_504_on_timeout(fake):
+    fake.gen_s = 1.0
+    client = client_for(fake, timeout=0.2)
+    with pytest.raises(HTTPException) as e:
+        run(client.forward("/v1/chat/completions", CHAT))
+    assert e.value.status_code == 504 and e.value.detail["type"] == "timeout"
+    assert client.active == 0
+
+
+def test_cancelled_stream_releases_slot_and_closes_upstream(fake):
+    fake.chunks, fake.chunk_s = 500, 0.01
+
+    async def main():
+        client = client_for(fake)
+        response = await client.stream_response("/v1/chat/completions", {**CHAT, "stream": True})
+        assert client.active == 1
+        relay = response.body_iterator
+        await relay.__anext__()
+        await relay.aclose()  # what Starlette's cancellation does to the generator
+        return client
+
+    client = run(main())
+    assert client.active == 0 and client.disconnects == 1
+    assert fake.disconnected.wait(5)
+
+
+def test_never_started_stream_released_on_gc(fake):
+    fake.chunks, fake.chunk_s = 500, 0.01
+
+    async def main():
+        client = client_for(fake)
+        response = await client.stream_response("/v1/chat/completions", {**CHAT, "stream": True})
+        assert client.active == 1
+        del response  # the client left before the body was iterated
+        gc.collect()
+        assert await released(client)
+        await asyncio.sleep(0.1)  # let the scheduled aclose() run
+        return client
+
+    client = run(main())
+    assert client.active == 0
+    assert fake.disconnected.wait(5)
+
+
+# ── SSE relay ──────────────────────────────────────────────────────────
+
+async def stream_body(fake, **kwargs):
+    client = client_for(fake, **kwargs)
+    response = await client.stream_response("/v1/chat/completions", {**CHAT, "stream": True})
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    await client.aclose()
+    return client, response, body
+
+
+def test_stream_relayed_unchanged_to_done(fake):
+    client, response, body = run(stream_body(fake))
+    assert response.media_type == "text/event-stream"
+    assert response.headers["cache-control"] == "no-cache"
+    assert "x-queue-wait-ms" in response.headers and "x-generation-ms" not in response.headers
+    frames = body.split(b"\n\n")
+    assert frames[:5] == [chunk(i).rstrip(b"\n") for i in range(5)]
+    assert frames[-2:] == [b"data: [DONE]", b""]
+    assert client.active == 0 and client.streams == 1 and client.disconnects == 0
+    assert client.prompt_tokens_cached == 30  # timings from the final chunk
+    assert fake.calls[-1][1]["stream"] is True
+
+
+def test_stream_error_status_before_headers(fake):
+    fake.fail_status = 400
+    with pytest.raises(HTTPException) as e:
+        run(stream_body(fake))
+    assert e.value.status_code == 400
+    assert e.value.detail["error"]["type"] == "invalid_request_error"
+
+
+def test_upstream_failure_mid_stream_becomes_error_frame(fake):
+    fake.stream_script = "abort"
+    client, _, body = run(stream_body(fake))
+    frames = [f for f in body.split(b"\n\n") if f]
+    assert frames[:2] == [chunk(0).rstrip(b"\n"), chunk(1).rstrip(b"\n")]
+    error = json.loads(frames[-1][len(b"data: "):])["error"]
+    assert error["type"] == "internal_error"
+    assert client.active == 0
+
+
+def test_stalled_stream_times_out_in_band(fake):
+    fake.stream_script = "stall"
+    client, _, body = run(stream_body(fake, timeout=0.3))
+    error = json.loads(body.split(b"\n\n")[-2][len(b"data: "):])["error"]
+    assert error["type"] == "timeout"
+    assert client.active == 0
@@ -0,0 +1,118 @@
+"""LlamaSupervisor launches llama-server, reads readiness from its log (or
+/health), restarts it with backoff after a crash, and summarize_metrics
+reports its /metrics.
+
+Runs locally against tests/fake_llama_server.py, a subprocess that logs and
+answers /health and /metrics like llama-server.
+"""
+
+import os
+import socket
+import sys
+import time
+import urllib.request
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from llama_proxy import parse_metrics  # noqa: E402
+from llama_supervisor import LlamaSupervisor, summarize_metrics  # noqa: E402
+
+FAKE = os.path.join(HERE, "fake_llama_server.py")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def supervisor():
+    started = []
+
+    def make(*flags, **kwargs):
+        port = free_port()
+        sup = LlamaSupervisor([sys.executable, FAKE, "--port", str(port), *flags], port,
+                              label="test", ready_timeout_s=kwargs.pop("ready_timeout_s", 15),
+                              backoff_s=(0.2,), **kwargs)
+        started.append(sup)
+        return sup
+
+    yield make
+    for sup in started:
+        sup.stop(grace_s=2)
+
+
+def wait_for(predicate, timeout_s=15):
+    deadline = time.time() + timeout_s
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_ready_from_log_and_metrics(supervisor):
+    sup = supervisor()
+    sup.start()
+    assert sup.alive and sup.ready_source == "log" and sup.down_reason() is None
+    with urllib.request.urlopen(f"http://127.0.0.1:{sup.port}/metrics") as r:
+        summary = summarize_metrics(parse_metrics(r.read().decode()))
+    assert summary["available"]
+    assert summary["generation_tokens_per_s"] == 30
+    assert summary["prompt_eval_s_total"] == 0.8
+    assert summary["kv_cache_usage_ratio"] == 0.25
+    assert summary["requests_deferred"] == 2
+
+
+def test_ready_from_health_when_log_is_silent(supervisor):
+    sup = supervisor("--silent-ready")
+    sup.start()
+    assert sup.alive and sup.ready_source == "health"
+
+
+def test_crash_restarts_with_backoff(supervisor, tmp_path):
+    restored = []
+    sup = supervisor("--crash-after", "0.3", "--crash-marker", str(tmp_path / "crashed"))
+    sup.on_restart.append(lambda: restored.append(sup.proc.pid))
+    sup.start()
+    first_pid = sup.proc.pid
+    assert wait_for(lambda: sup.state != "ready")
+    assert sup.down_reason() is not None
+    assert wait_for(lambda: sup.restarts == 1 and restored)
+    assert sup.alive and sup.proc.pid != first_pid
+    assert sup.last_exit_code == 134
+    assert "out of memory" in sup.last_error
+    assert restored == [sup.proc.pid]
+
+
+def test_exit_during_startup_fails_fast(supervisor):
+    sup = supervisor("--fail-load", ready_timeout_s=60)
+    t0 = time.time()
+    with pytest.raises(RuntimeError, match="exited with code 1"):
+        sup.start()
+    assert time.time() - t0 < 10
+    assert sup.state == "failed" and "model loading error" in sup.last_error
+
+
+def test_stop_does_not_restart(supervisor):
+    sup = supervisor()
+    sup.start()
+    proc = sup.proc
+    sup.stop(grace_s=2)
+    assert proc.poll() is not None
+    time.sleep(0.5)
+    assert sup.proc is proc and sup.state == "stopped" and sup.restarts == 0
+
+
+def test_summary_falls_back_to_counters():
+    raw = {"tokens_predicted_total": 200.0, "tokens_predicted_seconds_total": 8.0,
+           "prompt_tokens_total": 900.0, "prompt_seconds_total": 0.5}
+    summary = summarize_metrics(raw)
+    assert summary["generation_tokens_per_s"] == 25
+    assert summary["prompt_tokens_per_s"] == 1800
+    assert summary["kv_cache_usage_ratio"] is None
+    assert summarize_metrics({})["available"] is False
@@ -0,0 +1,109 @@
+"""PrefixCache saves a repeated system prefix and restores it on the next boot,
+falling back to re-warming when llama-server refuses slot files.
+
+Runs locally against tests/fake_llama_server.py (/apply-template, /tokenize,
+/completion, /slots/0?action=save|restore).
+"""
+
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import urllib.request
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from fake_llama_server import FakeLlama  # noqa: E402
+from prefix_cache import PrefixCache  # noqa: E402
+
+SYSTEM = [{"role": "system", "content": "You are Holly."}]
+
+
+class SyncClient:
+    """The slice of llama_proxy.LlamaClient PrefixCache uses, over urllib."""
+
+    active = 0
+    waiting = 0
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        yield
+
+    async def call(self, path, body=None, method="POST"):
+        req = urllib.request.Request(self.base_url + path, data=json.dumps(body).encode(),
+                                     headers={"Content-Type": "application/json"}, method=method)
+        try:
+            with urllib.request.urlopen(req) as resp:
+                return resp.status, json.loads(resp.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    async def tokenize(self, text):
+        _status, body = await self.call("/tokenize", {"content": text})
+        return len(body["tokens"])
+
+
+@pytest.fixture
+def fake_llama():
+    fake = FakeLlama().start()
+    yield fake
+    fake.stop()
+
+
+async def _observe_twice(cache, request):
+    for _ in range(2):
+        cache.observe(request)
+    await cache._task
+
+
+def test_repeated_prefix_saved_then_restored(fake_llama, tmp_path):
+    commits = []
+    cache = PrefixCache(SyncClient(fake_llama.url), str(tmp_path), "model.gguf", commit=lambda: commits.append(1))
+    request = {"messages": SYSTEM + [{"role": "user", "content": "hi"}]}
+    assert cache.prepare(request)["cache_prompt"] is True
+    asyncio.run(_observe_twice(cache, request))
+    assert cache.saves == 1 and commits == [1]
+    manifest = json.loads((tmp_path / "prefix-manifest.json").read_text())
+    assert manifest["messages"] == SYSTEM and manifest["file"].startswith("holly-prefix-")
+
+    # Next container: restore the slot file before traffic
+    booted = PrefixCache(SyncClient(fake_llama.url), str(tmp_path), "model.gguf")
+    open(tmp_path / manifest["file"], "wb").close()  # llama-server would have written it
+    assert booted.restore()
+    assert booted.restored_tokens == 12
+    assert fake_llama.calls[-1][0] == "/slots/0?action=restore"
+
+    # Same prefix again: counted as a hit, nothing re-saved
+    booted.observe(request)
+    assert booted.requests_on_saved_prefix == 1 and booted._task is None
+
+
+def test_unsupported_slot_files_fall_back_to_boot_warm(fake_llama, tmp_path):
+    fake_llama.slot_files = False
+    cache = PrefixCache(SyncClient(fake_llama.url), str(tmp_path), "model.gguf")
+    asyncio.run(_observe_twice(cache, {"messages": SYSTEM}))
+    assert cache.slot_files_supported is False
+    assert cache.manifest["file"] is None  # manifest only
+    assert cache.manifest["n_tokens"] == 4  # /tokenize of the rendered template, one per word
+    # The probe found out first — slot 0 was never overwritten by a warm
+    paths = [path for path, _ in fake_llama.calls]
+    assert "/completion" not in paths and paths.count("/slots/0?action=save") == 1
+
+    booted = PrefixCache(SyncClient(fake_llama.url), str(tmp_path), "model.gguf")
+    assert booted.restore()
+    assert booted.boot_warm_ms is not None
+    assert [path for path, _ in fake_llama.calls[-2:]] == ["/apply-template", "/completion"]
+
+
+def test_manifest_for_another_model_ignored(fake_llama, tmp_path):
+    cache = PrefixCache(SyncClient(fake_llama.url), str(tmp_path), "model.gguf")
+    asyncio.run(_observe_twice(cache, {"messages": SYSTEM}))
+    assert PrefixCache(SyncClient(fake_llama.url), str(tmp_path), "other.gguf").manifest is None
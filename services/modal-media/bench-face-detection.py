@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Micro-benchmark: legacy full-res Haar face detection vs face_detector.FaceDetector.
+
+Runs locally (no Modal). Needs opencv-python-headless<5 + numpy (+ Pillow for
+image paths):
+
+    python services/modal-media/bench-face-detection.py                 # synthetic 1024/1280/1536px
+    python services/modal-media/bench-face-detection.py a.png b.png     # real Klein outputs
+
+Reports CPU ms per detection (process time, median of --repeat runs) for the
+old per-call path (cascades re-read from XML + up to 7 full-resolution sweeps)
+and the new one (cascades loaded once + bounded pyramid), and whether both
+return the same face.
+"""
+
+import argparse
+import statistics
+import time
+
+from face_detector import DetectionFrame, FaceDetector
+
+
+def legacy_detect(rgb):
+    """The pre-face_detector _detect_face_bbox, verbatim (a100 lines 650-689)."""
+    import cv2
+
+    gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
+    gray = cv2.equalizeHist(gray)
+
+    frontal = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+    profile = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_profileface.xml")
+
+    min_size = (60, 60)
+    faces = []
+    for sf in (1.05, 1.1, 1.2):
+        found = frontal.detectMultiScale(gray, scaleFactor=sf, minNeighbors=5, minSize=min_size)
+        if len(found):
+            faces.extend(found)
+
+    if not faces:
+        for sf in (1.05, 1.1):
+            found = profile.detectMultiScale(gray, scaleFactor=sf, minNeighbors=5, minSize=min_size)
+            if len(found):
+                faces.extend(found)
+            flipped = cv2.flip(gray, 1)
+            found_r = profile.detectMultiScale(flipped, scaleFactor=sf, minNeighbors=5, minSize=min_size)
+            if len(found_r):
+                w_img = gray.shape[1]
+                for (x, y, w, h) in found_r:
+                    faces.append((w_img - x - w, y, w, h))
+
+    if not faces:
+        return None
+    best = max(faces, key=lambda f: f[2] * f[3])
+    return tuple(int(v) for v in best)
+
+
+def synthetic_images():
+    """Portrait-ish test frames: smooth gradient + noise + a skin-tone head blob."""
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    images = []
+    for side in (1024, 1280, 1536):
+        h, w = side, int(side * 0.75)
+        yy, xx = np.mgrid[0:h, 0:w]
+        base = np.stack([(xx * 255 // w), (yy * 255 // h), np.full_like(xx, 128)], axis=-1)
+        img = (base + rng.normal(0, 12, (h, w, 3))).clip(0, 255).astype(np.uint8)
+        cx, cy, r = w // 2, h // 3, side // 10
+        cv2.ellipse(img, (cx, cy), (r, int(r * 1.3)), 0, 0, 360, (224, 172, 150), -1)
+        for dx in (-r // 3, r // 3):
+            cv2.circle(img, (cx + dx, cy - r // 4), r // 10, (40, 30, 30), -1)
+        cv2.ellipse(img, (cx, cy + r // 2), (r // 3, r // 10), 0, 0, 180, (120, 60, 60), -1)
+        images.append((f"synthetic {w}x{h}", img))
+    return images
+
+
+def load_images(paths):
+    import numpy as np
+    from PIL import Image
+
+    return [(p, np.asarray(Image.open(p).convert("RGB"))) for p in paths]
+
+
+def cpu_ms(fn, repeat):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        t0 = time.process_time()
+        result = fn()
+        samples.append((time.process_time() - t0) * 1000)
+    return statistics.median(samples), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("images", nargs="*", help="image files (default: synthetic 1024-1536px frames)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    images = load_images(args.images) if args.images else synthetic_images()
+
+    t0 = time.process_time()
+    detector = FaceDetector()
+    load_ms = (time.process_time() - t0) * 1000
+    print(f"FaceDetector() cascade load (once per container): {load_ms:.1f} ms CPU\n")
+
+    print(f"{'image':<28} {'legacy ms':>10} {'new ms':>8} {'saved ms':>9}  boxes")
+    total_old = total_new = 0.0
+    for name, rgb in images:
+        old_ms, old_box = cpu_ms(lambda: legacy_detect(rgb), args.repeat)
+        # Fresh frame each run — the gray/pyramid build is part of the cost.
+        new_ms, new_box = cpu_ms(lambda: detector.detect(DetectionFrame(rgb)), args.repeat)
+        total_old += old_ms
+        total_new += new_ms
+        print(f"{name[-28:]:<28} {old_ms:>10.1f} {new_ms:>8.1f} {old_ms - new_ms:>9.1f}  {old_box} → {new_box}")
+
+    n = len(images)
+    print(f"\nmean per request: legacy {total_old / n:.1f} ms, new {total_new / n:.1f} ms "
+          f"({(1 - total_new / total_old) * 100 if total_old else 0:.0f}% less CPU)")
+
+
+if __name__ == "__main__":
+    main()
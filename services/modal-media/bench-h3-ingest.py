@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Micro-benchmark: legacy H3 input ingestion vs media_inputs single-pass decode.
+
+Runs locally (no Modal, no ComfyUI). Needs Pillow for the legacy path and to
+build the synthetic frames:
+
+    python services/modal-media/bench-h3-ingest.py                  # synthetic R2V request
+    python services/modal-media/bench-h3-ingest.py a.png b.jpg      # real reference images
+
+One "request" is what h3-animate-ref does before queueing the workflow:
+size detection for the first image, then hash + write of every reference
+(up to 3) into an input dir. Reports wall ms per request (median of
+--repeat runs) and peak Python heap from tracemalloc for:
+
+  legacy   b64decode + PIL.Image.open for _auto_dims, then b64decode +
+           sha256 + write again per image (the pre-media_inputs code)
+  new      media_inputs.decode_images (one decode, header sniff) + write
+"""
+
+import argparse
+import base64
+import hashlib
+import io
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from media_inputs import decode_images
+
+
+def legacy_ingest(refs, input_dir):
+    """_auto_dims + _save_input_image before media_inputs, minus input_cache."""
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(base64.b64decode(refs[0]))) as img:
+            w, h = img.size
+    except Exception:
+        w, h = 864, 480
+    names = []
+    for b64 in refs:
+        data = base64.b64decode(b64)
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(input_dir, f"h3_ref_{digest[:16]}.png")
+        with open(path, "wb") as f:
+            f.write(data)
+        names.append(path)
+    return (w, h), names
+
+
+def new_ingest(refs, input_dir):
+    images = decode_images(refs)
+    names = []
+    for img in images:
+        path = os.path.join(input_dir, f"h3_ref_{img.digest[:16]}{img.ext}")
+        with open(path, "wb") as f:
+            f.write(img.data)
+        names.append(path)
+    return images[0].size, names
+
+
+def synthetic_refs():
+    """Three noisy portrait frames (PNG compresses noise poorly → realistic sizes)."""
+    from PIL import Image
+
+    refs = []
+    for i, (w, h) in enumerate(((864, 1280), (1024, 1024), (1280, 720))):
+        img = Image.effect_noise((w, h), 40 + i * 10).convert("RGB")
+        buf = io.BytesIO()
+        img.save(buf, format="PNG")
+        refs.append((f"synthetic {w}x{h}", base64.b64encode(buf.getvalue()).decode("ascii")))
+    return refs
+
+
+def load_refs(paths):
+    refs = []
+    for p in paths[:3]:
+        with open(p, "rb") as f:
+            refs.append((p, base64.b64encode(f.read()).decode("ascii")))
+    return refs
+
+
+def measure(fn, refs, input_dir, repeat):
+    samples = []
+    peak = 0
+    result = None
+    for _ in range(repeat):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        result = fn(refs, input_dir)
+        samples.append((time.perf_counter() - t0) * 1000)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return statistics.median(samples), peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("images", nargs="*", help="up to 3 image files (default: synthetic frames)")
+    parser.add_argument("--repeat", type=int, default=7)
+    args = parser.parse_args()
+
+    named = load_refs(args.images) if args.images else synthetic_refs()
+    refs = [b64 for _name, b64 in named]
+    for name, b64 in named:
+        print(f"  {name[-40:]:<40} {len(b64) * 3 // 4 / 1024**2:6.2f} MB")
+    print()
+
+    with tempfile.TemporaryDirectory(prefix="bench_h3_ingest_") as input_dir:
+        old_ms, old_peak, (old_dims, _) = measure(legacy_ingest, refs, input_dir, args.repeat)
+        new_ms, new_peak, (new_dims, _) = measure(new_ingest, refs, input_dir, args.repeat)
+
+    print(f"{'path':<8} {'ms/request':>11} {'peak heap MB':>13}  dims")
+    print(f"{'legacy':<8} {old_ms:>11.1f} {old_peak / 1024**2:>13.1f}  {old_dims}")
+    print(f"{'new':<8} {new_ms:>11.1f} {new_peak / 1024**2:>13.1f}  {new_dims}")
+    print(f"\nsaved {old_ms - new_ms:.1f} ms/request "
+          f"({(1 - new_ms / old_ms) * 100 if old_ms else 0:.0f}%), dims match: {old_dims == new_dims}")
+
+
+if __name__ == "__main__":
+    main()
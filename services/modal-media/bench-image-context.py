@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""Micro-benchmark: legacy Klein PIL pipeline vs image_context.ImageContext.
+
+Runs locally (no Modal, no ComfyUI — the refined crops ComfyUI would return
+are pre-rendered). Needs numpy + Pillow + opencv-python-headless<5:
+
+    python services/modal-media/bench-image-context.py              # synthetic 1536x1536, 5 regions
+    python services/modal-media/bench-image-context.py a.png        # a real Klein output
+    python services/modal-media/bench-image-context.py --regions 3
+
+One "request" is the image handling of a Klein generate with
+enhance_details: QA decode (_check_image_quality), detection buffers, one
+crop → refined-crop composite per region (face, 2 hands, 2 feet), then the
+PNG that goes out. Reports, per pipeline:
+
+  decodes   full-frame PNG decodes (Image.open of the generated image)
+  CPU ms    process time, median of --repeat runs
+  peak MB   VmHWM growth over the run, each pipeline in its own process so
+            one's high-water mark can't hide the other's
+
+  legacy   the pre-ImageContext code: decode for QA, decode again for the
+           refinement pass + DetectionFrame.from_pil, convert("RGB").copy()
+           of the whole frame per region, PIL paste, PNG encode at level 6
+  new      ImageContext.from_bytes once, shared for QA / detection /
+           crops, composite() in place, encode() once
+"""
+
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from face_detector import DetectionFrame
+from image_context import ImageContext
+
+REFINE_SIZE = 768
+FEATHER_RATIO = 0.18
+
+
+class DecodeCounter:
+    """Counts Image.open calls on the generated frame's bytes."""
+
+    def __init__(self, frame_bytes):
+        from PIL import Image
+
+        self.count = 0
+        self._size = len(frame_bytes)
+        self._open = Image.open
+
+        def counting_open(fp, *args, **kwargs):
+            if isinstance(fp, io.BytesIO) and len(fp.getbuffer()) == self._size:
+                self.count += 1
+            return self._open(fp, *args, **kwargs)
+
+        Image.open = counting_open
+
+
+def paste_alpha(side):
+    """_build_paste_alpha, verbatim."""
+    import cv2
+    import numpy as np
+
+    feather = max(8, int(side * FEATHER_RATIO))
+    mask = np.zeros((side, side), dtype=np.uint8)
+    cv2.rectangle(mask, (feather, feather), (side - feather, side - feather), 255, thickness=-1)
+    dist = cv2.distanceTransform(mask, cv2.DIST_L2, 3)
+    alpha = (dist.clip(0, feather) / feather * 255).astype(np.uint8)
+    return cv2.GaussianBlur(alpha, (feather * 2 + 1, feather * 2 + 1), feather / 3)
+
+
+def match_skin_tone(src, enh):
+    import numpy as np
+
+    src = np.asarray(src, dtype=np.float32)
+    enh = np.asarray(enh, dtype=np.float32)
+    return (enh + (src.mean(axis=(0, 1)) - enh.mean(axis=(0, 1))) * 0.5).clip(0, 255).astype(np.uint8)
+
+
+def legacy_request(frame_bytes, boxes, refined):
+    """_check_image_quality + generate's refinement block + _refine_region
+    before image_context (baseline comfyui_klein.py)."""
+    import numpy as np
+    from PIL import Image
+
+    # QA: _check_image_quality decodes, MediaPipe gets an RGB array
+    qa_img = Image.open(io.BytesIO(frame_bytes)).convert("RGB")
+    np.array(qa_img)
+
+    # generate(): decode again for the refinement pass; one frame for both detectors
+    pil_img = Image.open(io.BytesIO(frame_bytes)).convert("RGB")
+    DetectionFrame.from_pil(pil_img).gray
+
+    refined_img = pil_img
+    for (x0, y0, side), refined_bytes in zip(boxes, refined):
+        crop_orig = refined_img.convert("RGB").crop((x0, y0, x0 + side, y0 + side))
+        buf = io.BytesIO()
+        crop_orig.resize((REFINE_SIZE, REFINE_SIZE), Image.LANCZOS).save(buf, format="PNG")
+        refined_up = Image.open(io.BytesIO(refined_bytes)).convert("RGB")
+        refined_orig = refined_up.resize((side, side), Image.LANCZOS)
+        refined_orig = Image.fromarray(match_skin_tone(np.array(crop_orig), np.array(refined_orig)), "RGB")
+        final = refined_img.convert("RGB").copy()
+        final.paste(refined_orig, (x0, y0), Image.fromarray(paste_alpha(side), mode="L"))
+        refined_img = final
+
+    buf = io.BytesIO()
+    refined_img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def new_request(frame_bytes, boxes, refined):
+    """The same stages on one ImageContext."""
+    import numpy as np
+    from PIL import Image
+
+    ctx = ImageContext.from_bytes(frame_bytes)
+    ctx.gray
+
+    for (x0, y0, side), refined_bytes in zip(boxes, refined):
+        crop_orig = ctx.crop((x0, y0, x0 + side, y0 + side))
+        buf = io.BytesIO()
+        Image.fromarray(crop_orig, mode="RGB").resize(
+            (REFINE_SIZE, REFINE_SIZE), Image.LANCZOS).save(buf, format="PNG")
+        with Image.open(io.BytesIO(refined_bytes)) as refined_up:
+            refined_orig = np.asarray(refined_up.convert("RGB").resize((side, side), Image.LANCZOS))
+        ctx.composite(match_skin_tone(crop_orig, refined_orig), (x0, y0), paste_alpha(side))
+
+    return ctx.encode()
+
+
+PIPELINES = {"legacy": legacy_request, "new": new_request}
+
+
+def synthetic_frame(side=1536):
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[0:side, 0:side]
+    base = np.stack([(xx * 255 // side), (yy * 255 // side), np.full_like(xx, 128)], axis=-1)
+    rgb = (base + rng.normal(0, 12, (side, side, 3))).clip(0, 255).astype(np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(rgb, mode="RGB").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def request_inputs(path, n_regions):
+    """(frame PNG bytes, [(x0, y0, side)], [refined crop PNG bytes])."""
+    from PIL import Image
+
+    if path:
+        with open(path, "rb") as f:
+            frame_bytes = f.read()
+    else:
+        frame_bytes = synthetic_frame()
+    with Image.open(io.BytesIO(frame_bytes)) as im:
+        w, h = im.size
+    # Face (largest) first, then hands / feet, spread over the frame
+    sides = [min(w, h) // 2] + [min(w, h) // 4] * 4
+    spots = [(0.25, 0.05), (0.05, 0.5), (0.7, 0.5), (0.2, 0.75), (0.55, 0.75)]
+    boxes = [(int(w * fx), int(h * fy), side) for (fx, fy), side in zip(spots, sides)][:n_regions]
+    refined = []
+    for i, _box in enumerate(boxes):
+        buf = io.BytesIO()
+        Image.new("RGB", (REFINE_SIZE, REFINE_SIZE), (200 - 20 * i, 160, 140)).save(buf, format="PNG")
+        refined.append(buf.getvalue())
+    return frame_bytes, boxes, refined
+
+
+def rss_mb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def run_one(name, path, n_regions, repeat):
+    """One pipeline in this process → JSON stats on stdout."""
+    frame_bytes, boxes, refined = request_inputs(path, n_regions)
+    fn = PIPELINES[name]
+    fn(frame_bytes, boxes[:1], refined[:1])  # imports / first-use allocations out of the peak
+    counter = DecodeCounter(frame_bytes)
+    rss0 = rss_mb("VmRSS")
+    fn(frame_bytes, boxes, refined)
+    peak_mb = rss_mb("VmHWM") - rss0
+    decodes = counter.count
+    samples = []
+    for _ in range(repeat):
+        t0 = time.process_time()
+        fn(frame_bytes, boxes, refined)
+        samples.append((time.process_time() - t0) * 1000)
+    print(json.dumps({"decodes": decodes, "cpu_ms": statistics.median(samples), "peak_mb": peak_mb}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("image", nargs="?", help="a Klein output PNG (default: synthetic 1536x1536)")
+    parser.add_argument("--regions", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", choices=sorted(PIPELINES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.only:
+        return run_one(args.only, args.image, args.regions, args.repeat)
+
+    results = {}
+    for name in PIPELINES:
+        cmd = [sys.executable, os.path.abspath(__file__), "--only", name,
+               "--regions", str(args.regions), "--repeat", str(args.repeat)]
+        if args.image:
+            cmd.append(args.image)
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        results[name] = json.loads(out.strip().splitlines()[-1])
+
+    print(f"{args.image or 'synthetic 1536x1536'}, {args.regions} region(s)\n")
+    print(f"{'pipeline':<8} {'decodes':>8} {'CPU ms':>8} {'peak MB':>8}")
+    for name, r in results.items():
+        print(f"{name:<8} {r['decodes']:>8} {r['cpu_ms']:>8.0f} {r['peak_mb']:>8.1f}")
+    old, new = results["legacy"], results["new"]
+    print(f"\nnew vs legacy: {old['decodes'] - new['decodes']} fewer decodes, "
+          f"{(1 - new['cpu_ms'] / old['cpu_ms']) * 100:.0f}% less CPU, "
+          f"{old['peak_mb'] - new['peak_mb']:.1f} MB lower peak RSS")
+
+
+if __name__ == "__main__":
+    main()
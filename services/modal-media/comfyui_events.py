@@ -0,0 +1,504 @@
+"""
+ComfyUI execution-event listener — shared by comfyui_klein.py and video_generate_h3.py
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+Both endpoints used to find out a job was done by sleeping and re-requesting
+/history/{prompt_id} (1s for Klein, 3s for H3). Every generation, refinement
+inpaint and pose-guided call paid up to one full poll interval of dead time
+after ComfyUI had already finished — four times per request on the
+refinement path.
+
+ComfyUI pushes execution events over /ws to the client_id that submitted the
+prompt. One ComfyUIEventListener per container keeps that socket open on a
+daemon thread and records per-prompt state (executing node, step progress,
+node timings, outputs). Callers block in wait() on a condition variable and
+wake the moment `execution_success` arrives.
+
+If the socket is down (or dropped at any point after the prompt was
+submitted) wait() returns None and the caller falls back to poll_history()
+— events may have been missed, so polling is the only safe answer.
+
+Pure stdlib + websocket-client (imported lazily on the listener thread), no
+modal import — host/port are parameters so the listener can be pointed at a
+small local fake ComfyUI server.
+"""
+
+import json
+import os
+import struct
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+# Binary /ws frame types (comfy server BinaryEventTypes)
+_BIN_PREVIEW_IMAGE = 1
+_BIN_PREVIEW_IMAGE_WITH_METADATA = 4
+_IMAGE_FORMATS = {1: "jpeg", 2: "png", 3: "webp"}
+
+# Frames kept per node per prompt. SaveImageWebsocket sends one frame per
+# batch image (≤ 8 here); sampler latent previews beyond this roll off.
+_MAX_FRAMES_PER_NODE = 64
+
+
+def poll_history(prompt_id: str, port: int = 8188, host: str = "127.0.0.1",
+                 timeout: float = 300, interval: float = 1.0) -> dict:
+    """Poll /history/{prompt_id} until the job completes; returns its entry.
+
+    The fallback for ComfyUIEventListener.wait() returning None. Raises
+    RuntimeError on an execution error and TimeoutError on timeout.
+    SaveImageWebsocket jobs have no outputs — completed status is the
+    signal for those.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            req = urllib.request.Request(f"http://{host}:{port}/history/{prompt_id}")
+            with urllib.request.urlopen(req, timeout=10) as resp:
+                history = json.loads(resp.read())
+            entry = history.get(prompt_id)
+            if entry:
+                status = entry.get("status") or {}
+                if status.get("status_str") == "error":
+                    raise RuntimeError(
+                        f"ComfyUI job failed: {str(status.get('messages', 'unknown error'))[:2000]}")
+                if entry.get("outputs") or status.get("completed"):
+                    return entry
+        except urllib.error.URLError:
+            pass
+        time.sleep(interval)
+    raise TimeoutError(f"ComfyUI job {prompt_id} did not complete within {timeout}s")
+
+
+class ComfyUIEventListener:
+    """Background /ws client tracking every prompt submitted under one client_id."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8188, client_id: str = None,
+                 state_ttl: float = 900.0, max_age: float = 4 * 3600.0, on_executed=None):
+        """on_executed(prompt_id, node, output): called on the listener thread
+        for every `executed` event (e.g. OutputIndex.record) — keep it cheap.
+
+        state_ttl: how long a FINISHED prompt's state is kept. max_age: hard
+        cap for any state, finished or not (a prompt whose final event never
+        arrived) — far above the longest job (H3's 1800s container timeout),
+        so a prompt still queued behind other requests keeps its state.
+        """
+        self.host = host
+        self.port = port
+        self.client_id = client_id or uuid.uuid4().hex
+        self.state_ttl = state_ttl
+        self.max_age = max_age
+        self.on_executed = on_executed
+        self._cond = threading.Condition()
+        self._prompts = {}
+        self._connected = False
+        # Bumped on every successful (re)connect. A prompt submitted under an
+        # older epoch may have lost events across the reconnect → poll it.
+        self._epoch = 0
+        self._stop = False
+        self._thread = None
+        self._ws = None
+        # ComfyUI executes one prompt at a time; binary frames carry no
+        # prompt_id, so they're attributed to whichever prompt ran last.
+        self._current_prompt = None
+
+    # ── Lifecycle ───────────────────────────────────────────────────────
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    @property
+    def epoch(self) -> int:
+        return self._epoch
+
+    def start(self, connect_timeout: float = 10.0) -> bool:
+        """Start the listener thread. Returns True once the socket is open."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="comfyui-ws", daemon=True)
+            self._thread.start()
+        with self._cond:
+            self._cond.wait_for(lambda: self._connected, timeout=connect_timeout)
+            return self._connected
+
+    def stop(self):
+        self._stop = True
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def _run(self):
+        import websocket
+
+        url = f"ws://{self.host}:{self.port}/ws?clientId={self.client_id}"
+        backoff = 0.5
+        while not self._stop:
+            try:
+                ws = websocket.create_connection(url, timeout=10)
+            except Exception as e:
+                print(f"⚠️ ComfyUI /ws connect failed ({e}) — retrying in {backoff:.1f}s")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 10.0)
+                continue
+
+            # Block in recv() indefinitely — ComfyUI goes quiet between jobs.
+            ws.settimeout(None)
+            self._ws = ws
+            with self._cond:
+                self._epoch += 1
+                self._connected = True
+                self._cond.notify_all()
+            backoff = 0.5
+            print(f"✅ ComfyUI /ws connected (client_id={self.client_id[:8]}, epoch={self._epoch})")
+
+            try:
+                while not self._stop:
+                    msg = ws.recv()
+                    if isinstance(msg, (bytes, bytearray)):
+                        self._handle_binary(bytes(msg))
+                    elif msg:
+                        self._handle_text(msg)
+            except Exception as e:
+                if not self._stop:
+                    print(f"⚠️ ComfyUI /ws dropped ({type(e).__name__}: {e}) — waiters fall back to polling")
+            finally:
+                self._ws = None
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+                with self._cond:
+                    self._connected = False
+                    self._cond.notify_all()
+
+    # ── Per-prompt state ────────────────────────────────────────────────
+
+    def _state(self, prompt_id: str) -> dict:
+        """Get-or-create prompt state. Caller must hold self._cond."""
+        st = self._prompts.get(prompt_id)
+        if st is None:
+            st = {
+                "prompt_id": prompt_id,
+                "epoch": self._epoch,
+                "status": "pending",     # pending → running → success|error|interrupted
+                "error": None,
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "node": None,            # currently executing node id
+                "node_started": None,
+                "node_times": {},        # node id → seconds spent executing
+                "cached": [],            # node ids served from ComfyUI's cache
+                "outputs": {},           # node id → `executed` UI output
+                "frames": {},            # node id → [(format, bytes)] binary image frames
+                "capture": set(),        # nodes whose frames are outputs (SaveImageWebsocket)
+                "updates": [],           # progress feed consumed by wait()
+            }
+            self._prompts[prompt_id] = st
+        return st
+
+    def track(self, prompt_id: str, epoch: int, capture_nodes=None):
+        """Register a freshly submitted prompt with the epoch captured BEFORE submit.
+
+        capture_nodes: ids of SaveImageWebsocket nodes — their binary frames
+        are the job's output images and are returned by wait() as "ws_images".
+        """
+        with self._cond:
+            st = self._state(prompt_id)
+            st["epoch"] = min(st["epoch"], epoch)
+            st["capture"].update(capture_nodes or ())
+
+    def status(self, prompt_id: str):
+        """pending | running | success | error | interrupted, or None if untracked."""
+        with self._cond:
+            st = self._prompts.get(prompt_id)
+            return st["status"] if st is not None else None
+
+    def forget(self, prompt_id: str):
+        with self._cond:
+            self._prompts.pop(prompt_id, None)
+
+    def _prune(self):
+        """Drop states finished more than state_ttl ago, and any state older
+        than max_age. Pending / running prompts are kept however long they
+        queue. Caller holds the lock."""
+        now = time.time()
+        finished_cutoff = now - self.state_ttl
+        created_cutoff = now - self.max_age
+        stale = [pid for pid, st in self._prompts.items()
+                 if (st["finished_at"] is not None and st["finished_at"] < finished_cutoff)
+                 or st["created_at"] < created_cutoff]
+        for pid in stale:
+            del self._prompts[pid]
+
+    def _close_node(self, st: dict, now: float):
+        if st["node"] is not None and st["node_started"] is not None:
+            st["node_times"][st["node"]] = (
+                st["node_times"].get(st["node"], 0.0) + now - st["node_started"])
+        st["node"] = None
+        st["node_started"] = None
+
+    def _finish(self, st: dict, status: str, now: float, error=None):
+        self._close_node(st, now)
+        st["status"] = status
+        st["error"] = error
+        st["finished_at"] = now
+        if self._current_prompt == st["prompt_id"]:
+            self._current_prompt = None
+
+    # ── Message handlers (listener thread) ──────────────────────────────
+
+    def _handle_text(self, raw: str):
+        try:
+            msg = json.loads(raw)
+        except ValueError:
+            return
+        mtype = msg.get("type")
+        data = msg.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        if not prompt_id:
+            return  # "status" broadcasts (queue depth) — nothing per-prompt
+        now = time.time()
+
+        with self._cond:
+            st = self._state(prompt_id)
+            if mtype == "execution_start":
+                st["status"] = "running"
+                st["started_at"] = now
+                self._current_prompt = prompt_id
+            elif mtype == "execution_cached":
+                st["cached"] = list(data.get("nodes") or [])
+                st["updates"].append({"type": "cached", "nodes": st["cached"], "t": now})
+            elif mtype == "executing":
+                self._close_node(st, now)
+                node = data.get("node")
+                if node is None:
+                    # Legacy completion signal (pre-execution_success ComfyUI).
+                    # Also sent after execution_error — never overwrite that.
+                    if st["finished_at"] is None:
+                        self._finish(st, "success", now)
+                else:
+                    st["status"] = "running"
+                    st["node"] = node
+                    st["node_started"] = now
+                    self._current_prompt = prompt_id
+                    st["updates"].append({"type": "executing", "node": node, "t": now})
+            elif mtype == "progress":
+                st["updates"].append({
+                    "type": "progress", "node": data.get("node"),
+                    "value": data.get("value"), "max": data.get("max"), "t": now,
+                })
+            elif mtype == "executed":
+                node = data.get("node")
+                if node is not None:
+                    st["outputs"][node] = data.get("output") or {}
+                    if self.on_executed is not None:
+                        try:
+                            self.on_executed(prompt_id, node, st["outputs"][node])
+                        except Exception as e:
+                            print(f"⚠️ on_executed hook failed: {e}")
+            elif mtype == "execution_success":
+                if st["finished_at"] is None:
+                    self._finish(st, "success", now)
+            elif mtype == "execution_error":
+                detail = " ".join(str(x) for x in (
+                    data.get("exception_type"), data.get("exception_message")) if x)
+                self._finish(st, "error", now, error=(
+                    f"{data.get('node_type', '?')} (node {data.get('node_id', '?')}): {detail}"))
+            elif mtype == "execution_interrupted":
+                self._finish(st, "interrupted", now, error="interrupted")
+            else:
+                return
+            if st["finished_at"] is not None:
+                self._prune()
+            self._cond.notify_all()
+
+    def _handle_binary(self, raw: bytes):
+        """Binary image frames: SaveImageWebsocket outputs and sampler previews.
+
+        Legacy PREVIEW_IMAGE frames carry no ids — they belong to the node the
+        current prompt is executing. PREVIEW_IMAGE_WITH_METADATA names both.
+        """
+        if len(raw) < 8:
+            return
+        event = struct.unpack(">I", raw[:4])[0]
+        prompt_id = node = None
+        if event == _BIN_PREVIEW_IMAGE:
+            fmt = _IMAGE_FORMATS.get(struct.unpack(">I", raw[4:8])[0], "png")
+            payload = raw[8:]
+        elif event == _BIN_PREVIEW_IMAGE_WITH_METADATA:
+            meta_len = struct.unpack(">I", raw[4:8])[0]
+            try:
+                meta = json.loads(raw[8:8 + meta_len])
+            except ValueError:
+                return
+            prompt_id = meta.get("prompt_id")
+            node = meta.get("node_id")
+            fmt = str(meta.get("image_type", "image/png")).split("/")[-1]
+            payload = raw[8 + meta_len:]
+        else:
+            return
+
+        with self._cond:
+            prompt_id = prompt_id or self._current_prompt
+            if not prompt_id:
+                return
+            st = self._state(prompt_id)
+            node = node or st["node"]
+            if node is None:
+                return
+            frames = st["frames"].setdefault(node, [])
+            frames.append((fmt, payload))
+            if len(frames) > _MAX_FRAMES_PER_NODE:
+                del frames[0]
+            if node not in st["capture"]:
+                # Sampler latent preview — fed to on_progress for streaming
+                # callers; wait() drops the bytes once delivered.
+                st["updates"].append({"type": "preview", "node": node, "format": fmt,
+                                      "image": payload, "t": time.time()})
+            self._cond.notify_all()
+
+    # ── Waiting (request threads) ───────────────────────────────────────
+
+    def wait(self, prompt_id: str, timeout: float = 300, on_progress=None):
+        """Block until the prompt finishes. Returns a history-like entry.
+
+        Returns None if the socket is (or was, since submit) down — the caller
+        must fall back to /history polling. Raises RuntimeError on a ComfyUI
+        execution error/interrupt and TimeoutError on timeout.
+
+        on_progress(update) receives each progress/executing/cached/preview
+        update for this prompt, called on the waiting thread (never the
+        listener). Preview updates carry the frame bytes as "image".
+        """
+        deadline = time.time() + timeout
+        seen = 0
+        with self._cond:
+            while True:
+                st = self._state(prompt_id)
+                if on_progress is not None and len(st["updates"]) > seen:
+                    pending = st["updates"][seen:]
+                    seen = len(st["updates"])
+                    self._cond.release()
+                    try:
+                        for update in pending:
+                            try:
+                                on_progress(update)
+                            except Exception as e:
+                                print(f"⚠️ progress callback failed: {e}")
+                            update.pop("image", None)
+                    finally:
+                        self._cond.acquire()
+                    continue
+
+                if st["status"] == "success":
+                    entry = self.history_entry(st)
+                    # Hand the image bytes over exactly once — don't keep
+                    # megabytes per prompt alive for state_ttl.
+                    st["frames"] = {}
+                    for update in st["updates"]:
+                        update.pop("image", None)
+                    return entry
+                if st["status"] in ("error", "interrupted"):
+                    raise RuntimeError(f"ComfyUI job failed: {st['error']}")
+                if not self._connected or st["epoch"] != self._epoch:
+                    return None
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError(f"ComfyUI job {prompt_id} did not complete within {timeout}s")
+                self._cond.wait(timeout=min(remaining, 5.0))
+
+    @staticmethod
+    def history_entry(st: dict) -> dict:
+        """Shape the tracked state like a /history/{prompt_id} entry.
+
+        Adds "ws_images": {node_id: [png_bytes, ...]} for capture nodes.
+        """
+        return {
+            "outputs": dict(st["outputs"]),
+            "ws_images": {
+                node: [data for _fmt, data in frames]
+                for node, frames in st["frames"].items() if node in st["capture"]
+            },
+            "status": {"status_str": "success", "completed": True, "messages": []},
+            "timings": {
+                "queued_s": round((st["started_at"] or st["created_at"]) - st["created_at"], 3),
+                "run_s": round((st["finished_at"] or time.time()) - (st["started_at"] or st["created_at"]), 3),
+                # Wall-clock bounds of GPU execution — consecutive prompts'
+                # finished_at → started_at gaps are GPU idle time.
+                "started_at": st["started_at"],
+                "finished_at": st["finished_at"],
+                "nodes": {k: round(v, 3) for k, v in st["node_times"].items()},
+                "cached": list(st["cached"]),
+            },
+        }
+
+
+class OutputIndex:
+    """prompt_id → output file paths, for jobs whose outputs are files on disk.
+
+    Each job saves under a filename_prefix unique to it, so the path its save
+    node will write is known up front (expect()). `executed` events (wire
+    record() to ComfyUIEventListener's on_executed) and /history entries
+    (record_history()) add what ComfyUI actually reported. path() is a dict
+    lookup + one exists() check — no directory scan, and never another
+    job's file.
+    """
+
+    def __init__(self, output_dir: str, kinds=("videos", "gifs", "images"), ttl: float = 3600.0):
+        self.output_dir = output_dir
+        self.kinds = kinds
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # prompt_id → {"expected": path, "reported": [paths], "t": ts}
+
+    def _entry(self, prompt_id: str) -> dict:
+        entry = self._entries.get(prompt_id)
+        if entry is None:
+            entry = self._entries[prompt_id] = {"expected": None, "reported": [], "t": time.time()}
+            cutoff = time.time() - self.ttl
+            for pid in [p for p, e in self._entries.items() if e["t"] < cutoff]:
+                del self._entries[pid]
+        return entry
+
+    def expect(self, prompt_id: str, path: str):
+        with self._lock:
+            self._entry(prompt_id)["expected"] = path
+
+    def record(self, prompt_id: str, node: str, output: dict):
+        """Store the files of one `executed` output (type "output" only)."""
+        paths = []
+        for kind in self.kinds:
+            for artifact in (output or {}).get(kind) or []:
+                if artifact.get("filename") and artifact.get("type", "output") == "output":
+                    paths.append(os.path.join(self.output_dir, artifact.get("subfolder", ""),
+                                              artifact["filename"]))
+        if paths:
+            with self._lock:
+                reported = self._entry(prompt_id)["reported"]
+                reported.extend(p for p in paths if p not in reported)
+
+    def record_history(self, prompt_id: str, history: dict):
+        for node, output in (history.get("outputs") or {}).items():
+            self.record(prompt_id, node, output)
+
+    def path(self, prompt_id: str):
+        """The job's output file if it exists on disk, else None."""
+        with self._lock:
+            entry = self._entries.get(prompt_id)
+            candidates = list(entry["reported"]) + [entry["expected"]] if entry else []
+        for path in candidates:
+            if path and os.path.exists(path):
+                return path
+        return None
+
+    def forget(self, prompt_id: str):
+        with self._lock:
+            self._entries.pop(prompt_id, None)
+
+    def __len__(self):
+        return len(self._entries)
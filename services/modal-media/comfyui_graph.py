@@ -0,0 +1,160 @@
+"""
+ComfyUI graph construction — stable semantic node ids for the Klein builders
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+The original builders numbered nodes with a running counter ("1", "2", ...),
+so every id after the LoRA chain shifted whenever the stack length changed:
+the positive encode was "5" with two LoRAs and "6" with three. The negative
+encode also hung off the LAST LoRA's CLIP, so a different stack meant a
+different negative conditioning even though the text never changes.
+
+WorkflowGraph gives each node a role-based id instead:
+
+  unet / clip / vae            loaders — identical in every Klein graph
+  lora_<digest>                one per LoraLoader; the digest covers the
+                               parent id + name + strengths, so a shared
+                               stack PREFIX (identity LoRA, then specialist)
+                               has the same ids in every request using it
+  neg                          negative encode on the BASE clip when
+                               cfg ≤ 1.0 (the uncond branch is never
+                               evaluated, so the LoRA-patched CLIP buys
+                               nothing) — one encode shared by every stack
+  neg_<lora id>                negative on the patched clip (cfg > 1.0)
+  pos / latent / sampler / decode / save   per-request tail
+
+ComfyUI's cache matches node outputs by input signature; with stable ids
+the same sub-graph also has the same id across requests, so its
+execution_cached lists, /history timings and our per-node progress line up.
+subgraph_hash() is the Merkle hash of a node and everything upstream of it,
+independent of ids — the test suite uses it to check that requests sharing
+loaders / a LoRA prefix / the negative branch really build identical
+sub-graphs.
+
+Stdlib only, no modal import — tests/test_workflow_graph.py runs it locally.
+"""
+
+import hashlib
+import json
+
+# Output modes for the final node of every builder:
+#   "file"      — SaveImage: PNG written to OUTPUT_DIR, read back by
+#                 _fetch_images (direct file read + unlink, /view fallback).
+#   "websocket" — SaveImageWebsocket (ships in ComfyUI's custom_nodes/):
+#                 PNG bytes pushed over /ws to our client_id, nothing on disk,
+#                 no second HTTP transfer. Requires the /ws listener.
+OUTPUT_MODE_FILE = "file"
+OUTPUT_MODE_WEBSOCKET = "websocket"
+
+# Above this CFG the sampler evaluates the negative (uncond) branch, so it
+# must see the same LoRA-patched CLIP as the positive prompt.
+UNCOND_CFG = 1.0
+
+
+def output_node(images, filename_prefix: str, output_mode: str = OUTPUT_MODE_FILE) -> dict:
+    """Terminal image node for the given output mode."""
+    if output_mode == OUTPUT_MODE_WEBSOCKET:
+        return {"class_type": "SaveImageWebsocket", "inputs": {"images": images}}
+    return {"class_type": "SaveImage", "inputs": {"images": images, "filename_prefix": filename_prefix}}
+
+
+def lora_spec(lora: dict) -> tuple:
+    """(name, strength_model, strength_clip) with the repo-wide 0.8 default."""
+    strength = lora.get("strength", 0.8)
+    return lora["name"], strength, lora.get("strength_clip", strength)
+
+
+def _digest(*parts) -> str:
+    blob = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()[:12]
+
+
+def _is_link(value) -> bool:
+    return (isinstance(value, list) and len(value) == 2
+            and isinstance(value[0], str) and isinstance(value[1], int))
+
+
+class WorkflowGraph:
+    """API-format graph under construction. Node ids are caller-chosen roles."""
+
+    def __init__(self):
+        self.nodes = {}
+
+    def add(self, node_id: str, class_type: str, **inputs) -> str:
+        """Add (or re-add an identical) node. Returns node_id."""
+        node = {"class_type": class_type, "inputs": inputs}
+        existing = self.nodes.get(node_id)
+        if existing is not None and existing != node:
+            raise ValueError(f"node id {node_id!r} already used by a different node")
+        self.nodes[node_id] = node
+        return node_id
+
+    def loaders(self, unet_name: str, clip_name: str, vae_name: str, clip_type: str = "flux2"):
+        """unet / clip / vae loaders. Returns (model, clip, vae) links."""
+        self.add("unet", "UNETLoader", unet_name=unet_name, weight_dtype="default")
+        self.add("clip", "CLIPLoader", clip_name=clip_name, type=clip_type)
+        self.add("vae", "VAELoader", vae_name=vae_name)
+        return ["unet", 0], ["clip", 0], ["vae", 0]
+
+    def lora_chain(self, loras, model=None, clip=None):
+        """Chain LoraLoaders onto (model, clip). Returns the patched (model, clip).
+
+        Ids are content-derived from the parent, so chains sharing a prefix
+        share nodes (and building the same stack twice in one graph is a no-op).
+        """
+        model = model or ["unet", 0]
+        clip = clip or ["clip", 0]
+        for lora in loras or []:
+            name, strength_model, strength_clip = lora_spec(lora)
+            lid = "lora_" + _digest(model, clip, name, strength_model, strength_clip)
+            self.add(lid, "LoraLoader", lora_name=name,
+                     strength_model=strength_model, strength_clip=strength_clip,
+                     model=model, clip=clip)
+            model, clip = [lid, 0], [lid, 1]
+        return model, clip
+
+    def encode(self, node_id: str, text: str, clip) -> list:
+        self.add(node_id, "CLIPTextEncode", text=text, clip=clip)
+        return [node_id, 0]
+
+    def negative(self, text: str, clip, cfg: float) -> list:
+        """Negative conditioning link — base-CLIP branch unless cfg needs the patch."""
+        if cfg <= UNCOND_CFG or clip == ["clip", 0]:
+            return self.encode("neg", text, ["clip", 0])
+        return self.encode(f"neg_{clip[0]}", text, clip)
+
+    def output(self, node_id: str, images, filename_prefix: str, output_mode: str = OUTPUT_MODE_FILE) -> str:
+        self.nodes[node_id] = output_node(images, filename_prefix, output_mode)
+        return node_id
+
+    def workflow(self) -> dict:
+        return {"prompt": self.nodes}
+
+
+def subgraph_hash(workflow: dict, node_id: str, _memo: dict = None) -> str:
+    """Merkle hash of node_id and all of its ancestors.
+
+    Literal inputs are hashed by value, links by (parent hash, output index),
+    so the result does not depend on node ids — two graphs that compute the
+    same thing at a node hash the same there.
+    """
+    nodes = workflow.get("prompt", workflow)
+    memo = {} if _memo is None else _memo
+    if node_id in memo:
+        return memo[node_id]
+    node = nodes[node_id]
+    inputs = {}
+    for key, value in node.get("inputs", {}).items():
+        if _is_link(value) and value[0] in nodes:
+            inputs[key] = ["@", subgraph_hash(nodes, value[0], memo), value[1]]
+        else:
+            inputs[key] = value
+    blob = json.dumps({"class_type": node["class_type"], "inputs": inputs},
+                      sort_keys=True, separators=(",", ":"))
+    memo[node_id] = hashlib.sha256(blob.encode("utf-8")).hexdigest()
+    return memo[node_id]
+
+
+def subgraph_hashes(workflow: dict) -> dict:
+    """{node_id: subgraph_hash} for every node in the graph."""
+    nodes = workflow.get("prompt", workflow)
+    memo = {}
+    return {node_id: subgraph_hash(nodes, node_id, memo) for node_id in nodes}
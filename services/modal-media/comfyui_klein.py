@@ -21,7 +21,10 @@ WHY KLEIN (not Z-Image, not SDXL):
 
 ARCHITECTURE:
   1. ComfyUI runs as a background subprocess (localhost:8188) inside the Modal container
-  2. A FastAPI wrapper handles: build workflow JSON → POST /prompt → poll /history → GET /view
+  2. A FastAPI wrapper handles: build workflow JSON → POST /prompt → wait for
+     /ws execution events (poll /history only if the socket drops) → image
+     bytes pushed over /ws by SaveImageWebsocket (SaveImage + direct file
+     read/unlink when the socket is unavailable)
   3. Returns raw image bytes (same contract as the diffusers Klein endpoint)
 
 MODEL FILES (all ComfyUI single-file format):
@@ -48,6 +51,8 @@ import sys
 import time
 import json
 import uuid
+import threading
+import contextlib
 import urllib.request
 import urllib.error
 import subprocess
@@ -55,6 +60,21 @@ import signal
 
 import modal
 
+from comfyui_events import ComfyUIEventListener, poll_history
+from face_detector import DetectionFrame, FaceDetector
+from generation_attempts import run_attempts, runners_up
+from result_cache import ResultCache, digest_bytes, graph_key
+from comfyui_graph import OUTPUT_MODE_FILE, OUTPUT_MODE_WEBSOCKET, WorkflowGraph, output_node
+from lora_residency import LoraResidency, cache_lru_size, cached_nodes
+from request_scheduler import PRIORITIES, PRIORITY_BATCH, PRIORITY_INTERACTIVE, QueueFull, RequestScheduler
+import media_jobs
+from preview_stream import SSEStream
+from input_cache import InputCache, content_name, multipart_body
+from media_janitor import Budget, MediaJanitor
+from image_context import (
+    FORMATS, THUMBNAIL_SIDE, ImageContext, RequestMeter, format_available, negotiate_format,
+)
+
 app = modal.App("holly-comfyui-klein")
 
 # ─── Paths ────────────────────────────────────────────────────────────
@@ -77,6 +97,62 @@ MODEL_VOL = "/models"
 LORA_VOL_MOUNT = "/lora"
 COMFYUI_PORT = 8188
 
+# Content-addressed cache of deterministic (explicit-seed) graph outputs —
+# see result_cache.py. Lives on the models volume so it survives scale-down.
+RESULT_CACHE_DIR = f"{MODEL_VOL}/result-cache"
+RESULT_CACHE_MAX_BYTES = 8 * 1024**3
+
+# LoRA stack residency — see lora_residency.py. ComfyUI runs with --cache-lru
+# sized for LORA_STACK_SLOTS chains (fewer if the stacks seen so far would
+# exceed the byte budget); usage counts persist on the models volume and the
+# most frequent stacks are prewarmed at startup.
+LORA_STACK_SLOTS = 4
+LORA_STACK_MAX_DEPTH = 4
+LORA_STACK_BUDGET_BYTES = 6 * 1024**3
+LORA_USAGE_PATH = f"{MODEL_VOL}/lora-residency.json"
+# Persist usage every N observed jobs (and on container exit)
+LORA_USAGE_SAVE_EVERY = 10
+
+# Request admission — see request_scheduler.py. SCHEDULER_MAX_ACTIVE requests
+# run at once (CPU stages overlap the GPU queue), SCHEDULER_MAX_WAITING more
+# wait by priority, the rest get 429. Modal may deliver a few more inputs
+# than that so overflow reaches our 429 instead of Modal's opaque queue.
+SCHEDULER_MAX_ACTIVE = 3
+SCHEDULER_MAX_WAITING = 6
+SCHEDULER_WAIT_TIMEOUT_S = 300
+KLEIN_MAX_INPUTS = SCHEDULER_MAX_ACTIVE + SCHEDULER_MAX_WAITING + 4
+
+# Disk janitor — see media_janitor.py. ComfyUI's output/ (PNGs left by the
+# /view fallback, ws fallback saves) and input/ (content-addressed pose refs,
+# skeletons, refinement crops) are swept to these budgets every minute.
+OUTPUT_BUDGET_BYTES = 2 * 1024**3
+OUTPUT_MAX_AGE_S = 3600
+INPUT_BUDGET_BYTES = 2 * 1024**3
+INPUT_MAX_AGE_S = 6 * 3600
+
+# Async jobs — see media_jobs.py. Records in the shared holly-media-jobs
+# modal.Dict, result bytes on the holly-media-jobs volume under klein/.
+JOBS_VOL_MOUNT = "/jobs"
+JOBS_RESULTS_DIR = f"{JOBS_VOL_MOUNT}/klein"
+# Sync endpoint → job "endpoint" name (the worker calls the same body)
+KLEIN_JOB_ENDPOINTS = ("generate", "generate_pose_guided", "generate_controlnet", "finalize")
+
+# Draft-then-finalize (2026-10-16). quality_mode="draft" renders the same
+# graph at DRAFT_SCALE of the requested size and DRAFT_STEPS, one attempt, no
+# QA/refinement, and returns X-Draft-Token. finalize re-renders the chosen
+# draft at full size with the same seed, prompt and LoRA stack — by default
+# through a latent upscale of the draft itself (the draft nodes keep their
+# ids and inputs, so ComfyUI's --cache-lru usually still holds the draft
+# latent) + a partial-denoise pass. Users discard most images after a
+# glance; only accepted ones pay for full-resolution sampling.
+DRAFT_SCALE = 0.5
+DRAFT_STEPS = 6
+DRAFT_MIN_SIDE = 384
+DRAFT_TTL_S = 24 * 3600
+FINALIZE_METHODS = ("latent_upscale", "scratch")
+FINALIZE_DENOISE = 0.6
+FINALIZE_UPSCALE_METHOD = "bislerp"
+
 # FLUX.2 Klein 9B DISTILLED — the proven base for photorealistic Holly.
 #
 # Base was tested THREE times (Aug 5, Aug 6, Aug 11) with multiple CFG values
@@ -298,7 +374,66 @@ def get_anatomy_anchors(raw_prompt: str) -> str:
         return BASE_ANCHORS + ", wearing clothes, dressed, fabric covering her body"
 
 
-# ─── Workflow builder (inlined — avoids cross-module packaging issues) ──
+# ─── Workflow builders ───────────────────────────────────────────────
+# Node ids are semantic and content-derived (see comfyui_graph.py) — the
+# same loaders / LoRA prefix / negative branch get the same ids in every
+# request. Output modes for the final node: OUTPUT_MODE_FILE (SaveImage,
+# read back by _fetch_images) or OUTPUT_MODE_WEBSOCKET (SaveImageWebsocket,
+# PNG bytes over /ws — requires the listener).
+
+
+def with_file_output(workflow: dict, filename_prefix: str) -> dict:
+    """Copy of a workflow with every SaveImageWebsocket swapped for SaveImage.
+
+    Used when the /ws stream drops mid-job: the re-queued graph is identical
+    up to the output node, so ComfyUI's node cache serves everything else.
+    """
+    wf = {}
+    for node_id, node in workflow["prompt"].items():
+        if node["class_type"] == "SaveImageWebsocket":
+            node = output_node(node["inputs"]["images"], filename_prefix, OUTPUT_MODE_FILE)
+        wf[node_id] = node
+    return {**workflow, "prompt": wf}
+
+
+# Latent-batch candidate mode: max candidates sampled in one KSampler pass.
+# 4 × 1024² latents keep activation memory well inside the A100 next to
+# the bf16 UNet + LoRA stack.
+LATENT_BATCH_MAX = 4
+
+
+def _multipart_chunks(parts, boundary: str):
+    for headers, body in parts:
+        if hasattr(body, "result"):
+            body = body.result()  # encoder Future — resolved when its part is reached
+        head = f"--{boundary}\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers.items()) + "\r\n"
+        yield head.encode("ascii", "replace")
+        yield body
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+
+def multipart_mixed(parts: list) -> tuple:
+    """Encode [(headers_dict, body_bytes), ...] as a multipart/mixed body.
+
+    Returns (body_bytes, content_type). Used to return several images in one
+    response (winner + runners-up) without a base64/JSON detour.
+    """
+    boundary = f"holly-{uuid.uuid4().hex}"
+    return b"".join(_multipart_chunks(parts, boundary)), f"multipart/mixed; boundary={boundary}"
+
+
+def multipart_mixed_stream(parts: list) -> tuple:
+    """Streaming multipart_mixed: returns (chunk_iterator, content_type).
+
+    A part's body may be a Future (see image_context.encode_async) — it is
+    only waited on when the stream reaches it, so a thumbnail part goes out
+    while the full-size encode is still running.
+    """
+    boundary = f"holly-{uuid.uuid4().hex}"
+    return _multipart_chunks(parts, boundary), f"multipart/mixed; boundary={boundary}"
+
+
 def build_workflow(
     prompt: str,
     width: int = 1024,
@@ -311,70 +446,94 @@ def build_workflow(
     scheduler: str = V2_SCHEDULER,
     filename_prefix: str = "Holly",
     negative_prompt: str = None,  # None = V2_NEGATIVE_PROMPT; "" = no negative
+    output_mode: str = OUTPUT_MODE_FILE,
+    batch_size: int = 1,
 ) -> dict:
-    """Build ComfyUI API-format workflow for FLUX.2 Klein 9B text-to-image with LoRA stacking."""
+    """Build ComfyUI API-format workflow for FLUX.2 Klein 9B text-to-image with LoRA stacking.
+
+    batch_size > 1 samples that many candidates in ONE KSampler pass (one
+    EmptyLatentImage batch) — graph validation, LoRA patching and text
+    encoding are paid once instead of per seed.
+    """
     import random as _random
     if seed is None:
         seed = _random.randint(0, 2**63 - 1)
-    if loras is None:
-        loras = []
 
-    wf = {}
-    nid = [1]
-
-    def _id():
-        v = str(nid[0]); nid[0] += 1; return v
-
-    # Loaders — Klein uses bf16 (NOT fp8). CLIPLoader type is "flux" for FLUX.2.
-    unet_id = _id()
-    wf[unet_id] = {"class_type": "UNETLoader", "inputs": {"unet_name": UNET_FILE, "weight_dtype": "default"}}
-    # CLIPLoader type for FLUX.2 Klein 9B is "flux2" (NOT "flux").
-    # ComfyUI's valid types (25): stable_diffusion, stable_cascade, sd3, ...,
-    # flux2, ... — verified from ComfyUI nodes.py CLIPLoader.INPUT_TYPES.
-    clip_id = _id()
-    wf[clip_id] = {"class_type": "CLIPLoader", "inputs": {"clip_name": CLIP_FILE, "type": "flux2"}}
-    vae_id = _id()
-    wf[vae_id] = {"class_type": "VAELoader", "inputs": {"vae_name": VAE_FILE}}
-
-    # Chained LoRAs
-    cur_model = [unet_id, 0]
-    cur_clip = [clip_id, 0]
-    for lora in loras:
-        lid = _id()
-        wf[lid] = {"class_type": "LoraLoader", "inputs": {
-            "lora_name": lora["name"],
-            "strength_model": lora.get("strength", 0.8),
-            "strength_clip": lora.get("strength_clip", lora.get("strength", 0.8)),
-            "model": cur_model, "clip": cur_clip,
-        }}
-        cur_model = [lid, 0]
-        cur_clip = [lid, 1]
+    g = WorkflowGraph()
+    # Loaders — Klein uses bf16 (NOT fp8). CLIPLoader type for FLUX.2 Klein
+    # 9B is "flux2" (NOT "flux") — verified from ComfyUI nodes.py
+    # CLIPLoader.INPUT_TYPES.
+    _, _, vae = g.loaders(UNET_FILE, CLIP_FILE, VAE_FILE)
+    model, clip = g.lora_chain(loras)
 
     # Conditioning
-    pos_id = _id()
-    wf[pos_id] = {"class_type": "CLIPTextEncode", "inputs": {"text": prompt, "clip": cur_clip}}
-    neg_id = _id()
+    pos = g.encode("pos", prompt, clip)
     _neg_text = V2_NEGATIVE_PROMPT if negative_prompt is None else negative_prompt
-    wf[neg_id] = {"class_type": "CLIPTextEncode", "inputs": {"text": _neg_text, "clip": cur_clip}}
+    neg = g.negative(_neg_text, clip, cfg)
 
     # Latent + Sampler
-    latent_id = _id()
-    wf[latent_id] = {"class_type": "EmptyLatentImage", "inputs": {"width": width, "height": height, "batch_size": 1}}
-    sampler_id = _id()
-    wf[sampler_id] = {"class_type": "KSampler", "inputs": {
-        "seed": seed, "steps": steps, "cfg": cfg,
-        "sampler_name": sampler, "scheduler": scheduler, "denoise": 1.0,
-        "model": cur_model, "positive": [pos_id, 0], "negative": [neg_id, 0],
-        "latent_image": [latent_id, 0],
-    }}
+    g.add("latent", "EmptyLatentImage", width=width, height=height, batch_size=batch_size)
+    g.add("sampler", "KSampler",
+          seed=seed, steps=steps, cfg=cfg,
+          sampler_name=sampler, scheduler=scheduler, denoise=1.0,
+          model=model, positive=pos, negative=neg,
+          latent_image=["latent", 0])
 
     # Decode + Save
-    decode_id = _id()
-    wf[decode_id] = {"class_type": "VAEDecode", "inputs": {"samples": [sampler_id, 0], "vae": [vae_id, 0]}}
-    save_id = _id()
-    wf[save_id] = {"class_type": "SaveImage", "inputs": {"images": [decode_id, 0], "filename_prefix": filename_prefix}}
+    g.add("decode", "VAEDecode", samples=["sampler", 0], vae=vae)
+    g.output("save", ["decode", 0], filename_prefix, output_mode)
+    return g.workflow()
+
+
+def draft_size(width: int, height: int, scale: float = DRAFT_SCALE) -> tuple:
+    """Draft render size — scaled, snapped to multiples of 16, ≥ DRAFT_MIN_SIDE."""
+    def _side(v):
+        return max(DRAFT_MIN_SIDE, int(v * scale) // 16 * 16)
+    return _side(width), _side(height)
+
+
+def build_latent_upscale_workflow(
+    prompt: str,
+    draft_width: int,
+    draft_height: int,
+    width: int,
+    height: int,
+    seed: int,
+    loras=None,
+    draft_steps: int = DRAFT_STEPS,
+    steps: int = V2_STEPS,
+    cfg: float = V2_CFG,
+    sampler: str = V2_SAMPLER,
+    scheduler: str = V2_SCHEDULER,
+    denoise: float = FINALIZE_DENOISE,
+    filename_prefix: str = "Holly",
+    negative_prompt: str = None,
+    output_mode: str = OUTPUT_MODE_FILE,
+) -> dict:
+    """Finalize a draft: the draft's build_workflow graph unchanged, then
+    LatentUpscale to full size and a partial-denoise KSampler pass with the
+    same seed, model and conditioning.
 
-    return {"prompt": wf}
+    The draft nodes ("latent", "sampler", the LoRA chain, "pos"/"neg") keep
+    exactly the ids and inputs the draft request used, so ComfyUI serves
+    them from its cache while the draft is still resident.
+    """
+    g = WorkflowGraph()
+    g.nodes.update(build_workflow(
+        prompt, draft_width, draft_height, seed, loras, draft_steps, cfg, sampler, scheduler,
+        filename_prefix=filename_prefix, negative_prompt=negative_prompt,
+        output_mode=output_mode,
+    )["prompt"])
+    # Re-pointed below — the draft's own decode/save aren't part of this graph
+    del g.nodes["decode"], g.nodes["save"]
+    draft = g.nodes["sampler"]["inputs"]
+    g.add("upscale", "LatentUpscale", samples=["sampler", 0],
+          upscale_method=FINALIZE_UPSCALE_METHOD, width=width, height=height, crop="disabled")
+    g.add("final_sampler", "KSampler", **{
+        **draft, "steps": steps, "denoise": denoise, "latent_image": ["upscale", 0]})
+    g.add("decode", "VAEDecode", samples=["final_sampler", 0], vae=["vae", 0])
+    g.output("save", ["decode", 0], filename_prefix, output_mode)
+    return g.workflow()
 
 
 def build_pose_guided_workflow(
@@ -390,6 +549,7 @@ def build_pose_guided_workflow(
     sampler: str = "euler",
     scheduler: str = "simple",
     filename_prefix: str = "Holly",
+    output_mode: str = OUTPUT_MODE_FILE,
 ) -> dict:
     """Build a ComfyUI POSE-GUIDED (img2img) workflow.
 
@@ -408,71 +568,33 @@ def build_pose_guided_workflow(
     import random as _random
     if seed is None:
         seed = _random.randint(0, 2**63 - 1)
-    if loras is None:
-        loras = []
 
-    wf = {}
-    nid = [1]
-
-    def _id():
-        v = str(nid[0]); nid[0] += 1; return v
-
-    # Loaders (same as build_workflow)
-    unet_id = _id()
-    wf[unet_id] = {"class_type": "UNETLoader", "inputs": {"unet_name": UNET_FILE, "weight_dtype": "default"}}
-    clip_id = _id()
-    wf[clip_id] = {"class_type": "CLIPLoader", "inputs": {"clip_name": CLIP_FILE, "type": "flux2"}}
-    vae_id = _id()
-    wf[vae_id] = {"class_type": "VAELoader", "inputs": {"vae_name": VAE_FILE}}
-
-    # Chained LoRAs (same stack)
-    cur_model = [unet_id, 0]
-    cur_clip = [clip_id, 0]
-    for lora in loras:
-        lid = _id()
-        wf[lid] = {"class_type": "LoraLoader", "inputs": {
-            "lora_name": lora["name"],
-            "strength_model": lora.get("strength", 0.8),
-            "strength_clip": lora.get("strength_clip", lora.get("strength", 0.8)),
-            "model": cur_model, "clip": cur_clip,
-        }}
-        cur_model = [lid, 0]
-        cur_clip = [lid, 1]
+    g = WorkflowGraph()
+    # Loaders + LoRA stack (same as build_workflow)
+    _, _, vae = g.loaders(UNET_FILE, CLIP_FILE, VAE_FILE)
+    model, clip = g.lora_chain(loras)
 
     # Conditioning
-    pos_id = _id()
-    wf[pos_id] = {"class_type": "CLIPTextEncode", "inputs": {"text": prompt, "clip": cur_clip}}
-    neg_id = _id()
-    wf[neg_id] = {"class_type": "CLIPTextEncode", "inputs": {"text": V2_NEGATIVE_PROMPT, "clip": cur_clip}}
+    pos = g.encode("pos", prompt, clip)
+    neg = g.negative(V2_NEGATIVE_PROMPT, clip, cfg)
 
     # POSE-GUIDED PATH: LoadImage → VAEEncode → KSampler(low denoise)
-    load_id = _id()
-    wf[load_id] = {"class_type": "LoadImage", "inputs": {"image": pose_image_filename}}
-
+    g.add("pose_image", "LoadImage", image=pose_image_filename)
     # Encode the reference pose image to latent space
-    vae_encode_id = _id()
-    wf[vae_encode_id] = {"class_type": "VAEEncode", "inputs": {
-        "pixels": [load_id, 0],
-        "vae": [vae_id, 0],
-    }}
+    g.add("pose_encode", "VAEEncode", pixels=["pose_image", 0], vae=vae)
 
     # KSampler with LOW denoise — follows the pose but re-renders as Holly
-    sampler_id = _id()
-    wf[sampler_id] = {"class_type": "KSampler", "inputs": {
-        "seed": seed, "steps": steps, "cfg": cfg,
-        "sampler_name": sampler, "scheduler": scheduler,
-        "denoise": denoise,
-        "model": cur_model, "positive": [pos_id, 0], "negative": [neg_id, 0],
-        "latent_image": [vae_encode_id, 0],
-    }}
+    g.add("sampler", "KSampler",
+          seed=seed, steps=steps, cfg=cfg,
+          sampler_name=sampler, scheduler=scheduler,
+          denoise=denoise,
+          model=model, positive=pos, negative=neg,
+          latent_image=["pose_encode", 0])
 
     # Decode + Save
-    decode_id = _id()
-    wf[decode_id] = {"class_type": "VAEDecode", "inputs": {"samples": [sampler_id, 0], "vae": [vae_id, 0]}}
-    save_id = _id()
-    wf[save_id] = {"class_type": "SaveImage", "inputs": {"images": [decode_id, 0], "filename_prefix": filename_prefix}}
-
-    return {"prompt": wf}
+    g.add("decode", "VAEDecode", samples=["sampler", 0], vae=vae)
+    g.output("save", ["decode", 0], filename_prefix, output_mode)
+    return g.workflow()
 
 
 def build_controlnet_workflow(
@@ -488,6 +610,7 @@ def build_controlnet_workflow(
     scheduler: str = V2_SCHEDULER,
     controlnet_strength: float = 0.7,
     filename_prefix: str = "Holly",
+    output_mode: str = OUTPUT_MODE_FILE,
 ) -> dict:
     """Build a ComfyUI workflow using BUILT-IN ControlNet (not the broken custom node).
 
@@ -502,93 +625,49 @@ def build_controlnet_workflow(
     import random as _random
     if seed is None:
         seed = _random.randint(0, 2**63 - 1)
-    if loras is None:
-        loras = []
 
-    wf = {}
-    nid = [1]
-
-    def _id():
-        v = str(nid[0]); nid[0] += 1; return v
-
-    # Loaders
-    unet_id = _id()
-    wf[unet_id] = {"class_type": "UNETLoader", "inputs": {"unet_name": UNET_FILE, "weight_dtype": "default"}}
-    clip_id = _id()
-    wf[clip_id] = {"class_type": "CLIPLoader", "inputs": {"clip_name": CLIP_FILE, "type": "flux2"}}
-    vae_id = _id()
-    wf[vae_id] = {"class_type": "VAELoader", "inputs": {"vae_name": VAE_FILE}}
-
-    # Chained LoRAs
-    cur_model = [unet_id, 0]
-    cur_clip = [clip_id, 0]
-    for lora in loras:
-        lid = _id()
-        wf[lid] = {"class_type": "LoraLoader", "inputs": {
-            "lora_name": lora["name"],
-            "strength_model": lora.get("strength", 0.8),
-            "strength_clip": lora.get("strength_clip", lora.get("strength", 0.8)),
-            "model": cur_model, "clip": cur_clip,
-        }}
-        cur_model = [lid, 0]
-        cur_clip = [lid, 1]
+    g = WorkflowGraph()
+    # Loaders + LoRA stack
+    _, _, vae = g.loaders(UNET_FILE, CLIP_FILE, VAE_FILE)
+    model, clip = g.lora_chain(loras)
 
-    # Load the control image (reference photo or hole-mapped version)
-    image_id = _id()
-    wf[image_id] = {"class_type": "LoadImage", "inputs": {"image": pose_skeleton_path}}
+    # Conditioning
+    pos = g.encode("pos", prompt, clip)
+    neg = g.negative(V2_NEGATIVE_PROMPT, clip, cfg)
 
+    # Load the control image (reference photo or hole-mapped version)
+    g.add("control_image", "LoadImage", image=pose_skeleton_path)
     # Load the ControlNet model
-    cn_load_id = _id()
-    wf[cn_load_id] = {"class_type": "ControlNetLoader", "inputs": {
-        "control_net_name": CONTROLNET_FILE,
-    }}
+    g.add("controlnet", "ControlNetLoader", control_net_name=CONTROLNET_FILE)
 
     # Apply ControlNet to the MODEL (not conditioning) using built-in node
     # This patches the model weights — the ControlNet signal flows through
     # the model's attention layers during sampling.
     # strength: 0.0-2.0 (recommended 0.7-1.0 for pose guidance)
-    cn_apply_id = _id()
-    wf[cn_apply_id] = {"class_type": "ControlNetApplyAdvanced", "inputs": {
-        "positive": None,  # Will be set below
-        "negative": None,
-        "control_net": [cn_load_id, 0],
-        "vae": [vae_id, 0],
-        "image": [image_id, 0],
-        "strength": controlnet_strength,
-        "start_percent": 0.0,
-        "end_percent": 0.8,  # Apply CN for first 80% of denoising
-    }}
-
-    # Conditioning
-    pos_id = _id()
-    wf[pos_id] = {"class_type": "CLIPTextEncode", "inputs": {"text": prompt, "clip": cur_clip}}
-    neg_id = _id()
-    wf[neg_id] = {"class_type": "CLIPTextEncode", "inputs": {"text": V2_NEGATIVE_PROMPT, "clip": cur_clip}}
-
-    # Connect conditioning into ControlNetApplyAdvanced
-    wf[cn_apply_id]["inputs"]["positive"] = [pos_id, 0]
-    wf[cn_apply_id]["inputs"]["negative"] = [neg_id, 0]
+    g.add("controlnet_apply", "ControlNetApplyAdvanced",
+          positive=pos,
+          negative=neg,
+          control_net=["controlnet", 0],
+          vae=vae,
+          image=["control_image", 0],
+          strength=controlnet_strength,
+          start_percent=0.0,
+          end_percent=0.8)  # Apply CN for first 80% of denoising
 
     # Latent + Sampler
-    latent_id = _id()
-    wf[latent_id] = {"class_type": "EmptyLatentImage", "inputs": {"width": width, "height": height, "batch_size": 1}}
-    sampler_id = _id()
-    wf[sampler_id] = {"class_type": "KSampler", "inputs": {
-        "seed": seed, "steps": steps, "cfg": cfg,
-        "sampler_name": sampler, "scheduler": scheduler, "denoise": 1.0,
-        "model": cur_model,
-        "positive": [cn_apply_id, 0],
-        "negative": [cn_apply_id, 1],
-        "latent_image": [latent_id, 0],
-    }}
+    g.add("latent", "EmptyLatentImage", width=width, height=height, batch_size=1)
+    g.add("sampler", "KSampler",
+          seed=seed, steps=steps, cfg=cfg,
+          sampler_name=sampler, scheduler=scheduler, denoise=1.0,
+          model=model,
+          positive=["controlnet_apply", 0],
+          negative=["controlnet_apply", 1],
+          latent_image=["latent", 0])
 
     # Decode + Save
-    decode_id = _id()
-    wf[decode_id] = {"class_type": "VAEDecode", "inputs": {"samples": [sampler_id, 0], "vae": [vae_id, 0]}}
-    save_id = _id()
-    wf[save_id] = {"class_type": "SaveImage", "inputs": {"images": [decode_id, 0], "filename_prefix": filename_prefix}}
-
-    return {"prompt": wf}
+    g.add("decode", "VAEDecode", samples=["sampler", 0], vae=vae)
+    g.output("save", ["decode", 0], filename_prefix, output_mode)
+    return g.workflow()
 
 
 def build_inpaint_workflow(
@@ -604,6 +683,7 @@ def build_inpaint_workflow(
     sampler: str = "euler",
     scheduler: str = "simple",
     filename_prefix: str = "Holly_refined",
+    output_mode: str = OUTPUT_MODE_FILE,
 ) -> dict:
     """Build a ComfyUI INPAINT workflow for region refinement (ADetailer-style).
 
@@ -625,78 +705,131 @@ def build_inpaint_workflow(
     import random as _random
     if seed is None:
         seed = _random.randint(0, 2**63 - 1)
-    if loras is None:
-        loras = []
-
-    wf = {}
-    nid = [1]
-
-    def _id():
-        v = str(nid[0]); nid[0] += 1; return v
 
+    g = WorkflowGraph()
     # Loaders — identical to build_workflow (Klein bf16, flux2 CLIPLoader)
-    unet_id = _id()
-    wf[unet_id] = {"class_type": "UNETLoader", "inputs": {"unet_name": UNET_FILE, "weight_dtype": "default"}}
-    clip_id = _id()
-    wf[clip_id] = {"class_type": "CLIPLoader", "inputs": {"clip_name": CLIP_FILE, "type": "flux2"}}
-    vae_id = _id()
-    wf[vae_id] = {"class_type": "VAELoader", "inputs": {"vae_name": VAE_FILE}}
-
-    # Chained LoRAs — SAME stack as main generation (identity-preserving)
-    cur_model = [unet_id, 0]
-    cur_clip = [clip_id, 0]
-    for lora in loras:
-        lid = _id()
-        wf[lid] = {"class_type": "LoraLoader", "inputs": {
-            "lora_name": lora["name"],
-            "strength_model": lora.get("strength", 0.8),
-            "strength_clip": lora.get("strength_clip", lora.get("strength", 0.8)),
-            "model": cur_model, "clip": cur_clip,
-        }}
-        cur_model = [lid, 0]
-        cur_clip = [lid, 1]
+    _, _, vae = g.loaders(UNET_FILE, CLIP_FILE, VAE_FILE)
+    # SAME LoRA stack as main generation (identity-preserving) — same ids too,
+    # so the patched model is the one the generation just used.
+    model, clip = g.lora_chain(loras)
 
     # Conditioning
-    pos_id = _id()
-    wf[pos_id] = {"class_type": "CLIPTextEncode", "inputs": {"text": prompt, "clip": cur_clip}}
-    neg_id = _id()
-    wf[neg_id] = {"class_type": "CLIPTextEncode", "inputs": {"text": V2_NEGATIVE_PROMPT, "clip": cur_clip}}
+    pos = g.encode("pos", prompt, clip)
+    neg = g.negative(V2_NEGATIVE_PROMPT, clip, cfg)
 
     # INPAINT path: LoadImage → VAEEncodeForInpaint (full-white mask = img2img)
-    load_id = _id()
-    wf[load_id] = {"class_type": "LoadImage", "inputs": {"image": image_filename}}
-
-    # Full-white mask via ImagePadForOutputStyles? No — VAEEncodeForInpaint takes
-    # a MASK input. We build a white mask using a constant mask node.
-    # Simpler: VAEEncodeForInpaint with a white mask = regenerate entire region.
-    # ComfyUI's LoadImage outputs IMAGE + MASK. If the image has no alpha, MASK
-    # is all-white (full inpaint). That's what we want for region re-render.
-    vae_encode_id = _id()
-    wf[vae_encode_id] = {"class_type": "VAEEncodeForInpaint", "inputs": {
-        "pixels": [load_id, 0],
-        "vae": [vae_id, 0],
-        "mask": [load_id, 1],   # LoadImage's MASK output (all-white = full inpaint)
-        "grow_mask_by": 6,
-    }}
+    g.add("crop", "LoadImage", image=image_filename)
+
+    # VAEEncodeForInpaint takes a MASK input. ComfyUI's LoadImage outputs
+    # IMAGE + MASK; if the image has no alpha, MASK is all-white (full
+    # inpaint) — regenerate the entire region, which is what we want.
+    g.add("crop_encode", "VAEEncodeForInpaint",
+          pixels=["crop", 0],
+          vae=vae,
+          mask=["crop", 1],   # LoadImage's MASK output (all-white = full inpaint)
+          grow_mask_by=6)
 
     # KSampler with denoise < 1.0 (partial re-render, preserves structure)
-    sampler_id = _id()
-    wf[sampler_id] = {"class_type": "KSampler", "inputs": {
-        "seed": seed, "steps": steps, "cfg": cfg,
-        "sampler_name": sampler, "scheduler": scheduler,
-        "denoise": denoise,   # 0.55 = conservative refinement
-        "model": cur_model, "positive": [pos_id, 0], "negative": [neg_id, 0],
-        "latent_image": [vae_encode_id, 0],
-    }}
+    g.add("sampler", "KSampler",
+          seed=seed, steps=steps, cfg=cfg,
+          sampler_name=sampler, scheduler=scheduler,
+          denoise=denoise,   # 0.55 = conservative refinement
+          model=model, positive=pos, negative=neg,
+          latent_image=["crop_encode", 0])
 
     # Decode + Save
-    decode_id = _id()
-    wf[decode_id] = {"class_type": "VAEDecode", "inputs": {"samples": [sampler_id, 0], "vae": [vae_id, 0]}}
-    save_id = _id()
-    wf[save_id] = {"class_type": "SaveImage", "inputs": {"images": [decode_id, 0], "filename_prefix": filename_prefix}}
+    g.add("decode", "VAEDecode", samples=["sampler", 0], vae=vae)
+    g.output("save", ["decode", 0], filename_prefix, output_mode)
+    return g.workflow()
 
-    return {"prompt": wf}
 
+def build_batched_inpaint_workflow(
+    groups: list,
+    seed=None,
+    denoise: float = 0.55,
+    steps: int = V2_STEPS,
+    cfg: float = V2_CFG,
+    sampler: str = "euler",
+    scheduler: str = "simple",
+    filename_prefix: str = "Holly_refined",
+    output_mode: str = OUTPUT_MODE_FILE,
+) -> dict:
+    """Build ONE inpaint graph that refines every detected region (face + hands + feet).
+
+    Same per-region recipe as build_inpaint_workflow, but the loaders are
+    shared, LoRA chains are content-addressed (the face's identity-only set
+    is a prefix of the hands'/feet' full stack, so it is patched once), the
+    negative encode is shared when cfg ≤ 1.0, and every group of crops
+    sharing a LoRA set + prompt is sampled as a single latent batch
+    (LoadImage × N → ImageBatch → VAEEncodeForInpaint → one KSampler).
+
+    Args:
+        groups: [{"key": "hand", "images": [uploaded filenames], "prompt": str,
+                  "loras": [...]}]. All crops must share one size (REFINE_SIZE).
+                  key must be unique and id-safe — node ids are "{key}_<role>",
+                  so the output for a group is node "{key}_save" (one image per
+                  crop, in input order) and its sampling time is the sum over
+                  "{key}_*" nodes.
+    """
+    import random as _random
+    if seed is None:
+        seed = _random.randint(0, 2**63 - 1)
+
+    g = WorkflowGraph()
+    _, _, vae = g.loaders(UNET_FILE, CLIP_FILE, VAE_FILE)
+
+    for group in groups:
+        key = group["key"]
+        # LoRA chains are content-addressed — groups with the same set (or
+        # the same prefix) share nodes; the face's identity-only chain is the
+        # hands'/feet' prefix when the identity LoRA comes first.
+        model, clip = g.lora_chain(group["loras"])
+        neg = g.negative(V2_NEGATIVE_PROMPT, clip, cfg)
+        pos = g.encode(f"{key}_pos", group["prompt"], clip)
+
+        # Crops → one IMAGE batch. The mask comes from the first LoadImage
+        # (all crops are alpha-free PNGs of the same size, so masks are
+        # identical); the sampler repeats it across the batch.
+        for j, filename in enumerate(group["images"]):
+            g.add(f"{key}_load{j}", "LoadImage", image=filename)
+        pixels = [f"{key}_load0", 0]
+        for j in range(1, len(group["images"])):
+            g.add(f"{key}_batch{j}", "ImageBatch", image1=pixels, image2=[f"{key}_load{j}", 0])
+            pixels = [f"{key}_batch{j}", 0]
+
+        g.add(f"{key}_encode", "VAEEncodeForInpaint",
+              pixels=pixels, vae=vae, mask=[f"{key}_load0", 1], grow_mask_by=6)
+        g.add(f"{key}_sample", "KSampler",
+              seed=seed, steps=steps, cfg=cfg,
+              sampler_name=sampler, scheduler=scheduler,
+              denoise=denoise,
+              model=model, positive=pos, negative=neg,
+              latent_image=[f"{key}_encode", 0])
+        g.add(f"{key}_decode", "VAEDecode", samples=[f"{key}_sample", 0], vae=vae)
+        g.output(f"{key}_save", [f"{key}_decode", 0], f"{filename_prefix}_{key}", output_mode)
+
+    return g.workflow()
+
+
+def batched_inpaint_groups(preps: dict) -> list:
+    """build_batched_inpaint_workflow groups from {region_type: [prepared
+    region]} — one latent batch per region type, crops in upload order."""
+    return [
+        {"key": key, "images": [p["uploaded"] for p in group],
+         "prompt": group[0]["prompt"], "loras": group[0]["loras"]}
+        for key, group in preps.items()
+    ]
+
+
+def split_batched_outputs(preps: dict, by_node: dict) -> list:
+    """[(prepared region, refined image)] from a batched inpaint run: node
+    "{key}_save" returns one image per crop, in the order they were batched.
+    Regions whose image is missing are left out (not composited)."""
+    return [
+        (prep, image)
+        for key, group in preps.items()
+        for prep, image in zip(group, by_node.get(f"{key}_save", []))
+    ]
 
 # ─── Volumes ──────────────────────────────────────────────────────────
 # holly-flux2klein-weights: holds the Klein UNET single-file (shared with the
@@ -707,6 +840,17 @@ def build_inpaint_workflow(
 klein_volume = modal.Volume.from_name("holly-flux2klein-weights", create_if_missing=True)
 model_volume = modal.Volume.from_name("holly-comfyui-models", create_if_missing=True)
 lora_volume = modal.Volume.from_name("holly-lora-weights", create_if_missing=True)
+jobs_volume = modal.Volume.from_name("holly-media-jobs", create_if_missing=True)
+jobs_dict = modal.Dict.from_name("holly-media-jobs", create_if_missing=True)
+# Draft token → render spec (prompt, seed, LoRA stack, sizes) for finalize
+drafts_dict = modal.Dict.from_name("holly-klein-drafts", create_if_missing=True)
+
+# Local modules shipped into every image that imports this file
+LOCAL_MODULES = (
+    "comfyui_events", "comfyui_graph", "face_detector", "generation_attempts", "image_context",
+    "input_cache", "lora_residency", "media_delivery", "media_janitor", "media_jobs",
+    "preview_stream", "request_scheduler", "result_cache",
+)
 
 # ─── Image: ComfyUI + dependencies ────────────────────────────────────
 image = (
@@ -751,8 +895,23 @@ image = (
         "mediapipe==0.10.14",
         "pillow",
     )
+    # /ws execution events (completion wait + per-node progress) — the same
+    # client ComfyUI's own script_examples use.
+    .pip_install("websocket-client")
+    .add_local_python_source(*LOCAL_MODULES)
 )
 
+# CPU-only image for the job submit/status/result endpoints
+jobs_image = (
+    modal.Image.debian_slim(python_version="3.11")
+    .pip_install("fastapi[standard]")
+    .add_local_python_source(*LOCAL_MODULES)
+)
+
+# Container-only imports (endpoint signatures reference fastapi.Request)
+with image.imports():
+    import fastapi
+
 
 # ─── Helper: download Klein CLIP + VAE to volume (UNET already on Klein volume) ───
 def download_models():
@@ -1068,12 +1227,14 @@ def wait_for_comfyui(timeout: int = 120):
         KLEIN_VOL_MOUNT: klein_volume,
         MODEL_VOL: model_volume,
         LORA_VOL_MOUNT: lora_volume,
+        JOBS_VOL_MOUNT: jobs_volume,
     },
     secrets=[
         modal.Secret.from_name("huggingface-secret"),
         modal.Secret.from_name("holly-zai-vision"),  # ZAI_API_KEY — GLM-4.6V forensic QA gate
     ],
 )
+@modal.concurrent(max_inputs=KLEIN_MAX_INPUTS)
 class HollyComfyUIKlein:
     """ComfyUI + FLUX.2 Klein 9B v2-recipe endpoint with category-aware LoRA routing."""
 
@@ -1111,6 +1272,16 @@ class HollyComfyUIKlein:
         except Exception:
             pass
 
+        # LoRA residency: K stacks (budget-fitted from recorded usage) → the
+        # LRU node cache size ComfyUI launches with.
+        self.lora_residency = LoraResidency(
+            LORA_VOL_MOUNT, LORA_USAGE_PATH, LORA_STACK_BUDGET_BYTES, LORA_STACK_SLOTS)
+        self._lora_observed = 0
+        slots = self.lora_residency.fit_slots()
+        cache_lru = cache_lru_size(slots, LORA_STACK_MAX_DEPTH)
+        print(f"🧠 LoRA residency: {slots} stacks, budget {LORA_STACK_BUDGET_BYTES / 1024**3:.1f} GiB "
+              f"→ --cache-lru {cache_lru}")
+
         # Step 4: Launch ComfyUI as background process
         print(f"🚀 Launching ComfyUI on port {COMFYUI_PORT}...")
         self.comfyui_proc = subprocess.Popen(
@@ -1120,6 +1291,7 @@ class HollyComfyUIKlein:
                 "--port", str(COMFYUI_PORT),
                 "--preview-method", "auto",
                 "--output-directory", OUTPUT_DIR,
+                "--cache-lru", str(cache_lru),
             ],
             cwd=COMFYUI_DIR,
             stdout=subprocess.PIPE,
@@ -1130,12 +1302,60 @@ class HollyComfyUIKlein:
         # Step 5: Wait for ComfyUI to be ready
         wait_for_comfyui(timeout=180)
 
+        # Step 6: Open the /ws event stream. Every prompt is submitted under
+        # this client_id so completion + progress arrive as pushed events
+        # instead of 1s /history polling. Not fatal if it fails — _wait_for_completion
+        # falls back to polling whenever the socket is down.
+        self.events = ComfyUIEventListener(port=COMFYUI_PORT)
+        if not self.events.start(connect_timeout=15):
+            print("⚠️ ComfyUI /ws not connected yet — polling /history until it is")
+
+        # Step 7: In-memory image hand-off. SaveImageWebsocket is ComfyUI's
+        # bundled example node (custom_nodes/websocket_image_save.py); confirm
+        # it registered before routing outputs through it.
+        self.ws_output_available = False
+        try:
+            with urllib.request.urlopen(
+                f"http://127.0.0.1:{COMFYUI_PORT}/object_info/SaveImageWebsocket", timeout=10
+            ) as resp:
+                self.ws_output_available = "SaveImageWebsocket" in json.loads(resp.read())
+        except Exception as e:
+            print(f"⚠️ SaveImageWebsocket lookup failed: {e}")
+        print(f"   Output hand-off: {'websocket (in-memory)' if self.ws_output_available else 'file (read + unlink)'}")
+
+        # Step 8: Result cache for explicit-seed regenerate/retry requests
+        self.result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+        # ... and content-addressed input/ files (pose refs, skeletons, crops)
+        self.input_cache = InputCache(INPUT_DIR)
+
+        # Step 9: Prewarm the most frequently used LoRA stacks
+        self._prewarm_lora_stacks()
+
+        # Step 10: Admission control — several inputs in flight (the class is
+        # @modal.concurrent), bounded + prioritised here.
+        self.scheduler = RequestScheduler(SCHEDULER_MAX_ACTIVE, SCHEDULER_MAX_WAITING)
+        self._request_local = threading.local()
+        self._detector_lock = threading.Lock()
+
+        # Step 11: Disk janitor for ComfyUI's scratch dirs
+        self.janitor = MediaJanitor([
+            Budget(OUTPUT_DIR, OUTPUT_BUDGET_BYTES, OUTPUT_MAX_AGE_S),
+            Budget(INPUT_DIR, INPUT_BUDGET_BYTES, INPUT_MAX_AGE_S),
+        ])
+        self.janitor.start()
+
         # Print any startup output for debugging
         print("═══ ComfyUI Klein v2-recipe Ready ═══")
 
     @modal.exit()
     def shutdown(self):
         """Clean shutdown of ComfyUI subprocess."""
+        if getattr(self, "events", None) is not None:
+            self.events.stop()
+        if getattr(self, "janitor", None) is not None:
+            self.janitor.stop()
+        if getattr(self, "lora_residency", None) is not None:
+            self._save_lora_usage()
         if hasattr(self, 'comfyui_proc') and self.comfyui_proc.poll() is None:
             self.comfyui_proc.send_signal(signal.SIGTERM)
             self.comfyui_proc.wait(timeout=30)
@@ -1148,8 +1368,27 @@ class HollyComfyUIKlein:
         error (e.g. {"error": {"node_id": ["message"]}}). We capture and
         surface that body so the actual problem is visible instead of a
         generic "HTTP Error 400".
+
+        The prompt is submitted under the event listener's client_id so its
+        execution events are pushed to us over /ws (see _wait_for_completion).
         """
-        data = json.dumps(workflow).encode("utf-8")
+        events = getattr(self, "events", None)
+        epoch = events.epoch if events is not None else 0
+        payload = dict(workflow)
+        if events is not None:
+            payload["client_id"] = events.client_id
+        # Interactive requests jump ComfyUI's queue while batch jobs are in it.
+        # Only then — "front" is LIFO among front prompts, so interactive
+        # requests keep their FIFO order when nothing needs jumping.
+        scheduler = getattr(self, "scheduler", None)
+        if (scheduler is not None and scheduler.active_batch()
+                and getattr(self._request_local, "priority", None) == PRIORITY_INTERACTIVE):
+            payload["front"] = True
+        capture_nodes = [
+            node_id for node_id, node in workflow["prompt"].items()
+            if node.get("class_type") == "SaveImageWebsocket"
+        ]
+        data = json.dumps(payload).encode("utf-8")
         req = urllib.request.Request(
             f"http://127.0.0.1:{COMFYUI_PORT}/prompt",
             data=data,
@@ -1159,7 +1398,10 @@ class HollyComfyUIKlein:
         try:
             with urllib.request.urlopen(req, timeout=30) as resp:
                 result = json.loads(resp.read())
-            return result["prompt_id"]
+            prompt_id = result["prompt_id"]
+            if events is not None:
+                events.track(prompt_id, epoch, capture_nodes=capture_nodes)
+            return prompt_id
         except urllib.error.HTTPError as e:
             # Read ComfyUI's error body before re-raising
             err_body = ""
@@ -1170,50 +1412,301 @@ class HollyComfyUIKlein:
             print(f"❌ ComfyUI /prompt returned {e.code}: {err_body[:1000]}")
             raise RuntimeError(f"ComfyUI {e.code}: {err_body[:500]}") from e
 
-    def _poll_history(self, prompt_id: str, timeout: int = 300) -> dict:
-        """Poll /history/{prompt_id} until the job completes. Returns history entry."""
+    def _wait_for_completion(self, prompt_id: str, timeout: int = 300, on_progress=None,
+                             workflow: dict = None) -> dict:
+        """Wait for a submitted job via /ws events; poll /history if the socket drops.
+
+        on_progress(update) is called with per-node updates while the job runs:
+          {"type": "executing", "node": "7", "class_type": "KSampler", "t": ...}
+          {"type": "progress", "node": "7", "value": 3, "max": 12, ...}
+          {"type": "cached", "nodes": [...]}  (nodes served from ComfyUI's cache)
+        Progress is only available over the socket — the polling fallback
+        reports completion only. Pass the submitted workflow to get class_type
+        on executing/progress updates.
+        """
+        reporter = self._progress_reporter()
+        if reporter is not None:
+            _inner = on_progress
+
+            def on_progress(update):
+                reporter.comfy(update)
+                if _inner is not None:
+                    _inner(update)
+
+        if on_progress is not None and workflow is not None:
+            nodes = workflow.get("prompt", workflow)
+            _callback = on_progress
+
+            def on_progress(update):
+                node = update.get("node")
+                if node is not None and node in nodes:
+                    update = {**update, "class_type": nodes[node].get("class_type")}
+                _callback(update)
+
+        events = getattr(self, "events", None)
         start = time.time()
-        while time.time() - start < timeout:
+        if events is not None:
+            entry = events.wait(prompt_id, timeout=timeout, on_progress=on_progress)
+            if entry is not None:
+                if not entry["outputs"] and not any(entry["ws_images"].values()):
+                    # `executed` events missed — one /history read fills in
+                    # the outputs; no sleep loop.
+                    entry = self._poll_history(prompt_id, timeout=10, interval=0.25)
+                return entry
+            print(f"   /ws unavailable for {prompt_id[:8]} — falling back to /history polling")
+        remaining = max(1, int(timeout - (time.time() - start)))
+        return self._poll_history(prompt_id, timeout=remaining)
+
+    def _poll_history(self, prompt_id: str, timeout: int = 300, interval: float = 1.0) -> dict:
+        """Poll /history/{prompt_id} until the job completes. Returns history entry.
+
+        Fallback for _wait_for_completion when the /ws event stream is down.
+        """
+        return poll_history(prompt_id, port=COMFYUI_PORT, timeout=timeout, interval=interval)
+
+    def _cancel_prompt(self, prompt_id: str):
+        """Drop a speculatively queued prompt we no longer need.
+
+        Deletes it from the ComfyUI queue first, then interrupts it if it is
+        already sampling. /interrupt is scoped by prompt_id, but older ComfyUI
+        builds ignore the body and interrupt whatever runs — with concurrent
+        requests that could be someone else's prompt, so only interrupt when
+        the /ws listener says this one is running (or there is no listener to
+        ask). The status is read AFTER the delete: read before it, a prompt
+        that starts in between is neither in the queue nor interrupted.
+        """
+        base = f"http://127.0.0.1:{COMFYUI_PORT}"
+        events = getattr(self, "events", None)
+
+        def _post(path, body):
             try:
                 req = urllib.request.Request(
-                    f"http://127.0.0.1:{COMFYUI_PORT}/history/{prompt_id}"
+                    f"{base}{path}",
+                    data=json.dumps(body).encode("utf-8"),
+                    headers={"Content-Type": "application/json"},
+                    method="POST",
                 )
-                with urllib.request.urlopen(req, timeout=10) as resp:
-                    history = json.loads(resp.read())
-
-                if prompt_id in history:
-                    entry = history[prompt_id]
-                    # Check for errors
-                    if "status" in entry and entry["status"].get("status_str") == "error":
-                        raise RuntimeError(f"ComfyUI job failed: {entry['status'].get('messages', 'unknown error')}")
-                    # Check if outputs exist
-                    if "outputs" in entry and entry["outputs"]:
-                        return entry
-            except urllib.error.URLError:
-                pass
-            time.sleep(1)
+                urllib.request.urlopen(req, timeout=10).close()
+            except Exception as e:
+                print(f"   ⚠️ cancel {prompt_id[:8]} via {path} failed: {e}")
+
+        _post("/queue", {"delete": [prompt_id]})
+        status = events.status(prompt_id) if events is not None else None
+        if status == "running" or events is None:
+            _post("/interrupt", {"prompt_id": prompt_id})
+        if events is not None:
+            events.forget(prompt_id)
+        print(f"   🗑️ Cancelled speculative prompt {prompt_id[:8]} (was {status or 'unknown'})")
+
+    def _progress_reporter(self):
+        """This thread's progress sink: a media_jobs.ProgressReporter (async
+        job) or a preview_stream.SSEStream (streaming endpoint), else None."""
+        local = getattr(self, "_request_local", None)
+        return getattr(local, "reporter", None) if local is not None else None
+
+    def _report_progress(self, **fields):
+        reporter = self._progress_reporter()
+        if reporter is not None:
+            reporter.set(**fields)
+
+    @contextlib.contextmanager
+    def _admitted(self, request: dict):
+        """Run slot from the scheduler for one endpoint call, or HTTP 429.
+
+        request["priority"]: "interactive" (default — chat) or "batch"
+        (dataset/bulk jobs; yields to interactive work here and in ComfyUI's
+        queue).
+        """
+        from fastapi import HTTPException
 
-        raise TimeoutError(f"ComfyUI job {prompt_id} did not complete within {timeout}s")
+        priority = PRIORITIES.get(request.get("priority", "interactive"))
+        if priority is None:
+            raise HTTPException(status_code=400, detail=f"priority must be one of {sorted(PRIORITIES)}")
+        try:
+            with self.scheduler.admit(priority, timeout=SCHEDULER_WAIT_TIMEOUT_S) as ticket:
+                self._request_local.priority = priority
+                try:
+                    yield ticket
+                finally:
+                    self._request_local.priority = None
+        except QueueFull as e:  # only raised by admit() — the body runs after
+            print(f"   🚦 429 — {e}")
+            raise HTTPException(
+                status_code=429,
+                detail={"error": "queue full", "queue_depth": e.depth, "eta_s": round(e.eta_s, 1)},
+                headers={
+                    "Retry-After": str(e.retry_after),
+                    "X-Queue-Depth": str(e.depth),
+                    "X-Queue-Eta-S": str(round(e.eta_s, 1)),
+                },
+            ) from e
+
+    def _observe_lora_stacks(self, workflow: dict, history: dict):
+        """Feed a finished job's LoRA chains to the residency manager."""
+        residency = getattr(self, "lora_residency", None)
+        if residency is None:
+            return
+        try:
+            for stack_id, hit, patch_s in residency.observe(workflow, history):
+                if not hit:
+                    print(f"   🧩 LoRA stack {stack_id} loaded/patched in {patch_s:.2f}s")
+        except Exception as e:
+            print(f"   ⚠️ LoRA residency bookkeeping failed: {e}")
+            return
+        self._lora_observed += 1
+        if self._lora_observed % LORA_USAGE_SAVE_EVERY == 0:
+            self._save_lora_usage()
 
-    def _fetch_image(self, history_entry: dict) -> bytes:
-        """Fetch the generated image from ComfyUI's /view endpoint."""
-        # Find the SaveImage output
+    def _save_lora_usage(self):
+        try:
+            self.lora_residency.save()
+            model_volume.commit()
+        except Exception as e:
+            print(f"   ⚠️ LoRA usage save failed: {e}")
+
+    def _prewarm_lora_stacks(self):
+        """Run a 1-step 256² graph per frequent stack so ComfyUI's LRU cache
+        holds the loaded LoRAs before the first request."""
+        stacks = self.lora_residency.prewarm_stacks()
+        if not stacks:
+            return
+        t0 = time.time()
+        for loras in stacks:
+            workflow = build_workflow(
+                "warmup", width=256, height=256, seed=0, loras=loras, steps=1,
+                filename_prefix=f"Holly_prewarm_{uuid.uuid4().hex[:8]}",
+                output_mode=self._output_mode(),
+            )
+            try:
+                prompt_id = self._post_workflow(workflow)
+                history = self._wait_for_completion(prompt_id, timeout=180)
+                self._fetch_images(history)  # file mode: read + unlink the throwaway output
+            except Exception as e:
+                print(f"   ⚠️ LoRA prewarm failed for {[l['name'] for l in loras]}: {e}")
+                continue
+            self.lora_residency.observe(workflow, history, record=False)
+            self.lora_residency.prewarmed += 1
+        print(f"🔥 Prewarmed {self.lora_residency.prewarmed}/{len(stacks)} LoRA stacks "
+              f"in {time.time() - t0:.1f}s")
+
+    def _cache_key(self, request: dict, seed, workflow: dict, input_digests: dict = None):
+        """Graph cache key, or None (X-Cache: BYPASS) when the output isn't
+        reproducible (no explicit seed) or the caller sent cache: false."""
+        if seed is None or not request.get("cache", True) or getattr(self, "result_cache", None) is None:
+            return None
+        return graph_key(workflow, input_digests)
+
+    def _cache_store(self, key: str, images: list):
+        """Write a graph's outputs to the cache and commit the models volume."""
+        try:
+            if self.result_cache.put(key, images):
+                model_volume.commit()
+        except Exception as e:
+            print(f"   ⚠️ result cache write failed for {key[:12]}: {e}")
+
+    def _output_mode(self) -> str:
+        """websocket hand-off when the node exists and /ws is up, else file."""
+        events = getattr(self, "events", None)
+        if getattr(self, "ws_output_available", False) and events is not None and events.connected:
+            return OUTPUT_MODE_WEBSOCKET
+        return OUTPUT_MODE_FILE
+
+    def _run_image_workflow(self, workflow: dict, timeout: int = 300, on_progress=None,
+                            cache_key: str = None):
+        """Submit a workflow, wait, and return (images, prompt_id).
+
+        images is the flat list of PNG bytes from the graph's output nodes, in
+        graph order (see _run_image_workflow_nodes). With a cache_key (see
+        _cache_key) a cached result is returned without touching ComfyUI —
+        prompt_id is then "cached".
+        """
+        if cache_key:
+            cached = self.result_cache.get(cache_key)
+            if cached:
+                print(f"   💾 Result cache HIT {cache_key[:12]}")
+                return cached, "cached"
+        by_node, prompt_id, _history = self._run_image_workflow_nodes(
+            workflow, timeout=timeout, on_progress=on_progress)
+        order = list(workflow["prompt"])
+        images = [img for nid in sorted(by_node, key=order.index) for img in by_node[nid]]
+        if cache_key:
+            self._cache_store(cache_key, images)
+        return images, prompt_id
+
+    def _run_image_workflow_nodes(self, workflow: dict, timeout: int = 300, on_progress=None):
+        """Submit a workflow, wait, and return ({output_node_id: [png_bytes]}, prompt_id, history).
+
+        SaveImageWebsocket outputs come straight off the /ws stream. If the
+        socket dropped mid-job those bytes are gone — the same graph is
+        re-queued with SaveImage; ComfyUI's node cache means only the save
+        node actually re-executes.
+        """
+        prompt_id = self._post_workflow(workflow)
+        return self._collect_image_workflow(
+            workflow, prompt_id, timeout=timeout, on_progress=on_progress)
+
+    def _collect_image_workflow(self, workflow: dict, prompt_id: str, timeout: int = 300,
+                                on_progress=None):
+        """Wait for an already-submitted workflow; same return as _run_image_workflow_nodes."""
+        history = self._wait_for_completion(
+            prompt_id, timeout=timeout, on_progress=on_progress, workflow=workflow)
+        self._observe_lora_stacks(workflow, history)
+
+        ws_nodes = [nid for nid, node in workflow["prompt"].items()
+                    if node["class_type"] == "SaveImageWebsocket"]
+        if not ws_nodes:
+            return self._fetch_images(history), prompt_id, history
+
+        ws_images = history.get("ws_images") or {}
+        by_node = {nid: ws_images[nid] for nid in ws_nodes if ws_images.get(nid)}
+        if len(by_node) == len(ws_nodes):
+            return by_node, prompt_id, history
+
+        print(f"   ⚠️ Missing /ws image frames for {prompt_id[:8]} — re-queueing with file output")
+        file_wf = with_file_output(workflow, f"Holly_wsfallback_{prompt_id[:8]}")
+        prompt_id = self._post_workflow(file_wf)
+        history = self._wait_for_completion(prompt_id, timeout=timeout)
+        return self._fetch_images(history), prompt_id, history
+
+    def _fetch_images(self, history_entry: dict) -> dict:
+        """Read every SaveImage output straight off disk and delete it.
+
+        Returns {output_node_id: [png_bytes, ...]}. ComfyUI shares our
+        filesystem, so the /view round trip is only a fallback (e.g. file not
+        where history says). Unlinking after the read keeps OUTPUT_DIR from
+        growing without limit — which is why every file-mode graph must save
+        under a per-job filename_prefix: an identical graph would be served
+        from ComfyUI's node cache, pointing at the file already unlinked.
+        """
+        by_node = {}
         outputs = history_entry.get("outputs", {})
         for node_id, node_output in outputs.items():
-            if "images" in node_output:
-                img_info = node_output["images"][0]
+            for img_info in node_output.get("images", []):
                 filename = img_info["filename"]
                 subfolder = img_info.get("subfolder", "")
                 img_type = img_info.get("type", "output")
 
+                path = os.path.join(OUTPUT_DIR if img_type == "output" else INPUT_DIR, subfolder, filename)
+                if os.path.isfile(path):
+                    with open(path, "rb") as f:
+                        by_node.setdefault(node_id, []).append(f.read())
+                    if img_type == "output":
+                        try:
+                            os.unlink(path)
+                        except OSError:
+                            pass
+                    continue
+
                 url = (
                     f"http://127.0.0.1:{COMFYUI_PORT}/view?"
                     f"filename={filename}&subfolder={subfolder}&type={img_type}"
                 )
                 with urllib.request.urlopen(url, timeout=30) as resp:
-                    return resp.read()
+                    by_node.setdefault(node_id, []).append(resp.read())
 
-        raise RuntimeError("No image found in ComfyUI output")
+        if not by_node:
+            raise RuntimeError("No image found in ComfyUI output")
+        return by_node
 
     # ─────────────────────────────────────────────────────────────────────
     # ADetailer-style refinement pass (hands, feet, faces)
@@ -1224,77 +1717,71 @@ class HollyComfyUIKlein:
     # diffusers face-enhance (FACT.md lesson, June 27 2026).
     # Detection: Haar cascade for faces (proven), DWPose for hands/feet.
 
-    def _upload_image(self, img_bytes: bytes, filename: str = None) -> str:
+    def _upload_image(self, img_bytes: bytes, prefix: str = "refine") -> str:
         """Upload an image to ComfyUI's input/ dir via /upload/image.
 
-        Returns the filename ComfyUI stored it as (for LoadImage node).
-        Uses multipart form-data per ComfyUI's upload API.
+        Returns the filename ComfyUI stored it as (for LoadImage node). The
+        name is content-derived (see input_cache.py): identical bytes keep
+        the same LoadImage input — ComfyUI's node cache stays valid — and
+        are only transferred once per container.
         """
-        import uuid as _uuid
-        if filename is None:
-            filename = f"refine_{_uuid.uuid4().hex[:8]}.png"
-
-        # Build multipart form data manually (avoid extra deps)
-        boundary = f"----HolLyBoundary{_uuid.uuid4().hex}"
-        body = (
-            f"--{boundary}\r\n"
-            f'Content-Disposition: form-data; name="image"; filename="{filename}"\r\n'
-            f"Content-Type: image/png\r\n\r\n"
-        ).encode("utf-8") + img_bytes + f"\r\n--{boundary}--\r\n".encode("utf-8")
+        digest = digest_bytes(img_bytes)
+        return self._upload_input(digest, prefix, ".png", data=img_bytes)
+
+    def _upload_file(self, path: str, prefix: str) -> tuple:
+        """_upload_image for a file on a volume, streamed from disk.
 
+        Returns (name, sha256). A repeat of the same file is neither re-read
+        nor re-sent: the digest is memoised by size + mtime.
+        """
+        digest = self.input_cache.path_digest(path)
+        ext = os.path.splitext(path)[1].lower() or ".png"
+        return self._upload_input(digest, prefix, ext, path=path), digest
+
+    def _upload_input(self, digest: str, prefix: str, ext: str, data: bytes = None,
+                      path: str = None) -> str:
+        name = self.input_cache.lookup(digest)
+        if name is not None:
+            return name
+        filename = content_name(digest, prefix, ext)
+        # Streamed multipart (no second in-memory copy of the image);
+        # overwrite=true — the name already identifies the content.
+        chunks, content_type, length = multipart_body(
+            filename, data=data, path=path, fields={"overwrite": "true"})
         req = urllib.request.Request(
             f"http://127.0.0.1:{COMFYUI_PORT}/upload/image",
-            data=body,
-            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+            data=chunks,
+            headers={"Content-Type": content_type, "Content-Length": str(length)},
             method="POST",
         )
         with urllib.request.urlopen(req, timeout=30) as resp:
             result = json.loads(resp.read())
         # ComfyUI returns {"name": filename, "subfolder": "", "type": "input"}
-        return result.get("name", filename)
-
-    def _detect_face_bbox(self, pil_img):
+        name = result.get("name", filename)
+        self.input_cache.record(digest, name, len(data) if data is not None else os.path.getsize(path))
+        return name
+
+    def _load_face_detector(self):
+        """Lazy-load the Haar face detector (cascades parsed once per container)."""
+        if getattr(self, "_face_detector", None) is None:
+            with self._detector_lock:
+                if getattr(self, "_face_detector", None) is None:
+                    self._face_detector = FaceDetector()
+        return self._face_detector
+
+    @staticmethod
+    def _as_frame(img):
+        """ImageContext/DetectionFrame as-is; PIL images get a one-off frame."""
+        return img if isinstance(img, DetectionFrame) else DetectionFrame.from_pil(img)
+
+    def _detect_face_bbox(self, img):
         """Detect the largest face via OpenCV Haar cascades.
-        Ported verbatim from image_generate_flux2klein_a100.py lines 650-689.
+        Originally ported from image_generate_flux2klein_a100.py lines 650-689;
+        now a bounded-resolution pyramid (see face_detector.py).
+        img: the request's ImageContext (reuses its gray buffer) or a PIL image.
         Returns (x, y, w, h) or None.
         """
-        import cv2
-        import numpy as np
-
-        arr = np.array(pil_img.convert("RGB"))
-        gray = cv2.cvtColor(arr, cv2.COLOR_RGB2GRAY)
-        gray = cv2.equalizeHist(gray)
-
-        frontal_path = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
-        profile_path = cv2.data.haarcascades + "haarcascade_profileface.xml"
-
-        frontal = cv2.CascadeClassifier(frontal_path)
-        profile = cv2.CascadeClassifier(profile_path)
-
-        min_size = (60, 60)
-        faces = []
-        for sf in (1.05, 1.1, 1.2):
-            found = frontal.detectMultiScale(gray, scaleFactor=sf, minNeighbors=5, minSize=min_size)
-            if len(found):
-                faces.extend(found)
-
-        if not faces:
-            for sf in (1.05, 1.1):
-                found = profile.detectMultiScale(gray, scaleFactor=sf, minNeighbors=5, minSize=min_size)
-                if len(found):
-                    faces.extend(found)
-                flipped = cv2.flip(gray, 1)
-                found_r = profile.detectMultiScale(flipped, scaleFactor=sf, minNeighbors=5, minSize=min_size)
-                if len(found_r):
-                    w_img = gray.shape[1]
-                    for (x, y, w, h) in found_r:
-                        faces.append((w_img - x - w, y, w, h))
-
-        if not faces:
-            return None
-
-        best = max(faces, key=lambda f: f[2] * f[3])
-        return tuple(int(v) for v in best)
+        return self._load_face_detector().detect(self._as_frame(img))
 
     def _face_crop_region(self, img_w, img_h, bbox, crop_factor=3.0):
         """Square crop centered on face. Ported from a100 lines 691-721."""
@@ -1335,20 +1822,21 @@ class HollyComfyUIKlein:
         return alpha
 
     def _match_skin_tone(self, source_crop, enhanced_crop):
-        """RGB mean-shift color match. Ported from a100 lines 855-879."""
+        """RGB mean-shift color match. Ported from a100 lines 855-879.
+
+        Takes and returns HxWx3 uint8 arrays (the ImageContext pipeline).
+        """
         import numpy as np
-        from PIL import Image
 
-        src = np.array(source_crop.convert("RGB")).astype(np.float32)
-        enh = np.array(enhanced_crop.convert("RGB")).astype(np.float32)
+        src = np.asarray(source_crop, dtype=np.float32)
+        enh = np.asarray(enhanced_crop, dtype=np.float32)
         src_mean = src.mean(axis=(0, 1))
         enh_mean = enh.mean(axis=(0, 1))
         delta = src_mean - enh_mean
         matched = enh + delta * 0.5
-        matched = matched.clip(0, 255).astype(np.uint8)
-        return Image.fromarray(matched, mode="RGB")
+        return matched.clip(0, 255).astype(np.uint8)
 
-    def _check_image_quality(self, img_bytes):
+    def _check_image_quality(self, img):
         """Quick quality check on a generated image. Returns (passes, reason).
 
         Uses MediaPipe to count hands — more than 2 hands = likely conjoined/
@@ -1356,12 +1844,12 @@ class HollyComfyUIKlein:
 
         This is the auto-reject filter for multi-generation: if an image has
         >2 hands or >1 body, it's rejected and we try the next seed.
+
+        img: the candidate's ImageContext (or raw PNG bytes).
         """
         try:
-            import io
-            from PIL import Image
-            pil_img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-            hands, feet, body_count = self._detect_hand_and_foot_regions(pil_img)
+            ctx = img if isinstance(img, ImageContext) else ImageContext.from_bytes(img)
+            hands, feet, body_count = self._detect_hand_and_foot_regions(ctx)
             if body_count > 1:
                 return False, f"{body_count} bodies detected (conjoined)"
             if len(hands) > 2:
@@ -1462,8 +1950,63 @@ class HollyComfyUIKlein:
             return False, f"vision QA: {'; '.join(failures)} — {verdict.strip()[:250]}"
         return True, f"vision QA OK — {verdict.strip()[:150]}"
 
-    def _generate_single(self, prompt, width, height, seed, loras, steps, cfg, sampler=None, negative_prompt=None):
-        """Generate a single image via ComfyUI. Returns (img_bytes, prompt_id, job_id)."""
+    def _qa_candidates(self, images, body_integrity, require_face=True, action_desc=None):
+        """QA every candidate of an attempt. Returns [(passes, reason, severity, ctx)].
+
+        ctx is the candidate's decoded ImageContext when the local (MediaPipe)
+        check decoded it — the winner's is reused by the refinement pass —
+        else None (vision QA sends the PNG bytes as-is).
+
+        severity ranks failures for the all-fail fallback: fewer problems =
+        better; asymmetric (fused/missing) is worse than a soft fail like
+        "face not visible". Vision QA calls are remote, so a latent batch is
+        checked concurrently; the MediaPipe check shares detector instances
+        and stays serial.
+        """
+        def _one(img):
+            ctx = None
+            if body_integrity:
+                passes, reason = self._check_body_integrity(
+                    img, require_face=require_face, action_desc=action_desc)
+            else:
+                ctx = ImageContext.from_bytes(img)
+                passes, reason = self._check_image_quality(ctx)
+            sev = 0
+            if not passes:
+                sev = reason.count(";") + 1
+                if "asymmetric" in reason:
+                    sev += 10  # fusions/missing limbs = worst
+            return passes, reason, sev, ctx
+
+        if body_integrity and len(images) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=len(images)) as pool:
+                return list(pool.map(_one, images))
+        return [_one(img) for img in images]
+
+    def _generate_single(self, prompt, width, height, seed, loras, steps, cfg, sampler=None,
+                         negative_prompt=None, on_progress=None):
+        """Generate a single image via ComfyUI. Returns (img_bytes, prompt_id, job_id).
+
+        on_progress receives per-node updates (see _wait_for_completion).
+        """
+        handle = self._submit_single(
+            prompt, width, height, seed, loras, steps, cfg, sampler,
+            negative_prompt=negative_prompt,
+        )
+        img_bytes, prompt_id, _history = self._collect_single(handle, on_progress=on_progress)
+        return img_bytes, prompt_id, handle["job_id"]
+
+    def _submit_single(self, prompt, width, height, seed, loras, steps, cfg, sampler=None,
+                       negative_prompt=None, batch_size=1, request=None):
+        """Queue a single-image generation without waiting for it.
+
+        Returns a handle for _collect_single / _cancel_prompt — the pipelined
+        attempt loop in generate() queues attempt N+1 before QA'ing attempt N.
+        batch_size > 1 queues a latent batch of candidates (_collect_candidates).
+        Pass the request dict to enable the result cache — a hit is returned
+        in the handle without queueing anything.
+        """
         job_id = str(uuid.uuid4())[:8]
         workflow = build_workflow(
             prompt=prompt,
@@ -1476,35 +2019,65 @@ class HollyComfyUIKlein:
             sampler=sampler or V2_SAMPLER,
             filename_prefix=f"Holly_{job_id}",
             negative_prompt=negative_prompt,
+            output_mode=self._output_mode(),
+            batch_size=batch_size,
         )
-        prompt_id = self._post_workflow(workflow)
-        history = self._poll_history(prompt_id, timeout=300)
-        img_bytes = self._fetch_image(history)
-        return img_bytes, prompt_id, job_id
+        cache_key = self._cache_key(request, seed, workflow) if request is not None else None
+        handle = {"job_id": job_id, "workflow": workflow, "cache_key": cache_key, "cache": "BYPASS"}
+        if cache_key:
+            cached = self.result_cache.get(cache_key)
+            if cached:
+                print(f"   💾 Result cache HIT {cache_key[:12]}")
+                return {**handle, "prompt_id": "cached", "cached": cached, "cache": "HIT"}
+            handle["cache"] = "MISS"
+        handle["prompt_id"] = self._post_workflow(workflow)
+        return handle
+
+    def _collect_single(self, handle: dict, on_progress=None):
+        """Wait for a _submit_single job. Returns (img_bytes, prompt_id, history)."""
+        images, prompt_id, history = self._collect_candidates(handle, on_progress=on_progress)
+        return images[0], prompt_id, history
+
+    def _collect_candidates(self, handle: dict, on_progress=None):
+        """Wait for a _submit_single job. Returns ([img_bytes per batch item], prompt_id, history)."""
+        if handle.get("cached"):
+            return handle["cached"], handle["prompt_id"], {}
+        by_node, prompt_id, history = self._collect_image_workflow(
+            handle["workflow"], handle["prompt_id"], timeout=300, on_progress=on_progress)
+        images = [img for imgs in by_node.values() for img in imgs]
+        if not images:
+            raise RuntimeError(f"No images in ComfyUI output for {prompt_id}")
+        if handle.get("cache_key"):
+            self._cache_store(handle["cache_key"], images)
+        return images, prompt_id, history
 
     def _load_hand_detector(self):
         """Lazy-load MediaPipe Hands detector (cached on instance).
         Uses the solutions API (mediapipe==0.10.14 pinned — newer versions
-        dropped this API)."""
-        if hasattr(self, '_hand_detector') and self._hand_detector is not None:
+        dropped this API). Concurrent first requests would each build a
+        graph and race on the attribute — same lock as _load_face_detector."""
+        if getattr(self, "_hand_detector", None) is not None:
+            return self._hand_detector
+        with self._detector_lock:
+            if getattr(self, "_hand_detector", None) is not None:
+                return self._hand_detector
+            try:
+                import mediapipe as mp
+                print("📥 Loading MediaPipe Hands detector (first use)...")
+                self._hand_detector = mp.solutions.hands.Hands(
+                    static_image_mode=True,
+                    max_num_hands=4,
+                    min_detection_confidence=0.25,  # lowered from 0.4 — MediaPipe
+                    # struggles with hands near explicit content; lower threshold
+                    # catches more (may add false positives, but refinement is safe)
+                )
+                print("✅ MediaPipe Hands detector loaded")
+            except Exception as e:
+                print(f"⚠️ MediaPipe Hands load failed: {e}")
+                self._hand_detector = None
             return self._hand_detector
-        try:
-            import mediapipe as mp
-            print("📥 Loading MediaPipe Hands detector (first use)...")
-            self._hand_detector = mp.solutions.hands.Hands(
-                static_image_mode=True,
-                max_num_hands=4,
-                min_detection_confidence=0.25,  # lowered from 0.4 — MediaPipe
-                # struggles with hands near explicit content; lower threshold
-                # catches more (may add false positives, but refinement is safe)
-            )
-            print("✅ MediaPipe Hands detector loaded")
-        except Exception as e:
-            print(f"⚠️ MediaPipe Hands load failed: {e}")
-            self._hand_detector = None
-        return self._hand_detector
 
-    def _detect_hand_and_foot_regions(self, pil_img):
+    def _detect_hand_and_foot_regions(self, img):
         """Detect hand and foot regions via MediaPipe Hands.
 
         Returns (hands, feet, body_count) where each is a list of (x0, y0, x1, y1).
@@ -1523,14 +2096,16 @@ class HollyComfyUIKlein:
         if hands_detector is None:
             return [], [], 1
 
-        w_img, h_img = pil_img.size
+        frame = self._as_frame(img)
+        w_img, h_img = frame.size
         hands = []
 
         try:
-            import cv2
-            # MediaPipe expects RGB numpy array
-            rgb = np.array(pil_img.convert("RGB"))
-            results = hands_detector.process(rgb)
+            # MediaPipe expects an RGB numpy array — the request's ImageContext
+            # buffer, shared with face detection
+            # MediaPipe graphs aren't thread-safe — concurrent requests take turns
+            with self._detector_lock:
+                results = hands_detector.process(frame.rgb)
 
             if results.multi_hand_landmarks:
                 for hand_lms in results.multi_hand_landmarks:
@@ -1569,15 +2144,22 @@ class HollyComfyUIKlein:
 
         return hands, feet, max(body_count, 1)
 
-    def _refine_region(self, pil_img, region, region_type, prompt, loras, seed=None):
-        """Refine a single region (face/hand/foot) via ComfyUI inpaint.
+    # Crops are upscaled to this size for refinement (more pixel budget for
+    # digit geometry). Also keeps every crop the same size so the batched
+    # refinement graph can ImageBatch them.
+    REFINE_SIZE = 768
 
-        Returns (refined_pil, status_string) or (None, error_string).
+    def _prepare_region(self, ctx, region, region_type, prompt, loras):
+        """Square-crop a region and build its refinement prompt + LoRA stack.
+
+        ctx is the request's ImageContext. Returns (prep_dict, status).
+        prep_dict is None when the region is skipped; otherwise it carries
+        everything _composite_region needs.
         """
         import io
         from PIL import Image
 
-        w_img, h_img = pil_img.size
+        w_img, h_img = ctx.size
         x0, y0, x1, y1 = region
         crop_w = x1 - x0
         crop_h = y1 - y0
@@ -1601,12 +2183,12 @@ class HollyComfyUIKlein:
         if actual_side < 60:
             return None, f"skipped ({region_type} crop too small: {actual_side}px)"
 
-        # Crop
-        crop_orig = pil_img.convert("RGB").crop((sx0, sy0, sx1, sy1))
+        # Crop (array copy — later composites must not change the skin-tone
+        # reference)
+        crop_orig = ctx.crop((sx0, sy0, sx1, sy1))
 
-        # Upscale to 768 for refinement (more pixel budget for digit geometry)
-        REFINE_SIZE = 768
-        crop_up = crop_orig.resize((REFINE_SIZE, REFINE_SIZE), Image.LANCZOS)
+        crop_up = Image.fromarray(crop_orig, mode="RGB").resize(
+            (self.REFINE_SIZE, self.REFINE_SIZE), Image.LANCZOS)
 
         # Region-specific prompt
         if region_type == "face":
@@ -1651,124 +2233,289 @@ class HollyComfyUIKlein:
             else:
                 region_loras = list(V2_BAKED_LORAS)
 
-        # Upload crop to ComfyUI
         buf = io.BytesIO()
         crop_up.save(buf, format="PNG")
-        crop_bytes = buf.getvalue()
+        return {
+            "type": region_type,
+            "box": (sx0, sy0, sx1, sy1),
+            "side": actual_side,
+            "crop_orig": crop_orig,
+            "crop_bytes": buf.getvalue(),
+            "prompt": region_prompt,
+            "loras": region_loras,
+            "feather_ratio": feather_ratio,
+        }, "prepared"
+
+    def _composite_region(self, ctx, prep, refined_bytes):
+        """Resize a refined crop back, skin-tone match, and feather-paste it
+        into the request's ImageContext in place (no full-frame copy)."""
+        self._paste_region(ctx, prep, self._decode_refined(prep, refined_bytes))
+
+    def _decode_refined(self, prep, refined_bytes):
+        """Refined crop bytes → skin-tone-matched RGB array at the crop's
+        original side. Touches nothing shared, so a batch can decode every
+        output before the first paste (see _refine_regions_batched)."""
+        import io
+        import numpy as np
+        from PIL import Image
+
+        actual_side = prep["side"]
+
+        # Decode refined image + resize back to crop dimensions
+        with Image.open(io.BytesIO(refined_bytes)) as refined_up:
+            refined_orig = np.asarray(refined_up.convert("RGB").resize(
+                (actual_side, actual_side), Image.LANCZOS))
+
+        # Skin-tone match
         try:
-            uploaded_name = self._upload_image(crop_bytes)
+            refined_orig = self._match_skin_tone(prep["crop_orig"], refined_orig)
+        except Exception:
+            pass
+        return refined_orig
+
+    def _paste_region(self, ctx, prep, refined_orig):
+        """Feather-paste a decoded refined crop into ctx in place."""
+        sx0, sy0 = prep["box"][:2]
+        alpha = self._build_paste_alpha(prep["side"], feather_ratio=prep["feather_ratio"])
+        ctx.composite(refined_orig, (sx0, sy0), alpha)
+
+    def _refine_region(self, ctx, region, region_type, prompt, loras, seed=None):
+        """Refine a single region (face/hand/foot) via ComfyUI inpaint.
+
+        Composites into ctx in place. Returns (True, status_string) or
+        (None, error_string). One ComfyUI round trip per region — the
+        refine_mode="sequential" path.
+        """
+        prep, status = self._prepare_region(ctx, region, region_type, prompt, loras)
+        if prep is None:
+            return None, status
+
+        # Upload crop to ComfyUI
+        try:
+            uploaded_name = self._upload_image(prep["crop_bytes"])
         except Exception as e:
             return None, f"upload failed: {e}"
 
         # Build inpaint workflow (region-filtered LoRA stack for identity safety)
         workflow = build_inpaint_workflow(
             image_filename=uploaded_name,
-            prompt=region_prompt,
-            width=REFINE_SIZE,
-            height=REFINE_SIZE,
-            loras=region_loras,
+            prompt=prep["prompt"],
+            width=self.REFINE_SIZE,
+            height=self.REFINE_SIZE,
+            loras=prep["loras"],
             seed=seed,
             denoise=0.55,
             steps=12,
-            filename_prefix=f"Holly_refine_{region_type}",
+            filename_prefix=f"Holly_refine_{region_type}_{uuid.uuid4().hex[:8]}",
+            output_mode=self._output_mode(),
         )
 
         try:
-            prompt_id = self._post_workflow(workflow)
-            history = self._poll_history(prompt_id, timeout=120)
-            refined_bytes = self._fetch_image(history)
+            refined_bytes = self._run_image_workflow(workflow, timeout=120)[0][0]
         except Exception as e:
             return None, f"inpaint failed: {e}"
 
-        # Decode refined image
-        refined_up = Image.open(io.BytesIO(refined_bytes)).convert("RGB")
-
-        # Resize back to crop dimensions
-        refined_orig = refined_up.resize((actual_side, actual_side), Image.LANCZOS)
-
-        # Skin-tone match
-        try:
-            refined_orig = self._match_skin_tone(crop_orig, refined_orig)
-        except Exception:
-            pass
-
-        # Feathered paste
-        alpha = self._build_paste_alpha(actual_side, feather_ratio=feather_ratio)
-        alpha_pil = Image.fromarray(alpha, mode="L")
-
-        final = pil_img.convert("RGB").copy()
-        final.paste(refined_orig, (sx0, sy0), alpha_pil)
+        self._composite_region(ctx, prep, refined_bytes)
+        return True, f"refined {region_type} ({prep['side']}px)"
 
-        return final, f"refined {region_type} ({actual_side}px)"
+    def _refine_regions_batched(self, ctx, regions, prompt, loras, seed=None):
+        """Refine every region with ONE ComfyUI graph (see build_batched_inpaint_workflow).
 
-    def _run_refinement_pass(self, pil_img, prompt, loras, seed=None):
+        regions: [(label, region_type, bbox)] in composite order (face first).
+        Crops are taken from the same source frame, uploaded once each, sampled
+        in one prompt (one latent batch per LoRA set + prompt), then all decoded
+        and only then composited in order (into ctx, in place). Returns (labels_done, timings) where timings maps
+        "face" / "hand1+hand2" / ... → sampling seconds, plus "upload",
+        "comfyui" (whole graph) and "composite".
+        """
+        timings = {}
+        t0 = time.time()
+        groups = {}
+        for label, region_type, bbox in regions:
+            prep, status = self._prepare_region(ctx, bbox, region_type, prompt, loras)
+            if prep is None:
+                print(f"  ⏭️ {label}: {status}")
+                continue
+            try:
+                prep["uploaded"] = self._upload_image(prep["crop_bytes"])
+            except Exception as e:
+                print(f"  ⚠️ {label}: upload failed: {e}")
+                continue
+            prep["label"] = label
+            groups.setdefault(region_type, []).append(prep)
+        timings["upload"] = time.time() - t0
+        if not groups:
+            return [], timings
+
+        workflow = build_batched_inpaint_workflow(
+            groups=batched_inpaint_groups(groups),
+            seed=seed,
+            denoise=0.55,
+            steps=12,
+            filename_prefix=f"Holly_refine_{uuid.uuid4().hex[:8]}",
+            output_mode=self._output_mode(),
+        )
+        t1 = time.time()
+        by_node, _prompt_id, history = self._run_image_workflow_nodes(workflow, timeout=180)
+        timings["comfyui"] = time.time() - t1
+
+        node_times = (history.get("timings") or {}).get("nodes", {})
+        labels_done = []
+        t2 = time.time()
+        if node_times:
+            for key, preps in groups.items():
+                group_label = "+".join(p["label"] for p in preps)
+                timings[group_label] = sum(v for nid, v in node_times.items() if nid.startswith(f"{key}_"))
+        # Decode every output before pasting any: a bad image then raises
+        # with ctx untouched, and _run_refinement_pass's sequential fallback
+        # starts from the unrefined frame instead of re-refining (and
+        # double-pasting) regions this pass had already composited.
+        decoded = [(prep, self._decode_refined(prep, refined_bytes))
+                   for prep, refined_bytes in split_batched_outputs(groups, by_node)]
+        for prep, refined_orig in decoded:
+            self._paste_region(ctx, prep, refined_orig)
+            labels_done.append(prep["label"])
+            print(f"  ✨ refined {prep['label']} ({prep['side']}px, batched)")
+        timings["composite"] = time.time() - t2
+        return labels_done, timings
+
+    def _run_refinement_pass(self, ctx, prompt, loras, seed=None, mode="batched"):
         """Run the full ADetailer-style refinement pass.
 
-        Detects faces, hands, and feet, then refines each. Returns
-        (refined_pil, regions_refined_list, reroll_recommended_bool).
-        """
-        import numpy as np
-        from PIL import Image
+        Detects faces, hands, and feet on the request's ImageContext, then
+        refines each, compositing into ctx in place. Returns
+        (regions_refined_list, reroll_recommended_bool, timings).
 
-        refined = pil_img
+        mode="batched" (default) refines every region in one ComfyUI graph;
+        mode="sequential" is the original one-round-trip-per-region path
+        (each region re-cropped from the already-refined image).
+        timings maps region label → seconds (see _refine_regions_batched).
+        """
         regions_done = []
         reroll = False
+        timings = {}
 
         # 1. Detect conjoined-twin case (body count > 1 = re-roll needed)
-        hands, feet, body_count = self._detect_hand_and_foot_regions(pil_img)
+        hands, feet, body_count = self._detect_hand_and_foot_regions(ctx)
         if body_count > 1:
             print(f"⚠️ DWPose detected {body_count} bodies — conjoined-twin likely. Flagging for re-roll.")
             reroll = True
             # Still attempt face/hand refinement — may partially help
 
-        # 2. Detect faces (Haar cascade — proven, fast)
-        face_bbox = self._detect_face_bbox(pil_img)
+        # 2. Detect faces (Haar cascade — proven, fast; shares ctx's gray buffer)
+        face_bbox = self._detect_face_bbox(ctx)
         face_region = None
         if face_bbox:
             face_region, _ = self._face_crop_region(
-                pil_img.size[0], pil_img.size[1], face_bbox, crop_factor=3.0
+                ctx.width, ctx.height, face_bbox, crop_factor=3.0
             )
 
-        # 3. Refine face first (largest region, most identity impact)
+        # Composite order: face first (largest region, most identity impact),
+        # hands (up to 2 — the digit-count problem is mainly here), then feet
+        # (weakest detection — best-effort).
+        regions = []
         if face_region:
-            try:
-                refined, status = self._refine_region(
-                    refined, face_region, "face", prompt, loras, seed
-                )
-                if refined is not None:
-                    regions_done.append("face")
-                    print(f"  ✨ {status}")
-            except Exception as e:
-                print(f"  ⚠️ Face refinement failed: {e}")
+            regions.append(("face", "face", face_region))
+        regions += [(f"hand{i+1}", "hand", r) for i, r in enumerate(hands[:2])]
+        regions += [(f"foot{i+1}", "foot", r) for i, r in enumerate(feet[:2])]
 
-        # 4. Refine hands (up to 2 — the digit-count problem is mainly here)
-        for i, hand_region in enumerate(hands[:2]):
+        if mode != "sequential":
             try:
-                refined, status = self._refine_region(
-                    refined, hand_region, "hand", prompt, loras, seed
+                regions_done, timings = self._refine_regions_batched(
+                    ctx, regions, prompt, loras, seed
                 )
-                if refined is not None:
-                    regions_done.append(f"hand{i+1}")
-                    print(f"  ✨ {status}")
+                return regions_done, reroll, timings
             except Exception as e:
-                print(f"  ⚠️ Hand {i+1} refinement failed: {e}")
+                print(f"  ⚠️ Batched refinement failed ({e}) — falling back to sequential")
+                regions_done = []
 
-        # 5. Refine feet (weakest detection — best-effort)
-        for i, foot_region in enumerate(feet[:2]):
+        for label, region_type, region in regions:
+            t0 = time.time()
             try:
-                refined, status = self._refine_region(
-                    refined, foot_region, "foot", prompt, loras, seed
+                ok, status = self._refine_region(
+                    ctx, region, region_type, prompt, loras, seed
                 )
-                if refined is not None:
-                    regions_done.append(f"foot{i+1}")
+                if ok:
+                    regions_done.append(label)
+                    timings[label] = time.time() - t0
                     print(f"  ✨ {status}")
             except Exception as e:
-                print(f"  ⚠️ Foot {i+1} refinement failed: {e}")
+                print(f"  ⚠️ {label} refinement failed: {e}")
+
+        return regions_done, reroll, timings
 
-        return refined, regions_done, reroll
+    # ─── Output encoding ───────────────────────────────────────────────
+
+    def _output_format(self, request: dict, http_request=None) -> dict:
+        """Resolve format/quality/thumbnail options BEFORE generating (400 early).
+
+        format: png | webp | jpeg | avif (explicit) — else the Accept header;
+        quality: 1-100 for lossy formats; thumbnail: true or a max side in px.
+        """
+        from fastapi import HTTPException
+
+        accept = http_request.headers.get("accept") if http_request is not None else None
+        try:
+            fmt = negotiate_format(request.get("format"), accept)
+            quality = request.get("quality")
+            if quality is not None:
+                quality = int(quality)
+                if not 1 <= quality <= 100:
+                    raise ValueError("quality must be 1-100")
+            thumb = request.get("thumbnail")
+            thumb_side = THUMBNAIL_SIDE if thumb is True else int(thumb or 0)
+        except (TypeError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {"format": fmt, "quality": quality, "thumbnail": thumb_side}
+
+    def _image_response(self, image, out: dict, headers: dict, main_headers=None, extra_parts=()):
+        """Encode the final image per _output_format and build the Response.
+
+        image: PNG bytes or the request's ImageContext. Unmodified PNG goes out
+        as-is. Otherwise encoding runs on the image_context thread pool; with a
+        thumbnail (or extra parts, e.g. runners-up) the response is a streamed
+        multipart/mixed: thumbnail first, then the full image, then extras.
+        """
+        from fastapi import Response
+        from fastapi.responses import StreamingResponse
+
+        self._report_progress(stage="encoding")
+        fmt = out["format"]
+        mime = FORMATS[fmt][1]
+        headers = {**headers, "X-Format": fmt, "Vary": "Accept"}
+        ctx = image if isinstance(image, ImageContext) else None
+        t0 = time.time()
+
+        if fmt == "png" and ctx is None:
+            main = image  # ComfyUI's PNG, byte-for-byte
+        else:
+            ctx = ctx or ImageContext.from_bytes(image)
+            main = ctx.encode_async(fmt, out["quality"])
+
+        if not out["thumbnail"] and not extra_parts:
+            content = main.result() if hasattr(main, "result") else main
+            headers["X-Encode-Ms"] = str(int((time.time() - t0) * 1000))
+            return Response(content=content, media_type=mime, headers=headers)
+
+        parts = []
+        if out["thumbnail"]:
+            ctx = ctx or ImageContext.from_bytes(image)
+            tfmt = fmt if fmt != "png" else ("webp" if format_available("webp") else "jpeg")
+            parts.append((
+                {"Content-Type": FORMATS[tfmt][1], "X-Rendition": "thumbnail"},
+                ctx.encode_async(tfmt, 70, out["thumbnail"]),
+            ))
+        parts.append(({"Content-Type": mime, "X-Rendition": "full", **(main_headers or {})}, main))
+        parts.extend(extra_parts)
+        if self._progress_reporter() is not None:
+            # Async job / SSE: the result is stored or sent whole
+            body, content_type = multipart_mixed(parts)
+            return Response(content=body, media_type=content_type, headers=headers)
+        stream, content_type = multipart_mixed_stream(parts)
+        return StreamingResponse(stream, media_type=content_type, headers=headers)
 
     @modal.fastapi_endpoint(method="POST", label="generate-comfyui-klein")
-    def generate(self, request: dict) -> bytes:
+    def generate(self, request: dict, http_request: "fastapi.Request") -> bytes:
         """
         Generate an image using FLUX.2 Klein 9B via ComfyUI with the v2-recipe
         (face @ 0.8 + body v1 @ 0.8 + 12 steps + CFG 1) and category-aware LoRA
@@ -1793,12 +2540,92 @@ class HollyComfyUIKlein:
             cfg: float — CFG scale (default 1.0, v2-recipe)
             disable_routing: bool — if true, use only the provided loras (no
                              category routing). Defaults to false.
+            cache: bool — with an explicit seed, serve/store results in the
+                             graph-keyed result cache (default true; X-Cache).
+            priority: str — "interactive" (default) | "batch". Batch requests
+                             yield to interactive ones in the admission queue
+                             and ComfyUI's queue. A full queue returns 429
+                             with Retry-After, X-Queue-Depth and X-Queue-Eta-S.
+            pipeline_attempts: bool — queue the next retry seed while the
+                             current attempt is QA'd (default true).
+            latent_batch: bool — sample retry candidates as one latent batch
+                             (up to LATENT_BATCH_MAX per pass) and rank them.
+            return_candidates: bool — multipart/mixed response: winner first,
+                             then runners-up in rank order.
+            deterministic_variation: bool — choose the appended angle/lighting/
+                             expression variation from the seed instead of at
+                             random (default false; needs an explicit seed).
+            quality_mode: str — "auto" (default) | "fast" (1 attempt) | "best"
+                             (3 attempts) | "draft": DRAFT_SCALE size at
+                             DRAFT_STEPS, 1 attempt, no QA/refinement; the
+                             response carries X-Draft-Token for finalize.
+            format: str — png (default) | webp | jpeg | avif. Without it the
+                             Accept header is honoured (image/webp etc.).
+            quality: int — 1-100 for lossy formats.
+            thumbnail: bool|int — prepend a small preview rendition (streamed
+                             multipart/mixed; int = max side in px).
 
         Returns:
-            Raw image bytes (PNG).
+            Raw image bytes (PNG unless format/Accept asks otherwise).
         """
-        from fastapi import Response
+        with self._admitted(request) as ticket:
+            response = self._generate(request, http_request)
+        response.headers["X-Queue-Wait-Ms"] = str(ticket.wait_ms)
+        return response
 
+    @modal.fastapi_endpoint(method="POST", label="generate-comfyui-klein-stream")
+    def generate_stream(self, request: dict, http_request: "fastapi.Request"):
+        """
+        generate, streamed as Server-Sent Events (text/event-stream).
+
+        Same request body as generate-comfyui-klein (format/quality/thumbnail
+        apply to the final image; the Accept header does not — it asks for
+        the event stream). Events, see preview_stream.py:
+            progress  {"stage": ...} / {"step", "steps", "node"}
+            preview   low-res sampler preview per step, base64
+            result    {"media_type", "headers", "image": base64} — the
+                      bytes generate would have returned
+            error     {"status_code", "detail", "headers"} — incl. 429
+        The first preview typically arrives within a second or two of
+        admission instead of after sampling + QA + refinement.
+        """
+        from fastapi.responses import StreamingResponse
+
+        stream = SSEStream()
+        threading.Thread(target=self._stream_worker, args=(stream, request),
+                         name="klein-sse", daemon=True).start()
+        return StreamingResponse(
+            stream.events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no",
+                     "Access-Control-Allow-Origin": "*"},
+        )
+
+    def _stream_worker(self, stream: "SSEStream", request: dict):
+        """Run _generate for generate_stream with the stream as the reporter."""
+        from fastapi import HTTPException
+
+        self._request_local.reporter = stream
+        try:
+            stream.set(stage="queued")
+            with self._admitted(request) as ticket:
+                stream.set(stage="admitted", queue_wait_ms=ticket.wait_ms)
+                response = self._generate(request, None)
+            headers = {**response.headers, "X-Queue-Wait-Ms": str(ticket.wait_ms),
+                       "X-Previews": str(stream.previews)}
+            stream.result(response.body, response.media_type, headers)
+        except HTTPException as e:
+            stream.error(e.status_code, e.detail, e.headers)
+        except Exception as e:
+            print(f"❌ SSE generate failed: {type(e).__name__}: {e}")
+            stream.error(500, f"{type(e).__name__}: {e}")
+        finally:
+            self._request_local.reporter = None
+            stream.close()
+
+    def _generate(self, request: dict, http_request: "fastapi.Request"):
+        meter = RequestMeter()
+        out = self._output_format(request, http_request)
         raw_prompt = request.get("prompt", "")
         width = request.get("width", 1024)
         height = request.get("height", 1024)
@@ -1813,6 +2640,9 @@ class HollyComfyUIKlein:
         # ADetailer-style refinement: OFF by default (same caution as diffusers
         # face-enhance, disabled June 27 for over-processing). Enable explicitly.
         enhance_details = request.get("enhance_details", False)
+        # "batched" = one ComfyUI graph for face + hands + feet; "sequential"
+        # = one round trip per region (original behaviour).
+        refine_mode = request.get("refine_mode", "batched")
 
         # PROMPT CONSTRUCTION (2026-08-12):
         # When an action LoRA is active, DON'T append anatomy anchors or variation
@@ -1849,7 +2679,13 @@ class HollyComfyUIKlein:
         else:
             # SFW or simple nude — anatomy anchors + variation for quality
             prompt = f"{raw_prompt}, {get_anatomy_anchors(raw_prompt)}" if raw_prompt else get_anatomy_anchors(raw_prompt)
-            import random as _var_rng
+            # deterministic_variation: pick the variation from the request
+            # seed, so the same seed rebuilds the same prompt (and graph) —
+            # ComfyUI's text-encode cache and the result cache both hit.
+            import random as _random
+            _var_rng = (_random.Random(seed)
+                        if request.get("deterministic_variation", False) and seed is not None
+                        else _random)
             _ANGLES = [
                 "straight-on camera angle", "slightly from above", "slightly from below",
                 "three-quarter angle", "side angle", "looking over shoulder camera angle",
@@ -1912,89 +2748,93 @@ class HollyComfyUIKlein:
         if body_integrity:
             max_attempts = max(max_attempts, 6)
 
+        draft = quality_mode == "draft"
+        if draft:
+            # A cheap look, not a deliverable — finalize does the real render
+            max_attempts = 1
+            body_integrity = False
+            enhance_details = False
+            full_width, full_height, full_steps = min(width, 1536), min(height, 1536), steps
+            width, height = draft_size(full_width, full_height)
+            steps = min(steps, DRAFT_STEPS)
+            print(f"   ✏️ Draft {width}×{height} @ {steps} steps (final {full_width}×{full_height} @ {full_steps})")
+
+        # Speculative pipelining (2026-10-16): QA (_check_body_integrity is a
+        # remote vision call, up to 90s) used to run with the GPU idle. Now
+        # attempt N+1 is queued in ComfyUI BEFORE attempt N is checked; if N
+        # passes, N+1 is deleted from the queue / interrupted. Costs at most
+        # one wasted (cancelled) sample per request.
+        pipeline_attempts = request.get("pipeline_attempts", True)
+        # Latent-batch candidates: sample up to LATENT_BATCH_MAX seeds in ONE
+        # KSampler pass and rank them, instead of one prompt per seed.
+        # return_candidates=true returns winner + runners-up as multipart/mixed.
+        latent_batch = request.get("latent_batch", False)
+        return_candidates = request.get("return_candidates", False)
+        batch = min(max_attempts, LATENT_BATCH_MAX) if latent_batch else 1
+        rounds = -(-max_attempts // batch)
+
         import random as _rng
         base_seed = seed if seed is not None else _rng.randint(0, 2**63 - 1)
 
         try:
-            img_bytes = None
-            prompt_id = None
-            job_id = None
-            attempts_made = 0
-            reject_reason = ""
-            best_candidate = (None, None, None, None, "")  # (severity, img, prompt_id, job_id, reason)
-
-            for attempt in range(max_attempts):
-                attempt_seed = base_seed + attempt * 1000000  # different seed each try
-                attempts_made += 1
-                print(f"   Generation {attempt+1}/{max_attempts} (seed={attempt_seed})...")
-
-                img_bytes, prompt_id, job_id = self._generate_single(
+            def _submit(n):
+                attempt_seed = base_seed + n * 1000000  # different seed each try
+                label = f"{n+1}/{rounds} ×{batch}" if batch > 1 else f"{n+1}/{max_attempts}"
+                print(f"   Generation {label} (seed={attempt_seed})...")
+                return self._submit_single(
                     prompt, width, height, attempt_seed, loras, steps, cfg, sampler,
-                    negative_prompt=negative_prompt,
+                    negative_prompt=negative_prompt, batch_size=batch,
+                    # Only explicit-seed requests are reproducible → cacheable
+                    request=request if seed is not None else None,
                 )
 
-                # Quality check (auto-reject broken images)
-                if max_attempts > 1:
-                    if body_integrity:
-                        passes, reason = self._check_body_integrity(
-                            img_bytes, require_face=require_face,
-                            action_desc=action_desc)
-                        # Track least-broken candidate for all-fail fallback:
-                        # fewer problems = better; asymmetric (fused/missing) is
-                        # worse than a soft fail like "face not visible".
-                        _sev = 0
-                        if not passes:
-                            _sev = reason.count(";") + 1
-                            if "asymmetric" in reason:
-                                _sev += 10  # fusions/missing limbs = worst
-                        if best_candidate[0] is None or _sev < best_candidate[0]:
-                            best_candidate = (_sev, img_bytes, prompt_id, job_id, reason)
-                    else:
-                        passes, reason = self._check_image_quality(img_bytes)
-                    print(f"   Quality check: {reason}")
-                    if passes:
-                        print(f"   ✅ Accepted on attempt {attempt+1}")
-                        break
-                    else:
-                        reject_reason = reason
-                        print(f"   ❌ Rejected: {reason}")
-                        if attempt < max_attempts - 1:
-                            print(f"   → Trying next seed...")
-                        continue
-                else:
-                    break  # single-gen mode, accept whatever we get
+            # Quality check (auto-reject broken images), next attempt queued
+            # while the current one is checked — see generation_attempts
+            log = run_attempts(
+                submit=_submit,
+                collect=self._collect_candidates,
+                qa=lambda images: self._qa_candidates(
+                    images, body_integrity, require_face, action_desc),
+                cancel=self._cancel_prompt,
+                rounds=rounds, max_attempts=max_attempts,
+                pipeline=pipeline_attempts, report=self._report_progress, batch=batch,
+            )
+            img_bytes, img_ctx = log.image, log.ctx
+            prompt_id, job_id = log.prompt_id, log.job_id
 
             if img_bytes is None:
                 raise RuntimeError("All generation attempts failed")
 
             # All candidates rejected → return the least-broken one instead of
             # silently shipping the last seed's defects.
-            if body_integrity and reject_reason and best_candidate[1] is not None:
+            if body_integrity and not log.accepted and log.reject_reason and log.best is not None:
+                severity, img_bytes, prompt_id, job_id, issues = log.best
                 print(f"   ⚠️ No candidate passed integrity; returning least-broken "
-                      f"(severity={best_candidate[0]}, issues: {best_candidate[4]})")
-                img_bytes, prompt_id, job_id = best_candidate[1], best_candidate[2], best_candidate[3]
+                      f"(severity={severity}, issues: {issues})")
+                img_ctx = None
+            winner_raw = img_bytes  # pre-refinement, to exclude from runners-up
 
             # ── ADetailer-style refinement pass (hands, feet, faces) ──
             # Optional, gated by enhance_details flag. Detects anatomical regions
             # and re-renders each at high resolution to fix digit counts.
             refined_regions = "none"
+            refine_timings = {}
             reroll_recommended = False
+            final_image = img_ctx if img_ctx is not None else img_bytes
             if enhance_details:
                 try:
-                    import io
-                    from PIL import Image
-                    pil_img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
+                    # Reuse the QA decode when there was one — one decode per request
+                    ctx = img_ctx if img_ctx is not None else ImageContext.from_bytes(img_bytes)
                     print(f"✨ Running refinement pass (enhance_details=true)...")
-                    refined, regions_done, reroll = self._run_refinement_pass(
-                        pil_img, prompt, loras, seed
+                    self._report_progress(stage="refining")
+                    regions_done, reroll, refine_timings = self._run_refinement_pass(
+                        ctx, prompt, loras, seed, mode=refine_mode
                     )
                     refined_regions = ",".join(regions_done) if regions_done else "none"
                     reroll_recommended = reroll
                     if regions_done:
-                        # Re-encode the refined image
-                        buf = io.BytesIO()
-                        refined.save(buf, format="PNG")
-                        img_bytes = buf.getvalue()
+                        # Encoded once, in the requested format, by _image_response
+                        final_image = ctx
                         print(f"   Refined: {refined_regions}")
                     else:
                         print(f"   No regions refined (detection found nothing)")
@@ -2002,20 +2842,49 @@ class HollyComfyUIKlein:
                     print(f"⚠️ Refinement pass failed (returning unrefined): {re}")
                     refined_regions = f"error: {str(re)[:60]}"
 
-            return Response(
-                content=img_bytes,
-                media_type="image/png",
+            draft_headers = {}
+            if draft:
+                token = self._save_draft({
+                    "prompt": prompt, "negative_prompt": negative_prompt, "loras": loras,
+                    "seed": base_seed, "cfg": cfg, "sampler": sampler or V2_SAMPLER,
+                    "width": full_width, "height": full_height, "steps": full_steps,
+                    "draft_width": width, "draft_height": height, "draft_steps": steps,
+                    "routing": routing_info,
+                })
+                draft_headers = {"X-Quality-Mode": "draft", **({"X-Draft-Token": token} if token else {})}
+
+            extra_parts = []
+            if return_candidates and len(log.ranked) > 1:
+                # Winner (refined, if requested) first, then the rest by rank.
+                for img, reason in runners_up(log.ranked, winner_raw):
+                    extra_parts.append(({
+                        "Content-Type": "image/png",
+                        "X-Candidate-Rank": str(len(extra_parts) + 2),
+                        "X-Quality": reason[:120].replace("\r", " ").replace("\n", " "),
+                    }, img))
+
+            return self._image_response(
+                final_image, out,
+                main_headers={"X-Candidate-Rank": "1"} if extra_parts else None,
+                extra_parts=extra_parts,
                 headers={
                     "X-Model": "FLUX.2-Klein-9B-via-ComfyUI-v2-recipe",
                     "X-Provider": "holly-comfyui-klein",
                     "X-Routing": routing_info,
                     "X-Lora-Count": str(len(loras)),
-                    "X-Attempts": str(attempts_made),
+                    "X-Attempts": str(log.attempts),
+                    "X-Gpu-Idle-Ms": str(int(log.gpu_idle_ms)),
+                    "X-Candidates-Per-Pass": str(batch),
+                    "X-Cache": log.cache_status,
+                    **meter.headers(),
                     "X-Seed": str(base_seed),
                     "X-Refined-Regions": refined_regions.encode("ascii", "replace").decode("ascii")[:80],
                     "X-Reroll-Recommended": "true" if reroll_recommended else "false",
+                    "X-Refine-Timings": ",".join(
+                        f"{k}={v:.2f}s" for k, v in refine_timings.items()) or "none",
                     "X-Job-Id": job_id,
                     "X-Prompt-Id": prompt_id,
+                    **draft_headers,
                     "Access-Control-Allow-Origin": "*",
                 },
             )
@@ -2023,8 +2892,135 @@ class HollyComfyUIKlein:
             from fastapi import HTTPException
             raise HTTPException(status_code=503, detail=f"Generation failed: {str(e)}")
 
+    def _save_draft(self, spec: dict):
+        """Store a draft's render spec; returns its token (None if the store failed).
+
+        The token is content-derived — re-drafting the same prompt/seed/stack
+        returns the same token.
+        """
+        token = "draft_" + digest_bytes(json.dumps(spec, sort_keys=True).encode("utf-8"))[:24]
+        try:
+            drafts_dict[token] = {**spec, "created_at": time.time()}
+        except Exception as e:
+            print(f"   ⚠️ draft token store failed: {e}")
+            return None
+        return token
+
+    @modal.fastapi_endpoint(method="POST", label="generate-comfyui-klein-finalize")
+    def finalize(self, request: dict, http_request: "fastapi.Request") -> bytes:
+        """
+        Render a quality_mode="draft" result at full resolution.
+
+        Request body:
+            draft_token: str — X-Draft-Token from the draft response (required)
+            method: str — "latent_upscale" (default): upscale the draft latent
+                        and re-sample at `denoise` — keeps the draft's
+                        composition; "scratch": full-size render from noise
+                        with the same seed/conditioning (composition may shift).
+            denoise: float — latent_upscale strength, 0-1 (default 0.6).
+            enhance_details: bool — run the refinement pass on the result.
+            priority / cache / format / quality / thumbnail — as for generate.
+
+        Returns the image like generate; X-Draft-Reused says whether ComfyUI
+        served the draft latent from its cache.
+        """
+        with self._admitted(request) as ticket:
+            response = self._finalize(request, http_request)
+        response.headers["X-Queue-Wait-Ms"] = str(ticket.wait_ms)
+        return response
+
+    def _finalize(self, request: dict, http_request: "fastapi.Request"):
+        from fastapi import HTTPException
+
+        meter = RequestMeter()
+        out = self._output_format(request, http_request)
+        token = request.get("draft_token") or ""
+        spec = drafts_dict.get(token) if token else None
+        if spec is not None and draft_expired(spec):
+            try:
+                drafts_dict.pop(token)
+            except KeyError:
+                pass  # pruned concurrently
+            spec = None
+        if spec is None:
+            raise HTTPException(status_code=404, detail=f"unknown or expired draft_token {token!r}")
+        method = request.get("method", "latent_upscale")
+        if method not in FINALIZE_METHODS:
+            raise HTTPException(status_code=400, detail=f"method must be one of {list(FINALIZE_METHODS)}")
+        try:
+            denoise = float(request.get("denoise", FINALIZE_DENOISE))
+        except (TypeError, ValueError):
+            denoise = -1.0
+        if not 0.0 < denoise <= 1.0:
+            raise HTTPException(status_code=400, detail="denoise must be in (0, 1]")
+
+        job_id = str(uuid.uuid4())[:8]
+        common = dict(
+            seed=spec["seed"], loras=spec["loras"], steps=spec["steps"], cfg=spec["cfg"],
+            sampler=spec["sampler"], filename_prefix=f"Holly_{job_id}",
+            negative_prompt=spec["negative_prompt"], output_mode=self._output_mode(),
+        )
+        if method == "latent_upscale":
+            workflow = build_latent_upscale_workflow(
+                spec["prompt"], spec["draft_width"], spec["draft_height"],
+                spec["width"], spec["height"], draft_steps=spec["draft_steps"],
+                denoise=denoise, **common)
+        else:
+            workflow = build_workflow(spec["prompt"], spec["width"], spec["height"], **common)
+        print(f"🖼️ Finalize {token[:14]} via {method} → {spec['width']}×{spec['height']}")
+
+        try:
+            self._report_progress(stage="sampling")
+            cache_key = self._cache_key(request, spec["seed"], workflow)
+            images = self.result_cache.get(cache_key) if cache_key else None
+            cache_status = "HIT" if images else ("MISS" if cache_key else "BYPASS")
+            history, prompt_id = {}, "cached"
+            if not images:
+                by_node, prompt_id, history = self._run_image_workflow_nodes(workflow)
+                images = [img for imgs in by_node.values() for img in imgs]
+                if not images:
+                    raise RuntimeError(f"No images in ComfyUI output for {prompt_id}")
+                if cache_key:
+                    self._cache_store(cache_key, images)
+            final_image = images[0]
+
+            refined_regions = "none"
+            if request.get("enhance_details", False):
+                try:
+                    ctx = ImageContext.from_bytes(final_image)
+                    self._report_progress(stage="refining")
+                    regions_done, _reroll, _timings = self._run_refinement_pass(
+                        ctx, spec["prompt"], spec["loras"], spec["seed"],
+                        mode=request.get("refine_mode", "batched"))
+                    if regions_done:
+                        final_image = ctx
+                        refined_regions = ",".join(regions_done)
+                except Exception as re:
+                    print(f"⚠️ Refinement pass failed (returning unrefined): {re}")
+                    refined_regions = f"error: {str(re)[:60]}"
+        except Exception as e:
+            raise HTTPException(status_code=503, detail=f"Finalize failed: {str(e)}")
+
+        return self._image_response(final_image, out, headers={
+            "X-Model": "FLUX.2-Klein-9B-via-ComfyUI-v2-recipe",
+            "X-Provider": "holly-comfyui-klein",
+            "X-Routing": spec.get("routing", ""),
+            "X-Lora-Count": str(len(spec["loras"])),
+            "X-Quality-Mode": "final",
+            "X-Draft-Token": token,
+            "X-Finalize-Method": method,
+            "X-Draft-Reused": "true" if method == "latent_upscale" and "sampler" in cached_nodes(history) else "false",
+            "X-Cache": cache_status,
+            "X-Refined-Regions": refined_regions.encode("ascii", "replace").decode("ascii")[:80],
+            **meter.headers(),
+            "X-Seed": str(spec["seed"]),
+            "X-Job-Id": job_id,
+            "X-Prompt-Id": prompt_id,
+            "Access-Control-Allow-Origin": "*",
+        })
+
     @modal.fastapi_endpoint(method="POST", label="generate-pose-guided")
-    def generate_pose_guided(self, request: dict) -> bytes:
+    def generate_pose_guided(self, request: dict, http_request: "fastapi.Request") -> bytes:
         """
         Pose-guided generation — uses a reference pose image to guide composition.
 
@@ -2039,12 +3035,18 @@ class HollyComfyUIKlein:
                             LoRA volume (e.g. "dildo_dildo_004.webp")
             denoise: float — 0.35 default. Lower = more faithful to pose.
             width, height, seed, loras, steps, cfg — same as generate()
+            format, quality, thumbnail — output encoding, same as generate()
 
         Returns:
-            Raw image bytes (PNG).
+            Raw image bytes (PNG unless format/Accept asks otherwise).
         """
-        from fastapi import Response
+        with self._admitted(request) as ticket:
+            response = self._generate_pose_guided(request, http_request)
+        response.headers["X-Queue-Wait-Ms"] = str(ticket.wait_ms)
+        return response
 
+    def _generate_pose_guided(self, request: dict, http_request: "fastapi.Request"):
+        out = self._output_format(request, http_request)
         raw_prompt = request.get("prompt", "")
         pose_ref = request.get("pose_ref", "")
         denoise = float(request.get("denoise", 0.50))
@@ -2081,10 +3083,9 @@ class HollyComfyUIKlein:
             from fastapi import HTTPException
             raise HTTPException(status_code=400, detail=f"pose_ref not found: {pose_ref}")
 
-        # Read and upload the pose image to ComfyUI's input/ directory
-        with open(pose_path, 'rb') as f:
-            pose_bytes = f.read()
-        uploaded_name = self._upload_image(pose_bytes)
+        # Upload the pose image to ComfyUI's input/ directory (once per
+        # container per distinct file — content-addressed, see input_cache.py)
+        uploaded_name, pose_digest = self._upload_file(pose_path, "pose")
 
         job_id = str(uuid.uuid4())[:8]
         workflow = build_pose_guided_workflow(
@@ -2098,21 +3099,24 @@ class HollyComfyUIKlein:
             steps=steps,
             cfg=cfg,
             filename_prefix=f"Holly_pose_{job_id}",
+            output_mode=self._output_mode(),
         )
 
         print(f"🎨 [pose-guided] ref={pose_ref} denoise={denoise} prompt: {prompt[:80]}")
         print(f"   LoRA stack: {[(l['name'], l['strength']) for l in loras]}")
 
         try:
-            prompt_id = self._post_workflow(workflow)
-            history = self._poll_history(prompt_id, timeout=300)
-            img_bytes = self._fetch_image(history)
-
-            return Response(
-                content=img_bytes,
-                media_type="image/png",
+            cache_key = self._cache_key(
+                request, seed, workflow, {uploaded_name: pose_digest})
+            self._report_progress(stage="sampling")
+            images, prompt_id = self._run_image_workflow(workflow, timeout=300, cache_key=cache_key)
+            img_bytes = images[0]
+
+            return self._image_response(
+                img_bytes, out,
                 headers={
                     "X-Model": "FLUX.2-Klein-9B-pose-guided",
+                    "X-Cache": "BYPASS" if not cache_key else ("HIT" if prompt_id == "cached" else "MISS"),
                     "X-Provider": "holly-comfyui-klein",
                     "X-Pose-Ref": pose_ref,
                     "X-Denoise": str(denoise),
@@ -2127,7 +3131,7 @@ class HollyComfyUIKlein:
             raise HTTPException(status_code=503, detail=f"Generation failed: {str(e)}")
 
     @modal.fastapi_endpoint(method="POST", label="generate-controlnet")
-    def generate_controlnet(self, request: dict) -> bytes:
+    def generate_controlnet(self, request: dict, http_request: "fastapi.Request") -> bytes:
         """Generate using ControlNet pose skeleton guidance.
 
         Unlike the pose-guided (img2img) endpoint which TRACES a reference photo,
@@ -2144,10 +3148,17 @@ class HollyComfyUIKlein:
             seed: int — optional
             loras: list — optional caller-specified LoRAs (defaults to auto-routing)
             controlnet_strength: float — default 0.7 (range 0.0-2.0)
+            format, quality, thumbnail — output encoding, same as generate()
         """
-        from fastapi import Response
+        with self._admitted(request) as ticket:
+            response = self._generate_controlnet(request, http_request)
+        response.headers["X-Queue-Wait-Ms"] = str(ticket.wait_ms)
+        return response
+
+    def _generate_controlnet(self, request: dict, http_request: "fastapi.Request"):
         import uuid
 
+        out = self._output_format(request, http_request)
         pose_path = request.get("pose_skeleton", "")
         raw_prompt = request.get("prompt", "")
         width = request.get("width", 1024)
@@ -2173,12 +3184,21 @@ class HollyComfyUIKlein:
             raise HTTPException(status_code=400, detail=f"Skeleton not found: {pose_path}")
 
         # ComfyUI's LoadImage node only reads from its input/ directory.
-        # Copy the skeleton there with a unique name to avoid collisions.
-        import shutil
-        os.makedirs(INPUT_DIR, exist_ok=True)
-        skeleton_basename = os.path.basename(full_skeleton_path)
-        input_skeleton = f"{INPUT_DIR}/{skeleton_basename}"
-        shutil.copy2(full_skeleton_path, input_skeleton)
+        # Copy the skeleton there under a content-derived name — once per
+        # container; same-named skeletons from different folders can't clash.
+        skeleton_digest = self.input_cache.path_digest(full_skeleton_path)
+        skeleton_basename = self.input_cache.lookup(skeleton_digest)
+        if skeleton_basename is None:
+            import shutil
+            os.makedirs(INPUT_DIR, exist_ok=True)
+            skeleton_basename = content_name(
+                skeleton_digest, "skeleton", os.path.splitext(full_skeleton_path)[1].lower() or ".png")
+            # Copy + rename: a concurrent request's LoadImage never sees a partial file
+            tmp = f"{INPUT_DIR}/{skeleton_basename}.{uuid.uuid4().hex[:8]}.tmp"
+            shutil.copyfile(full_skeleton_path, tmp)
+            os.replace(tmp, f"{INPUT_DIR}/{skeleton_basename}")
+            self.input_cache.record(skeleton_digest, skeleton_basename,
+                                    os.path.getsize(full_skeleton_path))
 
         # Build prompt with anatomy anchors
         prompt = f"{raw_prompt}, {get_anatomy_anchors(raw_prompt)}" if raw_prompt else get_anatomy_anchors(raw_prompt)
@@ -2208,17 +3228,18 @@ class HollyComfyUIKlein:
             sampler=sampler,
             controlnet_strength=cn_strength,
             filename_prefix=f"Holly_cn_{job_id}",
+            output_mode=self._output_mode(),
         )
 
-        prompt_id = self._post_workflow(workflow)
-        history = self._poll_history(prompt_id, timeout=300)
-        img_bytes = self._fetch_image(history)
+        cache_key = self._cache_key(request, seed, workflow, {skeleton_basename: skeleton_digest})
+        self._report_progress(stage="sampling")
+        images, prompt_id = self._run_image_workflow(workflow, timeout=300, cache_key=cache_key)
+        img_bytes = images[0]
 
         print(f"✅ ControlNet generation complete — {len(img_bytes):,} bytes")
 
-        return Response(
-            content=img_bytes,
-            media_type="image/png",
+        return self._image_response(
+            img_bytes, out,
             headers={
                 "X-Model": "FLUX.2-Klein-9B-Distilled-ControlNet",
                 "X-Provider": "holly-comfyui-klein",
@@ -2227,12 +3248,36 @@ class HollyComfyUIKlein:
                 "X-ControlNet-Strength": str(cn_strength),
                 "X-Lora-Count": str(len(loras)),
                 "X-Seed": str(seed) if seed else "random",
+                "X-Cache": "BYPASS" if not cache_key else ("HIT" if prompt_id == "cached" else "MISS"),
                 "X-Job-Id": job_id,
                 "X-Prompt-Id": prompt_id,
                 "Access-Control-Allow-Origin": "*",
             },
         )
 
+    @modal.method()
+    def run_job(self, job_id: str, endpoint: str, request: dict):
+        """Async-job worker: run a sync endpoint's body and store the result.
+
+        Spawned by klein-jobs-submit. Admission is the same as the sync
+        endpoints (priority, 429 → a failed job with status_code 429);
+        progress (stage / attempt / ComfyUI step) goes to the job record.
+        """
+        handler = getattr(self, f"_{endpoint}")
+
+        def work(reporter):
+            self._request_local.reporter = reporter
+            try:
+                with self._admitted(request) as ticket:
+                    response = handler(request, None)
+            finally:
+                self._request_local.reporter = None
+            headers = {**response.headers, "X-Queue-Wait-Ms": str(ticket.wait_ms)}
+            return response.body, response.media_type, headers
+
+        media_jobs.run_job(klein_job_store(), job_id, work, commit=jobs_volume.commit)
+
+    @modal.fastapi_endpoint(method="GET", label="comfyui-klein-health")
     def health(self):
         """Health check — confirms ComfyUI is alive + Klein model is loaded."""
         import socket
@@ -2279,6 +3324,11 @@ class HollyComfyUIKlein:
                 "vae": vae_present,
             },
             "key_loras": loras_present,
+            "result_cache": self.result_cache.stats() if getattr(self, "result_cache", None) else None,
+            "lora_residency": self.lora_residency.stats() if getattr(self, "lora_residency", None) else None,
+            "input_cache": self.input_cache.stats() if getattr(self, "input_cache", None) else None,
+            "janitor": self.janitor.stats() if getattr(self, "janitor", None) else None,
+            "scheduler": self.scheduler.stats() if getattr(self, "scheduler", None) else None,
             "model": "FLUX.2-Klein-9B-Distilled",
             "backend": "ComfyUI",
             "recipe": f"Distilled + {V2_STEPS} steps + CFG {V2_CFG} + Euler + Simple (PROVEN photorealistic)",
@@ -2286,6 +3336,72 @@ class HollyComfyUIKlein:
         }
 
 
+# ─── Async job endpoints (CPU containers — answer while the GPU works) ───
+def klein_job_store() -> media_jobs.JobStore:
+    return media_jobs.JobStore(media_jobs.DictBackend(jobs_dict), JOBS_RESULTS_DIR)
+
+
+@app.function(image=jobs_image)
+@modal.fastapi_endpoint(method="POST", label="klein-jobs-submit")
+def jobs_submit(body: dict):
+    """{"endpoint": "generate" | "generate_pose_guided" | "generate_controlnet",
+    "request": <that endpoint's JSON body>} → job status (poll klein-jobs-status).
+
+    format/thumbnail work as on the sync endpoints; Accept-header negotiation
+    doesn't apply (pass "format" explicitly).
+    """
+    return media_jobs.submit(
+        klein_job_store(), "klein", body, KLEIN_JOB_ENDPOINTS,
+        spawn=lambda job_id, endpoint, request: HollyComfyUIKlein().run_job.spawn(job_id, endpoint, request),
+    )
+
+
+def draft_expired(spec: dict, now: float = None) -> bool:
+    now = time.time() if now is None else now
+    return now - (spec or {}).get("created_at", 0) > DRAFT_TTL_S
+
+
+def prune_drafts(now: float = None) -> int:
+    """Delete draft specs past DRAFT_TTL_S. finalize only checks the TTL of
+    the token it is given, so drafts nobody finalizes would stay forever."""
+    expired = [token for token, spec in drafts_dict.items() if draft_expired(spec, now)]
+    for token in expired:
+        try:
+            drafts_dict.pop(token)
+        except KeyError:
+            pass
+    return len(expired)
+
+
+@app.function(image=jobs_image, volumes={JOBS_VOL_MOUNT: jobs_volume},
+              schedule=modal.Period(hours=1))
+def jobs_expire():
+    """Drop klein jobs older than media_jobs.JOB_TTL_S with their result files
+    (hourly, with the jobs volume mounted so the deletions can be committed),
+    and draft tokens past DRAFT_TTL_S."""
+    jobs_volume.reload()
+    removed = klein_job_store().expire("klein")
+    if removed:
+        jobs_volume.commit()
+        print(f"🧹 Expired {removed} klein job(s)")
+    drafts = prune_drafts()
+    if drafts:
+        print(f"🧹 Expired {drafts} draft token(s)")
+
+
+@app.function(image=jobs_image)
+@modal.fastapi_endpoint(method="GET", label="klein-jobs-status")
+def jobs_status(job_id: str):
+    return media_jobs.status_response(klein_job_store(), job_id)
+
+
+@app.function(image=jobs_image, volumes={JOBS_VOL_MOUNT: jobs_volume})
+@modal.fastapi_endpoint(method="GET", label="klein-jobs-result")
+def jobs_result(job_id: str, http_request: "fastapi.Request"):
+    return media_jobs.result_response(klein_job_store(), job_id, reload=jobs_volume.reload,
+                                      range_header=http_request.headers.get("range"))
+
+
 # ─── Deploy hints ─────────────────────────────────────────────────────
 @app.local_entrypoint()
 def main():
@@ -2293,4 +3409,9 @@ def main():
     print(f"Deploy: modal deploy services/modal-media/comfyui_klein.py")
     print(f"  (deploy to the iamdoregosteve workspace — comfyui-klein lives there)")
     print(f"Generate: https://iamdoregosteve--generate-comfyui-klein.modal.run")
+    print(f"Stream:   https://iamdoregosteve--generate-comfyui-klein-stream.modal.run (SSE)")
+    print(f"Finalize: https://iamdoregosteve--generate-comfyui-klein-finalize.modal.run")
     print(f"Health:   https://iamdoregosteve--comfyui-klein-health.modal.run")
+    print(f"Jobs:     https://iamdoregosteve--klein-jobs-submit.modal.run (POST)")
+    print(f"          https://iamdoregosteve--klein-jobs-status.modal.run?job_id=…")
+    print(f"          https://iamdoregosteve--klein-jobs-result.modal.run?job_id=…")
@@ -0,0 +1,131 @@
+"""
+Face detection for the Klein refinement pass — shared detector + frame buffers
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+The original _detect_face_bbox (ported from image_generate_flux2klein_a100.py)
+re-read both Haar cascade XMLs from disk on every call, then ran up to seven
+detectMultiScale sweeps on the FULL-resolution frame (three frontal scale
+factors, then profile + flipped profile at two). On a 1536² image that is
+hundreds of ms of CPU per request for a box we only use to place a ~3× crop.
+
+FaceDetector loads the cascades once per container and detects on a
+bounded-resolution pyramid (longest side 640, then 960 if nothing is found),
+stopping at the first level/scale factor that finds a face. Boxes are mapped
+back to full-resolution coordinates. A face is ≥ 60px at full res, so it is
+still ≥ 24px (the frontal cascade window) at the 640 level for ≤ 1600px inputs.
+
+DetectionFrame holds one RGB array per image plus the lazily derived
+grayscale/equalized buffer and its downscaled levels, so face detection and
+MediaPipe hand detection share the same decode.
+
+No modal import, cv2/numpy imported lazily — bench-face-detection.py runs it
+locally.
+"""
+
+# Longest-side caps of the detection pyramid, smallest first.
+PYRAMID_LEVELS = (640, 960)
+# Minimum face size in FULL-resolution pixels (same as the a100 port).
+MIN_FACE_PX = 60
+# Haar frontal/profile cascade windows are 24×24 / 20×20 — never ask for less.
+_MIN_WINDOW = 24
+
+
+class DetectionFrame:
+    """One decoded image shared by every detector in a request.
+
+    rgb is an HxWx3 uint8 array. gray (equalized) and pyramid levels are
+    derived on first use and cached.
+    """
+
+    def __init__(self, rgb):
+        self.rgb = rgb
+        self.height, self.width = rgb.shape[:2]
+        self._gray = None
+        self._levels = {}
+
+    @classmethod
+    def from_pil(cls, pil_img):
+        import numpy as np
+        return cls(np.asarray(pil_img.convert("RGB")))
+
+    @property
+    def size(self):
+        """(width, height) — same order as PIL's Image.size."""
+        return self.width, self.height
+
+    @property
+    def gray(self):
+        """Histogram-equalized grayscale at full resolution."""
+        if self._gray is None:
+            import cv2
+            gray = cv2.cvtColor(self.rgb, cv2.COLOR_RGB2GRAY)
+            self._gray = cv2.equalizeHist(gray)
+        return self._gray
+
+    def gray_level(self, max_side: int):
+        """(gray, scale) with the longest side ≤ max_side; scale = level / full."""
+        longest = max(self.width, self.height)
+        if longest <= max_side:
+            return self.gray, 1.0
+        cached = self._levels.get(max_side)
+        if cached is None:
+            import cv2
+            scale = max_side / longest
+            size = (max(1, round(self.width * scale)), max(1, round(self.height * scale)))
+            cached = (cv2.resize(self.gray, size, interpolation=cv2.INTER_AREA), scale)
+            self._levels[max_side] = cached
+        return cached
+
+
+class FaceDetector:
+    """Haar frontal + profile face detector, cascades loaded once."""
+
+    def __init__(self, levels=PYRAMID_LEVELS, min_face_px: int = MIN_FACE_PX):
+        import cv2
+        self.levels = tuple(levels)
+        self.min_face_px = min_face_px
+        self.frontal = cv2.CascadeClassifier(
+            cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+        self.profile = cv2.CascadeClassifier(
+            cv2.data.haarcascades + "haarcascade_profileface.xml")
+        if self.frontal.empty() or self.profile.empty():
+            raise RuntimeError("Haar cascade XML failed to load (opencv>=5 dropped them?)")
+
+    def detect(self, frame: DetectionFrame):
+        """Largest face as (x, y, w, h) in full-resolution pixels, or None."""
+        faces = []
+        scale = 1.0
+        seen = set()
+        for max_side in self.levels:
+            gray, scale = frame.gray_level(max_side)
+            if gray.shape in seen:
+                continue  # image smaller than this level — already swept
+            seen.add(gray.shape)
+            faces = self._detect_level(gray, scale)
+            if faces:
+                break
+        if not faces:
+            return None
+
+        x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
+        inv = 1.0 / scale
+        return (int(round(x * inv)), int(round(y * inv)),
+                int(round(w * inv)), int(round(h * inv)))
+
+    def _detect_level(self, gray, scale: float) -> list:
+        import cv2
+
+        side = max(_MIN_WINDOW, int(self.min_face_px * scale))
+        min_size = (side, side)
+        for sf in (1.1, 1.05):
+            found = self.frontal.detectMultiScale(gray, scaleFactor=sf, minNeighbors=5, minSize=min_size)
+            if len(found):
+                return [tuple(f) for f in found]
+
+        faces = []
+        found = self.profile.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=min_size)
+        faces.extend(tuple(f) for f in found)
+        flipped = cv2.flip(gray, 1)
+        found_r = self.profile.detectMultiScale(flipped, scaleFactor=1.1, minNeighbors=5, minSize=min_size)
+        w_img = gray.shape[1]
+        faces.extend((w_img - x - w, y, w, h) for (x, y, w, h) in found_r)
+        return faces
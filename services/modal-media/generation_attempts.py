@@ -0,0 +1,131 @@
+"""
+Klein multi-attempt generation — speculative pipelining + candidate QA
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+Explicit / body-integrity prompts are generated up to max_attempts times
+with different seeds until one passes QA. QA (_check_body_integrity) is a
+remote vision call of up to 90s, so run_attempts queues attempt N+1 in
+ComfyUI BEFORE attempt N is checked. If N passes, N+1 is cancelled (deleted
+from the queue, or interrupted if it already started). That costs at most
+one wasted sample per request instead of a GPU left idle during every QA.
+
+With latent_batch each attempt ("round") samples several candidates in one
+KSampler pass. Every QA'd candidate is ranked (passes first, then severity,
+then the order it was made). The first passing one wins; runners_up()
+gives the rest best-first for return_candidates.
+
+The ComfyUI side comes in as callables, so the loop runs against fakes in
+tests:
+
+  submit(n)        → handle {"prompt_id", "job_id", "cache", "cached"?}
+                     (a result-cache hit has "cached" and is never queued)
+  collect(handle)  → ([image bytes per candidate], prompt_id, history)
+  qa(images)       → [(passes, reason, severity, decoded ctx or None)]
+  cancel(prompt_id)
+
+Stdlib only, no modal import.
+"""
+
+
+class AttemptLog:
+    """What run_attempts did: the chosen image and everything that led to it."""
+
+    def __init__(self):
+        self.image = None         # accepted image, else the last one QA'd
+        self.ctx = None           # its decoded ImageContext, if QA made one
+        self.prompt_id = None
+        self.job_id = None
+        self.attempts = 0         # candidates generated (and QA'd)
+        self.accepted = False
+        self.reject_reason = ""   # last rejection
+        self.best = None          # (severity, image, prompt_id, job_id, reason), least broken
+        self.ranked = []          # (rank_key, image, reason) per QA'd candidate
+        self.gpu_spans = []       # (started_at, finished_at) per collected round
+        self.cache_statuses = []  # HIT / MISS / BYPASS per round
+        self.cancelled = []       # prompt ids of speculative rounds dropped
+
+    @property
+    def gpu_idle_ms(self) -> float:
+        """GPU idle between consecutive rounds (listener timestamps; the
+        /history polling fallback has none, so those gaps aren't counted)."""
+        idle = 0.0
+        for (_s0, f0), (s1, _f1) in zip(self.gpu_spans, self.gpu_spans[1:]):
+            if f0 is not None and s1 is not None:
+                idle += max(0.0, s1 - f0) * 1000
+        return idle
+
+    @property
+    def cache_status(self) -> str:
+        """HIT only if every round came from the result cache."""
+        if all(c == "HIT" for c in self.cache_statuses):
+            return "HIT"
+        if all(c == "BYPASS" for c in self.cache_statuses):
+            return "BYPASS"
+        return "MISS"
+
+
+def run_attempts(submit, collect, qa, cancel, rounds: int, max_attempts: int,
+                 pipeline: bool = True, report=None, batch: int = 1) -> AttemptLog:
+    """Generate until a candidate passes QA (see module docstring).
+
+    max_attempts == 1 is single-generation mode: no QA, the first image is
+    accepted. batch is the candidates per round (log tags only).
+    report(**fields) receives progress stages (sampling / qa).
+    """
+    log = AttemptLog()
+    pending = None  # speculatively queued next round
+    try:
+        for rnd in range(rounds):
+            handle = pending or submit(rnd)
+            pending = None
+            log.cache_statuses.append(handle["cache"])
+
+            if report is not None:
+                report(stage="sampling", attempt=log.attempts + 1, round=rnd + 1, rounds=rounds)
+            images, log.prompt_id, history = collect(handle)
+            log.job_id = handle["job_id"]
+            timings = history.get("timings") or {}
+            log.gpu_spans.append((timings.get("started_at"), timings.get("finished_at")))
+
+            if max_attempts <= 1:
+                log.attempts += 1
+                log.image = images[0]
+                log.accepted = True
+                break  # single-gen mode, accept whatever we get
+
+            if pipeline and rnd < rounds - 1:
+                pending = submit(rnd + 1)  # samples while we QA
+            images = images[:max_attempts - log.attempts]
+            if report is not None:
+                report(stage="qa")
+            accepted = None
+            for i, (img, (passes, reason, severity, ctx)) in enumerate(zip(images, qa(images))):
+                log.attempts += 1
+                tag = f"{log.attempts}" if batch == 1 else f"{rnd+1}.{i+1}"
+                log.ranked.append(((0 if passes else 1, severity, log.attempts), img, reason))
+                if log.best is None or severity < log.best[0]:
+                    log.best = (severity, img, log.prompt_id, log.job_id, reason)
+                print(f"   Quality check [{tag}]: {reason}")
+                if passes and accepted is None:
+                    accepted = (img, ctx)
+                elif not passes:
+                    log.reject_reason = reason
+                    print(f"   ❌ Rejected: {reason}")
+                log.image, log.ctx = img, ctx
+            if accepted is not None:
+                log.image, log.ctx = accepted
+                log.accepted = True
+                print(f"   ✅ Accepted after {log.attempts} candidate(s)")
+                break
+            if rnd < rounds - 1:
+                print(f"   → Trying next seed...")
+    finally:
+        if pending is not None and not pending.get("cached"):
+            cancel(pending["prompt_id"])
+            log.cancelled.append(pending["prompt_id"])
+    return log
+
+
+def runners_up(ranked: list, winner) -> list:
+    """[(image, reason)] of every ranked candidate except the winner, best first."""
+    return [(img, reason) for _key, img, reason in sorted(ranked, key=lambda r: r[0])
+            if img is not winner]
@@ -0,0 +1,220 @@
+"""
+Per-request image context — decode once, composite in place, encode once
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+A Klein request used to decode the same PNG over and over: _check_image_quality
+(Image.open → convert RGB), generate() again for the refinement pass, each
+_refine_region did pil_img.convert("RGB") twice plus a full-frame .copy() per
+region, and the result was re-encoded to PNG. On a 1536² frame that is ~7 MB
+per copy and a decode per stage.
+
+ImageContext is a DetectionFrame (one RGB array + lazy equalized gray, see
+face_detector.py) that also keeps the original encoded bytes. Stages share
+it; regions are composited straight into the array; encode() only runs when
+the pixels actually changed (dirty), otherwise the source bytes go out as-is.
+
+RequestMeter reports CPU time for one request (process-wide — exact when
+the request ran alone, an upper bound when other admitted requests
+overlapped it) and the container process's peak RSS so far. The peak is
+deliberately not reset per request: VmHWM is one counter for the whole
+process, so a reset at the start of one request would wipe the peak that
+concurrent requests are still measuring against.
+
+Output encoding: PNG of a 1024–1536px photo is several MB and slow to
+encode; chat delivery wants WebP/JPEG/AVIF. negotiate_format() picks the
+format from the request's `format` option or the Accept header, and
+encode_async() runs Pillow encodes on a small thread pool (Pillow releases
+the GIL while encoding, so the full image and its thumbnail encode in
+parallel and the request thread is free to start streaming the thumbnail).
+
+No modal import; numpy/PIL imported lazily.
+"""
+
+import threading
+import time
+
+from face_detector import DetectionFrame
+
+# format key → (Pillow format, MIME type)
+FORMATS = {
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "avif": ("AVIF", "image/avif"),
+}
+_ALIASES = {"jpg": "jpeg"}
+# Accept-header tie-break: smallest-for-quality first
+_PREFERENCE = ("avif", "webp", "jpeg", "png")
+DEFAULT_QUALITY = {"webp": 90, "jpeg": 92, "avif": 75}
+# zlib level for PNGs we encode ourselves (refined frames). Pillow's
+# default 6 is ~3× slower than 3 for a few % smaller output.
+PNG_COMPRESS_LEVEL = 3
+THUMBNAIL_SIDE = 320
+ENCODER_THREADS = 2
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def format_available(fmt: str) -> bool:
+    """Whether this Pillow build can write fmt (AVIF needs Pillow ≥ 11.3 + libavif)."""
+    if fmt in ("png", "jpeg"):
+        return True
+    try:
+        from PIL import features
+        return bool(features.check(fmt))
+    except Exception:
+        return False
+
+
+def negotiate_format(requested: str = None, accept: str = None) -> str:
+    """Pick the output format key.
+
+    An explicit request `format` wins (falling back to webp, then png, when
+    the build can't write it). Otherwise the Accept header's specific image
+    types are ranked by q-value then _PREFERENCE; wildcards / no header keep
+    PNG — the historical contract.
+    """
+    if requested:
+        fmt = _ALIASES.get(requested.lower(), requested.lower())
+        if fmt not in FORMATS:
+            raise ValueError(f"unsupported format {requested!r} (png, webp, jpeg, avif)")
+        for candidate in (fmt, "webp", "png"):
+            if format_available(candidate):
+                return candidate
+    ranked = []
+    for item in (accept or "").split(","):
+        mime, _, params = item.strip().partition(";")
+        fmt = mime.strip().lower().replace("image/", "", 1) if mime.strip().lower().startswith("image/") else None
+        fmt = _ALIASES.get(fmt, fmt)
+        if fmt not in FORMATS or not format_available(fmt):
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    pass
+        if q > 0:
+            ranked.append((-q, _PREFERENCE.index(fmt), fmt))
+    return min(ranked)[2] if ranked else "png"
+
+
+def encode_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _pool = ThreadPoolExecutor(max_workers=ENCODER_THREADS, thread_name_prefix="encode")
+        return _pool
+
+
+class ImageContext(DetectionFrame):
+    """One decoded image shared by QA, detection, refinement and encoding."""
+
+    def __init__(self, rgb, source_bytes: bytes = None):
+        super().__init__(rgb)
+        self.source_bytes = source_bytes
+        self.dirty = False
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        import io
+        import numpy as np
+        from PIL import Image
+
+        with Image.open(io.BytesIO(data)) as im:
+            rgb = np.array(im.convert("RGB"))  # writable — composited in place
+        return cls(rgb, source_bytes=data)
+
+    def crop(self, box):
+        """RGB array copy of (x0, y0, x1, y1) — safe across later composites."""
+        x0, y0, x1, y1 = box
+        return self.rgb[y0:y1, x0:x1].copy()
+
+    def composite(self, patch, origin, alpha):
+        """Alpha-blend an HxWx3 uint8 patch into the frame at origin, in place.
+
+        alpha: HxW uint8 (255 = patch). Equivalent to PIL paste(patch, origin,
+        mask) but touches only the region — no full-frame copy.
+        """
+        import numpy as np
+
+        x0, y0 = origin
+        h, w = patch.shape[:2]
+        region = self.rgb[y0:y0 + h, x0:x0 + w]
+        a = alpha[:region.shape[0], :region.shape[1], None].astype(np.float32) / 255.0
+        blended = patch[:region.shape[0], :region.shape[1]].astype(np.float32) * a
+        blended += region.astype(np.float32) * (1.0 - a)
+        region[...] = (blended + 0.5).astype(np.uint8)
+        self.invalidate()
+        self.dirty = True
+
+    def invalidate(self):
+        """Drop derived buffers after the pixels changed."""
+        self._gray = None
+        self._levels = {}
+
+    def to_pil(self):
+        from PIL import Image
+        return Image.fromarray(self.rgb, mode="RGB")
+
+    def encode(self, fmt: str = "png", quality: int = None, max_side: int = None) -> bytes:
+        """Encoded image — the untouched source bytes unless pixels changed.
+
+        fmt is a FORMATS key (Pillow names like "PNG" also accepted);
+        max_side downsizes (thumbnails).
+        """
+        fmt = _ALIASES.get(fmt.lower(), fmt.lower())
+        if (fmt == "png" and not max_side and not self.dirty
+                and self.source_bytes is not None):
+            return self.source_bytes
+        import io
+        from PIL import Image
+
+        img = self.to_pil()
+        if max_side and max(img.size) > max_side:
+            img = img.copy()
+            img.thumbnail((max_side, max_side), Image.BICUBIC)
+        opts = {}
+        if fmt == "png":
+            opts["compress_level"] = PNG_COMPRESS_LEVEL
+        else:
+            opts["quality"] = int(quality or DEFAULT_QUALITY[fmt])
+            if fmt == "webp":
+                opts["method"] = 4  # 6 is the slowest/smallest; 4 is the speed knee
+        buf = io.BytesIO()
+        img.save(buf, format=FORMATS[fmt][0], **opts)
+        return buf.getvalue()
+
+    def encode_async(self, fmt: str = "png", quality: int = None, max_side: int = None):
+        """encode() on the shared encoder pool. Returns a Future[bytes]."""
+        return encode_pool().submit(self.encode, fmt, quality, max_side)
+
+
+class RequestMeter:
+    """CPU ms for one request + the process peak RSS (X-Process-Peak-Rss-Mb,
+    see module docstring)."""
+
+    def __init__(self):
+        self._cpu0 = time.process_time()
+
+    def cpu_ms(self) -> int:
+        return int((time.process_time() - self._cpu0) * 1000)
+
+    @staticmethod
+    def process_peak_rss_mb() -> int:
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) // 1024
+        except OSError:
+            pass
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+    def headers(self) -> dict:
+        return {"X-Cpu-Ms": str(self.cpu_ms()),
+                "X-Process-Peak-Rss-Mb": str(self.process_peak_rss_mb())}
@@ -0,0 +1,160 @@
+"""
+Content-addressed ComfyUI input files — upload / copy each distinct image once
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+generate_pose_guided re-read its pose reference from /lora/pose-refs/ and
+re-uploaded it to ComfyUI on every request under a fresh random filename;
+generate_controlnet copied its skeleton into input/ each time; H3 wrote every
+reference image to a new uuid name. The bytes were identical run after run,
+and the changing LoadImage filename also changed the node's input signature,
+so ComfyUI re-loaded the image and everything downstream of it that would
+otherwise have come from its cache.
+
+InputCache names an input by its content (prefix + sha256 prefix) and
+remembers what this container has already placed in ComfyUI's input/ dir:
+
+  lookup(digest)      → the stored name if the file is still there
+  record(digest, ...) after an upload / copy
+  path_digest(path)   sha256 of a volume file, memoised by (size, mtime)
+                      so a hot pose ref is hashed once, not per request
+
+multipart_body() builds a /upload/image form body as a chunk iterator plus
+its Content-Length — the image is sent from the caller's buffer (or read
+from disk in CHUNK_BYTES pieces) instead of being concatenated into a second
+full-size copy.
+
+Stdlib only, no modal import.
+"""
+
+import hashlib
+import mimetypes
+import os
+import threading
+import uuid
+
+CHUNK_BYTES = 1 << 20
+# Hex digits of the sha256 kept in the filename
+NAME_DIGEST_LEN = 16
+
+
+def digest_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def content_name(digest: str, prefix: str = "in", ext: str = ".png") -> str:
+    """Stable input filename for a content digest."""
+    return f"{prefix}_{digest[:NAME_DIGEST_LEN]}{ext}"
+
+
+def _file_chunks(path: str):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b""):
+            yield chunk
+
+
+def multipart_body(filename: str, data: bytes = None, path: str = None,
+                   content_type: str = None, fields: dict = None):
+    """multipart/form-data for ComfyUI's /upload/image, without copying the image.
+
+    Pass the image as data (bytes) or path (streamed from disk); the part's
+    Content-Type defaults to a guess from the filename. Returns
+    (chunks, content_type_header, content_length) — hand chunks to
+    urllib.request.Request(data=...) with an explicit Content-Length.
+    """
+    boundary = f"----HolLyBoundary{uuid.uuid4().hex}"
+    content_type = content_type or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    head = b""
+    for name, value in (fields or {}).items():
+        head += (f"--{boundary}\r\n"
+                 f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                 f"{value}\r\n").encode("utf-8")
+    head += (f"--{boundary}\r\n"
+             f'Content-Disposition: form-data; name="image"; filename="{filename}"\r\n'
+             f"Content-Type: {content_type}\r\n\r\n").encode("utf-8")
+    tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+    size = len(data) if data is not None else os.path.getsize(path)
+
+    def chunks():
+        yield head
+        if data is not None:
+            view = memoryview(data)
+            for i in range(0, len(view), CHUNK_BYTES):
+                yield view[i:i + CHUNK_BYTES]
+        else:
+            yield from _file_chunks(path)
+        yield tail
+
+    return chunks(), f"multipart/form-data; boundary={boundary}", len(head) + size + len(tail)
+
+
+class InputCache:
+    """digest → filename of inputs already present in input_dir (per container)."""
+
+    def __init__(self, input_dir: str):
+        self.input_dir = input_dir
+        self._lock = threading.Lock()
+        self._names = {}
+        self._path_digests = {}  # path → (size, mtime_ns, digest)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def path_digest(self, path: str) -> str:
+        st = os.stat(path)
+        with self._lock:
+            memo = self._path_digests.get(path)
+        if memo is not None and memo[:2] == (st.st_size, st.st_mtime_ns):
+            return memo[2]
+        digest = digest_file(path)
+        with self._lock:
+            self._path_digests[path] = (st.st_size, st.st_mtime_ns, digest)
+        return digest
+
+    def lookup(self, digest: str):
+        """Stored filename for digest, or None (also if the file was deleted)."""
+        with self._lock:
+            entry = self._names.get(digest)
+        if entry is None:
+            return None
+        name, size = entry
+        if not os.path.exists(os.path.join(self.input_dir, name)):
+            with self._lock:
+                self._names.pop(digest, None)
+            return None
+        try:
+            # Fresh mtime = recently used — media_janitor sweeps by age
+            os.utime(os.path.join(self.input_dir, name))
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += size
+        return name
+
+    def record(self, digest: str, name: str, size: int):
+        with self._lock:
+            self._names[digest] = (name, size)
+            self.misses += 1
+
+    def forget_missing(self) -> int:
+        """Drop entries whose file is gone (e.g. after input/ cleanup)."""
+        with self._lock:
+            gone = [d for d, (name, _size) in self._names.items()
+                    if not os.path.exists(os.path.join(self.input_dir, name))]
+            for d in gone:
+                del self._names[d]
+        return len(gone)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._names),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "bytes_saved": self.bytes_saved,
+            }
@@ -0,0 +1,225 @@
+"""
+LoRA stack residency — keep the K most recent patched stacks warm in ComfyUI
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+ComfyUI's default (classic) cache only keeps the node outputs of the LAST
+prompt. Alternating between two LoRA stacks (identity only for SFW, identity
++ specialist for a category) therefore threw away the LoraLoader outputs
+every time: the next request re-read each .safetensors from the /lora volume
+and rebuilt the patched ModelPatcher for the 9B UNet.
+
+Launching ComfyUI with `--cache-lru N` keeps the N most recent node results
+instead. LoraResidency sizes N for K stacks (cache_lru_size) and mirrors that
+cache: an LRU of stack ids (the content-derived id of the chain's last
+LoraLoader — see comfyui_graph.lora_chain) with their on-disk byte size, so
+K shrinks when the stacks are large and the byte budget would be exceeded.
+
+observe() runs after every job. A stack whose last LoraLoader shows up in
+ComfyUI's execution_cached list was a hit; otherwise the LoraLoader node
+times are the load/patch cost we paid. Per-stack request counts persist as
+JSON on the models volume; at startup prewarm_stacks() returns the most
+frequent stacks that fit the budget so the container can run a 1-step
+graph for each before the first request.
+
+Stdlib only, no modal import — the caller commits the volume after save().
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from comfyui_graph import lora_spec
+
+# Node results kept per stack in the LRU cache: LoraLoaders + the two text
+# encodes + sampler/decode of the last graph that used it.
+_NODES_PER_STACK = 4
+# Loaders, latent, VAE encode/decode, output — shared by every graph.
+_BASE_NODES = 16
+
+
+def cache_lru_size(max_stacks: int, max_depth: int = 4) -> int:
+    """--cache-lru value that holds max_stacks chains of up to max_depth LoRAs."""
+    return _BASE_NODES + max_stacks * (max_depth + _NODES_PER_STACK)
+
+
+def lora_stacks(workflow: dict) -> dict:
+    """{terminal LoraLoader id: [lora dicts, base first]} for every stack a graph uses."""
+    nodes = workflow.get("prompt", workflow)
+    loaders = {nid: n for nid, n in nodes.items() if n.get("class_type") == "LoraLoader"}
+    parents = {n["inputs"]["model"][0] for n in loaders.values()
+               if isinstance(n["inputs"].get("model"), list)}
+    # A loader whose output a non-LoraLoader node uses ends a stack even if
+    # it also feeds a longer chain (the face's identity-only set inside the
+    # hands' identity + specialist stack in one refinement graph)
+    used = {v[0] for n in nodes.values() if n.get("class_type") != "LoraLoader"
+            for v in n.get("inputs", {}).values() if isinstance(v, list) and v and v[0] in loaders}
+    stacks = {}
+    for nid in loaders:
+        if nid in parents and nid not in used:
+            continue  # only feeds another LoraLoader — not the end of a chain
+        chain = []
+        cur = nid
+        while cur in loaders:
+            inputs = loaders[cur]["inputs"]
+            chain.append({"name": inputs["lora_name"],
+                          "strength": inputs["strength_model"],
+                          "strength_clip": inputs["strength_clip"]})
+            model = inputs.get("model")
+            cur = model[0] if isinstance(model, list) else None
+        stacks[nid] = chain[::-1]
+    return stacks
+
+
+def cached_nodes(history: dict) -> set:
+    """Node ids ComfyUI served from cache — /ws timings or /history messages."""
+    timings = history.get("timings") or {}
+    if "cached" in timings:
+        return set(timings["cached"])
+    for message in (history.get("status") or {}).get("messages") or []:
+        if isinstance(message, (list, tuple)) and len(message) == 2 and message[0] == "execution_cached":
+            return set((message[1] or {}).get("nodes") or [])
+    return set()
+
+
+class LoraResidency:
+    """LRU bookkeeping of LoRA stacks resident in ComfyUI's node cache."""
+
+    def __init__(self, lora_dir: str, stats_path: str, budget_bytes: int, max_stacks: int):
+        self.lora_dir = lora_dir
+        self.stats_path = stats_path
+        self.budget_bytes = budget_bytes
+        self.max_stacks = max_stacks
+        self._lock = threading.Lock()
+        self._resident = OrderedDict()  # stack id → bytes, oldest first
+        self._sizes = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.patch_s = 0.0
+        self.prewarmed = 0
+        self.usage = self._load_usage()
+
+    def _load_usage(self) -> dict:
+        try:
+            with open(self.stats_path) as f:
+                return json.load(f).get("stacks", {})
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        """Persist per-stack usage (atomic replace). Caller commits the volume."""
+        with self._lock:
+            data = json.dumps({"stacks": self.usage, "saved_at": time.time()}, sort_keys=True)
+        os.makedirs(os.path.dirname(self.stats_path), exist_ok=True)
+        tmp = f"{self.stats_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, self.stats_path)
+
+    def lora_bytes(self, name: str) -> int:
+        size = self._sizes.get(name)
+        if size is None:
+            try:
+                size = os.path.getsize(os.path.join(self.lora_dir, name))
+            except OSError:
+                size = 0
+            self._sizes[name] = size
+        return size
+
+    def stack_bytes(self, loras) -> int:
+        return sum(self.lora_bytes(lora_spec(lora)[0]) for lora in loras)
+
+    def _admit(self, stack_id: str, size: int):
+        """Mark stack_id most-recent; evict LRU stacks past K or the budget."""
+        self._resident.pop(stack_id, None)
+        self._resident[stack_id] = size
+        while len(self._resident) > 1 and (
+                len(self._resident) > self.max_stacks
+                or sum(self._resident.values()) > self.budget_bytes):
+            self._resident.popitem(last=False)
+            self.evictions += 1
+
+    def fit_slots(self) -> int:
+        """Shrink max_stacks so K average-sized known stacks fit the budget.
+
+        Called before ComfyUI launches — the result sizes --cache-lru.
+        """
+        sizes = [s for s in (self.stack_bytes(e["loras"]) for e in self.usage.values()) if s]
+        if sizes:
+            avg = sum(sizes) / len(sizes)
+            self.max_stacks = max(1, min(self.max_stacks, int(self.budget_bytes // avg)))
+        return self.max_stacks
+
+    def observe(self, workflow: dict, history: dict, record: bool = True) -> list:
+        """Record a finished job. Returns [(stack_id, hit, patch_s)] per chain.
+
+        record=False (prewarm) only marks the stacks resident — no hit/miss
+        or usage counts.
+        """
+        timings = (history.get("timings") or {}).get("nodes") or {}
+        served = cached_nodes(history)
+        results = []
+        for stack_id, loras in lora_stacks(workflow).items():
+            size = self.stack_bytes(loras)
+            chain_ids = _chain_ids(workflow, stack_id)
+            hit = stack_id in served
+            patch_s = 0.0 if hit else sum(timings.get(nid, 0.0) for nid in chain_ids)
+            with self._lock:
+                self._admit(stack_id, size)
+                if record:
+                    if hit:
+                        self.hits += 1
+                    else:
+                        self.misses += 1
+                        self.patch_s += patch_s
+                    entry = self.usage.setdefault(stack_id, {"loras": loras, "count": 0})
+                    entry["count"] += 1
+                    entry["last_used"] = time.time()
+            results.append((stack_id, hit, patch_s))
+        return results
+
+    def prewarm_stacks(self) -> list:
+        """Most frequently used stacks that fit K and the byte budget (lora lists)."""
+        ranked = sorted(self.usage.values(), key=lambda e: (-e.get("count", 0), -e.get("last_used", 0)))
+        picked, total = [], 0
+        for entry in ranked:
+            if len(picked) >= self.max_stacks:
+                break
+            size = self.stack_bytes(entry["loras"])
+            if total + size > self.budget_bytes:
+                continue
+            if not all(os.path.exists(os.path.join(self.lora_dir, lora_spec(l)[0])) for l in entry["loras"]):
+                continue  # LoRA removed from the volume since it was recorded
+            picked.append(entry["loras"])
+            total += size
+        return picked
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "resident_stacks": len(self._resident),
+                "resident_bytes": sum(self._resident.values()),
+                "max_stacks": self.max_stacks,
+                "budget_bytes": self.budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "patch_s_total": round(self.patch_s, 3),
+                "patch_s_avg": round(self.patch_s / self.misses, 3) if self.misses else None,
+                "prewarmed": self.prewarmed,
+                "known_stacks": len(self.usage),
+            }
+
+
+def _chain_ids(workflow: dict, stack_id: str) -> list:
+    nodes = workflow.get("prompt", workflow)
+    ids = []
+    cur = stack_id
+    while cur in nodes and nodes[cur].get("class_type") == "LoraLoader":
+        ids.append(cur)
+        model = nodes[cur]["inputs"].get("model")
+        cur = model[0] if isinstance(model, list) else None
+    return ids
@@ -0,0 +1,229 @@
+"""
+Single-pass ingestion of base64 input images
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+H3 handled every reference image twice: _auto_dims base64-decoded the first
+image and opened it with PIL just to read its size, then _save_input_image
+decoded the same string again to hash and write it. An R2V request with
+three references paid four full decodes, and nothing bounded how large a
+decoded image could get.
+
+decode_image() does it once per image:
+
+  1. reject on the ENCODED length before allocating anything — base64
+     decodes to at most 3/4 of its length, so an oversized payload is
+     refused without decoding it (InputTooLarge → HTTP 413)
+  2. decode, strip a "data:image/...;base64," prefix if a client sent one
+  3. sha256 (the input_cache content name) and width/height sniffed from
+     the header bytes — PNG IHDR, JPEG SOFn, WebP VP8/VP8L/VP8X, GIF —
+     no pixel decode, no PIL. Anything else (AVIF from the Klein output
+     negotiation, BMP, TIFF, …) falls back to PIL.Image.open, which also
+     reads only the header; the byte caps above still apply first.
+
+The resulting InputImage carries the bytes, digest, size and a file
+extension; the caller writes .data straight into ComfyUI's input/ dir.
+
+Stdlib only, no modal import (Pillow is imported lazily for the fallback).
+"""
+
+import base64
+import binascii
+import hashlib
+import struct
+
+# Per-image and per-request caps on DECODED bytes. A 1280px PNG reference is
+# ~2-4 MB; 16 MB leaves room for an uncompressed 4K still.
+MAX_IMAGE_BYTES = 16 * 1024**2
+MAX_REQUEST_BYTES = 40 * 1024**2
+
+_EXT = {"png": ".png", "jpeg": ".jpg", "webp": ".webp", "gif": ".gif",
+        "avif": ".avif", "bmp": ".bmp", "tiff": ".tif"}
+
+
+class InputTooLarge(ValueError):
+    """Decoded input over its limit — the endpoints answer 413."""
+
+    def __init__(self, size: int, limit: int, what: str = "image"):
+        super().__init__(f"{what} is {size} bytes decoded, limit {limit}")
+        self.size = size
+        self.limit = limit
+        self.what = what
+
+
+class InvalidImage(ValueError):
+    """Not base64, or not an image format we can read a size from."""
+
+
+class InputImage:
+    """One decoded input: bytes + sha256 + (width, height) from the header."""
+
+    __slots__ = ("data", "digest", "format", "width", "height")
+
+    def __init__(self, data: bytes, digest: str, fmt: str, width: int, height: int):
+        self.data = data
+        self.digest = digest
+        self.format = fmt
+        self.width = width
+        self.height = height
+
+    @property
+    def size(self) -> tuple:
+        return self.width, self.height
+
+    @property
+    def ext(self) -> str:
+        return _EXT.get(self.format, ".png")
+
+    def __repr__(self):
+        return f"InputImage({self.format} {self.width}x{self.height}, {len(self.data)} bytes)"
+
+
+# ── Header sniffing ─────────────────────────────────────────────────────
+
+def _png_size(data: bytes):
+    # 8-byte signature, then the IHDR chunk: length, "IHDR", width, height
+    if len(data) >= 24 and data[12:16] == b"IHDR":
+        return struct.unpack(">II", data[16:24])
+    return None
+
+
+def _jpeg_size(data: bytes):
+    # Walk the marker segments up to the first SOFn (frame header)
+    pos = 2
+    n = len(data)
+    while pos + 4 <= n:
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:  # no length field
+            pos += 2
+            continue
+        (seg_len,) = struct.unpack(">H", data[pos + 2:pos + 4])
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if pos + 9 > n:
+                return None
+            height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + seg_len
+    return None
+
+
+def _webp_size(data: bytes):
+    chunk = data[12:16]
+    if chunk == b"VP8 " and len(data) >= 30:
+        w, h = struct.unpack("<HH", data[26:30])
+        return w & 0x3FFF, h & 0x3FFF
+    if chunk == b"VP8L" and len(data) >= 25:
+        bits = int.from_bytes(data[21:25], "little")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X" and len(data) >= 30:
+        return (int.from_bytes(data[24:27], "little") + 1,
+                int.from_bytes(data[27:30], "little") + 1)
+    return None
+
+
+def _gif_size(data: bytes):
+    if len(data) >= 10:
+        return struct.unpack("<HH", data[6:10])
+    return None
+
+
+def sniff_image(data: bytes):
+    """(format, width, height) from the header bytes, or None."""
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        fmt, size = "png", _png_size(data)
+    elif data[:3] == b"\xff\xd8\xff":
+        fmt, size = "jpeg", _jpeg_size(data)
+    elif data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        fmt, size = "webp", _webp_size(data)
+    elif data[:6] in (b"GIF87a", b"GIF89a"):
+        fmt, size = "gif", _gif_size(data)
+    else:
+        return None
+    if not size or not size[0] or not size[1]:
+        return None
+    return fmt, int(size[0]), int(size[1])
+
+
+def pillow_size(data: bytes):
+    """(format, width, height) via PIL.Image.open — header only, the pixels
+    aren't decoded until .load(). None if Pillow is missing or can't read it."""
+    try:
+        import io
+        from PIL import Image
+        with Image.open(io.BytesIO(data)) as img:
+            width, height = img.size
+            fmt = (img.format or "").lower()
+    except Exception:
+        return None
+    if not fmt or not width or not height:
+        return None
+    return fmt, int(width), int(height)
+
+
+# ── Decoding ────────────────────────────────────────────────────────────
+
+def _strip_data_url(b64: str) -> str:
+    if b64.startswith("data:"):
+        _, _, b64 = b64.partition(",")
+    return b64
+
+
+def max_decoded_size(b64: str) -> int:
+    """Upper bound on the decoded length of a base64 string (no decode).
+    Line breaks inflate it slightly; callers allow for padding themselves."""
+    return len(b64) * 3 // 4
+
+
+def _over(b64: str, limit: int) -> int:
+    """Decoded-size bound if it is over limit, else 0. Recounts without
+    whitespace before refusing, so MIME-wrapped base64 near the limit passes."""
+    bound = max_decoded_size(b64)
+    if bound <= limit:
+        return 0
+    bound = max_decoded_size("".join(b64.split()))
+    return bound if bound > limit else 0
+
+
+def decode_image(b64: str, max_bytes: int = MAX_IMAGE_BYTES) -> InputImage:
+    """Decode one base64 image exactly once. Raises InputTooLarge / InvalidImage."""
+    b64 = _strip_data_url((b64 or "").strip())
+    if not b64:
+        raise InvalidImage("empty image")
+    bound = _over(b64, max_bytes + 2)  # +2: padding rounds the bound up
+    if bound:
+        raise InputTooLarge(bound, max_bytes)
+    try:
+        data = base64.b64decode(b64)
+    except (binascii.Error, ValueError) as e:
+        raise InvalidImage(f"not valid base64: {e}") from None
+    if len(data) > max_bytes:
+        raise InputTooLarge(len(data), max_bytes)
+    sniffed = sniff_image(data) or pillow_size(data)
+    if sniffed is None:
+        raise InvalidImage("unrecognised image format")
+    fmt, width, height = sniffed
+    return InputImage(data, hashlib.sha256(data).hexdigest(), fmt, width, height)
+
+
+def decode_images(b64_list, max_bytes: int = MAX_IMAGE_BYTES,
+                  max_total: int = MAX_REQUEST_BYTES) -> list:
+    """decode_image over a request's images, with a cap on their sum. The
+    total is checked on encoded lengths first so nothing is decoded for a
+    request that cannot fit."""
+    limit = max_total + 2 * len(b64_list)
+    if sum(max_decoded_size(b or "") for b in b64_list) > limit:
+        bound = sum(max_decoded_size("".join((b or "").split())) for b in b64_list)
+        if bound > limit:
+            raise InputTooLarge(bound, max_total, "request images")
+    images = []
+    total = 0
+    for b64 in b64_list:
+        img = decode_image(b64, max_bytes)
+        total += len(img.data)
+        if total > max_total:
+            raise InputTooLarge(total, max_total, "request images")
+        images.append(img)
+    return images
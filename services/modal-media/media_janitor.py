@@ -0,0 +1,217 @@
+"""
+Background disk janitor — byte / age budgets for scratch directories
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+Nothing ever deleted from ComfyUI's output/ and input/ dirs: Klein PNGs that
+fell back to /view, refinement crops and uploaded references, H3's
+multi-second MP4s and their reference frames. ACE-Step renders left one
+mkdtemp directory per song. A container kept warm for an evening filled its
+disk, and H3's output scan (os.walk over output/) slowed down with every
+video left behind.
+
+MediaJanitor runs on a daemon thread next to ComfyUI and sweeps every
+interval_s. Each Budget names a directory and its limits:
+
+  max_age_s    units older than this are deleted
+  max_bytes    then the oldest units go until the directory fits
+  pattern      glob on the unit's name (None = everything)
+  entries      True: top-level entries (e.g. mkdtemp dirs) are the units,
+               deleted whole; False: every file below the directory
+
+Nothing younger than min_age_s is touched, so a file a running job is still
+writing or reading survives. "Age" is mtime — InputCache.lookup bumps it on
+reuse, so a hot pose ref counts as fresh.
+
+stats() reports current usage and what has been reclaimed; the apps put it
+in their health output.
+
+Stdlib only, no modal import.
+"""
+
+import fnmatch
+import os
+import shutil
+import threading
+import time
+
+# Sweep period and the grace age below which nothing is deleted
+SWEEP_INTERVAL_S = 60.0
+MIN_AGE_S = 120.0
+
+
+class Budget:
+    """Limits for one directory — see the module docstring."""
+
+    def __init__(self, path: str, max_bytes: int = None, max_age_s: float = None,
+                 pattern: str = None, entries: bool = False, min_age_s: float = MIN_AGE_S):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.pattern = pattern
+        self.entries = entries
+        self.min_age_s = min_age_s
+
+    def __repr__(self):
+        return f"Budget({self.path!r}, max_bytes={self.max_bytes}, max_age_s={self.max_age_s})"
+
+
+def _tree_size(path: str) -> tuple:
+    """(bytes, newest mtime) of a file or directory tree."""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return 0, 0.0
+    if not os.path.isdir(path) or os.path.islink(path):
+        return st.st_size, st.st_mtime
+    total, newest = 0, st.st_mtime
+    for root, _dirs, files in os.walk(path):
+        for fn in files:
+            try:
+                fst = os.lstat(os.path.join(root, fn))
+            except OSError:
+                continue
+            total += fst.st_size
+            newest = max(newest, fst.st_mtime)
+    return total, newest
+
+
+def scan(budget: Budget) -> list:
+    """[(mtime, bytes, path)] of the budget's units, oldest first."""
+    units = []
+    if not os.path.isdir(budget.path):
+        return units
+    if budget.entries:
+        with os.scandir(budget.path) as it:
+            for entry in it:
+                if budget.pattern and not fnmatch.fnmatch(entry.name, budget.pattern):
+                    continue
+                size, mtime = _tree_size(entry.path)
+                units.append((mtime, size, entry.path))
+    else:
+        for root, _dirs, files in os.walk(budget.path):
+            for fn in files:
+                if budget.pattern and not fnmatch.fnmatch(fn, budget.pattern):
+                    continue
+                path = os.path.join(root, fn)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue  # deleted by its owner mid-scan
+                units.append((st.st_mtime, st.st_size, path))
+    units.sort()
+    return units
+
+
+def _remove(path: str):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+class MediaJanitor:
+    """Periodic sweeper over a list of Budgets."""
+
+    def __init__(self, budgets, interval_s: float = SWEEP_INTERVAL_S, name: str = "media-janitor"):
+        self.budgets = list(budgets)
+        self.interval_s = interval_s
+        self.name = name
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.sweeps = 0
+        self.reclaimed_files = 0
+        self.reclaimed_bytes = 0
+        self.errors = 0
+        self.last_sweep_at = None
+        self.last_sweep_ms = None
+        self._usage = {}  # path → {"units", "bytes"} after the last sweep
+        self._by_dir = {}  # path → {"files", "bytes"} reclaimed
+
+    def sweep_budget(self, budget: Budget, now: float = None) -> tuple:
+        """Apply one budget. Returns (units removed, bytes removed)."""
+        now = time.time() if now is None else now
+        units = scan(budget)
+        total = sum(size for _m, size, _p in units)
+        removed_n = removed_bytes = 0
+        keep = []
+        for mtime, size, path in units:
+            age = now - mtime
+            expired = budget.max_age_s is not None and age > budget.max_age_s
+            over = budget.max_bytes is not None and total > budget.max_bytes
+            if (expired or over) and age >= budget.min_age_s:
+                try:
+                    _remove(path)
+                except FileNotFoundError:
+                    pass  # its owner got there first
+                except OSError as e:
+                    self.errors += 1
+                    print(f"   ⚠️ janitor: could not remove {path}: {e}")
+                    keep.append((mtime, size, path))
+                    continue
+                total -= size
+                removed_n += 1
+                removed_bytes += size
+            else:
+                keep.append((mtime, size, path))
+        with self._lock:
+            self._usage[budget.path] = {"units": len(keep), "bytes": total}
+            d = self._by_dir.setdefault(budget.path, {"files": 0, "bytes": 0})
+            d["files"] += removed_n
+            d["bytes"] += removed_bytes
+        return removed_n, removed_bytes
+
+    def sweep(self) -> tuple:
+        """One pass over every budget. Returns (units removed, bytes removed)."""
+        t0 = time.time()
+        removed_n = removed_bytes = 0
+        for budget in self.budgets:
+            try:
+                n, b = self.sweep_budget(budget, now=t0)
+            except Exception as e:
+                self.errors += 1
+                print(f"   ⚠️ janitor sweep of {budget.path} failed: {e}")
+                continue
+            removed_n += n
+            removed_bytes += b
+        with self._lock:
+            self.sweeps += 1
+            self.reclaimed_files += removed_n
+            self.reclaimed_bytes += removed_bytes
+            self.last_sweep_at = t0
+            self.last_sweep_ms = int((time.time() - t0) * 1000)
+        if removed_n:
+            print(f"🧹 janitor: removed {removed_n} item(s), {removed_bytes / 1024**2:.1f} MB")
+        return removed_n, removed_bytes
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            self.sweep()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sweeps": self.sweeps,
+                "interval_s": self.interval_s,
+                "last_sweep_at": self.last_sweep_at,
+                "last_sweep_ms": self.last_sweep_ms,
+                "reclaimed_files": self.reclaimed_files,
+                "reclaimed_bytes": self.reclaimed_bytes,
+                "errors": self.errors,
+                "dirs": {
+                    b.path: {
+                        "max_bytes": b.max_bytes,
+                        "max_age_s": b.max_age_s,
+                        **self._usage.get(b.path, {}),
+                        "reclaimed": self._by_dir.get(b.path, {"files": 0, "bytes": 0}),
+                    }
+                    for b in self.budgets
+                },
+            }
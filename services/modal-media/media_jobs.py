@@ -0,0 +1,427 @@
+"""
+Async job store — submit / status / result for long-running media endpoints
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+Klein with body_integrity (6 attempts + refinement), H3 animate/animate_ref
+(up to 1800s) and Music generate (up to 240s of audio) used to hold one HTTP
+request open for the whole render. A dropped client connection threw the GPU
+work away, and the caller saw nothing until the end.
+
+Each app now has three small CPU endpoints next to its synchronous ones:
+
+  POST <app>-jobs-submit   {"endpoint": ..., "request": {...}} → {"job_id", ...}
+                           creates the job and .spawn()s the GPU worker
+  GET  <app>-jobs-status   ?job_id= → state + progress (stage, attempt,
+                           ComfyUI step/steps) + result metadata when done
+  GET  <app>-jobs-result   ?job_id= → the stored bytes with the original
+                           media type and X- headers (409 until finished),
+                           streamed; honours Range (media_delivery.py)
+
+Job records live in a JobStore: metadata in a key-value backend and result
+bytes as files under results_dir (a Modal volume in production — results
+outlive the container and the client's connection).
+
+  SQLiteBackend(path)   local runs and tests
+  DictBackend(mapping)  production: a modal.Dict (any mapping with get /
+                        __setitem__ / pop works)
+
+States: queued → running → succeeded | failed. ProgressReporter is the
+worker-side handle: it merges stage/attempt/step updates into the record,
+rate-limited so per-step ComfyUI events don't hammer the backend.
+
+Expiry: all apps share one backend, so create() also appends the job id to
+an hourly created-at index, index:<kind>:<hour>. expire(kind) — run by each
+app's hourly jobs_expire function, which mounts the results volume and
+commits the deletions — walks only the buckets that aged past JOB_TTL_S
+since its last run (cursor in index:<kind>:cursor), drops those records and
+their result files, and never touches another kind's jobs. A job is at most
+30 minutes long, so everything in an expired bucket is finished (or its
+worker is gone). Records written before the index existed are swept by a
+full scan for one JOB_TTL_S after the first run, then never again.
+
+Stdlib only, no modal import — the apps pass modal.Dict / volume paths in.
+"""
+
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+from media_delivery import file_response
+
+STATES = ("queued", "running", "succeeded", "failed")
+TERMINAL_STATES = ("succeeded", "failed")
+
+# Minimum seconds between progress writes (stage changes always write)
+PROGRESS_INTERVAL_S = 0.5
+# Jobs (and their result files) are dropped this long after creation
+JOB_TTL_S = 24 * 3600
+# Created-at index bucket width
+INDEX_BUCKET_S = 3600
+# How far back the first expire() looks for index buckets
+INDEX_LOOKBACK_S = 30 * 24 * 3600
+
+
+class SQLiteBackend:
+    """Job records in one SQLite table — {job_id: JSON}."""
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, job_id: str):
+        with self._connect() as db:
+            row = db.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, job_id: str, job: dict):
+        with self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO jobs (id, data) VALUES (?, ?)", (job_id, json.dumps(job)))
+
+    def delete(self, job_id: str):
+        with self._connect() as db:
+            db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def keys(self):
+        with self._connect() as db:
+            return [r[0] for r in db.execute("SELECT id FROM jobs")]
+
+
+class DictBackend:
+    """Job records in a modal.Dict (or any dict-like mapping)."""
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+
+    def get(self, job_id: str):
+        return self.mapping.get(job_id)
+
+    def put(self, job_id: str, job: dict):
+        self.mapping[job_id] = job
+
+    def delete(self, job_id: str):
+        self.mapping.pop(job_id, None)
+
+    def keys(self):
+        return list(self.mapping.keys())
+
+
+class JobStore:
+    """Job metadata in a backend, result bytes in results_dir/<job_id>.bin."""
+
+    def __init__(self, backend, results_dir: str):
+        self.backend = backend
+        self.results_dir = results_dir
+        self._lock = threading.Lock()  # read-modify-write of one record
+
+    def create(self, kind: str, endpoint: str) -> dict:
+        now = time.time()
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "kind": kind,
+            "endpoint": endpoint,
+            "state": "queued",
+            "created_at": now,
+            "updated_at": now,
+            "progress": {"stage": "queued"},
+            "error": None,
+            "result": None,
+        }
+        self.backend.put(job["job_id"], job)
+        self._index_add(kind, int(now // INDEX_BUCKET_S), job["job_id"])
+        return job
+
+    def get(self, job_id: str):
+        job = self.backend.get(job_id)
+        # Index entries share the backend — never hand them out as jobs
+        return job if isinstance(job, dict) and "job_id" in job else None
+
+    # ── Created-at index ───────────────────────────────────────────────
+
+    @staticmethod
+    def _index_key(kind: str, bucket) -> str:
+        return f"index:{kind}:{bucket}"
+
+    def _index_add(self, kind: str, bucket: int, job_id: str, retries: int = 3):
+        """Append job_id to its bucket. The backend has no atomic append, so
+        read the list back and retry if a concurrent submit overwrote it."""
+        key = self._index_key(kind, bucket)
+        with self._lock:
+            for _ in range(retries):
+                ids = self.backend.get(key) or []
+                if job_id not in ids:
+                    self.backend.put(key, ids + [job_id])
+                if job_id in (self.backend.get(key) or []):
+                    return
+
+    def update(self, job_id: str, **fields) -> dict:
+        with self._lock:
+            job = self.backend.get(job_id)
+            if job is None:
+                raise KeyError(job_id)
+            progress = fields.pop("progress", None)
+            if progress:
+                job["progress"] = {**job.get("progress", {}), **progress}
+            job.update(fields)
+            job["updated_at"] = time.time()
+            self.backend.put(job_id, job)
+            return job
+
+    def start(self, job_id: str) -> dict:
+        return self.update(job_id, state="running", started_at=time.time(),
+                           progress={"stage": "starting"})
+
+    def result_path(self, job_id: str) -> str:
+        return os.path.join(self.results_dir, f"{job_id}.bin")
+
+    def succeed(self, job_id: str, body, media_type: str, headers: dict = None,
+                commit=None) -> dict:
+        """Write the result file (atomic), commit() it, then flip the record.
+
+        body: the result bytes, or the path of a file holding them (copied
+        without loading it — e.g. a rendered video).
+        commit: e.g. volume.commit — runs before the state change so a reader
+        that sees "succeeded" always finds the file.
+        """
+        os.makedirs(self.results_dir, exist_ok=True)
+        path = self.result_path(job_id)
+        tmp = f"{path}.tmp"
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            with open(tmp, "wb") as f:
+                f.write(body)
+        else:
+            shutil.copyfile(body, tmp)
+        os.replace(tmp, path)
+        if commit is not None:
+            commit()
+        return self.update(job_id, state="succeeded", finished_at=time.time(),
+                           progress={"stage": "done"},
+                           result={"media_type": media_type, "bytes": os.path.getsize(path),
+                                   "headers": _public_headers(headers or {})})
+
+    def fail(self, job_id: str, error, status_code: int = 500) -> dict:
+        detail = error if isinstance(error, dict) else str(error)[:2000]
+        return self.update(job_id, state="failed", finished_at=time.time(),
+                           progress={"stage": "failed"},
+                           error={"status_code": status_code, "detail": detail})
+
+    def read_result(self, job_id: str):
+        """(bytes, media_type, headers) for a succeeded job, else None."""
+        job = self.get(job_id)
+        if job is None or job["state"] != "succeeded":
+            return None
+        with open(self.result_path(job_id), "rb") as f:
+            body = f.read()
+        return body, job["result"]["media_type"], job["result"]["headers"]
+
+    def _drop(self, job_id: str):
+        try:
+            os.remove(self.result_path(job_id))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"   ⚠️ job {job_id[:8]} result not removed: {e}")
+        self.backend.delete(job_id)
+
+    def expire(self, kind: str, ttl_s: float = JOB_TTL_S, now: float = None) -> int:
+        """Drop kind's jobs created more than ttl_s ago, and their result
+        files (see module docstring). Returns how many were removed."""
+        now = time.time() if now is None else now
+        # Buckets that ended before the cutoff hold only expired jobs
+        last = int((now - ttl_s) // INDEX_BUCKET_S) - 1
+        cursor_key = self._index_key(kind, "cursor")
+        legacy_key = self._index_key(kind, "legacy")
+        cursor = self.backend.get(cursor_key)
+        removed = 0
+        if cursor is None:
+            cursor = int((now - INDEX_LOOKBACK_S) // INDEX_BUCKET_S)
+            self.backend.put(legacy_key, now)
+        legacy = self.backend.get(legacy_key)
+        if legacy is not None:
+            removed += self._expire_unindexed(kind, now - ttl_s)
+            if now - ttl_s > legacy:
+                self.backend.delete(legacy_key)  # every pre-index record is gone
+        for bucket in range(cursor + 1, last + 1):
+            key = self._index_key(kind, bucket)
+            for job_id in self.backend.get(key) or []:
+                if self.get(job_id) is not None:
+                    self._drop(job_id)
+                    removed += 1
+            self.backend.delete(key)
+        self.backend.put(cursor_key, max(cursor, last))
+        return removed
+
+    def _expire_unindexed(self, kind: str, cutoff: float) -> int:
+        """Full scan for records written before the index existed."""
+        removed = 0
+        for job_id in self.backend.keys():
+            job = self.get(job_id)
+            if job is not None and job["kind"] == kind and job["created_at"] < cutoff:
+                self._drop(job_id)
+                removed += 1
+        return removed
+
+
+def _public_headers(headers: dict) -> dict:
+    """X- headers worth replaying on /result (content headers are recomputed)."""
+    return {k: v for k, v in headers.items() if k.lower().startswith("x-")}
+
+
+def status_payload(job: dict) -> dict:
+    """What the status endpoint returns for a job record."""
+    out = {
+        "job_id": job["job_id"],
+        "kind": job["kind"],
+        "endpoint": job["endpoint"],
+        "state": job["state"],
+        "progress": job.get("progress", {}),
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
+    if job.get("error"):
+        out["error"] = job["error"]
+    if job.get("result"):
+        out["result"] = {k: job["result"][k] for k in ("media_type", "bytes", "headers")}
+    return out
+
+
+class ProgressReporter:
+    """Worker-side progress handle for one job.
+
+    set(stage=..., attempt=...) merges fields; comfy(update) maps ComfyUI
+    /ws updates (see comfyui_events) to step/steps/node. Writes are throttled
+    to PROGRESS_INTERVAL_S unless the stage changes. Failures are swallowed —
+    progress is advisory, the render must not die on a store hiccup.
+    """
+
+    def __init__(self, store: JobStore, job_id: str, min_interval: float = PROGRESS_INTERVAL_S):
+        self.store = store
+        self.job_id = job_id
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._stage = None
+        self._last_write = 0.0
+
+    def set(self, **fields):
+        with self._lock:
+            self._pending.update(fields)
+            stage_changed = "stage" in fields and fields["stage"] != self._stage
+            if not stage_changed and time.time() - self._last_write < self.min_interval:
+                return
+            self._flush_locked()
+
+    def comfy(self, update: dict):
+        if update.get("type") == "progress":
+            self.set(step=update.get("value"), steps=update.get("max"), node=update.get("node"))
+        elif update.get("type") == "executing" and update.get("class_type"):
+            self.set(node=update.get("node"), node_class=update.get("class_type"))
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._pending:
+            return
+        try:
+            self.store.update(self.job_id, progress=self._pending)
+        except Exception as e:
+            print(f"   ⚠️ job {self.job_id[:8]} progress write failed: {e}")
+            return
+        self._stage = self._pending.get("stage", self._stage)
+        self._pending = {}
+        self._last_write = time.time()
+
+
+def run_job(store: JobStore, job_id: str, work, commit=None) -> bool:
+    """Worker side: run work(reporter) → (body, media_type, headers) and
+    record the outcome (body: bytes or a file path, see JobStore.succeed).
+    HTTPException-style errors keep their status_code. Returns True on success."""
+    reporter = ProgressReporter(store, job_id)
+    store.start(job_id)
+    t0 = time.time()
+    try:
+        body, media_type, headers = work(reporter)
+    except Exception as e:
+        reporter.flush()
+        status_code = getattr(e, "status_code", 500)
+        detail = getattr(e, "detail", None) or f"{type(e).__name__}: {e}"
+        print(f"❌ job {job_id[:8]} failed after {time.time() - t0:.1f}s: {detail}")
+        store.fail(job_id, detail, status_code)
+        return False
+    reporter.flush()
+    job = store.succeed(job_id, body, media_type, headers, commit=commit)
+    print(f"✅ job {job_id[:8]} done in {time.time() - t0:.1f}s ({job['result']['bytes']} bytes)")
+    return True
+
+
+# ── HTTP glue (fastapi imported lazily — only the web containers need it) ──
+
+def submit(store: JobStore, kind: str, body: dict, endpoints, spawn) -> dict:
+    """Create a job for body = {"endpoint": ..., "request": {...}} and start it.
+
+    spawn(job_id, endpoint, request) launches the worker (a Modal
+    .spawn()) and returns its FunctionCall (or None).
+    """
+    from fastapi import HTTPException
+
+    endpoint = body.get("endpoint") or endpoints[0]
+    if endpoint not in endpoints:
+        raise HTTPException(status_code=400, detail=f"endpoint must be one of {list(endpoints)}")
+    request = body.get("request")
+    if not isinstance(request, dict):
+        raise HTTPException(status_code=400, detail='"request" must be the endpoint\'s JSON body')
+    job = store.create(kind, endpoint)
+    try:
+        call = spawn(job["job_id"], endpoint, request)
+    except Exception as e:
+        store.fail(job["job_id"], f"spawn failed: {e}")
+        raise HTTPException(status_code=503, detail=f"could not start job: {e}")
+    if call is not None and getattr(call, "object_id", None):
+        job = store.update(job["job_id"], call_id=call.object_id)
+    return status_payload(job)
+
+
+def status_response(store: JobStore, job_id: str):
+    from fastapi import HTTPException
+
+    job = store.get(job_id) if job_id else None
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"unknown job {job_id!r}")
+    return status_payload(job)
+
+
+def result_response(store: JobStore, job_id: str, reload=None, range_header: str = None):
+    """The stored result, or the job's error / 409 while it is still running.
+
+    reload: e.g. volume.reload — picks up result files committed by the worker.
+    range_header: the request's Range — 206 partial content for video seeking
+    and resumed downloads.
+    """
+    from fastapi import HTTPException
+    from fastapi.responses import JSONResponse
+
+    job = store.get(job_id) if job_id else None
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"unknown job {job_id!r}")
+    if job["state"] == "failed":
+        return JSONResponse(status_payload(job), status_code=job["error"]["status_code"])
+    if job["state"] != "succeeded":
+        return JSONResponse(status_payload(job), status_code=409)
+    if reload is not None:
+        reload()
+    result = job["result"]
+    return file_response(
+        store.result_path(job_id), result["media_type"],
+        headers={**result["headers"], "X-Job-Id": job_id, "X-Job-State": "succeeded"},
+        range_header=range_header,
+    )
@@ -16,18 +16,32 @@ Env:     MODAL_MUSIC_URL=https://nexamusicgroup--music-generate.modal.run
 Endpoints:
   POST /generate {"prompt","lyrics","duration","seed","tags"} → {"audio": base64 mp3}
   GET  /warmup                                                     → {"ok": true}
+  POST /music-jobs-submit {"endpoint": "generate", "request": {...}} → {"job_id", ...}
+  GET  /music-jobs-status?job_id=  → state + progress
+  GET  /music-jobs-result?job_id=  → the /generate JSON body (409 until done)
 """
 
 import base64
+import json
+import tempfile
 
 import modal
 
+import media_jobs
+from media_janitor import Budget, MediaJanitor
+
 app = modal.App("holly-music-acestep")
 
 # ACE-Step 1.5 checkpoint (MIT). Baked into the image at build time so cold
 # boots load from disk (same pattern as holly-vision — proxy timeout safety).
 ACE_REPO = "ACE-Step/ACE-Step-v1-3.5B"
 
+# Per-song render dirs (tempfile.TemporaryDirectory). Removed after every
+# song; the janitor sweeps any a crashed request left behind.
+ACE_TMP_PREFIX = "acestep_"
+TMP_BUDGET_BYTES = 2 * 1024**3
+TMP_MAX_AGE_S = 3600
+
 
 def _download_weights():
     from huggingface_hub import snapshot_download
@@ -53,10 +67,31 @@ image = (
     # ACE-Step (MIT) — installed from source (no PyPI wheel)
     .pip_install("git+https://github.com/ace-step/ACE-Step.git")
     .run_function(_download_weights)
+    .add_local_python_source("media_delivery", "media_janitor", "media_jobs")
+)
+
+# CPU-only image for the job submit/status/result endpoints
+jobs_image = (
+    modal.Image.debian_slim(python_version="3.11")
+    .pip_install("fastapi[standard]")
+    .add_local_python_source("media_delivery", "media_janitor", "media_jobs")
 )
 
+# Endpoint signatures reference fastapi.Request
+with jobs_image.imports():
+    import fastapi
 
-@app.cls(image=image, gpu="A10G", timeout=900, scaledown_window=300, max_containers=1)
+# Async jobs — see media_jobs.py. A full song at 240s holds the HTTP request
+# open for the whole render; jobs keep the result on a volume instead.
+jobs_volume = modal.Volume.from_name("holly-media-jobs", create_if_missing=True)
+jobs_dict = modal.Dict.from_name("holly-media-jobs", create_if_missing=True)
+JOBS_VOL_MOUNT = "/jobs"
+JOBS_RESULTS_DIR = f"{JOBS_VOL_MOUNT}/music"
+MUSIC_JOB_ENDPOINTS = ("generate",)
+
+
+@app.cls(image=image, gpu="A10G", timeout=900, scaledown_window=300, max_containers=1,
+         volumes={JOBS_VOL_MOUNT: jobs_volume})
 class HollyMusic:
     @modal.enter()
     def load(self):
@@ -66,12 +101,18 @@ class HollyMusic:
         # Verified API (infer-api.py): checkpoint_dir + dtype; the pipeline
         # writes rendered songs to save_path rather than returning arrays.
         self.pipe = ACEStepPipeline(checkpoint_dir="/models/acestep", dtype="bfloat16")
+        self.janitor = MediaJanitor([
+            Budget(tempfile.gettempdir(), TMP_BUDGET_BYTES, TMP_MAX_AGE_S,
+                   pattern=f"{ACE_TMP_PREFIX}*", entries=True),
+        ])
+        self.janitor.start()
         print("─── Holly music engine ready ───")
 
     @modal.fastapi_endpoint(method="GET", label="music-warmup")
     def warmup(self) -> dict:
         """Wake container + load weights. No inference, no credits beyond boot."""
-        return {"ok": True, "model": ACE_REPO}
+        return {"ok": True, "model": ACE_REPO,
+                "janitor": self.janitor.stats() if getattr(self, "janitor", None) else None}
 
     @modal.fastapi_endpoint(method="POST", label="music-generate", docs=True)
     def generate(self, request: dict) -> dict:
@@ -87,8 +128,24 @@ class HollyMusic:
           seed    — int (default random; returned for reproducibility)
           bpm     — int 60-220 (optional, appended to style tags)
         """
+        return self._generate(request)
+
+    @modal.method()
+    def run_job(self, job_id: str, endpoint: str, request: dict):
+        """Async-job worker (spawned by music-jobs-submit): run generate and
+        store its JSON body on the jobs volume. {"error"} bodies fail the job."""
+
+        def work(reporter):
+            out = self._generate(request, reporter=reporter)
+            if "error" in out:
+                raise _JobError(400 if out["error"].startswith(("lyrics", "unsupported")) else 500, out)
+            return json.dumps(out).encode(), "application/json", {
+                "X-Music-Seed": str(out["seed"]), "X-Music-Format": out["format"]}
+
+        media_jobs.run_job(music_job_store(), job_id, work, commit=jobs_volume.commit)
+
+    def _generate(self, request: dict, reporter=None) -> dict:
         import glob
-        import json
         import os
         import random
         import subprocess
@@ -116,94 +173,148 @@ class HollyMusic:
         if bpm is not None:
             style_prompt = f"{style_prompt}, {bpm} bpm"
 
-        out_dir = tempfile.mkdtemp(prefix="acestep_")
-        try:
-            self.pipe(
-                audio_duration=duration,
-                prompt=style_prompt,
-                lyrics=lyrics,
-                infer_step=27,        # repo default quality/speed point (A100: ~2.2s/min audio)
-                guidance_scale=15.0,
-                scheduler_type="euler",  # repo default — flow-matching is not a registered scheduler here
-                cfg_type="apg",
-                omega_scale=10.0,
-                manual_seeds=[seed],
-                save_path=out_dir,
-            )
-        except Exception as e:  # noqa: BLE001 — surface every failure honestly
-            return {"error": f"ACE-Step generation failed: {e}"}
-
-        # Pipeline writes audio files into save_path — take the newest one
-        # Pipeline writes output_paths + an input-params JSON — audio only
-        candidates = sorted(
-            (f for f in glob.glob(os.path.join(out_dir, "*.*"))
-             if f.lower().endswith((".wav", ".mp3", ".flac", ".ogg"))),
-            key=os.path.getmtime,
-        )
-        if not candidates:
-            return {"error": "ACE-Step produced no output files"}
-        wav_path = candidates[-1]
-
-        # ── Post-render duration guarantee ────────────────────────────────────
-        # duration is a HARD CAP: if ACE-Step runs even 1s over, trim. A reel
-        # can never come back at 2+ minutes (the Suno failure mode).
-        def probe_duration(path: str) -> float:
+        if reporter is not None:
+            reporter.set(stage="rendering", duration=duration, seed=seed)
+        # Removed on the way out (every return below) — the janitor only
+        # sweeps what a killed container left behind.
+        with tempfile.TemporaryDirectory(prefix=ACE_TMP_PREFIX) as out_dir:
             try:
-                p = subprocess.run(
-                    ["ffprobe", "-v", "quiet", "-print_format", "json", "-show_format", path],
-                    capture_output=True, text=True, timeout=30,
+                self.pipe(
+                    audio_duration=duration,
+                    prompt=style_prompt,
+                    lyrics=lyrics,
+                    infer_step=27,        # repo default quality/speed point (A100: ~2.2s/min audio)
+                    guidance_scale=15.0,
+                    scheduler_type="euler",  # repo default — flow-matching is not a registered scheduler here
+                    cfg_type="apg",
+                    omega_scale=10.0,
+                    manual_seeds=[seed],
+                    save_path=out_dir,
+                )
+            except Exception as e:  # noqa: BLE001 — surface every failure honestly
+                return {"error": f"ACE-Step generation failed: {e}"}
+
+            # Pipeline writes audio files into save_path — take the newest one
+            # Pipeline writes output_paths + an input-params JSON — audio only
+            candidates = sorted(
+                (f for f in glob.glob(os.path.join(out_dir, "*.*"))
+                 if f.lower().endswith((".wav", ".mp3", ".flac", ".ogg"))),
+                key=os.path.getmtime,
+            )
+            if not candidates:
+                return {"error": "ACE-Step produced no output files"}
+            wav_path = candidates[-1]
+
+            # ── Post-render duration guarantee ────────────────────────────────────
+            # duration is a HARD CAP: if ACE-Step runs even 1s over, trim. A reel
+            # can never come back at 2+ minutes (the Suno failure mode).
+            def probe_duration(path: str) -> float:
+                try:
+                    p = subprocess.run(
+                        ["ffprobe", "-v", "quiet", "-print_format", "json", "-show_format", path],
+                        capture_output=True, text=True, timeout=30,
+                    )
+                    return float(json.loads(p.stdout or "{}").get("format", {}).get("duration", 0))
+                except Exception:  # noqa: BLE001 — probe failure must not kill the song
+                    return 0.0
+
+            if reporter is not None:
+                reporter.set(stage="encoding")
+            actual = probe_duration(wav_path)
+            trimmed = False
+            if actual > duration + 1.0:
+                trimmed_path = wav_path + ".trim.wav"
+                t = subprocess.run(
+                    ["ffmpeg", "-y", "-i", wav_path, "-t", str(duration), "-c", "copy", trimmed_path],
+                    capture_output=True,
                 )
-                return float(json.loads(p.stdout or "{}").get("format", {}).get("duration", 0))
-            except Exception:  # noqa: BLE001 — probe failure must not kill the song
-                return 0.0
-
-        actual = probe_duration(wav_path)
-        trimmed = False
-        if actual > duration + 1.0:
-            trimmed_path = wav_path + ".trim.wav"
-            t = subprocess.run(
-                ["ffmpeg", "-y", "-i", wav_path, "-t", str(duration), "-c", "copy", trimmed_path],
+                if t.returncode == 0 and os.path.getsize(trimmed_path) > 0:
+                    wav_path = trimmed_path
+                    actual = probe_duration(wav_path)
+                    trimmed = True
+
+            # WAV requested → lossless raw render, skip conversion (~10MB/60s)
+            if out_format == "wav":
+                with open(wav_path, "rb") as f:
+                    return {
+                        "audio": base64.b64encode(f.read()).decode(),
+                        "format": "wav",
+                        "seed": seed,
+                        "duration": round(actual if actual > 0 else duration, 2),
+                        "requested_duration": duration,
+                        "trimmed": trimmed,
+                        "model": ACE_REPO,
+                    }
+
+            # → mp3 via ffmpeg (smaller payloads over the wire); -t enforces the cap again
+            proc = subprocess.run(
+                ["ffmpeg", "-y", "-i", wav_path, "-t", str(duration), "-b:a", "320k", "-f", "mp3", "pipe:1"],  # 320k = highest MP3 quality
                 capture_output=True,
             )
-            if t.returncode == 0 and os.path.getsize(trimmed_path) > 0:
-                wav_path = trimmed_path
-                actual = probe_duration(wav_path)
-                trimmed = True
-
-        # WAV requested → lossless raw render, skip conversion (~10MB/60s)
-        if out_format == "wav":
-            with open(wav_path, "rb") as f:
-                return {
-                    "audio": base64.b64encode(f.read()).decode(),
-                    "format": "wav",
-                    "seed": seed,
-                    "duration": round(actual if actual > 0 else duration, 2),
-                    "requested_duration": duration,
-                    "trimmed": trimmed,
-                    "model": ACE_REPO,
-                }
-
-        # → mp3 via ffmpeg (smaller payloads over the wire); -t enforces the cap again
-        proc = subprocess.run(
-            ["ffmpeg", "-y", "-i", wav_path, "-t", str(duration), "-b:a", "320k", "-f", "mp3", "pipe:1"],  # 320k = highest MP3 quality
-            capture_output=True,
-        )
-        if proc.returncode != 0 or not proc.stdout:
-            # Fall back to raw WAV if ffmpeg path fails — never lose the song
-            with open(wav_path, "rb") as f:
-                return {
-                    "audio": base64.b64encode(f.read()).decode(),
-                    "format": os.path.splitext(wav_path)[1].lstrip("."),
-                    "seed": seed,
-                    "duration": round(actual if actual > 0 else duration, 2),
-                    "trimmed": trimmed,
-                }
-        return {
-            "audio": base64.b64encode(proc.stdout).decode(),
-            "format": "mp3",
-            "seed": seed,
-            "duration": round(actual if actual > 0 else duration, 2),
-            "requested_duration": duration,
-            "trimmed": trimmed,
-            "model": ACE_REPO,
-        }
+            if proc.returncode != 0 or not proc.stdout:
+                # Fall back to raw WAV if ffmpeg path fails — never lose the song
+                with open(wav_path, "rb") as f:
+                    return {
+                        "audio": base64.b64encode(f.read()).decode(),
+                        "format": os.path.splitext(wav_path)[1].lstrip("."),
+                        "seed": seed,
+                        "duration": round(actual if actual > 0 else duration, 2),
+                        "trimmed": trimmed,
+                    }
+            return {
+                "audio": base64.b64encode(proc.stdout).decode(),
+                "format": "mp3",
+                "seed": seed,
+                "duration": round(actual if actual > 0 else duration, 2),
+                "requested_duration": duration,
+                "trimmed": trimmed,
+                "model": ACE_REPO,
+            }
+
+
+class _JobError(Exception):
+    def __init__(self, status_code: int, detail):
+        super().__init__(str(detail))
+        self.status_code = status_code
+        self.detail = detail
+
+
+# ── Async job endpoints (CPU containers — answer while the GPU renders) ──
+
+def music_job_store() -> media_jobs.JobStore:
+    return media_jobs.JobStore(media_jobs.DictBackend(jobs_dict), JOBS_RESULTS_DIR)
+
+
+@app.function(image=jobs_image)
+@modal.fastapi_endpoint(method="POST", label="music-jobs-submit")
+def jobs_submit(body: dict):
+    """{"endpoint": "generate", "request": <generate JSON body>} → job status."""
+    return media_jobs.submit(
+        music_job_store(), "music", body, MUSIC_JOB_ENDPOINTS,
+        spawn=lambda job_id, endpoint, request: HollyMusic().run_job.spawn(job_id, endpoint, request),
+    )
+
+
+@app.function(image=jobs_image, volumes={JOBS_VOL_MOUNT: jobs_volume},
+              schedule=modal.Period(hours=1))
+def jobs_expire():
+    """Drop music jobs older than media_jobs.JOB_TTL_S with their result files
+    (hourly, with the jobs volume mounted so the deletions can be committed)."""
+    jobs_volume.reload()
+    removed = music_job_store().expire("music")
+    if removed:
+        jobs_volume.commit()
+        print(f"🧹 Expired {removed} music job(s)")
+
+
+@app.function(image=jobs_image)
+@modal.fastapi_endpoint(method="GET", label="music-jobs-status")
+def jobs_status(job_id: str):
+    return media_jobs.status_response(music_job_store(), job_id)
+
+
+@app.function(image=jobs_image, volumes={JOBS_VOL_MOUNT: jobs_volume})
+@modal.fastapi_endpoint(method="GET", label="music-jobs-result")
+def jobs_result(job_id: str, http_request: "fastapi.Request"):
+    return media_jobs.result_response(music_job_store(), job_id, reload=jobs_volume.reload,
+                                      range_header=http_request.headers.get("range"))
@@ -0,0 +1,127 @@
+"""
+Server-Sent Events stream for progressive Klein previews
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+ComfyUI runs with `--preview-method auto`, so every sampler step pushes a
+low-res latent preview over /ws — but generate only answered once sampling,
+QA and refinement were all done, and the chat UI showed a blank spinner for
+that whole time.
+
+generate-comfyui-klein-stream answers at once with text/event-stream and
+runs the normal generate pipeline on a worker thread. SSEStream is that
+request's progress reporter (same set()/comfy() interface as
+media_jobs.ProgressReporter) and turns what it receives into events:
+
+  event: progress   {"stage": "sampling", "attempt": 1, ...} and
+                    {"step": 3, "steps": 12, "node": "sampler"}
+  event: preview    {"node", "step", "steps", "format", "image": base64}
+  event: result     {"media_type", "headers", "image": base64} — final bytes
+  event: error      {"status_code", "detail", "headers"}
+
+result / error is always the last event. A comment line goes out every
+KEEPALIVE_S so proxies don't drop the connection during QA or refinement,
+which send no previews.
+
+Stdlib only, no modal import.
+"""
+
+import base64
+import json
+import queue
+import time
+
+# Idle seconds before a ": keepalive" comment is sent
+KEEPALIVE_S = 15.0
+# Events buffered for a slow client before previews are dropped (progress,
+# result and error are always queued)
+MAX_BUFFERED = 64
+
+_DONE = object()
+
+
+def sse_event(event: str, data) -> bytes:
+    """One SSE frame. data is JSON-encoded onto a single data: line."""
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode("utf-8")
+
+
+class SSEStream:
+    """Worker-thread reporter on one side, SSE byte generator on the other."""
+
+    def __init__(self, keepalive_s: float = KEEPALIVE_S, max_buffered: int = MAX_BUFFERED):
+        self.keepalive_s = keepalive_s
+        self.max_buffered = max_buffered
+        self._queue = queue.Queue()
+        self._step = None
+        self._steps = None
+        self.previews = 0
+        self.dropped = 0
+        self.disconnected = False
+        self.closed = False
+
+    # ── Reporter side (worker thread) ──────────────────────────────────
+
+    def _put(self, frame: bytes):
+        if not self.disconnected:
+            self._queue.put(frame)
+
+    def set(self, **fields):
+        self._put(sse_event("progress", fields))
+
+    def comfy(self, update: dict):
+        """ComfyUI /ws update (see comfyui_events) → progress / preview events."""
+        utype = update.get("type")
+        if utype == "progress":
+            self._step, self._steps = update.get("value"), update.get("max")
+            self.set(step=self._step, steps=self._steps, node=update.get("node"))
+        elif utype == "preview" and update.get("image"):
+            if update.get("class_type") == "SaveImageWebsocket":
+                return  # an output frame, not a preview — the result event carries it
+            if self._queue.qsize() >= self.max_buffered:
+                self.dropped += 1
+                return
+            self.previews += 1
+            self._put(sse_event("preview", {
+                "node": update.get("node"),
+                "step": self._step,
+                "steps": self._steps,
+                "format": update.get("format"),
+                "image": base64.b64encode(update["image"]).decode("ascii"),
+            }))
+
+    def result(self, body: bytes, media_type: str, headers: dict = None):
+        self._put(sse_event("result", {
+            "media_type": media_type,
+            "headers": {k: v for k, v in (headers or {}).items() if k.lower().startswith("x-")},
+            "image": base64.b64encode(body).decode("ascii"),
+        }))
+
+    def error(self, status_code: int, detail, headers: dict = None):
+        self._put(sse_event("error", {
+            "status_code": status_code,
+            "detail": detail if isinstance(detail, (dict, list)) else str(detail)[:2000],
+            "headers": dict(headers or {}),
+        }))
+
+    def close(self):
+        self.closed = True
+        self._queue.put(_DONE)
+
+    # ── Response side (StreamingResponse iterates this) ────────────────
+
+    def events(self):
+        """SSE frames until result/error and close(). Stops buffering if the
+        client goes away — the worker finishes its request regardless."""
+        try:
+            yield b": stream open\n\n"
+            while True:
+                try:
+                    frame = self._queue.get(timeout=self.keepalive_s)
+                except queue.Empty:
+                    yield b": keepalive\n\n"
+                    continue
+                if frame is _DONE:
+                    return
+                yield frame
+        finally:
+            if not self.closed:
+                self.disconnected = True
+                print(f"   📴 SSE client went away at {time.strftime('%H:%M:%S')} — finishing request unstreamed")
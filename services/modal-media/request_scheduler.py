@@ -0,0 +1,158 @@
+"""
+Bounded priority admission in front of ComfyUI
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+HollyComfyUIKlein ran one input at a time (max_containers=1, no
+@modal.concurrent): a second chat user waited in Modal's web layer with no
+idea how long, and the GPU sat idle while the first request did its CPU
+work (routing, QA, detection, encoding).
+
+The class now accepts several concurrent inputs and RequestScheduler decides
+which of them may run:
+
+  - up to max_active requests run at once — their CPU stages overlap each
+    other's sampling; ComfyUI's own queue serialises the GPU work (interactive
+    prompts are submitted with "front": true, so they sample first there too)
+  - up to max_waiting more wait in-process, ordered by priority
+    (PRIORITY_INTERACTIVE before PRIORITY_BATCH), FIFO within a priority
+  - anything beyond that is rejected at once with QueueFull (→ HTTP 429)
+    carrying the queue depth and an ETA
+
+ETA = EWMA of recent request service times × the number of "rounds" of
+max_active slots ahead of the new request, plus its own service time.
+
+Stdlib only, no modal import.
+"""
+
+import heapq
+import itertools
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITIES = {"interactive": PRIORITY_INTERACTIVE, "batch": PRIORITY_BATCH}
+
+# Service-time EWMA weight of the newest sample, and its seed value (s) until
+# the first request finishes — a typical single-attempt Klein generation.
+EWMA_ALPHA = 0.3
+DEFAULT_SERVICE_S = 20.0
+
+
+class QueueFull(Exception):
+    """Admission refused. depth = requests running + waiting; eta_s = when a
+    new request would finish if admitted; retry_after = seconds to back off."""
+
+    def __init__(self, depth: int, eta_s: float, retry_after: int):
+        super().__init__(f"queue full ({depth} requests ahead, ETA {eta_s:.0f}s)")
+        self.depth = depth
+        self.eta_s = eta_s
+        self.retry_after = retry_after
+
+
+class Ticket:
+    __slots__ = ("priority", "seq", "enqueued_at", "started_at")
+
+    def __init__(self, priority: int, seq: int):
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.time()
+        self.started_at = None
+
+    @property
+    def wait_ms(self) -> int:
+        return int(((self.started_at or time.time()) - self.enqueued_at) * 1000)
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class RequestScheduler:
+    """max_active running + max_waiting queued, priority-ordered; 429 beyond."""
+
+    def __init__(self, max_active: int, max_waiting: int):
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self._cond = threading.Condition()
+        self._waiting = []  # heap of Tickets
+        self._active = 0
+        self._active_batch = 0
+        self._seq = itertools.count()
+        self.service_s = DEFAULT_SERVICE_S
+        self.admitted = 0
+        self.rejected = 0
+
+    def eta_s(self, ahead: int) -> float:
+        """Finish-time estimate for a request with `ahead` requests before it."""
+        rounds = math.floor(ahead / self.max_active)
+        return (rounds + 1) * self.service_s
+
+    def active_batch(self) -> int:
+        """Batch-priority requests currently running."""
+        return self._active_batch
+
+    def _ahead(self, priority: int) -> int:
+        # Running requests + waiters this one would queue behind.
+        return self._active + sum(1 for t in self._waiting if t.priority <= priority)
+
+    @contextmanager
+    def admit(self, priority: int = PRIORITY_INTERACTIVE, timeout: float = None):
+        """Hold a run slot for the duration of the block.
+
+        Raises QueueFull immediately if max_waiting requests are already
+        queued, or after `timeout` seconds of waiting.
+        """
+        with self._cond:
+            if self._active >= self.max_active and len(self._waiting) >= self.max_waiting:
+                self.rejected += 1
+                raise self._full(priority)
+            ticket = Ticket(priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            deadline = None if timeout is None else time.time() + timeout
+            while not (self._waiting[0] is ticket and self._active < self.max_active):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._cond.notify_all()
+                    self.rejected += 1
+                    raise self._full(priority)
+                self._cond.wait(timeout=remaining)
+            heapq.heappop(self._waiting)
+            self._active += 1
+            self._active_batch += ticket.priority >= PRIORITY_BATCH
+            self.admitted += 1
+            ticket.started_at = time.time()
+            self._cond.notify_all()  # next waiter may fit another free slot
+        try:
+            yield ticket
+        finally:
+            elapsed = time.time() - ticket.started_at
+            with self._cond:
+                self._active -= 1
+                self._active_batch -= ticket.priority >= PRIORITY_BATCH
+                self.service_s += EWMA_ALPHA * (elapsed - self.service_s)
+                self._cond.notify_all()
+
+    def _full(self, priority: int) -> QueueFull:
+        ahead = self._ahead(priority)
+        eta = self.eta_s(ahead)
+        # Retry when this request would have started, not when it would finish
+        retry_after = max(1, math.ceil(eta - self.service_s))
+        return QueueFull(self._active + len(self._waiting), eta, retry_after)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "active": self._active,
+                "waiting": len(self._waiting),
+                "active_batch": self._active_batch,
+                "waiting_interactive": sum(1 for t in self._waiting if t.priority == PRIORITY_INTERACTIVE),
+                "max_active": self.max_active,
+                "max_waiting": self.max_waiting,
+                "service_s_ewma": round(self.service_s, 2),
+                "eta_s": round(self.eta_s(self._active + len(self._waiting)), 1),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
@@ -0,0 +1,190 @@
+"""
+Content-addressed result cache for deterministic ComfyUI graphs
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+With an explicit seed, a built Klein graph fully determines ComfyUI's output
+(same weights, same prompt, same sampler). The app's regenerate/retry paths
+still re-ran identical graphs on the A100. ResultCache stores each graph's
+output images on the models volume, keyed by graph_key(): sha256 over the
+canonical JSON of the graph with the per-run noise stripped — output node
+filename_prefix / SaveImage vs SaveImageWebsocket, and LoadImage filenames
+replaced by the uploaded content's digest.
+
+Layout: <root>/<key[:2]>/<key>.bin — a 4-byte image count, then per image an
+8-byte length + PNG bytes. Writes go to a temp file + rename (a crashed
+write never leaves a torn entry). Reads bump mtime, so eviction by oldest
+mtime is LRU; the total is kept under max_bytes.
+
+Stdlib only, no modal import — the caller commits the volume after put().
+"""
+
+import hashlib
+import json
+import os
+import struct
+import threading
+
+_OUTPUT_CLASSES = ("SaveImage", "SaveImageWebsocket", "PreviewImage")
+
+
+def digest_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def graph_key(workflow: dict, input_digests: dict = None) -> str:
+    """Canonical hash of an API-format graph.
+
+    input_digests: {LoadImage filename: content digest} — uploaded inputs are
+    identified by content, not by their per-request upload name. A LoadImage
+    whose filename isn't listed keeps the name (volume-backed inputs).
+    """
+    input_digests = input_digests or {}
+    canon = {}
+    for node_id, node in workflow.get("prompt", workflow).items():
+        class_type = node["class_type"]
+        inputs = dict(node.get("inputs", {}))
+        if class_type in _OUTPUT_CLASSES:
+            class_type = "Output"
+            inputs.pop("filename_prefix", None)
+        elif class_type == "LoadImage" and inputs.get("image") in input_digests:
+            inputs["image"] = "sha256:" + input_digests[inputs["image"]]
+        canon[node_id] = {"class_type": class_type, "inputs": inputs}
+    blob = json.dumps(canon, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Size-bounded LRU of graph outputs on disk."""
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total = None  # lazily scanned
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.bin")
+
+    def _entries(self):
+        """[(mtime, size, path)] for every entry on disk."""
+        out = []
+        if not os.path.isdir(self.root):
+            return out
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".bin"):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    out.append((st.st_mtime, st.st_size, entry.path))
+        return out
+
+    def get(self, key: str):
+        """Cached images for key (list of bytes), or None."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        try:
+            images = _unpack(data)
+        except (ValueError, struct.error):
+            # Torn/foreign file — drop it rather than serve garbage
+            self._remove(path)
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)  # LRU touch
+        except OSError:
+            pass
+        self.hits += 1
+        return images
+
+    def put(self, key: str, images: list) -> bool:
+        """Store images under key. Returns True if written."""
+        if not images:
+            return False
+        data = _pack(images)
+        if len(data) > self.max_bytes:
+            return False
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        existed = os.path.exists(path)
+        os.replace(tmp, path)
+        with self._lock:
+            if self._total is not None and not existed:
+                self._total += len(data)
+        self._evict()
+        return True
+
+    def _remove(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            if self._total is not None:
+                self._total -= size
+
+    def _evict(self):
+        with self._lock:
+            if self._total is None:
+                self._total = sum(size for _m, size, _p in self._entries())
+            if self._total <= self.max_bytes:
+                return
+            # Trim to 90% so we don't rescan on every subsequent put
+            target = int(self.max_bytes * 0.9)
+            for _mtime, size, path in sorted(self._entries()):
+                if self._total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self._total -= size
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._total
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hit_rate": round(self.hits / (self.hits + self.misses), 3) if (self.hits + self.misses) else None,
+        }
+
+
+def _pack(images: list) -> bytes:
+    parts = [struct.pack(">I", len(images))]
+    for img in images:
+        parts.append(struct.pack(">Q", len(img)))
+        parts.append(img)
+    return b"".join(parts)
+
+
+def _unpack(data: bytes) -> list:
+    (count,) = struct.unpack_from(">I", data, 0)
+    offset = 4
+    images = []
+    for _ in range(count):
+        (length,) = struct.unpack_from(">Q", data, offset)
+        offset += 8
+        if offset + length > len(data):
+            raise ValueError("truncated cache entry")
+        images.append(data[offset:offset + length])
+        offset += length
+    return images
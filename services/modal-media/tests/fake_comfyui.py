@@ -0,0 +1,219 @@
+"""Small local fake ComfyUI for the comfyui_events and input_cache tests.
+
+Stdlib only: /prompt queues a prompt and plays a scripted run, pushing the
+execution events to the submitting client_id over /ws (minimal RFC 6455
+server side: handshake + unmasked text frames out, frames in ignored), and
+/history/{prompt_id} answers like ComfyUI once the run is over.
+
+  script = "success"  execution_start → executing → progress → executed →
+                      execution_success
+  script = "error"    … → execution_error (history status_str "error")
+  script = "drop"     the /ws connection is closed mid-run; the prompt
+                      still finishes and shows up in /history
+
+/upload/image parses the multipart form like ComfyUI (an "image" file part
+plus form fields) into uploads[name] = (bytes, part Content-Type, fields),
+renaming to "name (1).ext" on a clash unless overwrite is "true".
+"""
+
+import base64
+import email.parser
+import email.policy
+import hashlib
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+_WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+OUTPUT = {"images": [{"filename": "Holly_00001_.png", "subfolder": "", "type": "output"}]}
+
+
+def _text_frame(payload: str) -> bytes:
+    data = payload.encode("utf-8")
+    if len(data) < 126:
+        head = struct.pack(">BB", 0x81, len(data))
+    elif len(data) < 65536:
+        head = struct.pack(">BBH", 0x81, 126, len(data))
+    else:
+        head = struct.pack(">BBQ", 0x81, 127, len(data))
+    return head + data
+
+
+class FakeComfyUI:
+    def __init__(self, script: str = "success", step_s: float = 0.05):
+        self.script = script
+        self.step_s = step_s
+        self.history = {}
+        self.uploads = {}  # name → (bytes, content type, {field: value})
+        self.sockets = {}  # client_id → socket
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        for sock in list(self.sockets.values()):
+            try:
+                sock.close()
+            except OSError:
+                pass
+        self.server.server_close()
+
+    def wait_connected(self, client_id: str, timeout: float = 5) -> bool:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if client_id in self.sockets:
+                return True
+            time.sleep(0.01)
+        return False
+
+    # ── Scripted run ────────────────────────────────────────────────────
+
+    def _send(self, client_id: str, mtype: str, **data):
+        with self._lock:
+            sock = self.sockets.get(client_id)
+            if sock is None:
+                return
+            try:
+                sock.sendall(_text_frame(json.dumps({"type": mtype, "data": data})))
+            except OSError:
+                self.sockets.pop(client_id, None)
+
+    def _drop(self, client_id: str):
+        with self._lock:
+            sock = self.sockets.pop(client_id, None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def _run(self, prompt_id: str, client_id: str):
+        step = self.step_s
+        time.sleep(step)
+        self._send(client_id, "execution_start", prompt_id=prompt_id)
+        self._send(client_id, "executing", prompt_id=prompt_id, node="sampler")
+        for value in (1, 2):
+            time.sleep(step)
+            self._send(client_id, "progress", prompt_id=prompt_id, node="sampler",
+                       value=value, max=2)
+        if self.script == "drop":
+            self._drop(client_id)
+            time.sleep(step * 4)
+        elif self.script == "error":
+            self._send(client_id, "execution_error", prompt_id=prompt_id, node_id="sampler",
+                       node_type="KSampler", exception_type="torch.OutOfMemoryError",
+                       exception_message="CUDA out of memory")
+            self.history[prompt_id] = {"outputs": {}, "status": {
+                "status_str": "error", "completed": False,
+                "messages": [["execution_error", {"exception_message": "CUDA out of memory"}]]}}
+            return
+        self._send(client_id, "executing", prompt_id=prompt_id, node="save")
+        self._send(client_id, "executed", prompt_id=prompt_id, node="save", output=OUTPUT)
+        self._send(client_id, "execution_success", prompt_id=prompt_id)
+        self.history[prompt_id] = {"outputs": {"save": OUTPUT}, "status": {
+            "status_str": "success", "completed": True, "messages": []}}
+
+    # ── HTTP ────────────────────────────────────────────────────────────
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _json(self, status: int, obj):
+                body = json.dumps(obj).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/ws":
+                    return self._websocket(parse_qs(url.query).get("clientId", [""])[0])
+                if url.path.startswith("/history/"):
+                    prompt_id = url.path.rsplit("/", 1)[1]
+                    entry = fake.history.get(prompt_id)
+                    return self._json(200, {prompt_id: entry} if entry else {})
+                self._json(404, {})
+
+            def do_POST(self):
+                if self.path == "/upload/image":
+                    return self._upload(self.rfile.read(int(self.headers["Content-Length"])))
+                if self.path != "/prompt":
+                    return self._json(404, {})
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                prompt_id = str(uuid.uuid4())
+                threading.Thread(target=fake._run, args=(prompt_id, body.get("client_id")),
+                                 daemon=True).start()
+                self._json(200, {"prompt_id": prompt_id, "number": 1, "node_errors": {}})
+
+            def _upload(self, body: bytes):
+                head = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode()
+                form = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(head + body)
+                image, fields = None, {}
+                for part in form.iter_parts():
+                    if part.get_param("name", header="content-disposition") == "image":
+                        image = part
+                    else:
+                        fields[part.get_param("name", header="content-disposition")] = \
+                            part.get_content().strip()
+                if image is None or not image.get_filename():
+                    return self._json(400, {})
+                name = image.get_filename()
+                base, ext = os.path.splitext(name)
+                i = 1
+                while name in fake.uploads and fields.get("overwrite") != "true":
+                    name = f"{base} ({i}){ext}"
+                    i += 1
+                fake.uploads[name] = (image.get_payload(decode=True), image.get_content_type(), fields)
+                self._json(200, {"name": name, "subfolder": "", "type": "input"})
+
+            def _websocket(self, client_id: str):
+                key = self.headers["Sec-WebSocket-Key"]
+                accept = base64.b64encode(hashlib.sha1((key + _WS_GUID).encode()).digest()).decode()
+                self.send_response(101)
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                self.send_header("Sec-WebSocket-Accept", accept)
+                self.end_headers()
+                self.wfile.flush()
+                with fake._lock:
+                    fake.sockets[client_id] = self.connection
+                # Hold the connection open until either side closes it. The
+                # client only ever sends a close frame (opcode 8) — echo it.
+                try:
+                    while True:
+                        chunk = self.connection.recv(4096)
+                        if not chunk:
+                            break
+                        if chunk[0] & 0x0F == 0x8:
+                            with fake._lock:
+                                self.connection.sendall(b"\x88\x00")
+                            break
+                except OSError:
+                    pass
+                with fake._lock:
+                    if fake.sockets.get(client_id) is self.connection:
+                        del fake.sockets[client_id]
+                self.close_connection = True
+
+        return Handler
@@ -0,0 +1,101 @@
+"""ComfyUIEventListener wakes waiters on /ws execution events, hands over to
+/history polling when the socket drops, and surfaces execution errors.
+
+Runs locally against tests/fake_comfyui.py (stdlib /ws, /prompt, /history).
+comfyui_events is stdlib-only; its listener thread needs websocket-client.
+"""
+
+import json
+import os
+import sys
+import time
+import urllib.request
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+pytest.importorskip("websocket")
+
+from comfyui_events import ComfyUIEventListener, poll_history  # noqa: E402
+from fake_comfyui import OUTPUT, FakeComfyUI  # noqa: E402
+
+
+@pytest.fixture
+def comfy():
+    fakes, listeners = [], []
+
+    def make(script="success"):
+        fake = FakeComfyUI(script).start()
+        listener = ComfyUIEventListener(port=fake.port)
+        assert listener.start(connect_timeout=5)
+        assert fake.wait_connected(listener.client_id)
+        fakes.append(fake)
+        listeners.append(listener)
+        return fake, listener
+
+    yield make
+    for listener in listeners:
+        listener.stop()
+    for fake in fakes:
+        fake.stop()
+
+
+def submit(fake, listener):
+    """Queue a prompt the way _post_workflow does: epoch captured before submit."""
+    epoch = listener.epoch
+    req = urllib.request.Request(
+        f"http://127.0.0.1:{fake.port}/prompt",
+        data=json.dumps({"prompt": {}, "client_id": listener.client_id}).encode(),
+        headers={"Content-Type": "application/json"}, method="POST")
+    with urllib.request.urlopen(req, timeout=5) as resp:
+        prompt_id = json.loads(resp.read())["prompt_id"]
+    listener.track(prompt_id, epoch)
+    return prompt_id
+
+
+def test_completion_pushed_over_ws(comfy):
+    fake, listener = comfy()
+    prompt_id = submit(fake, listener)
+    updates = []
+    entry = listener.wait(prompt_id, timeout=10, on_progress=updates.append)
+    assert entry["outputs"] == {"save": OUTPUT}
+    assert entry["status"]["completed"]
+    assert listener.status(prompt_id) == "success"
+    assert [u["value"] for u in updates if u["type"] == "progress"] == [1, 2]
+    assert entry["timings"]["started_at"] <= entry["timings"]["finished_at"]
+
+
+def test_socket_drop_falls_back_to_history(comfy):
+    fake, listener = comfy("drop")
+    prompt_id = submit(fake, listener)
+    t0 = time.time()
+    assert listener.wait(prompt_id, timeout=10) is None
+    assert time.time() - t0 < 5  # woken by the drop, not the timeout
+    entry = poll_history(prompt_id, port=fake.port, timeout=10, interval=0.05)
+    assert entry["outputs"] == {"save": OUTPUT}
+
+
+def test_execution_error_raises(comfy):
+    fake, listener = comfy("error")
+    prompt_id = submit(fake, listener)
+    with pytest.raises(RuntimeError, match="KSampler .*CUDA out of memory"):
+        listener.wait(prompt_id, timeout=10)
+    assert listener.status(prompt_id) == "error"
+    with pytest.raises(RuntimeError, match="CUDA out of memory"):
+        poll_history(prompt_id, port=fake.port, timeout=5, interval=0.05)
+
+
+def test_prune_keeps_queued_prompts():
+    listener = ComfyUIEventListener(state_ttl=1, max_age=100)
+    with listener._cond:
+        queued = listener._state("queued")
+        done = listener._state("done")
+        ancient = listener._state("ancient")
+        queued["created_at"] -= 50                      # waiting behind other requests
+        done["finished_at"] = time.time() - 5           # finished past state_ttl
+        ancient["created_at"] -= 500                    # never finished, past max_age
+        listener._prune()
+    assert set(listener._prompts) == {"queued"}
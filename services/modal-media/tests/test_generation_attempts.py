@@ -0,0 +1,143 @@
+"""Klein's attempt loop: the speculatively queued attempt N+1 is cancelled
+when N passes QA and reused when it fails; latent-batch candidates are
+ranked passes-first, then by severity.
+
+generation_attempts is stdlib-only; ComfyUI and the QA call are fakes.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generation_attempts import run_attempts, runners_up  # noqa: E402
+
+
+class FakeComfy:
+    """submit / collect / cancel over an in-memory queue; round n yields
+    images b"r{n}.{i}" for i < batch."""
+
+    def __init__(self, batch=1, cached=()):
+        self.batch = batch
+        self.cached = set(cached)
+        self.submitted = []
+        self.cancelled = []
+
+    def submit(self, n):
+        self.submitted.append(n)
+        handle = {"prompt_id": f"p{n}", "job_id": f"j{n}", "round": n,
+                  "cache": "HIT" if n in self.cached else "MISS"}
+        if n in self.cached:
+            handle["cached"] = True
+        return handle
+
+    def collect(self, handle):
+        n = handle["round"]
+        images = [f"r{n}.{i}".encode() for i in range(self.batch)]
+        return images, handle["prompt_id"], {"timings": {"started_at": 10.0 * n,
+                                                         "finished_at": 10.0 * n + 8}}
+
+    def cancel(self, prompt_id):
+        self.cancelled.append(prompt_id)
+
+
+def qa_by(verdicts):
+    """QA fake: verdicts maps image → (passes, severity)."""
+    def qa(images):
+        out = []
+        for img in images:
+            passes, severity = verdicts.get(img, (False, 5))
+            out.append((passes, img.decode(), severity, None))  # reason = image name
+        return out
+    return qa
+
+
+def run(comfy, qa, rounds=3, max_attempts=3, **kw):
+    return run_attempts(comfy.submit, comfy.collect, qa, comfy.cancel,
+                        rounds=rounds, max_attempts=max_attempts, batch=comfy.batch, **kw)
+
+
+def test_pass_cancels_speculative_next_attempt():
+    comfy = FakeComfy()
+    log = run(comfy, qa_by({b"r0.0": (True, 0)}))
+    assert log.accepted and log.image == b"r0.0" and log.attempts == 1
+    assert comfy.submitted == [0, 1]  # attempt 2 queued before attempt 1's QA
+    assert comfy.cancelled == log.cancelled == ["p1"]
+
+
+def test_failed_attempt_reuses_queued_next_one():
+    comfy = FakeComfy()
+    log = run(comfy, qa_by({b"r1.0": (True, 0)}))
+    assert log.accepted and log.image == b"r1.0" and log.attempts == 2
+    assert log.prompt_id == "p1" and log.job_id == "j1"
+    assert comfy.submitted == [0, 1, 2]  # each round submitted once
+    assert comfy.cancelled == ["p2"]
+    assert log.gpu_idle_ms == 2000  # p0 finished at 8, p1 started at 10
+
+
+def test_cached_speculative_attempt_is_not_cancelled():
+    comfy = FakeComfy(cached={1})
+    log = run(comfy, qa_by({b"r0.0": (True, 0)}))
+    assert log.accepted
+    assert comfy.cancelled == [] and log.cancelled == []
+
+
+def test_all_rejected_keeps_least_broken_and_cancels_nothing():
+    comfy = FakeComfy()
+    log = run(comfy, qa_by({b"r0.0": (False, 3), b"r1.0": (False, 1), b"r2.0": (False, 4)}))
+    assert not log.accepted and log.attempts == 3
+    assert log.image == b"r2.0" and log.reject_reason == "r2.0"
+    assert log.best == (1, b"r1.0", "p1", "j1", "r1.0")
+    assert comfy.submitted == [0, 1, 2] and comfy.cancelled == []
+
+
+def test_no_pipelining_submits_only_after_qa():
+    comfy = FakeComfy()
+    log = run(comfy, qa_by({b"r0.0": (True, 0)}), pipeline=False)
+    assert log.accepted and comfy.submitted == [0] and comfy.cancelled == []
+
+
+def test_single_generation_skips_qa():
+    comfy = FakeComfy()
+
+    def qa(images):
+        raise AssertionError("single-gen mode runs no QA")
+
+    log = run(comfy, qa, rounds=1, max_attempts=1)
+    assert log.accepted and log.image == b"r0.0" and log.attempts == 1
+    assert comfy.submitted == [0] and comfy.cancelled == []
+
+
+def test_latent_batch_ranks_candidates():
+    comfy = FakeComfy(batch=4)
+    qa = qa_by({b"r0.0": (False, 2), b"r0.1": (True, 1), b"r0.2": (True, 0), b"r0.3": (False, 1)})
+    stages = []
+    log = run(comfy, qa, rounds=2, max_attempts=8,
+              report=lambda **fields: stages.append(fields["stage"]))
+    # First passing candidate in batch order wins, not the lowest severity
+    assert log.accepted and log.image == b"r0.1" and log.attempts == 4
+    assert comfy.cancelled == ["p1"]
+    assert stages == ["sampling", "qa"]
+    others = runners_up(log.ranked, log.image)
+    assert [img for img, _reason in others] == [b"r0.2", b"r0.3", b"r0.0"]
+    assert others[0][1] == "r0.2"
+
+
+def test_latent_batch_truncated_to_max_attempts():
+    comfy = FakeComfy(batch=4)
+    log = run(comfy, qa_by({}), rounds=2, max_attempts=6)
+    assert log.attempts == 6 and len(log.ranked) == 6
+    assert [img for _k, img, _r in log.ranked][-2:] == [b"r1.0", b"r1.1"]
+    assert log.cache_status == "MISS"
+
+
+def test_latent_batch_ranks_across_rounds():
+    comfy = FakeComfy(batch=2)
+    qa = qa_by({b"r0.0": (False, 3), b"r0.1": (False, 1), b"r1.0": (False, 1), b"r1.1": (True, 2)})
+    log = run(comfy, qa, rounds=2, max_attempts=4)
+    assert log.accepted and log.image == b"r1.1" and log.prompt_id == "p1"
+    assert comfy.submitted == [0, 1] and comfy.cancelled == []
+    # Passing candidate first (X-Candidate-Rank 1), then by severity, equal
+    # severities in the order they were made
+    assert [img for img, _r in runners_up(log.ranked, log.image)] == [b"r0.1", b"r1.0", b"r0.0"]
+    assert log.best[1] == b"r0.1"
@@ -0,0 +1,113 @@
+"""Content-addressed ComfyUI inputs: stable names, lookups that keep a reused
+file fresh for the janitor, the size/mtime-keyed path digest memo, and the
+streamed /upload/image body as ComfyUI parses it.
+
+input_cache is stdlib-only; the upload target is tests/fake_comfyui.py.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import time
+import urllib.request
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import input_cache  # noqa: E402
+from fake_comfyui import FakeComfyUI  # noqa: E402
+from input_cache import InputCache, content_name, multipart_body  # noqa: E402
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 40
+
+
+@pytest.fixture
+def comfy():
+    fake = FakeComfyUI().start()
+    yield fake
+    fake.stop()
+
+
+def upload(port, filename, **kwargs):
+    """What HollyComfyUIKlein._upload_input sends."""
+    chunks, content_type, length = multipart_body(filename, fields={"overwrite": "true"}, **kwargs)
+    req = urllib.request.Request(
+        f"http://127.0.0.1:{port}/upload/image", data=chunks,
+        headers={"Content-Type": content_type, "Content-Length": str(length)}, method="POST")
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        return json.loads(resp.read())
+
+
+def test_identical_bytes_same_name(tmp_path):
+    a = tmp_path / "a.png"
+    b = tmp_path / "copy-of-a.png"
+    a.write_bytes(PNG)
+    b.write_bytes(PNG)
+    cache = InputCache(str(tmp_path / "input"))
+    digest = cache.path_digest(str(a))
+    assert digest == cache.path_digest(str(b)) == hashlib.sha256(PNG).hexdigest()
+    name = content_name(digest, "pose", ".png")
+    assert name == f"pose_{digest[:16]}.png"
+    other = content_name(hashlib.sha256(PNG + b"\0").hexdigest(), "pose", ".png")
+    assert other != name
+
+
+def test_lookup_bumps_mtime_and_forgets_deleted_files(tmp_path):
+    cache = InputCache(str(tmp_path))
+    path = tmp_path / "in_abc.png"
+    path.write_bytes(PNG)
+    old = time.time() - 3600
+    os.utime(path, (old, old))
+    cache.record("abc", "in_abc.png", len(PNG))
+    assert cache.lookup("abc") == "in_abc.png"
+    assert path.stat().st_mtime > old + 3000  # fresh again for media_janitor
+    assert cache.stats()["hits"] == 1 and cache.stats()["bytes_saved"] == len(PNG)
+    assert cache.lookup("missing") is None
+    path.unlink()
+    assert cache.lookup("abc") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_path_digest_memo_invalidated_on_size_or_mtime(tmp_path, monkeypatch):
+    calls = []
+    real = input_cache.digest_file
+    monkeypatch.setattr(input_cache, "digest_file", lambda p: calls.append(p) or real(p))
+    cache = InputCache(str(tmp_path / "input"))
+    ref = tmp_path / "pose.png"
+    ref.write_bytes(PNG)
+    first = cache.path_digest(str(ref))
+    assert cache.path_digest(str(ref)) == first and len(calls) == 1  # memoised
+
+    st = ref.stat()
+    ref.write_bytes(PNG[::-1])  # same size, new content…
+    os.utime(ref, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))  # …and mtime
+    second = cache.path_digest(str(ref))
+    assert second != first and len(calls) == 2
+
+    ref.write_bytes(PNG[::-1] + b"more")
+    os.utime(ref, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))  # same mtime, new size
+    assert cache.path_digest(str(ref)) not in (first, second) and len(calls) == 3
+
+
+@pytest.mark.parametrize("source", ["data", "path"])
+def test_streamed_multipart_parses_like_comfyui(comfy, tmp_path, source):
+    if source == "data":
+        kwargs = {"data": PNG}
+    else:
+        ref = tmp_path / "pose.png"
+        ref.write_bytes(PNG)
+        kwargs = {"path": str(ref)}
+    name = content_name(hashlib.sha256(PNG).hexdigest(), "pose")
+    chunks, _ctype, length = multipart_body(name, **kwargs)
+    assert length == sum(len(c) for c in chunks)
+
+    assert upload(comfy.port, name, **kwargs) == {"name": name, "subfolder": "", "type": "input"}
+    data, content_type, fields = comfy.uploads[name]
+    assert data == PNG and content_type == "image/png" and fields == {"overwrite": "true"}
+    # Same content again keeps the same name (overwrite), no "(1)" copy
+    assert upload(comfy.port, name, **kwargs)["name"] == name
+    assert list(comfy.uploads) == [name]
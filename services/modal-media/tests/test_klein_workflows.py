@@ -0,0 +1,87 @@
+"""Klein graph builders and the helpers around them: the latent-batch
+candidate graph, the batched face / hands / feet refinement graph and its
+per-region split.
+
+The builders live in comfyui_klein, which needs modal importable — skipped
+otherwise (same as the builder checks in test_workflow_graph.py).
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("modal")
+
+import comfyui_klein as klein  # noqa: E402
+from comfyui_graph import subgraph_hashes  # noqa: E402
+
+IDENTITY = {"name": "holly-combined-v1.safetensors", "strength": 0.9}
+SPECIALIST = {"name": "pussydiffusion.safetensors", "strength": 0.8}
+
+
+def nodes_of(workflow, class_type):
+    return {nid: n for nid, n in workflow["prompt"].items() if n["class_type"] == class_type}
+
+
+def region_preps():
+    """_prepare_region output as _refine_regions_batched groups it."""
+    return {
+        "face": [{"label": "face", "uploaded": "f.png", "prompt": "face", "loras": [IDENTITY]}],
+        "hand": [
+            {"label": "hand1", "uploaded": "h1.png", "prompt": "hand", "loras": [IDENTITY, SPECIALIST]},
+            {"label": "hand2", "uploaded": "h2.png", "prompt": "hand", "loras": [IDENTITY, SPECIALIST]},
+        ],
+        "foot": [{"label": "foot1", "uploaded": "ft.png", "prompt": "foot", "loras": [IDENTITY, SPECIALIST]}],
+    }
+
+
+def test_batched_inpaint_one_sampler_per_region_type():
+    groups = klein.batched_inpaint_groups(region_preps())
+    assert [g["key"] for g in groups] == ["face", "hand", "foot"]
+    assert groups[1]["images"] == ["h1.png", "h2.png"]
+
+    wf = klein.build_batched_inpaint_workflow(groups, seed=5, denoise=0.55,
+                                              filename_prefix="Holly_refine_job1")
+    nodes = wf["prompt"]
+    assert len(nodes_of(wf, "LoadImage")) == 4
+    assert set(nodes_of(wf, "KSampler")) == {"face_sample", "hand_sample", "foot_sample"}
+    # Shared loaders, one latent batch per group
+    assert len(nodes_of(wf, "UNETLoader")) == len(nodes_of(wf, "VAELoader")) == 1
+    assert nodes["hand_batch1"]["inputs"] == {"image1": ["hand_load0", 0], "image2": ["hand_load1", 0]}
+    assert nodes["hand_encode"]["inputs"]["pixels"] == ["hand_batch1", 0]
+    assert nodes["face_encode"]["inputs"]["pixels"] == ["face_load0", 0]
+    assert "foot_batch1" not in nodes
+    for key in ("face", "hand", "foot"):
+        sampler = nodes[f"{key}_sample"]["inputs"]
+        assert sampler["seed"] == 5 and sampler["denoise"] == 0.55
+        assert sampler["latent_image"] == [f"{key}_encode", 0]
+        save = nodes[f"{key}_save"]
+        assert save["class_type"] == "SaveImage"
+        assert save["inputs"]["filename_prefix"] == f"Holly_refine_job1_{key}"
+        assert save["inputs"]["images"] == [f"{key}_decode", 0]
+    # Hands and feet share the full LoRA stack; the face's identity-only
+    # chain is its first link
+    assert nodes["hand_sample"]["inputs"]["model"] == nodes["foot_sample"]["inputs"]["model"]
+    assert len(nodes_of(wf, "LoraLoader")) == 2
+
+
+def test_batched_outputs_split_back_per_region():
+    preps = region_preps()
+    by_node = {"hand_save": [b"H1", b"H2"], "face_save": [b"F"]}  # foot output missing
+    pairs = klein.split_batched_outputs(preps, by_node)
+    assert [(p["label"], img) for p, img in pairs] == [("face", b"F"), ("hand1", b"H1"), ("hand2", b"H2")]
+
+
+def test_latent_batch_is_one_sampler_pass():
+    single = klein.build_workflow("holly", seed=9, loras=[IDENTITY, SPECIALIST])
+    batched = klein.build_workflow("holly", seed=9, loras=[IDENTITY, SPECIALIST], batch_size=4)
+    assert nodes_of(batched, "EmptyLatentImage")["latent"]["inputs"]["batch_size"] == 4
+    assert len(nodes_of(batched, "KSampler")) == 1
+    assert batched["prompt"]["sampler"]["inputs"]["latent_image"] == ["latent", 0]
+    # Only the latent (and what samples it) differs — loaders, LoRAs and text
+    # encoding stay cached between batched and single-seed requests
+    hs, hb = subgraph_hashes(single), subgraph_hashes(batched)
+    assert {nid for nid in hs if hs[nid] != hb[nid]} == {"latent", "sampler", "decode", "save"}
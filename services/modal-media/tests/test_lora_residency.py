@@ -0,0 +1,150 @@
+"""LoRA stack residency: the LRU of stacks mirrors ComfyUI's --cache-lru
+(most recent kept, evicted past K stacks or the byte budget), hits / patch
+cost come from the job's cached-node list, and prewarm picks the most used
+stacks that fit.
+
+lora_residency and comfyui_graph are stdlib-only; LoRA files are sparse
+files of the given size on a tmp_path.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from comfyui_graph import WorkflowGraph  # noqa: E402
+from lora_residency import LoraResidency, cache_lru_size, cached_nodes, lora_stacks  # noqa: E402
+
+MB = 1 << 20
+IDENTITY = {"name": "holly-combined-v1.safetensors", "strength": 0.9}
+SPECIALIST = {"name": "pussydiffusion.safetensors", "strength": 0.8}
+POSE = {"name": "pose-kneeling.safetensors", "strength": 0.7}
+SIZES = {IDENTITY["name"]: 100 * MB, SPECIALIST["name"]: 200 * MB, POSE["name"]: 300 * MB}
+
+
+@pytest.fixture
+def lora_dir(tmp_path):
+    for name, size in SIZES.items():
+        with open(tmp_path / name, "wb") as f:
+            f.truncate(size)
+    return tmp_path
+
+
+def residency(lora_dir, budget=1000 * MB, max_stacks=4):
+    return LoraResidency(str(lora_dir), str(lora_dir / "stats" / "lora-usage.json"), budget, max_stacks)
+
+
+def job(*stacks):
+    """(workflow, [terminal LoraLoader id per stack]) — one sampler per stack."""
+    g = WorkflowGraph()
+    g.loaders("klein.safetensors", "qwen.safetensors", "vae.safetensors")
+    ends = []
+    for i, loras in enumerate(stacks):
+        model, clip = g.lora_chain(loras)
+        g.add(f"pos{i}", "CLIPTextEncode", text="holly", clip=clip)
+        g.add(f"sampler{i}", "KSampler", seed=1, model=model, positive=[f"pos{i}", 0])
+        ends.append(model[0])
+    return g.workflow(), ends
+
+
+def history(cached=(), nodes=None):
+    return {"timings": {"cached": list(cached), "nodes": nodes or {}}}
+
+
+def observe(res, *stacks, cached=()):
+    workflow, ends = job(*stacks)
+    res.observe(workflow, history(cached))
+    return ends
+
+
+def test_lora_stacks_base_first_and_shared_prefix():
+    workflow, (sfw, nsfw) = job([IDENTITY], [IDENTITY, SPECIALIST])
+    stacks = lora_stacks(workflow)
+    assert set(stacks) == {sfw, nsfw}
+    assert [l["name"] for l in stacks[nsfw]] == [IDENTITY["name"], SPECIALIST["name"]]
+    assert stacks[sfw] == [{"name": IDENTITY["name"], "strength": 0.9, "strength_clip": 0.9}]
+    # The identity loader feeds both the specialist loader and pos0: it is
+    # a stack of its own here, but not in a graph that only uses the chain
+    alone, (end,) = job([IDENTITY, SPECIALIST])
+    assert list(lora_stacks(alone)) == [end]
+
+
+def test_lru_keeps_most_recent_k_stacks(lora_dir):
+    res = residency(lora_dir, max_stacks=2)
+    a = observe(res, [IDENTITY])[0]
+    b = observe(res, [IDENTITY, SPECIALIST])[0]
+    observe(res, [IDENTITY], cached=[a])           # a used again → most recent
+    c = observe(res, [IDENTITY, POSE])[0]          # third stack: evicts b, not a
+    assert list(res._resident) == [a, c]
+    assert res.evictions == 1
+    observe(res, [IDENTITY, SPECIALIST])           # b back: a is now the oldest
+    assert list(res._resident) == [c, b]
+
+
+def test_byte_budget_evicts_oldest_until_it_fits(lora_dir):
+    res = residency(lora_dir, budget=450 * MB, max_stacks=8)
+    a = observe(res, [IDENTITY])[0]                 # 100 MB
+    b = observe(res, [IDENTITY, SPECIALIST])[0]     # 300 MB → 400 MB
+    c = observe(res, [IDENTITY, POSE])[0]           # 400 MB → a, then b go
+    assert list(res._resident) == [c] and res.evictions == 2
+    assert res.stats()["resident_bytes"] == 400 * MB
+    # A stack larger than the whole budget still counts as resident alone
+    big = residency(lora_dir, budget=50 * MB)
+    d = observe(big, [SPECIALIST])[0]
+    assert list(big._resident) == [d]
+    assert a != b != c
+
+
+def test_hits_and_patch_cost_from_cached_nodes(lora_dir):
+    res = residency(lora_dir)
+    workflow, (end,) = job([IDENTITY, SPECIALIST])
+    chain = [nid for nid, n in workflow["prompt"].items() if n["class_type"] == "LoraLoader"]
+    miss = res.observe(workflow, history(nodes={chain[0]: 1.5, chain[1]: 2.0, "sampler0": 9.0}))
+    hit = res.observe(workflow, history(cached=chain + ["unet"]))
+    assert miss == [(end, False, 3.5)] and hit == [(end, True, 0.0)]
+    stats = res.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_rate"], stats["patch_s_avg"]) == (1, 1, 0.5, 3.5)
+    assert res.usage[end]["count"] == 2
+
+
+def test_cached_nodes_from_history_messages():
+    polled = {"status": {"messages": [
+        ["execution_start", {"prompt_id": "p"}],
+        ["execution_cached", {"nodes": ["unet", "lora_x"], "prompt_id": "p"}]]}}
+    assert cached_nodes(polled) == {"unet", "lora_x"}
+    assert cached_nodes(history(cached=["lora_y"])) == {"lora_y"}
+    assert cached_nodes({}) == set()
+
+
+def test_prewarm_most_used_that_fit_and_persisted(lora_dir):
+    res = residency(lora_dir, budget=500 * MB, max_stacks=2)
+    for _ in range(3):
+        observe(res, [IDENTITY, POSE])              # 400 MB, most used
+    for _ in range(2):
+        observe(res, [IDENTITY, SPECIALIST])        # 300 MB: doesn't fit next to it
+    observe(res, [IDENTITY])                        # 100 MB: does
+    prewarm_only, _ = job([SPECIALIST])
+    res.observe(prewarm_only, history(), record=False)
+    assert len(res.usage) == 3                      # record=False adds no usage
+
+    res.save()
+    reloaded = residency(lora_dir, budget=500 * MB, max_stacks=2)
+    picked = reloaded.prewarm_stacks()
+    assert [[l["name"] for l in loras] for loras in picked] == [
+        [IDENTITY["name"], POSE["name"]], [IDENTITY["name"]]]
+
+    os.remove(lora_dir / POSE["name"])              # gone from the volume since
+    fresh = residency(lora_dir, budget=500 * MB, max_stacks=2)
+    assert [[l["name"] for l in loras] for loras in fresh.prewarm_stacks()] == [
+        [IDENTITY["name"], SPECIALIST["name"]], [IDENTITY["name"]]]
+
+
+def test_fit_slots_and_cache_size(lora_dir):
+    res = residency(lora_dir, budget=600 * MB, max_stacks=8)
+    assert res.fit_slots() == 8                     # nothing known yet
+    observe(res, [IDENTITY, SPECIALIST])            # 300 MB
+    observe(res, [IDENTITY, POSE])                  # 400 MB → avg 350 MB
+    assert res.fit_slots() == 1
+    assert cache_lru_size(3) == 16 + 3 * (4 + 4)
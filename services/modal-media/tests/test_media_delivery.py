@@ -0,0 +1,110 @@
+"""Range parsing, the MP4 top-level box walk behind faststart, and ranged
+file responses.
+
+media_delivery is stdlib-only; MP4s are hand-built box sequences. The
+response checks need fastapi.
+"""
+
+import asyncio
+import os
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from media_delivery import (  # noqa: E402
+    RangeNotSatisfiable, file_response, moov_first, parse_range, top_level_boxes,
+)
+
+
+def box(kind: str, payload: bytes = b"", large: bool = False) -> bytes:
+    if large:  # size == 1, 64-bit largesize after the type
+        return struct.pack(">I4sQ", 1, kind.encode(), 16 + len(payload)) + payload
+    return struct.pack(">I4s", 8 + len(payload), kind.encode()) + payload
+
+
+def write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def body_of(response) -> bytes:
+    async def collect():
+        return b"".join([chunk async for chunk in response.body_iterator])
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-", (0, 999)),
+    ("bytes=100-199", (100, 199)),
+    ("bytes=-500", (500, 999)),
+    ("bytes=-5000", (0, 999)),       # suffix longer than the file
+    ("bytes=900-5000", (900, 999)),  # end past EOF is clamped
+    ("bytes=999-999", (999, 999)),
+    ("  BYTES=10-20 ", (10, 20)),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", [
+    None, "", "items=0-10", "bytes=0-10,20-30", "bytes=abc-", "bytes=5-x",
+])
+def test_parse_range_whole_file(header):
+    assert parse_range(header, 1000) is None
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=5000-6000", "bytes=500-100", "bytes=-0"])
+def test_parse_range_unsatisfiable(header):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, 1000)
+
+
+def test_top_level_boxes_with_largesize(tmp_path):
+    data = box("ftyp", b"isom") + box("mdat", b"\0" * 100, large=True) + box("moov", b"m" * 20)
+    assert top_level_boxes(write(tmp_path, "large.mp4", data)) == ["ftyp", "mdat", "moov"]
+
+
+def test_top_level_boxes_truncated(tmp_path):
+    full = box("ftyp", b"isom") + box("moov", b"m" * 20) + box("mdat", b"\0" * 1000)
+    cut = write(tmp_path, "cut.mp4", full[:-900])  # mdat declares more than is there
+    assert top_level_boxes(cut) == ["ftyp", "moov", "mdat"]
+    half_header = write(tmp_path, "half.mp4", box("ftyp", b"isom") + b"\0\0\0\x01mdat")
+    assert top_level_boxes(half_header) == ["ftyp", "mdat"]  # largesize cut off → stop
+
+
+def test_moov_first(tmp_path):
+    ftyp = box("ftyp", b"isom")
+    moov = box("moov", b"m" * 20)
+    mdat = box("mdat", b"\0" * 100)
+    assert moov_first(write(tmp_path, "fast.mp4", ftyp + moov + mdat))
+    assert not moov_first(write(tmp_path, "slow.mp4", ftyp + mdat + moov))  # SaveVideo's layout
+    assert not moov_first(write(tmp_path, "nomoov.mp4", ftyp + mdat))
+
+
+def test_file_response_ranged(tmp_path):
+    pytest.importorskip("fastapi")
+    data = bytes(range(256)) * 4
+    path = write(tmp_path, "clip.mp4", data)
+
+    full = file_response(path, "video/mp4", {"X-Frames": "81"})
+    assert full.status_code == 200 and full.path == path
+    assert full.headers["content-length"] == "1024" and full.headers["accept-ranges"] == "bytes"
+    assert "content-range" not in full.headers
+    assert body_of(full) == data
+
+    part = file_response(path, "video/mp4", range_header="bytes=1000-")
+    assert part.status_code == 206
+    assert part.headers["content-range"] == "bytes 1000-1023/1024"
+    assert part.headers["content-length"] == "24"
+    assert body_of(part) == data[1000:]
+
+    tail = file_response(path, "video/mp4", range_header="bytes=-100")
+    assert tail.headers["content-range"] == "bytes 924-1023/1024"
+    assert body_of(tail) == data[-100:]
+
+    bad = file_response(path, "video/mp4", range_header="bytes=2048-")
+    assert bad.status_code == 416 and bad.headers["content-range"] == "bytes */1024"
@@ -0,0 +1,78 @@
+"""Input images are decoded once, sized from their header and size-capped.
+
+Runs locally: media_inputs is stdlib-only. Pillow (if installed) produces
+real PNG / JPEG / WebP / GIF files to sniff, and sizes the other formats.
+"""
+
+import base64
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from media_inputs import (  # noqa: E402
+    InputTooLarge, InvalidImage, decode_image, decode_images, sniff_image,
+)
+
+
+@pytest.mark.parametrize("fmt", ["PNG", "JPEG", "WEBP", "GIF"])
+def test_sniffed_size_matches_pillow(fmt):
+    Image = pytest.importorskip("PIL.Image")
+    buf = io.BytesIO()
+    Image.new("RGB", (864, 1280), (200, 120, 90)).save(buf, format=fmt)
+    sniffed = sniff_image(buf.getvalue())
+    assert sniffed is not None
+    assert sniffed[1:] == (864, 1280)
+
+
+def _png_b64(width=3, height=2, pad=0):
+    header = (b"\x89PNG\r\n\x1a\n" + b"\x00\x00\x00\x0dIHDR"
+              + width.to_bytes(4, "big") + height.to_bytes(4, "big"))
+    return base64.b64encode(header + b"\x00" * (16 + pad)).decode("ascii")
+
+
+def test_decode_image_once_with_digest_and_data_url():
+    img = decode_image("data:image/png;base64," + _png_b64(640, 480))
+    assert (img.format, img.size, img.ext) == ("png", (640, 480), ".png")
+    assert len(img.digest) == 64
+
+
+def test_oversized_image_refused_before_decoding():
+    with pytest.raises(InputTooLarge) as e:
+        decode_image(_png_b64(pad=4096), max_bytes=1024)
+    assert e.value.limit == 1024
+    # Line-wrapped base64 just under the limit still passes
+    b64 = _png_b64(pad=980)  # 1020 bytes decoded
+    wrapped = "\n".join(b64[i:i + 76] for i in range(0, len(b64), 76))
+    assert decode_image(wrapped, max_bytes=1024).size == (3, 2)
+
+
+def test_request_total_cap():
+    refs = [_png_b64(pad=600)] * 3
+    assert len(decode_images(refs, max_bytes=1024, max_total=4096)) == 3
+    with pytest.raises(InputTooLarge):
+        decode_images(refs, max_bytes=1024, max_total=1500)
+
+
+@pytest.mark.parametrize("fmt", ["AVIF", "BMP", "TIFF"])
+def test_other_formats_sized_by_pillow(fmt):
+    Image = pytest.importorskip("PIL.Image")
+    features = pytest.importorskip("PIL.features")
+    if fmt == "AVIF" and not features.check("avif"):
+        pytest.skip("Pillow built without AVIF")
+    buf = io.BytesIO()
+    Image.new("RGB", (864, 1280), (200, 120, 90)).save(buf, format=fmt)
+    assert sniff_image(buf.getvalue()) is None
+    img = decode_image(base64.b64encode(buf.getvalue()).decode())
+    assert img.size == (864, 1280)
+    assert img.format == fmt.lower() and img.ext != ".png"
+
+
+def test_not_an_image():
+    with pytest.raises(InvalidImage):
+        decode_image(base64.b64encode(b"hello world, not an image").decode())
+    with pytest.raises(InvalidImage):
+        decode_image("")
@@ -0,0 +1,113 @@
+"""Disk janitor budgets: the grace age, age- and size-based eviction oldest
+first, whole-entry removal and the name pattern.
+
+media_janitor is stdlib-only; files get explicit mtimes on a tmp_path tree
+relative to NOW, which the sweeps use as `now`.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from media_janitor import Budget, MediaJanitor, scan  # noqa: E402
+
+NOW = time.time()
+HOUR = 3600.0
+
+
+def make(path, size, age_s):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    os.utime(path, (NOW - age_s, NOW - age_s))
+    return str(path)
+
+
+def sweep(budget):
+    janitor = MediaJanitor([budget])
+    return janitor, janitor.sweep_budget(budget, now=NOW)
+
+
+def test_scan_oldest_first_and_pattern(tmp_path):
+    new = make(tmp_path / "a.png", 10, 60)
+    old = make(tmp_path / "sub" / "b.png", 20, 600)
+    make(tmp_path / "c.json", 30, 900)
+    units = scan(Budget(str(tmp_path), pattern="*.png"))
+    assert [(size, path) for _m, size, path in units] == [(20, old), (10, new)]
+    assert scan(Budget(str(tmp_path / "missing"))) == []
+
+
+def test_fresh_files_survive_every_limit(tmp_path):
+    fresh = make(tmp_path / "writing.mp4", 1000, 30)
+    old = make(tmp_path / "old.mp4", 1000, HOUR)
+    _, removed = sweep(Budget(str(tmp_path), max_bytes=0, max_age_s=0, min_age_s=120))
+    assert removed == (1, 1000)
+    assert os.path.exists(fresh) and not os.path.exists(old)
+
+
+def test_age_limit(tmp_path):
+    expired = make(tmp_path / "a.png", 10, 2 * HOUR)
+    kept = make(tmp_path / "b.png", 10, HOUR / 2)
+    janitor, removed = sweep(Budget(str(tmp_path), max_age_s=HOUR))
+    assert removed == (1, 10)
+    assert not os.path.exists(expired) and os.path.exists(kept)
+    usage = janitor.stats()["dirs"][str(tmp_path)]
+    assert usage["units"] == 1 and usage["bytes"] == 10 and usage["reclaimed"] == {"files": 1, "bytes": 10}
+
+
+def test_size_budget_evicts_oldest_first_until_under(tmp_path):
+    paths = [make(tmp_path / f"{i}.mp4", 100, (10 - i) * HOUR) for i in range(10)]  # 0 oldest
+    janitor, removed = sweep(Budget(str(tmp_path), max_bytes=450))
+    assert removed == (6, 600)
+    assert [os.path.exists(p) for p in paths] == [False] * 6 + [True] * 4
+    assert janitor.stats()["dirs"][str(tmp_path)]["bytes"] == 400
+
+
+def test_size_budget_skips_fresh_and_keeps_going(tmp_path):
+    # The biggest file is still being rendered: it is skipped, older ones
+    # go instead until the rest fits
+    big_fresh = make(tmp_path / "rendering.mp4", 500, 10)
+    a = make(tmp_path / "a.mp4", 100, 3 * HOUR)
+    b = make(tmp_path / "b.mp4", 100, 2 * HOUR)
+    _, removed = sweep(Budget(str(tmp_path), max_bytes=550))
+    assert removed == (2, 200)
+    assert os.path.exists(big_fresh) and not os.path.exists(a) and not os.path.exists(b)
+
+
+def test_entries_removed_as_whole_directories(tmp_path):
+    old_dir = tmp_path / "acestep_old"
+    make(old_dir / "song.wav", 300, 2 * HOUR)
+    make(old_dir / "nested" / "stem.wav", 200, 2 * HOUR)
+    live_dir = tmp_path / "acestep_live"
+    make(live_dir / "song.wav", 300, 2 * HOUR)
+    make(live_dir / "partial.wav", 10, 5)  # newest file decides the entry's age
+    other = make(tmp_path / "notes.txt", 10, 2 * HOUR)
+    for d in (old_dir / "nested", old_dir, live_dir):  # as if made two hours ago too
+        os.utime(d, (NOW - 2 * HOUR, NOW - 2 * HOUR))
+    budget = Budget(str(tmp_path), max_age_s=HOUR, pattern="acestep_*", entries=True)
+    units = scan(budget)
+    assert [(size, os.path.basename(path)) for _m, size, path in units] == [
+        (500, "acestep_old"), (310, "acestep_live")]
+    _, removed = sweep(budget)
+    assert removed == (1, 500)
+    assert not old_dir.exists() and live_dir.exists()
+    assert os.path.exists(other)  # outside the pattern
+
+
+def test_files_outside_pattern_left_alone(tmp_path):
+    png = make(tmp_path / "Holly_00001_.png", 100, 2 * HOUR)
+    mine = make(tmp_path / "h3_ref_abc.png", 100, 2 * HOUR)
+    _, removed = sweep(Budget(str(tmp_path), max_bytes=0, max_age_s=HOUR, pattern="h3_ref_*"))
+    assert removed == (1, 100)
+    assert os.path.exists(png) and not os.path.exists(mine)
+
+
+def test_sweep_totals_and_missing_dir(tmp_path):
+    make(tmp_path / "out" / "a.png", 10, 2 * HOUR)
+    janitor = MediaJanitor([Budget(str(tmp_path / "out"), max_age_s=HOUR),
+                            Budget(str(tmp_path / "never-created"), max_age_s=HOUR)])
+    assert janitor.sweep() == (1, 10)
+    stats = janitor.stats()
+    assert stats["sweeps"] == 1 and stats["reclaimed_files"] == 1 and stats["errors"] == 0
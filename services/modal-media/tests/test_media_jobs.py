@@ -0,0 +1,123 @@
+"""Async job store: lifecycle, result delivery and expiry.
+
+Runs locally on SQLiteBackend + a temp results dir: media_jobs is
+stdlib-only. The HTTP glue (status / result responses) needs fastapi and is
+skipped without it.
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import media_jobs  # noqa: E402
+from media_jobs import INDEX_BUCKET_S, JOB_TTL_S, JobStore, SQLiteBackend, run_job  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(SQLiteBackend(str(tmp_path / "jobs.db")), str(tmp_path / "results"))
+
+
+def body_of(response) -> bytes:
+    async def collect():
+        return b"".join([chunk async for chunk in response.body_iterator])
+    return asyncio.run(collect())
+
+
+def test_job_lifecycle_success(store):
+    job = store.create("klein", "generate")
+    assert store.get(job["job_id"])["state"] == "queued"
+
+    def work(reporter):
+        reporter.set(stage="sampling", attempt=1)
+        return b"PNGDATA", "image/png", {"X-Seed": "7", "Content-Type": "image/png"}
+
+    assert run_job(store, job["job_id"], work)
+    done = store.get(job["job_id"])
+    assert done["state"] == "succeeded" and done["started_at"] <= done["finished_at"]
+    assert done["progress"]["stage"] == "done" and done["progress"]["attempt"] == 1
+    assert done["result"] == {"media_type": "image/png", "bytes": 7, "headers": {"X-Seed": "7"}}
+    assert store.read_result(job["job_id"]) == (b"PNGDATA", "image/png", {"X-Seed": "7"})
+
+
+def test_job_failure_keeps_http_status(store):
+    fastapi = pytest.importorskip("fastapi")
+    job = store.create("h3", "animate")
+
+    def work(reporter):
+        raise fastapi.HTTPException(status_code=422, detail="init_image is not an image")
+
+    assert not run_job(store, job["job_id"], work)
+    failed = store.get(job["job_id"])
+    assert failed["state"] == "failed"
+    assert failed["error"] == {"status_code": 422, "detail": "init_image is not an image"}
+
+
+def test_unexpected_error_is_500(store):
+    job = store.create("music", "generate")
+
+    def work(reporter):
+        raise RuntimeError("CUDA out of memory")
+
+    assert not run_job(store, job["job_id"], work)
+    error = store.get(job["job_id"])["error"]
+    assert error == {"status_code": 500, "detail": "RuntimeError: CUDA out of memory"}
+
+
+def test_result_409_while_running_then_ranged(store):
+    pytest.importorskip("fastapi")
+    job = store.create("h3", "animate")
+    store.start(job["job_id"])
+    running = media_jobs.result_response(store, job["job_id"])
+    assert running.status_code == 409
+
+    store.succeed(job["job_id"], bytes(range(100)), "video/mp4", {"X-Frames": "81"})
+    full = media_jobs.result_response(store, job["job_id"])
+    assert full.status_code == 200 and body_of(full) == bytes(range(100))
+    part = media_jobs.result_response(store, job["job_id"], range_header="bytes=10-19")
+    assert part.status_code == 206
+    assert part.headers["content-range"] == "bytes 10-19/100"
+    assert part.headers["x-frames"] == "81" and part.headers["x-job-state"] == "succeeded"
+    assert body_of(part) == bytes(range(10, 20))
+
+
+def test_expire_removes_record_and_file(store):
+    old = store.create("klein", "generate")
+    store.succeed(old["job_id"], b"old", "image/png")
+    other = store.create("music", "generate")
+    assert os.path.exists(store.result_path(old["job_id"]))
+
+    assert store.expire("klein") == 0  # not past JOB_TTL_S yet
+    later = time.time() + JOB_TTL_S + 2 * INDEX_BUCKET_S
+    assert store.expire("klein", now=later) == 1
+    assert store.get(old["job_id"]) is None
+    assert not os.path.exists(store.result_path(old["job_id"]))
+    # Another kind's job in the same backend is left alone
+    assert store.get(other["job_id"]) is not None
+    assert store.expire("klein", now=later) == 0
+
+
+def test_expire_walks_index_not_backend(store):
+    job = store.create("klein", "generate")
+    store.succeed(job["job_id"], b"x", "image/png")
+    store.expire("klein")  # first run: legacy sweep, sets the cursor
+    store.backend.keys = lambda: pytest.fail("expire scanned the whole backend")
+    store.backend.delete(store._index_key("klein", "legacy"))  # pre-index sweep done
+    later = time.time() + JOB_TTL_S + 2 * INDEX_BUCKET_S
+    assert store.expire("klein", now=later) == 1
+    assert store.get(job["job_id"]) is None
+    assert store.get(store._index_key("klein", "cursor")) is None  # not a job
+
+
+def test_expire_sweeps_records_from_before_the_index(store):
+    legacy = {"job_id": "legacy1", "kind": "klein", "endpoint": "generate",
+              "state": "succeeded", "created_at": time.time() - JOB_TTL_S - 60}
+    store.backend.put("legacy1", legacy)
+    store.backend.put("legacy2", {**legacy, "job_id": "legacy2", "kind": "h3"})
+    assert store.expire("klein") == 1
+    assert store.get("legacy1") is None and store.get("legacy2") is not None
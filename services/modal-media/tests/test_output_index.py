@@ -0,0 +1,81 @@
+"""H3's OutputIndex resolves a job's video from what ComfyUI reported or from
+the name its unique SaveVideo prefix implies — never by scanning output/.
+
+comfyui_events is stdlib-only; output/ is a tmp_path.
+"""
+
+import os
+import sys
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from comfyui_events import OutputIndex  # noqa: E402
+
+
+def job(output_dir):
+    """(prompt_id, prefix, expected path) the way HollyH3Video._run names a job."""
+    prompt_id = uuid.uuid4().hex
+    prefix = f"holly_h3_{prompt_id[:16]}"
+    return prompt_id, prefix, os.path.join(str(output_dir), f"{prefix}_00001_.mp4")
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"\0\0\0\x08mdat")
+    return path
+
+
+def video(filename, subfolder="", kind="output"):
+    return {"videos": [{"filename": filename, "subfolder": subfolder, "type": kind}]}
+
+
+def test_expected_name_hit_without_any_report(tmp_path):
+    index = OutputIndex(str(tmp_path))
+    prompt_id, _prefix, expected = job(tmp_path)
+    index.expect(prompt_id, expected)
+    assert index.path(prompt_id) is None  # not written yet
+    touch(expected)
+    assert index.path(prompt_id) == expected
+    index.forget(prompt_id)
+    assert index.path(prompt_id) is None and len(index) == 0
+
+
+def test_miss_never_returns_another_jobs_file(tmp_path):
+    index = OutputIndex(str(tmp_path))
+    mine, _, my_expected = job(tmp_path)
+    other, other_prefix, other_expected = job(tmp_path)
+    index.expect(mine, my_expected)
+    index.expect(other, other_expected)
+    touch(other_expected)  # only the other job's video is on disk
+    index.record(other, "save", video(os.path.basename(other_expected)))
+    assert index.path(mine) is None
+    assert index.path(other) == other_expected
+    assert index.path("unknown-prompt") is None
+
+
+def test_reported_counter_other_than_00001(tmp_path):
+    index = OutputIndex(str(tmp_path))
+    prompt_id, prefix, expected = job(tmp_path)
+    index.expect(prompt_id, expected)
+    # A leftover _00001_ made SaveVideo count on; the executed event says which
+    touch(expected)
+    reported = touch(os.path.join(str(tmp_path), "h3", f"{prefix}_00002_.mp4"))
+    index.record(prompt_id, "save", video(f"{prefix}_00002_.mp4", subfolder="h3"))
+    assert index.path(prompt_id) == reported
+
+
+def test_history_and_non_output_entries(tmp_path):
+    index = OutputIndex(str(tmp_path))
+    prompt_id, prefix, _expected = job(tmp_path)
+    final = touch(os.path.join(str(tmp_path), f"{prefix}_00003_.mp4"))
+    touch(os.path.join(str(tmp_path), "preview.webp"))
+    history = {"outputs": {
+        "preview": {"images": [{"filename": "preview.webp", "subfolder": "", "type": "temp"}]},
+        "save": video(os.path.basename(final)),
+    }}
+    index.record_history(prompt_id, history)
+    index.record_history(prompt_id, history)  # polled twice: no duplicates
+    assert index._entries[prompt_id]["reported"] == [final]
+    assert index.path(prompt_id) == final
@@ -0,0 +1,101 @@
+"""Klein's SSE preview stream: previews are dropped (never result / error)
+when a slow client lets MAX_BUFFERED frames pile up, idle periods get a
+keepalive comment, and close() ends the generator.
+
+preview_stream is stdlib-only; the worker side is called directly.
+"""
+
+import base64
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from preview_stream import MAX_BUFFERED, SSEStream, sse_event  # noqa: E402
+
+
+def preview(stream, step, node="sampler"):
+    stream.comfy({"type": "progress", "value": step, "max": 12, "node": node})
+    stream.comfy({"type": "preview", "node": node, "format": "jpeg", "image": f"p{step}".encode()})
+
+
+def frames(stream):
+    """(event, data) of every frame after "stream open", comments skipped."""
+    out = []
+    for raw in stream.events():
+        if raw.startswith(b":"):
+            continue
+        event, data = raw.decode().strip().split("\n")
+        out.append((event[len("event: "):], json.loads(data[len("data: "):])))
+    return out
+
+
+def test_sse_event_frame():
+    assert sse_event("progress", {"stage": "qa"}) == b'event: progress\ndata: {"stage":"qa"}\n\n'
+
+
+def test_previews_past_the_buffer_dropped_never_result():
+    stream = SSEStream()
+    for step in range(MAX_BUFFERED):  # 2 frames per step: the queue fills half-way through
+        preview(stream, step)
+    assert stream.dropped > 0
+    assert stream.previews + stream.dropped == MAX_BUFFERED
+    stream.set(stage="qa")  # progress still queued over the cap
+    stream.result(b"PNG", "image/png", {"X-Seed": "7", "Content-Type": "image/png"})
+    stream.close()
+
+    got = frames(stream)
+    events = [e for e, _ in got]
+    assert events.count("preview") == stream.previews
+    assert events[-2:] == ["progress", "result"]
+    assert got[-1][1] == {"media_type": "image/png", "headers": {"X-Seed": "7"},
+                          "image": base64.b64encode(b"PNG").decode()}
+    first = next(d for e, d in got if e == "preview")
+    assert (first["step"], first["steps"], first["format"]) == (0, 12, "jpeg")
+
+
+def test_error_queued_over_the_cap():
+    stream = SSEStream(max_buffered=2)
+    for step in range(5):
+        preview(stream, step)
+    stream.error(500, "CUDA out of memory")
+    stream.close()
+    got = frames(stream)
+    assert got[-1] == ("error", {"status_code": 500, "detail": "CUDA out of memory", "headers": {}})
+    # Only step 0's preview fit; after that the progress frames filled the buffer
+    assert [e for e, _ in got].count("preview") == 1 and stream.dropped == 4
+
+
+def test_output_frames_are_not_previews():
+    stream = SSEStream()
+    stream.comfy({"type": "preview", "class_type": "SaveImageWebsocket", "image": b"full"})
+    stream.close()
+    assert frames(stream) == [] and stream.previews == 0
+
+
+def test_keepalive_when_idle_and_close_ends_generator():
+    stream = SSEStream(keepalive_s=0.05)
+    gen = stream.events()
+    assert next(gen) == b": stream open\n\n"
+    assert next(gen) == b": keepalive\n\n"  # nothing queued for keepalive_s
+
+    threading.Timer(0.1, lambda: (stream.set(stage="refining"), stream.close())).start()
+    rest = list(gen)  # returns once close() is seen
+    assert rest[-1].startswith(b"event: progress")
+    assert set(rest[:-1]) <= {b": keepalive\n\n"}
+    assert stream.closed and not stream.disconnected
+
+
+def test_client_gone_stops_buffering():
+    stream = SSEStream(keepalive_s=0.05)
+    gen = stream.events()
+    next(gen)
+    gen.close()  # StreamingResponse dropped the generator
+    assert stream.disconnected
+    t0 = time.time()
+    preview(stream, 1)
+    stream.result(b"PNG", "image/png")
+    assert stream._queue.qsize() == 0 and time.time() - t0 < 1
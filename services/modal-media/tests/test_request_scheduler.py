@@ -0,0 +1,145 @@
+"""Klein's admission control: priority order on the wait heap, QueueFull only
+when both the run slots and the wait queue are full, the ETA / Retry-After
+arithmetic, and a timed-out waiter leaving the queue.
+
+request_scheduler is stdlib-only; requests are threads holding a slot.
+"""
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from request_scheduler import (  # noqa: E402
+    DEFAULT_SERVICE_S, EWMA_ALPHA, PRIORITY_BATCH, PRIORITY_INTERACTIVE, QueueFull, RequestScheduler,
+)
+
+
+def hold(scheduler, priority=PRIORITY_INTERACTIVE):
+    """Enter admit() and keep the slot; call .__exit__(None, None, None) to release."""
+    block = scheduler.admit(priority)
+    block.__enter__()
+    return block
+
+
+def release(block):
+    block.__exit__(None, None, None)
+
+
+def wait_for(predicate, timeout_s=5):
+    deadline = time.time() + timeout_s
+    while not predicate():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def queue_waiter(scheduler, name, priority, order):
+    """Thread that records name once admitted; returns after it is queued."""
+    def run():
+        with scheduler.admit(priority):
+            order.append(name)
+
+    queued = scheduler.stats()["waiting"] + 1
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    wait_for(lambda: scheduler.stats()["waiting"] == queued)
+    return thread
+
+
+def test_interactive_before_batch_fifo_within_priority():
+    scheduler = RequestScheduler(max_active=1, max_waiting=8)
+    running = hold(scheduler)
+    order = []
+    threads = [queue_waiter(scheduler, name, priority, order) for name, priority in (
+        ("batch1", PRIORITY_BATCH), ("chat1", PRIORITY_INTERACTIVE),
+        ("batch2", PRIORITY_BATCH), ("chat2", PRIORITY_INTERACTIVE))]
+    assert scheduler.stats()["waiting_interactive"] == 2
+    release(running)
+    for thread in threads:
+        thread.join(5)
+    assert order == ["chat1", "chat2", "batch1", "batch2"]
+    assert scheduler.admitted == 5 and scheduler.rejected == 0
+
+
+def test_queue_full_only_when_slots_and_queue_are_both_full():
+    scheduler = RequestScheduler(max_active=2, max_waiting=1)
+    first = hold(scheduler)
+    second = hold(scheduler)  # a free slot: admitted, not queued
+    order = []
+    waiter = queue_waiter(scheduler, "third", PRIORITY_INTERACTIVE, order)
+    with pytest.raises(QueueFull) as e:
+        hold(scheduler)
+    assert e.value.depth == 3
+    stats = scheduler.stats()
+    assert (stats["active"], stats["waiting"], stats["rejected"]) == (2, 1, 1)
+    release(first)
+    waiter.join(5)
+    assert order == ["third"]
+    release(second)
+    assert scheduler.stats()["active"] == 0
+
+
+def test_no_wait_queue_rejects_only_when_every_slot_is_busy():
+    scheduler = RequestScheduler(max_active=1, max_waiting=0)
+    running = hold(scheduler)
+    with pytest.raises(QueueFull):
+        hold(scheduler)
+    release(running)
+    release(hold(scheduler))
+
+
+def test_eta_and_retry_after():
+    scheduler = RequestScheduler(max_active=1, max_waiting=1)
+    scheduler.service_s = 10.0
+    assert scheduler.eta_s(0) == 10.0
+    assert scheduler.eta_s(3) == 40.0
+    running = hold(scheduler)
+    waiter = queue_waiter(scheduler, "batch", PRIORITY_BATCH, [])
+    # Interactive: behind the running request only — the batch waiter doesn't count
+    with pytest.raises(QueueFull) as chat:
+        hold(scheduler, PRIORITY_INTERACTIVE)
+    assert (chat.value.eta_s, chat.value.retry_after) == (20.0, 10)
+    # Batch: behind both → one more round
+    with pytest.raises(QueueFull) as batch:
+        hold(scheduler, PRIORITY_BATCH)
+    assert (batch.value.eta_s, batch.value.retry_after) == (30.0, 20)
+    assert chat.value.depth == batch.value.depth == 2
+    release(running)
+    waiter.join(5)
+
+    # Rounds of max_active: 4 ahead over 2 slots = 2 rounds before this one
+    wide = RequestScheduler(max_active=2, max_waiting=0)
+    wide.service_s = 10.0
+    assert wide.eta_s(4) == 30.0
+    assert wide._full(PRIORITY_INTERACTIVE).retry_after == 1  # idle: never below 1s
+
+
+def test_service_time_ewma():
+    scheduler = RequestScheduler(max_active=1, max_waiting=0)
+    with scheduler.admit() as ticket:
+        ticket.started_at -= 2.0  # ran for 2s
+    expected = DEFAULT_SERVICE_S + EWMA_ALPHA * (2.0 - DEFAULT_SERVICE_S)
+    assert scheduler.service_s == pytest.approx(expected, abs=0.05)
+
+
+def test_timed_out_waiter_leaves_the_queue():
+    scheduler = RequestScheduler(max_active=1, max_waiting=4)
+    running = hold(scheduler)
+    order = []
+    behind = queue_waiter(scheduler, "batch", PRIORITY_BATCH, order)
+    # Queued ahead of the batch waiter, gives up after 0.1s
+    t0 = time.time()
+    with pytest.raises(QueueFull):
+        with scheduler.admit(PRIORITY_INTERACTIVE, timeout=0.1):
+            pass
+    assert 0.1 <= time.time() - t0 < 2
+    stats = scheduler.stats()
+    assert (stats["waiting"], stats["rejected"], stats["admitted"]) == (1, 1, 1)
+    release(running)
+    behind.join(5)
+    assert order == ["batch"]
+    assert scheduler.stats()["active"] == scheduler.stats()["waiting"] == 0
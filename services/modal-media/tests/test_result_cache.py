@@ -0,0 +1,97 @@
+"""Klein's result cache: graph_key is stable across runs of the same graph
+and changes with anything that changes the output; entries round-trip,
+count hits / misses and are evicted oldest-first under max_bytes.
+
+result_cache is stdlib-only; graphs are hand-written API-format prompts.
+"""
+
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from result_cache import ResultCache, digest_bytes, graph_key  # noqa: E402
+
+REF = b"\x89PNG pose reference"
+
+
+def graph(seed=7, prompt="holly on a beach", upload="refine_1a2b3c.png", prefix="Holly_0f9e"):
+    return {"prompt": {
+        "unet": {"class_type": "UNETLoader", "inputs": {"unet_name": "klein.safetensors"}},
+        "pos": {"class_type": "CLIPTextEncode", "inputs": {"text": prompt, "clip": ["clip", 0]}},
+        "ref": {"class_type": "LoadImage", "inputs": {"image": upload}},
+        "sampler": {"class_type": "KSampler", "inputs": {
+            "seed": seed, "steps": 12, "model": ["unet", 0], "positive": ["pos", 0],
+            "latent_image": ["ref", 0]}},
+        "save": {"class_type": "SaveImage", "inputs": {"images": ["sampler", 0],
+                                                       "filename_prefix": prefix}},
+    }}
+
+
+def key(workflow, ref=REF):
+    return graph_key(workflow, {"refine_1a2b3c.png": digest_bytes(ref),
+                                "refine_ffff.png": digest_bytes(ref)})
+
+
+def test_key_stable_across_runs_of_the_same_graph():
+    base = key(graph())
+    # Per-run noise: another output prefix, another upload name for the same
+    # bytes, websocket output instead of SaveImage, dict insertion order
+    ws = graph(prefix="Holly_1234", upload="refine_ffff.png")
+    ws["prompt"]["save"]["class_type"] = "SaveImageWebsocket"
+    del ws["prompt"]["save"]["inputs"]["filename_prefix"]
+    reordered = {"prompt": dict(reversed(list(graph()["prompt"].items())))}
+    assert key(ws) == key(reordered) == base
+    assert graph_key(graph()["prompt"], {"refine_1a2b3c.png": digest_bytes(REF)}) == base
+
+
+def test_key_changes_with_seed_prompt_or_input():
+    base = key(graph())
+    assert key(graph(seed=8)) != base
+    assert key(graph(prompt="holly in a kitchen")) != base
+    assert key(graph(), ref=REF + b"!") != base  # same upload name, other bytes
+    renamed = copy.deepcopy(graph())
+    renamed["prompt"]["sampler_2"] = renamed["prompt"].pop("sampler")
+    assert key(renamed) != base
+    # An unlisted LoadImage (volume file) is keyed by its name
+    assert graph_key(graph(upload="pose-refs/a.png")) != graph_key(graph(upload="pose-refs/b.png"))
+
+
+def test_put_get_hit_miss(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1 << 20)
+    k = key(graph())
+    assert cache.get(k) is None
+    assert cache.put(k, [b"PNG-A", b"PNG-B", b""])
+    assert cache.get(k) == [b"PNG-A", b"PNG-B", b""]
+    assert not cache.put(key(graph(seed=1)), [])
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 0.5)
+    assert os.path.exists(os.path.join(str(tmp_path), k[:2], f"{k}.bin"))
+
+
+def test_torn_entry_dropped(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1 << 20)
+    k = key(graph())
+    cache.put(k, [b"x" * 100])
+    path = os.path.join(str(tmp_path), k[:2], f"{k}.bin")
+    with open(path, "r+b") as f:
+        f.truncate(50)
+    assert cache.get(k) is None and not os.path.exists(path)
+
+
+def test_eviction_oldest_first_and_reads_refresh(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1000)
+    keys = [key(graph(seed=s)) for s in range(4)]
+    for i, k in enumerate(keys[:3]):
+        cache.put(k, [bytes(300)])  # 312 bytes packed
+        t = time.time() - 100 + i
+        os.utime(os.path.join(str(tmp_path), k[:2], f"{k}.bin"), (t, t))
+    assert cache.get(keys[0]) is not None  # read → newest
+    assert cache.put(keys[3], [bytes(300)])  # 4 × 312 > 1000 → trim to 900
+    assert cache.stats()["evictions"] == 2
+    assert cache.get(keys[1]) is None and cache.get(keys[2]) is None
+    assert cache.get(keys[0]) is not None and cache.get(keys[3]) is not None
+    assert cache.stats()["bytes"] == 624
+    assert not cache.put(key(graph(seed=9)), [bytes(2000)])  # larger than the cache
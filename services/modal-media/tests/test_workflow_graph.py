@@ -0,0 +1,142 @@
+"""Identical sub-graphs must hash (and be named) identically across requests.
+
+Runs locally: comfyui_graph is stdlib-only. The comfyui_klein builder checks
+need modal importable and are skipped otherwise.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from comfyui_graph import WorkflowGraph, subgraph_hash, subgraph_hashes  # noqa: E402
+
+IDENTITY = {"name": "holly-combined-v1.safetensors", "strength": 0.9}
+SPECIALIST = {"name": "pussydiffusion.safetensors", "strength": 0.8}
+NEGATIVE = "deformed hands, extra fingers"
+
+
+def txt2img(prompt, loras, seed=1, cfg=1.0):
+    g = WorkflowGraph()
+    _, _, vae = g.loaders("klein.safetensors", "qwen.safetensors", "vae.safetensors")
+    model, clip = g.lora_chain(loras)
+    pos = g.encode("pos", prompt, clip)
+    neg = g.negative(NEGATIVE, clip, cfg)
+    g.add("latent", "EmptyLatentImage", width=1024, height=1024, batch_size=1)
+    g.add("sampler", "KSampler", seed=seed, steps=12, cfg=cfg,
+          sampler_name="euler", scheduler="simple", denoise=1.0,
+          model=model, positive=pos, negative=neg, latent_image=["latent", 0])
+    g.add("decode", "VAEDecode", samples=["sampler", 0], vae=vae)
+    g.output("save", ["decode", 0], "Holly")
+    return g.workflow()
+
+
+def lora_ids(workflow):
+    return [nid for nid, n in workflow["prompt"].items() if n["class_type"] == "LoraLoader"]
+
+
+def test_shared_nodes_same_id_and_hash_across_requests():
+    a = txt2img("holly on a beach", [IDENTITY])
+    b = txt2img("holly in a kitchen", [IDENTITY, SPECIALIST], seed=2)
+    ha, hb = subgraph_hashes(a), subgraph_hashes(b)
+
+    for nid in ("unet", "clip", "vae", "neg"):
+        assert ha[nid] == hb[nid]
+    # The identity LoRA is the shared stack prefix: same id, same hash.
+    assert lora_ids(a)[0] == lora_ids(b)[0]
+    assert ha[lora_ids(a)[0]] == hb[lora_ids(b)[0]]
+    # Per-request tail keeps its semantic ids regardless of stack length.
+    assert {"pos", "latent", "sampler", "decode", "save"} <= set(a["prompt"]) & set(b["prompt"])
+    assert ha["pos"] != hb["pos"]
+    assert ha["sampler"] != hb["sampler"]
+
+
+def test_same_request_builds_identical_graph():
+    assert txt2img("holly", [IDENTITY, SPECIALIST]) == txt2img("holly", [IDENTITY, SPECIALIST])
+
+
+def test_lora_ids_depend_on_prefix_and_strength():
+    a = lora_ids(txt2img("p", [IDENTITY, SPECIALIST]))
+    b = lora_ids(txt2img("p", [SPECIALIST, IDENTITY]))
+    c = lora_ids(txt2img("p", [IDENTITY, {**SPECIALIST, "strength": 1.0}]))
+    assert not set(a) & set(b)
+    assert a[0] == c[0] and a[1] != c[1]
+
+
+def test_negative_branch_uses_base_clip_only_when_uncond_unused():
+    low = txt2img("p", [IDENTITY], cfg=1.0)["prompt"]
+    assert low["neg"]["inputs"]["clip"] == ["clip", 0]
+
+    high = txt2img("p", [IDENTITY], cfg=3.5)["prompt"]
+    assert "neg" not in high
+    (neg_id,) = [nid for nid in high if nid.startswith("neg_")]
+    assert high[neg_id]["inputs"]["clip"] == [lora_ids({"prompt": high})[0], 1]
+
+
+def test_subgraph_hash_ignores_node_ids():
+    wf = txt2img("holly", [IDENTITY, SPECIALIST])["prompt"]
+    rename = {nid: str(i) for i, nid in enumerate(wf, start=1)}
+
+    def relink(value):
+        if isinstance(value, list) and len(value) == 2 and value[0] in rename:
+            return [rename[value[0]], value[1]]
+        return value
+
+    numbered = {
+        rename[nid]: {"class_type": n["class_type"],
+                      "inputs": {k: relink(v) for k, v in n["inputs"].items()}}
+        for nid, n in wf.items()
+    }
+    for nid in wf:
+        assert subgraph_hash(wf, nid) == subgraph_hash(numbered, rename[nid])
+
+
+def test_conflicting_node_id_rejected():
+    g = WorkflowGraph()
+    g.encode("pos", "a", ["clip", 0])
+    g.encode("pos", "a", ["clip", 0])  # identical re-add is fine
+    with pytest.raises(ValueError):
+        g.encode("pos", "b", ["clip", 0])
+
+
+def test_klein_builders_share_subgraphs():
+    pytest.importorskip("modal")
+    import comfyui_klein as klein
+
+    gen = klein.build_workflow("holly", seed=1, loras=[IDENTITY, SPECIALIST])
+    inpaint = klein.build_inpaint_workflow("crop.png", "holly hand", 768, 768,
+                                           loras=[IDENTITY, SPECIALIST], seed=2)
+    batched = klein.build_batched_inpaint_workflow([
+        {"key": "face", "images": ["f.png"], "prompt": "face", "loras": [IDENTITY]},
+        {"key": "hand", "images": ["h0.png", "h1.png"], "prompt": "hand",
+         "loras": [IDENTITY, SPECIALIST]},
+    ], seed=3)
+    hg, hi, hb = subgraph_hashes(gen), subgraph_hashes(inpaint), subgraph_hashes(batched)
+
+    for nid in ("unet", "clip", "vae", "neg") + tuple(lora_ids(gen)):
+        assert hg[nid] == hi[nid] == hb[nid]
+    # Face (identity only) reuses the first link of the hands' chain.
+    assert len(lora_ids(batched)) == 2
+
+
+def test_finalize_reuses_draft_subgraph():
+    pytest.importorskip("modal")
+    import comfyui_klein as klein
+
+    dw, dh = klein.draft_size(1024, 1536)
+    assert (dw, dh) == (512, 768)
+    draft = klein.build_workflow("holly", dw, dh, seed=7, loras=[IDENTITY, SPECIALIST],
+                                 steps=klein.DRAFT_STEPS)
+    final = klein.build_latent_upscale_workflow("holly", dw, dh, 1024, 1536, seed=7,
+                                                loras=[IDENTITY, SPECIALIST])
+    hd, hf = subgraph_hashes(draft), subgraph_hashes(final)
+
+    # Same ids, same inputs — ComfyUI can serve the draft latent from cache.
+    assert hd["sampler"] == hf["sampler"]
+    nodes = final["prompt"]
+    assert nodes["upscale"]["inputs"]["samples"] == ["sampler", 0]
+    assert nodes["final_sampler"]["inputs"]["seed"] == 7
+    assert nodes["final_sampler"]["inputs"]["positive"] == nodes["sampler"]["inputs"]["positive"]
+    assert nodes["decode"]["inputs"]["samples"] == ["final_sampler", 0]
@@ -43,7 +43,6 @@ Identity strategy (NO MODEL STACKING — one model, one anchor pattern):
   3. Prompt describes MOTION ONLY (camera + action), never Holly's appearance.
 """
 
-import base64
 import json
 import os
 import signal
@@ -56,6 +55,13 @@ import uuid
 
 import modal
 
+from comfyui_events import ComfyUIEventListener, OutputIndex, poll_history
+from input_cache import InputCache, content_name
+from media_delivery import faststart, file_response, moov_first
+from media_inputs import InputTooLarge, InvalidImage, decode_images
+from media_janitor import Budget, MediaJanitor
+import media_jobs
+
 app = modal.App("holly-h3-video")
 
 COMFYUI_DIR = "/root/ComfyUI"
@@ -129,11 +135,40 @@ image = (
     .run_commands("git clone https://github.com/comfyanonymous/ComfyUI.git /root/ComfyUI")
     .run_commands("pip install -r /root/ComfyUI/requirements.txt")
     .run_commands(f"mkdir -p {UNET_DIR} {CLIP_DIR} {VAE_DIR} {LORA_DIR} {OUTPUT_DIR} {INPUT_DIR}")
-    .pip_install("huggingface_hub", "fastapi[standard]", "pillow")
+    .pip_install("huggingface_hub", "fastapi[standard]", "pillow", "websocket-client")
+    .add_local_python_source("comfyui_events", "input_cache", "media_delivery", "media_inputs",
+                             "media_janitor", "media_jobs")
+)
+
+# CPU-only image for the job submit/status/result endpoints
+jobs_image = (
+    modal.Image.debian_slim(python_version="3.11")
+    .pip_install("fastapi[standard]")
+    .add_local_python_source("comfyui_events", "input_cache", "media_delivery", "media_inputs",
+                             "media_janitor", "media_jobs")
 )
 
+# Endpoint signatures reference fastapi.Request
+with jobs_image.imports():
+    import fastapi
+
 h3_volume = modal.Volume.from_name("holly-h3-weights", create_if_missing=True)
 
+# Async jobs — see media_jobs.py. Records in the holly-media-jobs modal.Dict,
+# result mp4s on the holly-media-jobs volume under h3/.
+jobs_volume = modal.Volume.from_name("holly-media-jobs", create_if_missing=True)
+jobs_dict = modal.Dict.from_name("holly-media-jobs", create_if_missing=True)
+JOBS_VOL_MOUNT = "/jobs"
+JOBS_RESULTS_DIR = f"{JOBS_VOL_MOUNT}/h3"
+H3_JOB_ENDPOINTS = ("animate", "animate_ref")
+
+# Disk janitor — see media_janitor.py. Rendered MP4s stay in output/ after
+# the response (nothing deleted them); reference frames pile up in input/.
+OUTPUT_BUDGET_BYTES = 10 * 1024**3
+OUTPUT_MAX_AGE_S = 2 * 3600
+INPUT_BUDGET_BYTES = 2 * 1024**3
+INPUT_MAX_AGE_S = 6 * 3600
+
 
 def link_weights_to_comfyui():
     """Symlink volume files into ComfyUI's model directories."""
@@ -209,7 +244,7 @@ def frame_length(duration_s: float) -> int:
     timeout=1800,
     startup_timeout=3600,  # first run downloads ~67GB of weights
     memory=65536,
-    volumes={H3_VOL_MOUNT: h3_volume},
+    volumes={H3_VOL_MOUNT: h3_volume, JOBS_VOL_MOUNT: jobs_volume},
 )
 class HollyH3Video:
 
@@ -236,10 +271,27 @@ class HollyH3Video:
         )
         wait_for_comfyui._proc = self.comfyui_proc
         wait_for_comfyui(timeout=600)
+        # /ws execution events replace the 3s /history poll (see comfyui_events.py);
+        # `executed` events also feed the prompt_id → mp4 index
+        self.outputs = OutputIndex(OUTPUT_DIR)
+        self.events = ComfyUIEventListener(port=COMFYUI_PORT, on_executed=self.outputs.record)
+        if not self.events.start(connect_timeout=15):
+            print("⚠️ ComfyUI /ws not connected yet — polling /history until it is")
+        # Reference images repeat (Holly's identity set) — written once each
+        self.input_cache = InputCache(INPUT_DIR)
+        self.janitor = MediaJanitor([
+            Budget(OUTPUT_DIR, OUTPUT_BUDGET_BYTES, OUTPUT_MAX_AGE_S),
+            Budget(INPUT_DIR, INPUT_BUDGET_BYTES, INPUT_MAX_AGE_S),
+        ])
+        self.janitor.start()
         print("═══ Holly H3 Video Ready ═══")
 
     @modal.exit()
     def shutdown(self):
+        if getattr(self, "events", None) is not None:
+            self.events.stop()
+        if getattr(self, "janitor", None) is not None:
+            self.janitor.stop()
         if hasattr(self, "comfyui_proc") and self.comfyui_proc.poll() is None:
             self.comfyui_proc.send_signal(signal.SIGTERM)
             self.comfyui_proc.wait(timeout=30)
@@ -247,74 +299,105 @@ class HollyH3Video:
 
     # ── ComfyUI plumbing ────────────────────────────────────────────────
 
-    def _post_workflow(self, workflow: dict) -> str:
+    def _post_workflow(self, workflow: dict, prompt_id: str = None) -> str:
+        """Queue a workflow. prompt_id: our own id for it (ComfyUI honours a
+        client-supplied one); returns the id ComfyUI actually used."""
+        events = getattr(self, "events", None)
+        epoch = events.epoch if events is not None else 0
+        payload = {"prompt": workflow}
+        if prompt_id is not None:
+            payload["prompt_id"] = prompt_id
+        if events is not None:
+            payload["client_id"] = events.client_id
         req = urllib.request.Request(
             f"http://127.0.0.1:{COMFYUI_PORT}/prompt",
-            data=json.dumps({"prompt": workflow}).encode(),
+            data=json.dumps(payload).encode(),
             headers={"Content-Type": "application/json"},
         )
         try:
             with urllib.request.urlopen(req, timeout=30) as resp:
-                return json.loads(resp.read())["prompt_id"]
+                prompt_id = json.loads(resp.read())["prompt_id"]
+            if events is not None:
+                events.track(prompt_id, epoch)
+            return prompt_id
         except urllib.error.HTTPError as e:
             body = e.read().decode(errors="replace")
             raise RuntimeError(f"ComfyUI /prompt {e.code}: {body[:2000]}") from e
 
-    def _poll_history(self, prompt_id: str, timeout: int = 1500) -> dict:
+    def _wait_for_completion(self, prompt_id: str, timeout: int = 1500, on_progress=None) -> dict:
+        """Pushed /ws completion (+ per-node progress); /history polling if the socket drops."""
+        events = getattr(self, "events", None)
         deadline = time.time() + timeout
-        while time.time() < deadline:
-            try:
-                req = urllib.request.Request(
-                    f"http://127.0.0.1:{COMFYUI_PORT}/history/{prompt_id}"
-                )
-                with urllib.request.urlopen(req, timeout=10) as resp:
-                    hist = json.loads(resp.read())
-                entry = hist.get(prompt_id)
-                if entry:
-                    status = entry.get("status", {})
-                    if status.get("completed") or status.get("status_str") == "success":
-                        return entry
-                    if status.get("status_str") == "error":
-                        msgs = status.get("messages", [])
-                        raise RuntimeError(f"ComfyUI execution error: {str(msgs)[:2000]}")
-            except urllib.error.URLError:
-                pass
-            time.sleep(3)
-        raise TimeoutError(f"ComfyUI job {prompt_id} timed out")
-
-    def _read_output_video(self, history: dict) -> bytes:
-        """SaveVideo writes an mp4 into OUTPUT_DIR; read it directly."""
-        for node_out in history.get("outputs", {}).values():
-            for artifact in node_out.get("videos", []) or node_out.get("gifs", []) or []:
-                filename = artifact.get("filename")
-                subfolder = artifact.get("subfolder", "")
-                path = os.path.join(OUTPUT_DIR, subfolder, filename)
-                if filename and os.path.exists(path):
-                    with open(path, "rb") as f:
-                        return f.read()
-        print(f"🔍 _read_output_video: outputs={list(history.get('outputs', {}).keys())} "
-              f"status={history.get('status', {}).get('status_str')} "
-              f"OUTPUT_DIR contents={os.listdir(OUTPUT_DIR)}")
-        # Fallback: SaveVideo writes into OUTPUT_DIR regardless of history
-        # artifacts (history 'outputs' can omit the video entry depending on
-        # ComfyUI version). Scan for the newest holly_h3* mp4 directly.
-        candidates = []
-        for root, _dirs, files in os.walk(OUTPUT_DIR):
-            for fn in files:
-                if fn.startswith("holly_h3") and fn.endswith(".mp4"):
-                    p = os.path.join(root, fn)
-                    candidates.append((os.path.getmtime(p), p))
-        if candidates:
-            candidates.sort()
-            with open(candidates[-1][1], "rb") as f:
-                return f.read()
-        raise RuntimeError(f"No video in ComfyUI history outputs or {OUTPUT_DIR}: {str(history)[:500]}")
-
-    def _save_input_image(self, image_b64: str, name: str) -> str:
+        if events is not None:
+            entry = events.wait(prompt_id, timeout=timeout, on_progress=on_progress)
+            if entry is not None:
+                return entry
+            print(f"   /ws unavailable for {prompt_id[:8]} — falling back to /history polling")
+        return self._poll_history(prompt_id, timeout=max(1, int(deadline - time.time())))
+
+    def _poll_history(self, prompt_id: str, timeout: int = 1500) -> dict:
+        return poll_history(prompt_id, port=COMFYUI_PORT, timeout=timeout, interval=3)
+
+    def _output_video_path(self, prompt_id: str, history: dict) -> str:
+        """The job's mp4 from the output index (see OutputIndex).
+
+        `executed` events record what SaveVideo reported; the /history entry
+        covers the polling fallback; and because every job saves under its
+        own prefix, the expected filename is known even when ComfyUI's
+        history omits the video entry (version-dependent). Replaces the
+        os.walk + newest-mtime scan, which slowed as outputs piled up and
+        could return another job's video.
+        """
+        self.outputs.record_history(prompt_id, history)
+        path = self.outputs.path(prompt_id)
+        if path is None:
+            raise RuntimeError(f"No video for prompt {prompt_id} in ComfyUI outputs: {str(history)[:500]}")
+        return path
+
+    def _video_response(self, path: str, headers: dict):
+        """Streamed mp4 (Content-Length, moov first — playback starts on the
+        first bytes). The file stays in output/ for the janitor."""
+        return file_response(path, "video/mp4", headers={
+            **headers, "X-H3-Faststart": "true" if moov_first(path) else "false"})
+
+    def _decode_inputs(self, images_b64: list):
+        """Decode a request's images once each (media_inputs.py).
+
+        Returns (images, None), or (None, error response) — 413 over the
+        decoded-size limits, 400 for something that is not an image.
+        """
+        from fastapi.responses import JSONResponse
+
+        t0 = time.time()
+        try:
+            images = decode_images(images_b64)
+        except InputTooLarge as e:
+            return None, JSONResponse(
+                {"error": str(e), "limit_bytes": e.limit}, status_code=413)
+        except InvalidImage as e:
+            return None, JSONResponse({"error": str(e)}, status_code=400)
+        print(f"   📥 {len(images)} input image(s), "
+              f"{sum(len(i.data) for i in images) / 1024**2:.1f} MB decoded in "
+              f"{(time.time() - t0) * 1000:.0f}ms")
+        return images, None
+
+    def _save_input_image(self, image, prefix: str) -> str:
+        """Write a decoded input (media_inputs.InputImage) straight into
+        INPUT_DIR under a content-derived name (input_cache.py).
+
+        The same reference image sent again keeps its filename — nothing is
+        rewritten and ComfyUI's LoadImage cache still matches.
+        """
+        name = self.input_cache.lookup(image.digest)
+        if name is not None:
+            return name
+        name = content_name(image.digest, prefix, image.ext)
         os.makedirs(INPUT_DIR, exist_ok=True)
         path = os.path.join(INPUT_DIR, name)
-        with open(path, "wb") as f:
-            f.write(base64.b64decode(image_b64))
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(image.data)
+        os.replace(f"{path}.tmp", path)
+        self.input_cache.record(image.digest, name, len(image.data))
         return name
 
     # ── Workflow builders (API format, mirror official templates) ───────
@@ -391,15 +474,45 @@ class HollyH3Video:
         wf.update(self._build_sampler_chain("h3", "turbo", seed, steps))
         return wf
 
-    def _run(self, workflow: dict) -> bytes:
-        prompt_id = self._post_workflow(workflow)
-        history = self._poll_history(prompt_id)
-        return self._read_output_video(history)
+    def _run(self, workflow: dict, on_progress=None, reporter=None) -> str:
+        """Render a workflow; returns the path of its faststart mp4.
+
+        reporter: media_jobs.ProgressReporter when running as an async job.
+        """
+        if reporter is not None:
+            _inner = on_progress
+
+            def on_progress(update):
+                node = update.get("node")
+                if node in workflow:
+                    update = {**update, "class_type": workflow[node].get("class_type")}
+                reporter.comfy(update)
+                if _inner is not None:
+                    _inner(update)
+
+            reporter.set(stage="sampling")
+        # Unique, prompt-derived output name: SaveVideo writes
+        # <prefix>_00001_.mp4, so the index knows the file before it exists.
+        prompt_id = uuid.uuid4().hex
+        prefix = f"holly_h3_{prompt_id[:16]}"
+        for node in workflow.values():
+            if node["class_type"] == "SaveVideo":
+                node["inputs"]["filename_prefix"] = prefix
+        prompt_id = self._post_workflow(workflow, prompt_id=prompt_id)
+        self.outputs.expect(prompt_id, os.path.join(OUTPUT_DIR, f"{prefix}_00001_.mp4"))
+        history = self._wait_for_completion(prompt_id, on_progress=on_progress)
+        if reporter is not None:
+            reporter.set(stage="remuxing")
+        path = self._output_video_path(prompt_id, history)
+        self.outputs.forget(prompt_id)
+        faststart(path)
+        return path
 
     # ── HTTP endpoints ──────────────────────────────────────────────────
 
-    def _auto_dims(self, request: dict) -> tuple:
-        """Width/height from request, else detect from the first input image.
+    def _auto_dims(self, request: dict, image=None) -> tuple:
+        """Width/height from request, else from the first input image's header
+        (image: the media_inputs.InputImage already decoded for the request).
 
         Keeps portrait Klein frames portrait (no force-crop to 16:9).
         Rounds to multiples of 16 and caps the long edge at 1280 (VRAM headroom
@@ -412,15 +525,7 @@ class HollyH3Video:
             w = h = 0
         if w > 0 and h > 0:
             return w, h
-        from PIL import Image
-        b64 = (request.get("image_base64") or
-               (request.get("reference_images_base64") or [""])[0])
-        try:
-            import io
-            with Image.open(io.BytesIO(base64.b64decode(b64))) as img:
-                w, h = img.size
-        except Exception:
-            w, h = 864, 480
+        w, h = image.size if image is not None else (864, 480)
         scale = min(1.0, 1280 / max(w, h))
         w = max(256, int(round(w * scale / 16.0)) * 16)
         h = max(256, int(round(h * scale / 16.0)) * 16)
@@ -429,33 +534,37 @@ class HollyH3Video:
     @modal.fastapi_endpoint(method="POST", label="h3-animate")
     def animate(self, request: dict) -> bytes:
         """I2V: Klein-locked still frame → video. Prompt = motion only."""
-        from fastapi.responses import Response
+        return self._animate(request)
 
+    def _animate(self, request: dict, reporter=None):
         prompt = (request.get("prompt") or "").strip()
         image_b64 = (request.get("image_base64") or "").strip()
         if not prompt or not image_b64:
             from fastapi.responses import JSONResponse
             return JSONResponse({"error": "prompt and image_base64 required"}, status_code=400)
 
+        images, error = self._decode_inputs([image_b64])
+        if error is not None:
+            return error
+
         duration = min(max(float(request.get("duration", 5.0)), 1.0), 15.0)
-        width, height = self._auto_dims(request)
+        width, height = self._auto_dims(request, images[0])
         steps = min(max(int(request.get("steps", 8)), 4), 30)
         seed = int(request.get("seed") or uuid.uuid4().int % (2**48))
 
-        image_name = self._save_input_image(image_b64, f"h3_i2v_{uuid.uuid4().hex[:12]}.png")
+        image_name = self._save_input_image(images[0], "h3_i2v")
         wf = self.build_i2v_workflow(
             prompt, image_name, width, height, frame_length(duration), seed, steps)
-        video = self._run(wf)
-        return Response(
-            content=video,
-            media_type="video/mp4",
-            headers={"X-H3-Seed": str(seed), "X-H3-Steps": str(steps)},
-        )
+        path = self._run(wf, reporter=reporter)
+        return self._video_response(path, {"X-H3-Seed": str(seed), "X-H3-Steps": str(steps)})
 
     @modal.fastapi_endpoint(method="POST", label="h3-animate-ref")
     def animate_ref(self, request: dict) -> bytes:
         """R2V: reference images (Holly's identity set) → video."""
-        from fastapi.responses import Response, JSONResponse
+        return self._animate_ref(request)
+
+    def _animate_ref(self, request: dict, reporter=None):
+        from fastapi.responses import JSONResponse
 
         prompt = (request.get("prompt") or "").strip()
         refs = request.get("reference_images_base64") or []
@@ -464,23 +573,36 @@ class HollyH3Video:
                 {"error": "prompt and reference_images_base64 (1-3 images) required"},
                 status_code=400)
 
+        images, error = self._decode_inputs(refs[:3])
+        if error is not None:
+            return error
+
         duration = min(max(float(request.get("duration", 5.0)), 1.0), 15.0)
-        width, height = self._auto_dims(request)
+        width, height = self._auto_dims(request, images[0])
         steps = min(max(int(request.get("steps", 4)), 4), 30)
         seed = int(request.get("seed") or uuid.uuid4().int % (2**48))
 
-        names = [
-            self._save_input_image(b, f"h3_ref_{uuid.uuid4().hex[:12]}.png")
-            for b in refs[:3]
-        ]
+        names = [self._save_input_image(img, "h3_ref") for img in images]
         wf = self.build_r2v_workflow(
             prompt, names, width, height, frame_length(duration), seed, steps)
-        video = self._run(wf)
-        return Response(
-            content=video,
-            media_type="video/mp4",
-            headers={"X-H3-Seed": str(seed), "X-H3-Steps": str(steps)},
-        )
+        path = self._run(wf, reporter=reporter)
+        return self._video_response(path, {"X-H3-Seed": str(seed), "X-H3-Steps": str(steps)})
+
+    @modal.method()
+    def run_job(self, job_id: str, endpoint: str, request: dict):
+        """Async-job worker (spawned by h3-jobs-submit): run animate /
+        animate_ref and store the mp4 on the jobs volume."""
+        handler = getattr(self, f"_{endpoint}")
+
+        def work(reporter):
+            response = handler(request, reporter=reporter)
+            if response.status_code >= 400:
+                # Validation errors come back as JSONResponse — fail the job with them
+                raise _JobError(response.status_code, json.loads(response.body))
+            # Streamed file response — the job store copies the mp4 itself
+            return response.path, response.media_type, dict(response.headers)
+
+        media_jobs.run_job(h3_job_store(), job_id, work, commit=jobs_volume.commit)
 
     @modal.fastapi_endpoint(method="GET", label="h3-video-health")
     def health(self):
@@ -493,9 +615,62 @@ class HollyH3Video:
             "license": "MiniMax H3 Community License (deployer: Canada)",
             "length_rule": "duration*24fps, adjusted so length % 17 == 5",
             "version": "1.0.0 (Phase D1)",
+            "input_cache": self.input_cache.stats() if getattr(self, "input_cache", None) else None,
+            "janitor": self.janitor.stats() if getattr(self, "janitor", None) else None,
         })
 
 
+class _JobError(Exception):
+    def __init__(self, status_code: int, detail):
+        super().__init__(str(detail))
+        self.status_code = status_code
+        self.detail = detail
+
+
+# ── Async job endpoints (CPU containers — answer while the GPU renders) ──
+
+def h3_job_store() -> media_jobs.JobStore:
+    return media_jobs.JobStore(media_jobs.DictBackend(jobs_dict), JOBS_RESULTS_DIR)
+
+
+@app.function(image=jobs_image)
+@modal.fastapi_endpoint(method="POST", label="h3-jobs-submit")
+def jobs_submit(body: dict):
+    """{"endpoint": "animate" | "animate_ref", "request": <that endpoint's
+    JSON body>} → job status (poll h3-jobs-status, fetch h3-jobs-result)."""
+    return media_jobs.submit(
+        h3_job_store(), "h3", body, H3_JOB_ENDPOINTS,
+        spawn=lambda job_id, endpoint, request: HollyH3Video().run_job.spawn(job_id, endpoint, request),
+    )
+
+
+@app.function(image=jobs_image, volumes={JOBS_VOL_MOUNT: jobs_volume},
+              schedule=modal.Period(hours=1))
+def jobs_expire():
+    """Drop h3 jobs older than media_jobs.JOB_TTL_S with their result files
+    (hourly, with the jobs volume mounted so the deletions can be committed)."""
+    jobs_volume.reload()
+    removed = h3_job_store().expire("h3")
+    if removed:
+        jobs_volume.commit()
+        print(f"🧹 Expired {removed} h3 job(s)")
+
+
+@app.function(image=jobs_image)
+@modal.fastapi_endpoint(method="GET", label="h3-jobs-status")
+def jobs_status(job_id: str):
+    return media_jobs.status_response(h3_job_store(), job_id)
+
+
+@app.function(image=jobs_image, volumes={JOBS_VOL_MOUNT: jobs_volume})
+@modal.fastapi_endpoint(method="GET", label="h3-jobs-result")
+def jobs_result(job_id: str, http_request: "fastapi.Request"):
+    """The job's mp4, streamed; Range requests get 206 partial content, so
+    a <video> element can seek and start playing before the download ends."""
+    return media_jobs.result_response(h3_job_store(), job_id, reload=jobs_volume.reload,
+                                      range_header=http_request.headers.get("range"))
+
+
 @app.local_entrypoint()
 def main():
     print("Deploy: modal deploy services/modal-media/video_generate_h3.py")
@@ -503,3 +678,6 @@ def main():
     print("I2V:    https://iamdoregosteve--h3-animate.modal.run")
     print("R2V:    https://iamdoregosteve--h3-animate-ref.modal.run")
     print("Health: https://iamdoregosteve--h3-video-health.modal.run")
+    print("Jobs:   https://iamdoregosteve--h3-jobs-submit.modal.run (POST)")
+    print("        https://iamdoregosteve--h3-jobs-status.modal.run?job_id=…")
+    print("        https://iamdoregosteve--h3-jobs-result.modal.run?job_id=…")